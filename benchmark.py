@@ -0,0 +1,4 @@
+"""Redirect to ``cam.sgnmt.benchmark``. """
+import runpy
+
+runpy.run_module("cam.sgnmt.benchmark", run_name="__main__")
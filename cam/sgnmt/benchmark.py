@@ -0,0 +1,389 @@
+"""This script measures the throughput of the search strategies in
+``decode_utils.create_decoder`` without loading real models. Decoders
+are run with the synthetic predictors in ``predictors.synthetic`` on
+randomly generated source sentences of configurable lengths. Each
+combination of decoder and sentence length is decoded in a separate
+process, so that memory measurements do not interfere with each other.
+The following numbers are reported for each combination:
+
+  - ``time_per_sentence``: Average wall clock time per sentence
+  - ``expansions_per_second``: Node expansions (``apply_predictors``
+    calls) per second
+  - ``predictor_calls``: Number of ``predict_next`` calls of all
+    synthetic predictors
+  - ``peak_rss_kb``: Peak resident set size of the process
+  - ``gc_objects``: Increase of the number of objects tracked by the
+    garbage collector after decoding (objects retained by the decoder)
+  - ``allocated_blocks``: Increase of the number of allocated memory
+    blocks (only with ``sys.getallocatedblocks``, i.e. Python 3.4+)
+  - ``avg_best_score``: Average score of the best hypotheses, which
+    should be stable across commits unless the search changes
+
+If ``--benchmark_sentence_batch`` is greater than 1, the beam decoder
+is additionally run in lock-step batch mode (``BatchBeamDecoder``).
+Its results are reported as decoder ``beam-batch<N>``, and an error is
+logged if the best hypotheses differ from sequential beam search.
+
+All SGNMT options can be used to configure decoders and predictors,
+e.g. ``--beam``, ``--max_node_expansions``, or ``--predictors``
+together with the ``synthetic_*`` options. Results are written as JSON
+and can be compared with the results of a previous run::
+
+  python benchmark.py --benchmark_decoders beam,dfs \\
+                      --benchmark_lengths 5,10,20 \\
+                      --benchmark_output new.json \\
+                      --benchmark_compare old.json
+"""
+
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from cam.sgnmt import decode_utils
+from cam.sgnmt import utils
+from cam.sgnmt.decoding.batchbeam import BatchBeamDecoder
+from cam.sgnmt.predictors.synthetic import SyntheticPredictor
+from cam.sgnmt.ui import get_parser
+
+try:
+    import resource
+except ImportError:
+    pass # Peak RSS is not available on this platform
+
+
+BENCHMARK_DECODERS = ['greedy', 'beam', 'astar', 'dfs', 'bucket',
+                      'restarting', 'bow', 'flip', 'multisegbeam', 'mbrbeam',
+                      'syncbeam', 'sepbeam', 'combibeam']
+"""Decoders which are benchmarked by default. """
+
+
+def get_benchmark_parser():
+    """Extends the SGNMT parser with benchmark options and sets
+    defaults which are more suitable for synthetic predictors.
+
+    Returns:
+        ArgumentParser. The parser object
+    """
+    parser = get_parser()
+    group = parser.add_argument_group('Benchmark options')
+    group.add_argument("--benchmark_decoders",
+                       default=','.join(BENCHMARK_DECODERS),
+                       help="Comma separated list of decoders to benchmark.")
+    group.add_argument("--benchmark_lengths", default="5,10,20",
+                       help="Comma separated list of source sentence lengths. "
+                       "Synthetic predictors produce hypotheses of roughly "
+                       "the same length.")
+    group.add_argument("--benchmark_sentences", default=5, type=int,
+                       help="Number of sentences for each length.")
+    group.add_argument("--benchmark_output", default="",
+                       help="Path to the JSON file with the results. If "
+                       "empty, results are printed to stdout.")
+    group.add_argument("--benchmark_compare", default="",
+                       help="Path to a JSON file from a previous benchmark "
+                       "run. Relative changes are logged for each decoder "
+                       "and sentence length.")
+    group.add_argument("--benchmark_sentence_batch", default=0, type=int,
+                       help="If greater than 1, also run the beam decoder "
+                       "with this --sentence_batch and check that the best "
+                       "hypotheses are the same as with sequential decoding.")
+    parser.set_defaults(predictors="synthdense",
+                        pred_trg_vocab_size=1000,
+                        max_node_expansions=-200,
+                        outputs="",
+                        verbosity="warn")
+    return parser
+
+
+def create_sentences(args, length):
+    """Creates random source sentences and target bags of words for a
+    sentence length.
+
+    Args:
+        args (object): Benchmark configuration
+        length (int): Sentence length
+
+    Returns:
+        list. List of ``benchmark_sentences`` lists of word IDs
+    """
+    rs = np.random.RandomState(args.synthetic_seed + length)
+    return [rs.randint(3, args.pred_trg_vocab_size, length).tolist()
+            for _ in xrange(args.benchmark_sentences)]
+
+
+def get_decoder_args(args, decoder, sentences, tmp_dir):
+    """Creates the configuration for a single decoder. The bow and
+    flip decoders need a bag of words (we use the source sentences),
+    and the multisegbeam decoder needs a word map for the tokenizer.
+
+    Args:
+        args (object): Benchmark configuration
+        decoder (string): Name of the decoder
+        sentences (list): Source sentences
+        tmp_dir (string): Directory for temporary files
+
+    Returns:
+        object. Configuration object for ``decode_utils``
+    """
+    decoder_args = get_benchmark_parser().parse_args([])
+    decoder_args.__dict__.update(args.__dict__)
+    decoder_args.decoder = decoder
+    if decoder in ['bow', 'flip']:
+        decoder_args.trg_test = os.path.join(tmp_dir, "bags")
+        with open(decoder_args.trg_test, "w") as f:
+            for sen in sentences:
+                f.write("%s\n" % ' '.join([str(w) for w in sen]))
+        if decoder == 'bow':
+            decoder_args.predictors = "%s,bow" % args.predictors
+    elif decoder == 'multisegbeam':
+        wmap_path = os.path.join(tmp_dir, "wmap")
+        with open(wmap_path, "w") as f:
+            f.write("<unk> %d\n<s> %d\n</s> %d\n" % (utils.UNK_ID,
+                                                     utils.GO_ID,
+                                                     utils.EOS_ID))
+            for w in xrange(3, args.pred_trg_vocab_size):
+                f.write("w%d %d\n" % (w, w))
+        decoder_args.multiseg_tokenizations = ','.join(
+            ["word:%s" % wmap_path] * len(args.predictors.split(",")))
+    return decoder_args
+
+
+def _get_peak_rss():
+    """Returns the peak resident set size in KB, or -1. """
+    try:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except NameError:
+        return -1
+    if sys.platform == 'darwin': # Bytes on OSX
+        rss /= 1024
+    return rss
+
+
+def _get_allocated_blocks():
+    """Returns the number of allocated memory blocks, or 0. """
+    try:
+        return sys.getallocatedblocks()
+    except AttributeError:
+        return 0
+
+
+def run_decoder(decoder_args, sentences):
+    """Decodes ``sentences`` with a single decoder and collects
+    the statistics. This is meant to be called in a separate process.
+
+    Args:
+        decoder_args (object): SGNMT configuration
+        sentences (list): Source sentences
+
+    Returns:
+        dict. Benchmark results
+    """
+    decode_utils.base_init(decoder_args)
+    decoder = decode_utils.create_decoder()
+    synth_preds = [p for p, _ in decoder.predictors
+                   if isinstance(p, SyntheticPredictor)]
+    gc.collect()
+    gc_objects = len(gc.get_objects())
+    allocated_blocks = _get_allocated_blocks()
+    times = []
+    all_hypos = []
+    start_expansions = decoder.apply_predictors_count
+    if isinstance(decoder, BatchBeamDecoder):
+        start_time = time.time()
+        batch_hypos = {}
+        for sen_idx, hypos, _, _ in decoder.decode_batch(
+                enumerate(sentences)):
+            batch_hypos[sen_idx] = hypos
+        times.append(time.time() - start_time)
+        all_hypos = [batch_hypos[idx] for idx in xrange(len(sentences))]
+    else:
+        for sen_idx, src in enumerate(sentences):
+            decoder.set_current_sen_id(sen_idx)
+            start_time = time.time()
+            all_hypos.append(decoder.decode(src))
+            times.append(time.time() - start_time)
+    best_scores = [hypos[0].total_score for hypos in all_hypos if hypos]
+    expansions = decoder.apply_predictors_count - start_expansions
+    total_time = sum(times)
+    gc.collect()
+    return {"decoder": decoder_args.decoder,
+            "length": len(sentences[0]) if sentences else 0,
+            "sentences": len(sentences),
+            "total_time": total_time,
+            "time_per_sentence": total_time / max(1, len(sentences)),
+            "expansions": expansions,
+            "expansions_per_second": expansions / total_time
+                                     if total_time > 0.0 else 0.0,
+            "predictor_calls": sum([p.n_calls for p in synth_preds]),
+            "peak_rss_kb": _get_peak_rss(),
+            "gc_objects": len(gc.get_objects()) - gc_objects,
+            "allocated_blocks": _get_allocated_blocks() - allocated_blocks,
+            "avg_best_score": float(np.mean(best_scores))
+                              if best_scores else None,
+            "best_hypos": [hypos[0].trgt_sentence if hypos else None
+                           for hypos in all_hypos],
+            "n_failed": len(sentences) - len(best_scores)}
+
+
+def _run_decoder_worker(decoder_args, sentences, queue):
+    """Target of benchmark processes. Puts the results or the error
+    message to ``queue``.
+    """
+    try:
+        queue.put(run_decoder(decoder_args, sentences))
+    except Exception as e:
+        queue.put({"decoder": decoder_args.decoder,
+                   "length": len(sentences[0]) if sentences else 0,
+                   "error": "%s: %s" % (type(e).__name__, e)})
+
+
+def run_in_process(decoder_args, sentences):
+    """Runs ``run_decoder`` in a new process.
+
+    Returns:
+        dict. Benchmark results, or a dict with the key 'error'
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_decoder_worker,
+                                      args=(decoder_args, sentences, queue))
+    process.start()
+    try:
+        result = queue.get()
+    except (IOError, EOFError) as e:
+        result = {"decoder": decoder_args.decoder,
+                  "length": len(sentences[0]) if sentences else 0,
+                  "error": "Benchmark process failed: %s" % e}
+    process.join()
+    return result
+
+
+def check_batch_results(result, batch_result):
+    """Checks that lock-step batch decoding yields the same best
+    hypotheses as sequential decoding. Sets the field ``n_mismatches``
+    in ``batch_result``.
+
+    Args:
+        result (dict): Results of the sequential beam decoder
+        batch_result (dict): Results of the batch beam decoder
+    """
+    mismatches = [idx for idx, (hypo, batch_hypo) in enumerate(zip(
+                        result["best_hypos"], batch_result["best_hypos"]))
+                  if hypo != batch_hypo]
+    batch_result["n_mismatches"] = len(mismatches)
+    if mismatches:
+        logging.error("%s length=%d: Best hypotheses differ from sequential "
+                      "beam search for sentences %s" % (
+                        batch_result["decoder"],
+                        batch_result["length"],
+                        ', '.join([str(idx) for idx in mismatches])))
+
+
+def get_commit():
+    """Returns the git commit of the SGNMT source tree, or None. """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, path):
+    """Logs relative changes of the time per sentence and the
+    expansions per second compared to a previous benchmark run.
+
+    Args:
+        results (list): Results of this run
+        path (string): Path to the JSON file of the previous run
+    """
+    with open(path) as f:
+        old_results = {(r["decoder"], r["length"]): r
+                       for r in json.load(f)["results"] if not "error" in r}
+    for result in results:
+        old = old_results.get((result["decoder"], result["length"]))
+        if old is None or "error" in result:
+            continue
+        logging.info("%s length=%d: time per sentence %.4fs -> %.4fs (%+.1f%%)"
+                     ", expansions per second %.1f -> %.1f, peak RSS %d KB "
+                     "-> %d KB" % (
+                        result["decoder"],
+                        result["length"],
+                        old["time_per_sentence"],
+                        result["time_per_sentence"],
+                        100.0 * (result["time_per_sentence"]
+                                 / max(old["time_per_sentence"], 1e-9) - 1.0),
+                        old["expansions_per_second"],
+                        result["expansions_per_second"],
+                        old["peak_rss_kb"],
+                        result["peak_rss_kb"]))
+
+
+def main():
+    """Runs all configured decoders on all sentence lengths. """
+    args = get_benchmark_parser().parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s')
+    logging.getLogger().setLevel(logging.INFO)
+    tmp_dir = tempfile.mkdtemp(prefix="sgnmt-benchmark")
+    results = []
+    for length in utils.split_comma(args.benchmark_lengths, int):
+        sentences = create_sentences(args, length)
+        for decoder in utils.split_comma(args.benchmark_decoders):
+            decoder_args = get_decoder_args(args, decoder, sentences, tmp_dir)
+            result = run_in_process(decoder_args, sentences)
+            if "error" in result:
+                logging.error("%s length=%d failed: %s" % (decoder,
+                                                           length,
+                                                           result["error"]))
+            else:
+                logging.info("%s length=%d: %.4fs per sentence, %.1f "
+                             "expansions per second, peak RSS %d KB" % (
+                                decoder,
+                                length,
+                                result["time_per_sentence"],
+                                result["expansions_per_second"],
+                                result["peak_rss_kb"]))
+            results.append(result)
+            if decoder == 'beam' and args.benchmark_sentence_batch > 1:
+                batch_args = get_decoder_args(args, decoder, sentences, 
+                                              tmp_dir)
+                batch_args.sentence_batch = args.benchmark_sentence_batch
+                batch_result = run_in_process(batch_args, sentences)
+                batch_result["decoder"] = "beam-batch%d" % (
+                                        args.benchmark_sentence_batch)
+                if "error" in batch_result:
+                    logging.error("%s length=%d failed: %s" % (
+                                        batch_result["decoder"],
+                                        length,
+                                        batch_result["error"]))
+                elif not "error" in result:
+                    check_batch_results(result, batch_result)
+                results.append(batch_result)
+    output = {"commit": get_commit(),
+              "python": platform.python_version(),
+              "predictors": args.predictors,
+              "vocab_size": args.pred_trg_vocab_size,
+              "synthetic_seed": args.synthetic_seed,
+              "synthetic_latency": args.synthetic_latency,
+              "beam": args.beam,
+              "max_node_expansions": args.max_node_expansions,
+              "results": results}
+    if args.benchmark_output:
+        with open(args.benchmark_output, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+    if args.benchmark_compare:
+        compare_results(results, args.benchmark_compare)
+
+
+if __name__ == "__main__":
+    main()
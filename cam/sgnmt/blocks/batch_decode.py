@@ -10,8 +10,13 @@ be summarized as follows:
     variable in the GPU memory to minimize CPU/GPU communication costs
   * Use buckets to cluster sentences with similar lengths which can be
     grouped in a single batch for the GPU
+  * Continuous batching: Limit the number of active sentences and admit
+    new sentences as soon as others are finished
+  * Adapt the job sizes to the measured computation latency, and keep
+    track of queue depths and batch occupancy in ``SchedulerMetrics``
 """
 
+import json
 import logging
 import time
 import pprint
@@ -74,6 +79,20 @@ PARAM_MIN_TASKS_PER_BUCKET = args.min_tasks_per_bucket
 PARAM_MIN_BUCKET_TOLERANCE = args.min_bucket_tolerance
 """Global variable storing ``--min_bucket_tolerance``. """
 
+PARAM_MAX_ACTIVE_TASKS = args.max_active_tasks
+"""Global variable storing ``--max_active_tasks``. """
+
+PARAM_TARGET_JOB_LATENCY = args.target_job_latency
+"""Global variable storing ``--target_job_latency``. """
+
+PARAM_METRICS_INTERVAL = args.metrics_interval
+"""Global variable storing ``--metrics_interval``. """
+
+JOB_LATENCY_SMOOTHING = 0.8
+"""Smoothing factor for the exponential moving average of the per task
+latency in ``JobSizeController``.
+"""
+
 
 def load_sentences(path, _range, src_vocab_size):
     """Loads the source sentences to decode from the file system.
@@ -229,7 +248,13 @@ class ComputationJob(object):
     job or a state update job.
     """
     
-    def __init__(self, bucket, tasks, src_indices, states, outputs = None):
+    def __init__(self, 
+                 bucket, 
+                 tasks, 
+                 src_indices, 
+                 states, 
+                 outputs = None, 
+                 max_tasks = 0):
         """Sole constructor.
         
         Args:
@@ -241,13 +266,159 @@ class ComputationJob(object):
             src_indices (OrderedDict): passed through to Theano function
             states (OrderedDict): passed through to Theano function
             outputs (OrderedDict): passed through to Theano function
+            max_tasks (int): Maximum number of tasks the job could
+                             have had. Used for occupancy metrics
         """
         self.bucket = bucket
         self.tasks = tasks
         self.src_indices = src_indices
         self.states = states 
         self.outputs = outputs
+        self.max_tasks = max_tasks
         self.result = None
+
+
+class JobSizeController(object):
+    """Adjusts the maximum number of tasks in a job to the measured
+    computation time. We keep an exponential moving average of the time
+    per task and choose the job size such that a full job takes about
+    ``--target_job_latency`` seconds. If the target latency is not
+    positive, the job size is constant.
+    """
+
+    def __init__(self, max_tasks, target_latency):
+        """Creates a new controller.
+
+        Args:
+            max_tasks (int): Upper bound and initial value for the
+                             job size
+            target_latency (float): Target time for computing a job in
+                                    seconds
+        """
+        self.max_tasks = max_tasks
+        self.target_latency = target_latency
+        self.task_latency = None
+        self.job_size = max_tasks
+
+    def update(self, n_tasks, latency):
+        """Update the job size with the latency of a computed job. This
+        is called from the computation thread. Writing ``job_size`` is
+        atomic, so no locking is required.
+
+        Args:
+            n_tasks (int): Number of tasks in the job
+            latency (float): Computation time in seconds
+        """
+        if self.target_latency <= 0.0 or n_tasks < 1:
+            return
+        task_latency = latency / n_tasks
+        if self.task_latency is None:
+            self.task_latency = task_latency
+        else:
+            self.task_latency = JOB_LATENCY_SMOOTHING * self.task_latency \
+                                + (1.0 - JOB_LATENCY_SMOOTHING) * task_latency
+        self.job_size = max(1, min(self.max_tasks, 
+                                   int(self.target_latency 
+                                       / max(self.task_latency, 1e-9))))
+
+
+class SchedulerMetrics(object):
+    """Collects statistics about the pipeline: number, size, occupancy,
+    and latency of the computed jobs for each job type, time the
+    computation thread spent idle, queue depths, and the number of
+    active tasks. This class is thread safe.
+    """
+
+    def __init__(self):
+        """Initializes all counters with zero. """
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.jobs = {kind: {'n_jobs': 0, 
+                            'n_tasks': 0, 
+                            'n_rows': 0, 
+                            'occupancy': 0.0,
+                            'compute_time': 0.0}
+                     for kind in ['logprobs', 'state_update']}
+        self.idle_time = 0.0
+        self.n_queue_samples = 0
+        self.queue_depth_sum = 0
+        self.queue_depth_max = 0
+        self.active_tasks_sum = 0
+
+    def record_job(self, kind, job, latency):
+        """Add a computed job to the statistics.
+
+        Args:
+            kind (string): 'logprobs' or 'state_update'
+            job (ComputationJob): The computed job
+            latency (float): Computation time in seconds
+        """
+        with self.lock:
+            stats = self.jobs[kind]
+            stats['n_jobs'] += 1
+            stats['n_tasks'] += len(job.tasks)
+            stats['n_rows'] += len(job.src_indices)
+            if job.max_tasks > 0:
+                stats['occupancy'] += min(1.0, 
+                                          float(len(job.tasks)) / job.max_tasks)
+            stats['compute_time'] += latency
+
+    def record_idle(self, idle_time):
+        """Add time the computation thread had no jobs to compute. """
+        with self.lock:
+            self.idle_time += idle_time
+
+    def record_queue_depth(self, n_jobs, n_active):
+        """Add a sample of the total number of jobs in the computation
+        queues and the number of active tasks.
+        """
+        with self.lock:
+            self.n_queue_samples += 1
+            self.queue_depth_sum += n_jobs
+            self.queue_depth_max = max(self.queue_depth_max, n_jobs)
+            self.active_tasks_sum += n_active
+
+    def get_summary(self):
+        """Get a dictionary with the aggregated metrics. """
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            summary = {'elapsed_time': elapsed,
+                       'idle_time': self.idle_time,
+                       'idle_fraction': self.idle_time / max(elapsed, 1e-9),
+                       'avg_queue_depth': float(self.queue_depth_sum) 
+                                          / max(1, self.n_queue_samples),
+                       'max_queue_depth': self.queue_depth_max,
+                       'avg_active_tasks': float(self.active_tasks_sum) 
+                                           / max(1, self.n_queue_samples)}
+            for kind, stats in self.jobs.iteritems():
+                n_jobs = max(1, stats['n_jobs'])
+                summary[kind] = {
+                    'n_jobs': stats['n_jobs'],
+                    'avg_tasks': float(stats['n_tasks']) / n_jobs,
+                    'avg_rows': float(stats['n_rows']) / n_jobs,
+                    'avg_occupancy': stats['occupancy'] / n_jobs,
+                    'avg_latency': stats['compute_time'] / n_jobs,
+                    'compute_time': stats['compute_time']}
+        return summary
+
+    def log_summary(self):
+        """Log the aggregated metrics on INFO level. """
+        summary = self.get_summary()
+        logging.info("Scheduler: idle=%.1f%% queue_depth=%.1f (max %d) "
+                     "active_tasks=%.1f" % (100.0 * summary['idle_fraction'],
+                                            summary['avg_queue_depth'],
+                                            summary['max_queue_depth'],
+                                            summary['avg_active_tasks']))
+        for kind in ['logprobs', 'state_update']:
+            stats = summary[kind]
+            logging.info("Scheduler %s jobs: n=%d tasks=%.1f rows=%.1f "
+                         "occupancy=%.1f%% latency=%.4fs" % (
+                                            kind,
+                                            stats['n_jobs'],
+                                            stats['avg_tasks'],
+                                            stats['avg_rows'],
+                                            100.0 * stats['avg_occupancy'],
+                                            stats['avg_latency']))
                                    
 
 class Pipeline(object):
@@ -265,16 +436,30 @@ class Pipeline(object):
     * state_update_result_queue: The computation worker puts state update
                                  jobs in here after processing them
     * finished_tasks_queue: All finished tasks end up here.
+    
+    Tasks which have not been admitted yet are kept in 
+    ``pending_tasks`` (see ``admit_tasks``).
     """
     
-    def __init__(self, buckets):
+    def __init__(self, buckets, tasks):
         """Initializes all the queues with empty lists.
         
         Args:
             buckets (list): List of all the buckets
+            tasks (list): List of all tasks in the order in which they
+                          should be admitted
         """
         self.buckets = buckets
         n_buckets = len(buckets)
+        self.pending_tasks = list(reversed(tasks))
+        self.admission_lock = threading.Lock()
+        self.metrics = SchedulerMetrics()
+        self.job_sizes = {
+            'logprobs': JobSizeController(PARAM_MAX_TASKS_PER_JOB,
+                                          PARAM_TARGET_JOB_LATENCY),
+            'state_update': JobSizeController(
+                                          PARAM_MAX_TASKS_PER_STATE_UPDATE_JOB,
+                                          PARAM_TARGET_JOB_LATENCY)}
         self.unscheduled_tasks = Queue.Queue() # Lists of tasks 
 
         self.logprobs_jobs_queues = [Queue.Queue() for _ in xrange(n_buckets)]
@@ -299,6 +484,35 @@ class Pipeline(object):
                         key=lambda bucket_id: self.buckets[bucket_id].priority)
         self.bucket_order = new_bucket_order
 
+    def admit_tasks(self, n_tasks):
+        """Removes up to ``n_tasks`` tasks from the pending tasks and
+        marks them as admitted in their buckets. This implementation is
+        thread safe.
+        
+        Args:
+            n_tasks (int): Maximum number of tasks to admit
+        
+        Returns:
+            list. List of admitted tasks
+        """
+        with self.admission_lock:
+            admitted = []
+            while self.pending_tasks and len(admitted) < n_tasks:
+                task = self.pending_tasks.pop()
+                task.bucket.n_admitted += 1
+                admitted.append(task)
+        return admitted
+
+    def count_queued_jobs(self):
+        """Returns the total number of jobs in the computation queues.
+        """
+        return sum([q.qsize() for q in 
+            self.state_update_jobs_queues + self.logprobs_jobs_queues])
+
+    def count_active_tasks(self):
+        """Returns the number of admitted but unfinished tasks. """
+        return sum([b.count_active() for b in self.buckets])
+
 
 class Bucket(object):
     """A bucket is a set of decoding tasks which correspond to source
@@ -345,6 +559,12 @@ class Bucket(object):
         """Returns the number of unfinished tasks in this bucket. """
         return self.n_tasks - self.n_finished
 
+    def count_active(self):
+        """Returns the number of admitted but unfinished tasks in this 
+        bucket. 
+        """
+        return self.n_admitted - self.n_finished
+
     def add_task(self, task):
         """Add a new task to the bucket, and update its index and
         bucket reference. Note that we add the task even if ``can_add``
@@ -367,6 +587,7 @@ class Bucket(object):
         """
         self.n_tasks = len(self.tasks)
         self.n_finished = 0
+        self.n_admitted = 0
         self.all_attended = shared_floatx_zeros((1, 1, 1))
         self.all_masks = shared_floatx_zeros((1, 1))
         self.src_indices = T.ivector()
@@ -493,11 +714,12 @@ def make_states(states_lst, outputs_lst):
     return all_states
 
 
-def create_state_update_job(tasks):
+def create_state_update_job(tasks, max_tasks=0):
     """Constructs a state update job from the given tasks.
     
     Args:
         tasks (list): List of tasks.
+        max_tasks (int): Current maximum job size (for metrics)
     
     Returns:
         ComputationJob
@@ -513,14 +735,16 @@ def create_state_update_job(tasks):
                           tasks, 
                           src_indices, 
                           make_states(states, outputs), 
-                          outputs)
+                          outputs,
+                          max_tasks)
 
 
-def create_logprobs_job(tasks):
+def create_logprobs_job(tasks, max_tasks=0):
     """Constructs a logprobs job from the given tasks.
     
     Args:
         tasks (list): List of tasks.
+        max_tasks (int): Current maximum job size (for metrics)
     
     Returns:
         ComputationJob
@@ -541,11 +765,13 @@ def create_logprobs_job(tasks):
                     return ComputationJob(tasks[0].bucket, 
                                           tasks, 
                                           src_indices, 
-                                          make_states(states, outputs))
+                                          make_states(states, outputs),
+                                          max_tasks=max_tasks)
     return ComputationJob(tasks[0].bucket, 
                           tasks, 
                           src_indices, 
-                          make_states(states, outputs))
+                          make_states(states, outputs),
+                          max_tasks=max_tasks)
 
 
 # Workers which consume or produce elements from/to queues in the pipeline
@@ -556,10 +782,12 @@ def computation_worker_func(pipeline):
     queus and sends them to theano for computation. This worker
     must run on the main thread to work. The computation results are
     stored in the ``result`` attribute of the job, and the job is added
-    to the *_result* queues..
+    to the *_result* queues. The computation time of each job is used
+    to update the job sizes and the scheduler metrics.
     """
     logging.debug("Start computation")
     reported = False
+    idle_start = None
     while not pipeline.is_finished:
         # We hope that usually one of those queues is not empty and 
         # busy waiting is not a big issue
@@ -567,9 +795,12 @@ def computation_worker_func(pipeline):
         for bucket_id in pipeline.bucket_order:
             if not pipeline.state_update_jobs_queues[bucket_id].empty():
                 job = pipeline.state_update_jobs_queues[bucket_id].get()
+                idle_start = _record_idle(pipeline, idle_start)
+                start = time.time()
                 job.result = job.bucket.compute_next_states(job.src_indices,
                                                             job.states,
                                                             job.outputs)
+                _record_job(pipeline, 'state_update', job, time.time()-start)
                 pipeline.state_update_result_queue.put(job)
                 did_sth = True
                 reported = False
@@ -577,58 +808,95 @@ def computation_worker_func(pipeline):
         for bucket_id in pipeline.bucket_order:
             if not pipeline.logprobs_jobs_queues[bucket_id].empty():
                 job = pipeline.logprobs_jobs_queues[bucket_id].get()
+                idle_start = _record_idle(pipeline, idle_start)
+                start = time.time()
                 job.result = job.bucket.compute_logprobs(job.src_indices,
                                                          job.states)
+                _record_job(pipeline, 'logprobs', job, time.time()-start)
                 pipeline.logprobs_result_queue.put(job)
                 did_sth = True
                 reported = False
                 break
-        if reported and not did_sth:
-            logging.debug("Computation worker is idle!!!")
-            reported = True
+        if not did_sth:
+            if idle_start is None:
+                idle_start = time.time()
+            if not reported:
+                logging.debug("Computation worker is idle!!!")
+                reported = True
+
+
+def _record_idle(pipeline, idle_start):
+    """Helper function for ``computation_worker_func`` which adds the
+    time since ``idle_start`` to the idle time metric.
+    
+    Returns:
+        None. The new value for ``idle_start``
+    """
+    if idle_start is not None:
+        pipeline.metrics.record_idle(time.time() - idle_start)
+    return None
+
+
+def _record_job(pipeline, kind, job, latency):
+    """Helper function for ``computation_worker_func`` which updates 
+    the job size controller and the metrics after computing a job.
+    """
+    pipeline.job_sizes[kind].update(len(job.tasks), latency)
+    pipeline.metrics.record_job(kind, job, latency)
                 
 
 def task2job_worker_func(pipeline):
     """This worker assigns tasks to jobs. As soon as we have collected
     enough tasks to fill a batch, we construct a job and send it via
-    the appropriate queue. If all tasks of a bucket are collected, and
-    a full batch cannot be constructed, we build a smaller batch with
-    the remaining tasks, either a logprobs or a state update job
-    (depending on which is more urgent). If the total number of jobs in
-    the computation queues falls below a threshold, we schedule all 
-    tasks we have to avoid having an idle computation thread.
+    the appropriate queue. If all active tasks of a bucket are 
+    collected, and a full batch cannot be constructed, we build a 
+    smaller batch with the remaining tasks, either a logprobs or a 
+    state update job (depending on which is more urgent). If the total
+    number of jobs in the computation queues falls below a threshold, 
+    we schedule all tasks we have to avoid having an idle computation 
+    thread. For each finished task, we admit a new task to the 
+    pipeline. The size of full batches is controlled by the
+    ``JobSizeController`` instances in the pipeline.
     """
     n_buckets = len(pipeline.buckets)
     logprobs_tasks = [[] for _ in xrange(n_buckets)]
     state_update_tasks = [[] for _ in xrange(n_buckets)]
     while True:
         new_tasks = pipeline.unscheduled_tasks.get()
+        n_finished = 0
         for task in new_tasks:
             if task.is_finished():
                 task.bucket.n_finished += 1
                 pipeline.finished_tasks_queue.put(task)
+                n_finished += 1
             elif task.needs_state_update:
                 state_update_tasks[task.bucket.bucket_id].append(task)
             else:
                 logprobs_tasks[task.bucket.bucket_id].append(task)
+        for task in pipeline.admit_tasks(n_finished):
+            logprobs_tasks[task.bucket.bucket_id].append(task)
+        max_logprobs_tasks = pipeline.job_sizes['logprobs'].job_size
+        max_state_update_tasks = pipeline.job_sizes['state_update'].job_size
         for bucket_id in xrange(n_buckets):
-            n_unfinished = pipeline.buckets[bucket_id].count_unfinished()
+            n_active = pipeline.buckets[bucket_id].count_active()
             all_tasks_waiting = len(state_update_tasks[bucket_id]) \
-                                + len(logprobs_tasks[bucket_id]) == n_unfinished
+                                + len(logprobs_tasks[bucket_id]) == n_active
             scheduled_full_logprobs = False
             scheduled_full_state_update = False
-            while len(logprobs_tasks[bucket_id]) >= PARAM_MAX_TASKS_PER_JOB:
+            while len(logprobs_tasks[bucket_id]) >= max_logprobs_tasks:
                 job = create_logprobs_job(
-                            logprobs_tasks[bucket_id][:PARAM_MAX_TASKS_PER_JOB])
+                            logprobs_tasks[bucket_id][:max_logprobs_tasks],
+                            max_logprobs_tasks)
                 logprobs_tasks[bucket_id] = \
-                            logprobs_tasks[bucket_id][PARAM_MAX_TASKS_PER_JOB:]
+                            logprobs_tasks[bucket_id][max_logprobs_tasks:]
                 pipeline.logprobs_jobs_queues[bucket_id].put(job)
                 scheduled_full_logprobs = True
-            while len(state_update_tasks[bucket_id]) >= PARAM_MAX_TASKS_PER_STATE_UPDATE_JOB:
+            while len(state_update_tasks[bucket_id]) >= max_state_update_tasks:
                 job = create_state_update_job(
-                    state_update_tasks[bucket_id][:PARAM_MAX_TASKS_PER_STATE_UPDATE_JOB])
+                    state_update_tasks[bucket_id][:max_state_update_tasks],
+                    max_state_update_tasks)
                 state_update_tasks[bucket_id] = \
-                    state_update_tasks[bucket_id][PARAM_MAX_TASKS_PER_STATE_UPDATE_JOB:]
+                    state_update_tasks[bucket_id][max_state_update_tasks:]
                 pipeline.state_update_jobs_queues[bucket_id].put(job)
                 scheduled_full_state_update = True
             if (not all_tasks_waiting) \
@@ -637,25 +905,30 @@ def task2job_worker_func(pipeline):
                 continue
             if len(logprobs_tasks[bucket_id]) > len(state_update_tasks[bucket_id]):
                 pipeline.logprobs_jobs_queues[bucket_id].put(
-                                create_logprobs_job(logprobs_tasks[bucket_id]))
+                                create_logprobs_job(logprobs_tasks[bucket_id],
+                                                    max_logprobs_tasks))
                 logprobs_tasks[bucket_id] = []
             elif len(state_update_tasks[bucket_id]) > 0:
                 pipeline.state_update_jobs_queues[bucket_id].put(
-                        create_state_update_job(state_update_tasks[bucket_id]))
+                        create_state_update_job(state_update_tasks[bucket_id],
+                                                max_state_update_tasks))
                 state_update_tasks[bucket_id] = []
         # Schedule all we have if the total number of jobs is below threshold
-        n_jobs = sum([q.qsize() for q in 
-            pipeline.state_update_jobs_queues + pipeline.logprobs_jobs_queues])
+        n_jobs = pipeline.count_queued_jobs()
+        pipeline.metrics.record_queue_depth(n_jobs, 
+                                            pipeline.count_active_tasks())
         if n_jobs < PARAM_MIN_JOBS:
             logging.debug("Number of jobs critical: %d" % n_jobs)
             for bucket_id in xrange(n_buckets):
                 if len(state_update_tasks[bucket_id]) > 0:
                     pipeline.state_update_jobs_queues[bucket_id].put(
-                        create_state_update_job(state_update_tasks[bucket_id]))
+                        create_state_update_job(state_update_tasks[bucket_id],
+                                                max_state_update_tasks))
                     state_update_tasks[bucket_id] = []
                 if len(logprobs_tasks[bucket_id]) > 0:
                     pipeline.logprobs_jobs_queues[bucket_id].put(
-                                create_logprobs_job(logprobs_tasks[bucket_id]))
+                                create_logprobs_job(logprobs_tasks[bucket_id],
+                                                    max_logprobs_tasks))
                     logprobs_tasks[bucket_id] = []
 
 
@@ -722,19 +995,30 @@ def finished_worker_func(pipeline):
     """
     finished_tasks = []
     n_tasks = sum([b.n_tasks for b in pipeline.buckets])
+    last_metrics_time = time.time()
     for _ in xrange(n_tasks):
         finished_tasks.append(pipeline.finished_tasks_queue.get())
         logging.debug("Finished %d translations" % (len(finished_tasks),))
         logging.debug("Bucket order: %s" % pipeline.bucket_order)
         for bucket in pipeline.buckets:
-            logging.debug("Bucket %d: %d/%d (queues: probs=%d update=%d)" % (
+            logging.debug("Bucket %d: %d/%d active=%d (queues: probs=%d "
+                          "update=%d)" % (
                     bucket.bucket_id, 
                     bucket.n_finished, 
                     bucket.n_tasks, 
+                    bucket.count_active(),
                     pipeline.logprobs_jobs_queues[bucket.bucket_id].qsize(), 
                     pipeline.state_update_jobs_queues[bucket.bucket_id].qsize()))
+        if PARAM_METRICS_INTERVAL > 0.0 \
+                and time.time() - last_metrics_time > PARAM_METRICS_INTERVAL:
+            pipeline.metrics.log_summary()
+            last_metrics_time = time.time()
     stop_time = time.time()
     pipeline.is_finished = True
+    pipeline.metrics.log_summary()
+    if args.metrics_file:
+        with open(args.metrics_file, 'w') as f:
+            json.dump(pipeline.metrics.get_summary(), f, indent=2)
 
     # Print out result
     for task in sorted(finished_tasks, key=lambda t: t.sen_id): 
@@ -810,18 +1094,17 @@ for bucket in buckets:
     bucket.compute_context()
     all_tasks.extend(bucket.tasks)
 
-pipeline = Pipeline(buckets)
-pipeline.unscheduled_tasks.put(all_tasks)
+pipeline = Pipeline(buckets, all_tasks)
+pipeline.unscheduled_tasks.put(pipeline.admit_tasks(
+       PARAM_MAX_ACTIVE_TASKS if PARAM_MAX_ACTIVE_TASKS > 0 else n_sentences))
 
 task2job_worker = threading.Thread(target=task2job_worker_func,
                                    args=(pipeline,))
 task2job_worker.start()
-logprobs_worker = threading.Thread(target=logprobs_worker_func,
-                                   args=(pipeline,))
-logprobs_worker.start()
-logprobs_worker2 = threading.Thread(target=logprobs_worker_func,
-                                    args=(pipeline,))
-logprobs_worker2.start()
+for _ in xrange(max(1, args.logprobs_workers)):
+    logprobs_worker = threading.Thread(target=logprobs_worker_func,
+                                       args=(pipeline,))
+    logprobs_worker.start()
 finished_worker = threading.Thread(target=finished_worker_func,
                                    args=(pipeline,))
 finished_worker.start()
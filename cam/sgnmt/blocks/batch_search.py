@@ -0,0 +1,109 @@
+"""This module is similar to the ``blocks.search`` module but decodes
+a batch of source sentences with the same length at once. The original
+``BeamSearch`` uses the batch dimension of the computation graph for
+the beam of a single sentence. ``BatchBeamSearch`` stacks the beams of
+multiple sentences along this dimension and selects the best
+continuations separately for each sentence. Since all sentences in the
+batch have the same length, the encoder does not need masking and the
+results are identical to decoding the sentences one by one.
+"""
+
+
+from blocks.search import BeamSearch
+from theano import config
+import numpy
+
+
+class BatchBeamSearch(BeamSearch):
+    """Beam search over a batch of source sentences. Rows of the input
+    have to be grouped by sentence, i.e. the first ``beam_size`` rows
+    contain the first sentence, the next ``beam_size`` rows the second
+    sentence and so on. As for ``SparseBeamSearch``, we inherit from
+    ``BeamSearch`` to reuse the compiled Theano functions.
+    """
+
+    def search(self, input_values, n_sentences, eol_symbol, max_length,
+               ignore_first_eol=False):
+        """Performs beam search for ``n_sentences`` sentences. For a
+        full description of the arguments see
+        ``blocks.search.BeamSearch.search``.
+
+        Args:
+            input_values (dict): Maps input variables to arrays with
+                                 ``n_sentences*beam_size`` rows
+            n_sentences (int): Number of sentences in the batch
+            eol_symbol (int): End of sentence symbol
+            max_length (int): Maximum translation length
+            ignore_first_eol (bool): Do not stop at a first </S>
+
+        Returns:
+            list. A list with ``(outputs, costs)`` tuples for each
+            sentence as returned by ``BeamSearch.search``
+        """
+        if not self.compiled:
+            self.compile()
+
+        contexts, states, _ = self.compute_initial_states_and_contexts(
+            input_values)
+        beam_size = states['outputs'].shape[0] // n_sentences
+        # Sentence indices and offsets of the beams of each sentence
+        sen_idxs = numpy.arange(n_sentences)[:, None]
+        beam_offsets = sen_idxs * beam_size
+        all_outputs = states['outputs'][None, :]
+        all_masks = numpy.ones_like(all_outputs, dtype=config.floatX)
+        all_costs = numpy.zeros_like(all_outputs, dtype=config.floatX)
+
+        for i in range(max_length):
+            if all_masks[-1].sum() == 0:
+                break
+
+            # All finished sequences are continued with eol_symbol
+            logprobs = self.compute_logprobs(contexts, states)
+            next_costs = (all_costs[-1, :, None] +
+                          logprobs * all_masks[-1, :, None])
+            (finished,) = numpy.where(all_masks[-1] == 0)
+            next_costs[finished, :eol_symbol] = numpy.inf
+            next_costs[finished, eol_symbol + 1:] = numpy.inf
+            vocab_size = next_costs.shape[1]
+            next_costs = next_costs.reshape((n_sentences,
+                                             beam_size,
+                                             vocab_size))
+            if i == 0: # At the first step, all beam entries are equal
+                next_costs = next_costs[:, :1, :]
+            next_costs = next_costs.reshape((n_sentences, -1))
+
+            # Select the beam_size best continuations for each sentence
+            best = numpy.argpartition(next_costs, beam_size - 1,
+                                      axis=1)[:, :beam_size]
+            best_costs = next_costs[sen_idxs, best]
+            order = numpy.argsort(best_costs, axis=1)
+            best = best[sen_idxs, order]
+            chosen_costs = best_costs[sen_idxs, order]
+            indexes = (beam_offsets + best // vocab_size).flatten()
+            outputs = (best % vocab_size).flatten()
+            chosen_costs = chosen_costs.flatten()
+
+            # Rearrange everything
+            for name in states:
+                states[name] = states[name][indexes]
+            all_outputs = all_outputs[:, indexes]
+            all_masks = all_masks[:, indexes]
+            all_costs = all_costs[:, indexes]
+
+            # Record chosen output and compute new states
+            states.update(self.compute_next_states(contexts, states, outputs))
+            all_outputs = numpy.vstack([all_outputs, outputs[None, :]])
+            all_costs = numpy.vstack([all_costs, chosen_costs[None, :]])
+            mask = outputs != eol_symbol
+            if ignore_first_eol and i == 0:
+                mask[:] = 1
+            all_masks = numpy.vstack([all_masks, mask[None, :]])
+
+        all_outputs = all_outputs[1:]
+        all_masks = all_masks[:-1]
+        all_costs = all_costs[1:] - all_costs[:-1]
+        return [self.result_to_lists((all_outputs[:, rows],
+                                      all_masks[:, rows],
+                                      all_costs[:, rows]))
+                for rows in [slice(offset, offset + beam_size)
+                             for offset in beam_offsets[:, 0]]]
@@ -1,24 +1,50 @@
 """This file is taken from the ``machine_translation`` example in 
 Blocks and handles storing and loading NMT models and iteration states
 during training. Note that this module is not used during decoding.
+
+In contrast to the Blocks version, ``CheckpointNMT`` can write
+checkpoints in a background thread. The training thread only takes a
+snapshot of the parameters, the iteration state, and the log in
+memory. All files are written to a temporary file first and renamed
+afterwards, so that a crash during writing never leaves a corrupted
+checkpoint behind. Parameters can be stored compressed or in float16
+to reduce disk usage.
 """
 
+import io
 import logging
 import numpy
 import os
+import re
+import shutil
+import threading
 import time
 
 from contextlib import closing
 from six.moves import cPickle
+from theano import config
 
 from blocks.extensions.saveload import SAVED_TO, LOADED_FROM
 from blocks.extensions import TrainingExtension, SimpleExtension
-from blocks.serialization import secure_dump, load
+from blocks.serialization import secure_dump, dump, load
 from blocks.utils import reraise_as
 
 logger = logging.getLogger(__name__)
 
 
+PARAM_FORMATS = ['npz', 'npz_compressed', 'float16']
+"""Supported formats for parameter files. 'npz' is the uncompressed
+numpy format, 'npz_compressed' is compressed with zlib, and 'float16'
+stores float parameters with half precision in a compressed archive.
+All formats are numpy archives and can be read with 
+``SaveLoadUtils.load_parameter_values``.
+"""
+
+
+ROTATED_PARAMS_PATTERN = re.compile('^params\\.([0-9]+)\\.npz$')
+"""Pattern for parameter files retained by checkpoint rotation """
+
+
 class SaveLoadUtils(object):
     """Utility class for checkpointing."""
 
@@ -49,13 +75,44 @@ class SaveLoadUtils(object):
                     name_ = name.replace('-', '/')
                     if not name_.startswith('/'):
                         name_ = '/' + name_
+                    if value.dtype == numpy.float16:
+                        value = value.astype(config.floatX)
                     param_values[name_] = value
         return param_values
 
-    def save_parameter_values(self, param_values, path):
+    def save_parameter_values(self, param_values, path, param_format='npz'):
+        """Stores parameters in a numpy archive.
+
+        Args:
+            param_values (dict): Parameter names and values
+            path (string|file): Path or file object to write to
+            param_format (string): One of ``PARAM_FORMATS``
+        """
         param_values = {name.replace("/", "-"): param
                         for name, param in param_values.items()}
-        numpy.savez(path, **param_values)
+        if param_format == 'npz':
+            numpy.savez(path, **param_values)
+        elif param_format == 'npz_compressed':
+            numpy.savez_compressed(path, **param_values)
+        elif param_format == 'float16':
+            numpy.savez_compressed(path, **{
+                name: param.astype(numpy.float16) 
+                        if numpy.issubdtype(param.dtype, numpy.floating) 
+                        else param
+                for name, param in param_values.items()})
+        else:
+            logger.fatal("Unknown parameter format %s" % param_format)
+
+
+def _write_atomic(path, write_function):
+    """Writes a file by calling ``write_function`` with a file object
+    for a temporary file, and renaming the temporary file to ``path``
+    afterwards.
+    """
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'wb') as f:
+        write_function(f)
+    os.rename(tmp_path, path)
 
 
 class CheckpointNMT(SimpleExtension, SaveLoadUtils):
@@ -63,46 +120,177 @@ class CheckpointNMT(SimpleExtension, SaveLoadUtils):
 
         Saves only parameters (npz), iteration state (pickle) and log (pickle).
 
+    Serialization of the iteration state and the log, and copying the
+    parameters happens in the training thread. Writing the files to
+    disk can be done in a background thread. Only one checkpoint is
+    written at the same time: if the previous checkpoint is still in
+    progress, we wait for it to finish before taking the next snapshot.
     """
 
-    def __init__(self, saveto, slim_iteration_state, **kwargs):
+    def __init__(self, 
+                 saveto, 
+                 slim_iteration_state, 
+                 background=False, 
+                 keep_checkpoints=0, 
+                 param_format='npz', 
+                 **kwargs):
+        """Creates a new checkpointing extension.
+
+        Args:
+            saveto (string): Training directory
+            slim_iteration_state (bool): Store only the epoch iterator
+                                         instead of the full iteration
+                                         state
+            background (bool): Write checkpoints in a background thread
+            keep_checkpoints (int): If positive, keep copies of the 
+                                    last parameter files as 
+                                    params.<iterations>.npz
+            param_format (string): Format of parameter files. See
+                                   ``PARAM_FORMATS``
+        """
         self.folder = saveto
         self.slim_iteration_state = slim_iteration_state
+        self.background = background
+        self.keep_checkpoints = keep_checkpoints
+        if not param_format in PARAM_FORMATS:
+            logger.fatal("Unknown parameter format %s. Use one of %s"
+                         % (param_format, ', '.join(PARAM_FORMATS)))
+            param_format = 'npz'
+        self.param_format = param_format
+        self.writer_thread = None
         kwargs.setdefault("after_training", True)
         super(CheckpointNMT, self).__init__(**kwargs)
 
     def dump_parameters(self, main_loop):
         logger.info(" ...saving parameters")
         params_to_save = main_loop.model.get_parameter_values()
-        self.save_parameter_values(params_to_save,
-                                   self.path_to_parameters)
+        self.write_parameters(params_to_save)
+
+    def write_parameters(self, param_values):
+        """Writes ``param_values`` to the parameter file. """
+        _write_atomic(self.path_to_parameters, 
+                      lambda f: self.save_parameter_values(param_values, 
+                                                           f,
+                                                           self.param_format))
+
+    def get_iteration_state(self, main_loop):
+        """Get the iteration state to store according 
+        ``slim_iteration_state``.
+        """
+        if self.slim_iteration_state:
+            return main_loop.epoch_iterator
+        return main_loop.iteration_state
 
     def dump_iteration_state(self, main_loop):
         if self.slim_iteration_state:
             logger.info(" ...saving iteration state (slim)")
-            secure_dump(main_loop.epoch_iterator, self.path_to_iteration_state)
         else:
             logger.info(" ...saving iteration state (full)")
-            secure_dump(main_loop.iteration_state, self.path_to_iteration_state)
+        secure_dump(self.get_iteration_state(main_loop), 
+                    self.path_to_iteration_state)
 
     def dump_log(self, main_loop):
         logger.info(" ...saving log")
         secure_dump(main_loop.log, self.path_to_log, cPickle.dump)
 
-    def dump(self, main_loop):
+    def rotate_checkpoints(self, iterations):
+        """Keeps a copy of the current parameter file and deletes the
+        oldest copies if there are more than ``keep_checkpoints``.
+
+        Args:
+            iterations (int): Number of iterations done
+        """
+        if self.keep_checkpoints <= 0:
+            return
+        path = os.path.join(self.folder, 'params.%d.npz' % iterations)
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.link(self.path_to_parameters, path)
+        except (OSError, AttributeError):
+            shutil.copyfile(self.path_to_parameters, path)
+        rotated = []
+        for f in os.listdir(self.folder):
+            m = ROTATED_PARAMS_PATTERN.match(f)
+            if m:
+                rotated.append((int(m.group(1)), f))
+        rotated.sort()
+        for _, f in rotated[:-self.keep_checkpoints]:
+            logger.debug(" ...removing old checkpoint %s" % f)
+            os.remove(os.path.join(self.folder, f))
+
+    def take_snapshot(self, main_loop):
+        """Creates an in-memory copy of the parameters, the 
+        serialized iteration state, and the serialized log.
+
+        Returns:
+            tuple. (param_values, iteration_state, log, iterations) 
+            where ``iteration_state`` and ``log`` are strings
+        """
+        param_values = {name: numpy.array(value, copy=True) 
+                        for name, value 
+                        in main_loop.model.get_parameter_values().items()}
+        with closing(io.BytesIO()) as f:
+            dump(self.get_iteration_state(main_loop), f)
+            iteration_state = f.getvalue()
+        log = cPickle.dumps(main_loop.log)
+        return (param_values, 
+                iteration_state, 
+                log, 
+                main_loop.status['iterations_done'])
+
+    def write_snapshot(self, snapshot):
+        """Writes a snapshot created by ``take_snapshot`` to disk. This
+        is called in the background thread.
+        """
+        param_values, iteration_state, log, iterations = snapshot
+        start = time.time()
+        try:
+            self.write_parameters(param_values)
+            _write_atomic(self.path_to_iteration_state, 
+                          lambda f: f.write(iteration_state))
+            _write_atomic(self.path_to_log, lambda f: f.write(log))
+            self.rotate_checkpoints(iterations)
+            logger.info(" Checkpoint after {} iterations written, took {} "
+                        "seconds.".format(iterations, time.time() - start))
+        except Exception as e:
+            logger.error(" Error writing checkpoint: {}".format(e))
+
+    def wait(self):
+        """Blocks until the background thread has finished writing the
+        last checkpoint.
+        """
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+            self.writer_thread = None
+
+    def dump(self, main_loop, wait=False):
         if not os.path.exists(self.path_to_folder):
             os.mkdir(self.path_to_folder)
         print("")
         logger.info(" Saving model")
         start = time.time()
+        if self.background:
+            self.wait()
+            snapshot = self.take_snapshot(main_loop)
+            self.writer_thread = threading.Thread(target=self.write_snapshot,
+                                                  args=(snapshot,))
+            self.writer_thread.daemon = False
+            self.writer_thread.start()
+            logger.info(" Model snapshot taken, took {} seconds."
+                        .format(time.time()-start))
+            if wait:
+                self.wait()
+            return
         self.dump_parameters(main_loop)
         self.dump_iteration_state(main_loop)
         self.dump_log(main_loop)
+        self.rotate_checkpoints(main_loop.status['iterations_done'])
         logger.info(" Model saved, took {} seconds.".format(time.time()-start))
 
     def do(self, callback_name, *args):
         try:
-            self.dump(self.main_loop)
+            self.dump(self.main_loop, wait=(callback_name == 'after_training'))
         except Exception:
             raise
         finally:
@@ -245,6 +245,17 @@ def blocks_get_default_nmt_config():
     # Beam-size
     config['beam_size'] = 12
 
+    # Number of dev set sentences with the same length which are decoded
+    # in a single batch during validation
+    config['val_batch_size'] = 10
+
+    # Compute BLEU in-process instead of calling bleu_script if
+    # bleu_script is the default multi-bleu.perl command
+    config['val_bleu_internal'] = True
+
+    # Decode the dev set in a background process on a parameter snapshot
+    config['val_async'] = False
+
     # Timing/monitoring related -----------------------------------------------
 
     # Maximum number of updates
@@ -256,6 +267,15 @@ def blocks_get_default_nmt_config():
     # Save model after this many updates
     config['save_freq'] = 750
 
+    # Write checkpoints in a background thread
+    config['checkpoint_background'] = False
+
+    # Number of old parameter files to keep (0: only params.npz)
+    config['keep_checkpoints'] = 0
+
+    # Format of parameter files: npz, npz_compressed, float16
+    config['checkpoint_format'] = 'npz'
+
     # Validate bleu after this many updates
     config['bleu_val_freq'] = 6000
 
@@ -333,9 +353,25 @@ def blocks_get_nmt_config_help():
     config['output_val_set'] = "Print validation output to file"
     config['val_set_out'] = "Validation output file"
     config['beam_size'] = "Beam-size for decoding DURING TRAINING"
+    config['val_batch_size'] = "Number of dev set sentences with the same " \
+                               "length decoded in one batch during validation"
+    config['val_bleu_internal'] = "Compute BLEU in-process (equivalent to " \
+                                  "multi-bleu.perl) instead of bleu_script. " \
+                                  "Only used if bleu_script is the stock " \
+                                  "multi-bleu.perl command without options, " \
+                                  "custom scripts are always called"
+    config['val_async'] = "Validate in a background process on a snapshot " \
+                          "of the parameters (CPU decoding only)"
     config['finish_after'] = "Maximum number of updates"
     config['reload'] = "Reload model from files if exist"
     config['save_freq'] = "Save model after this many updates"
+    config['checkpoint_background'] = "Write checkpoints in a background " \
+                                      "thread on a snapshot of the model"
+    config['keep_checkpoints'] = "If positive, keep this many old parameter " \
+                                 "files as params.<iterations>.npz"
+    config['checkpoint_format'] = "Format of parameter files: 'npz', " \
+                                  "'npz_compressed', or 'float16' " \
+                                  "(compressed half precision)"
     config['bleu_val_freq'] = "Validate bleu after this many updates"
     config['val_burn_in'] = "Start bleu validation after this many updates"
     config['store_full_main_loop'] = "Old style archives (not recommended)"
@@ -442,6 +478,17 @@ def get_blocks_train_parser():
                         help="Use bokeh server for plotting")
     parser.add_argument("--reshuffle",  default=False, action="store_true",
                         help="Reshuffle before each epoch")
+    parser.add_argument("--binary_corpus",  default=False, action="store_true",
+                        help="Convert src_data and trg_data to memory-mapped "
+                        "corpus stores (<file>.store) if necessary and build "
+                        "training batches in a background process. This "
+                        "reduces memory usage for large corpora and avoids "
+                        "stalls due to data loading. Not compatible with "
+                        "sparse feature maps.")
+    parser.add_argument("--prefetch_batches", default=20, type=int,
+                        help="Maximum number of training batches which are "
+                        "prepared ahead of time if --binary_corpus is "
+                        "enabled.")
     parser.add_argument("--slim_iteration_state",  default=False, action="store_true",
                         help="Per default the iteration state stores the data "
                         "stream and the main loop epoch iterator. Enabling "
@@ -495,6 +542,17 @@ def get_blocks_train_parser():
                         "If the most frequent word in the backtranslated "
                         "sentence has relative frequency higher than this, "
                          "discard this sentence pair")
+    parser.add_argument("--backtrans_workers", default=0, type=int,
+                        help="Number of background processes which back-"
+                        "translate monolingual sentences ahead of time. Each "
+                        "worker loads its own copy of the back-translating "
+                        "NMT system, so this should only be used for CPU "
+                        "decoding. Set to 0 to back-translate synchronously "
+                        "in the main loop.")
+    parser.add_argument("--backtrans_queue_size", default=100, type=int,
+                        help="Maximum number of sentences which are back-"
+                        "translated ahead of time if --backtrans_workers is "
+                        "positive.")
     parser.add_argument("--learning_rate", default=0.002, type=float,
                         help="Learning rate for AdaGrad and Adam")
     parser.add_argument("--prune_every", default=-1, type=int,
@@ -523,6 +581,12 @@ def get_blocks_train_parser():
                         "<layer> is one of the layer names specified via "
                         "--prune_layers. Set <start-idx> to 0.5 to add an "
                         "offset of half the matrix dimension to the indices.")
+    parser.add_argument("--prune_shrink_output", default="",
+                        help="If set, remove pruned neurons physically from "
+                        "the weight matrices at the end of training and store "
+                        "the smaller model at this path. The sizes of the "
+                        "shrunk layers are logged and need to be set in the "
+                        "NMT configuration when using this model.")
     parser.add_argument("--sampling_freq", default=13, type=int,
                         help="NOT USED, just to prevent old code from breaking")
     parser.add_argument("--hook_samples", default=0, type=int,
@@ -626,6 +690,32 @@ def get_blocks_batch_decode_parser():
                         "padding.")
     parser.add_argument("--beam", default=5, type=int,
                         help="Size of the beam.")
+    parser.add_argument("--max_active_tasks", default=0, type=int,
+                        help="Maximum number of sentences which are decoded "
+                        "at the same time. New sentences are admitted as "
+                        "soon as others are finished. Sentences are admitted "
+                        "in source length order, so active sentences tend to "
+                        "be in only a few buckets which leads to fuller "
+                        "batches. Set to 0 to admit all sentences at once.")
+    parser.add_argument("--target_job_latency", default=0.0, type=float,
+                        help="If positive, the CPU scheduler adjusts the "
+                        "number of tasks per job such that computing a job "
+                        "takes about this many seconds. The per-task "
+                        "latency is measured on the computed jobs. "
+                        "--max_tasks_per_job and "
+                        "--max_tasks_per_state_update_job are used as upper "
+                        "bounds. If this is not positive, the job sizes are "
+                        "constant.")
+    parser.add_argument("--logprobs_workers", default=2, type=int,
+                        help="Number of threads which process the results of "
+                        "forward pass jobs.")
+    parser.add_argument("--metrics_interval", default=0.0, type=float,
+                        help="Log scheduler metrics (queue depths, batch "
+                        "occupancy, latencies) every n seconds. Set to 0 to "
+                        "log them only at the end.")
+    parser.add_argument("--metrics_file", default="",
+                        help="If set, write the final scheduler metrics to "
+                        "this file in JSON format.")
     
     blocks_add_nmt_config(parser)
     return parser
@@ -8,9 +8,16 @@ https://arxiv.org/abs/1704.03279
 Note that to avoid rebuilding the computation graph after each
 prunning operation, we do not remove neurons but set their connections
 to zero. To realize speed ups, neurons with zero weights must be
-removed in a postprocessing step.
+removed in a postprocessing step with ``shrink_parameter_values``.
+This can be done at the end of training (see ``--prune_shrink_output``)
+or with the command line interface of this module::
+
+  python -m cam.sgnmt.blocks.pruning --params train/params.npz \\
+                                     --layout prune.layout \\
+                                     --output train/params.shrunk.npz
 """
 
+import argparse
 import logging
 
 from blocks.algorithms import GradientDescent
@@ -24,10 +31,32 @@ from theano import tensor
 import theano
 import numpy as np
 
+from cam.sgnmt.blocks.checkpoint import SaveLoadUtils
+
 logger = logging.getLogger(__name__)
 
 INF_DIST = 10000.0
 
+OBS_SAMPLE_SIZE = 50000
+"""Number of neuron activity vectors which are kept for the linear
+interpolation in ``_compensate_for_pruning_interpol``. The sample is
+drawn uniformly from all observations with reservoir sampling.
+"""
+
+PRUNABLE_LAYERS = ['encfwdgru', 'encbwdgru', 'decgru', 'decmaxout']
+"""Names of the layers which can be pruned. """
+
+TIED_LAYERS = [['encfwdgru', 'encbwdgru']]
+"""Layers which must have the same size after shrinking because they
+share a single size parameter in the NMT configuration.
+"""
+
+LAYER_CONFIG_KEYS = {'encfwdgru': 'enc_nhids',
+                     'encbwdgru': 'enc_nhids',
+                     'decgru': 'dec_nhids',
+                     'decmaxout': 'maxout_nhids'}
+"""NMT configuration parameters for the size of prunable layers. """
+
 class PrunableLayer(object):
     """This class represents a layer definition loaded from the file
     system and keeps track of neurons which have been removed in the
@@ -55,32 +84,31 @@ class PrunableLayer(object):
         """
         self.name = name
         self.theano_variable = theano_variable
-        self.dists = None
+        self.gram = None
         self.activities = None
-        self.mask = None
+        self.pruned = None
         self.n_obs = 0.0
         self.trg_size = trg_size
         self.n_steps = n_steps
         self.connections = []
         self.pruned_neurons = []
-        self.obs = []
+        self.obs = None
         self.maxout = maxout
 
     def reset(self):
         """Resets the activity records. Can be called after a pruning
         operation to maintain recency.
         """ 
-        self.dists = None
+        self.gram = None
         self.activities = None
         self.n_obs = 0.0
-        self.obs = []
+        self.obs = None
         logging.info("Layer %s reset" % self.name)
 
     def initialize_mask(self):
-        """Initialize the neuron mask to a upper triangular matrix, ie.
-        no neuron has been removed.
+        """Initialize the neuron mask, ie. no neuron has been removed.
         """
-        self.mask = np.triu(INF_DIST * np.ones_like(self.dists))
+        self.pruned = np.zeros((len(self.activities),), dtype=bool)
 
     def derive_step_size(self):
         """Calculate the required step size to reach the target size
@@ -91,31 +119,62 @@ class PrunableLayer(object):
 
     def get_size(self):
         """Get the size of the layer. """
-        return self.mask.shape[0]
+        return len(self.pruned)
+
+    def get_distances(self):
+        """Get the matrix with the sums of squared distances between 
+        the activities of all neuron pairs. They are derived from the
+        Gram matrix and the squared norms which are accumulated in
+        ``register_activities``.
+        """
+        dists = -2.0 * self.gram
+        dists += self.activities.reshape(-1, 1)
+        dists += self.activities
+        return dists
+
+    def get_obs_sample(self):
+        """Get the sample of neuron activity vectors collected since the
+        last reset as matrix with one column per observation.
+        """
+        return self.obs[:, :min(int(self.n_obs), OBS_SAMPLE_SIZE)]
+
+    def _update_obs_sample(self, x):
+        """Updates the activity sample with reservoir sampling.
+
+        Args:
+            x (array): Activities with one column per observation
+        """
+        if self.obs is None:
+            self.obs = np.empty((x.shape[0], OBS_SAMPLE_SIZE), dtype=x.dtype)
+        n_seen = int(self.n_obs)
+        n_fill = max(0, min(x.shape[1], OBS_SAMPLE_SIZE - n_seen))
+        if n_fill > 0:
+            self.obs[:, n_seen:n_seen+n_fill] = x[:, :n_fill]
+        if n_fill < x.shape[1]:
+            pos = np.arange(n_seen + n_fill, n_seen + x.shape[1])
+            slots = (np.random.random(len(pos)) * (pos + 1)).astype(int)
+            replace = slots < OBS_SAMPLE_SIZE
+            self.obs[:, slots[replace]] = x[:, n_fill:][:, replace]
 
     def register_activities(self, activity):
         """Store the layer activities in a training batch and update 
-        the distance matrix.
+        the distance statistics. We only accumulate the Gram matrix and
+        the squared norms of the activities, the distance matrix is
+        derived from them when needed.
         
         Args:
             activity (array): Neuron activity in the most recent batch
         """
         # TODO: Use Decoder training stream mask!
         x = activity.reshape((-1, activity.shape[-1])).transpose()
-        self.obs.append(x)
-        # http://stackoverflow.com/questions/15556116/implementing-support-
-        # vector-machine-efficiently-computing-gram-matrix-k
-        pt_sq_norms = (x ** 2).sum(axis=1)
-        dists_sq = np.dot(x, x.T)
-        dists_sq *= -2
-        dists_sq += pt_sq_norms.reshape(-1, 1)
-        dists_sq += pt_sq_norms
-        activities_sq = np.sum(np.square(x), axis=1)
-        if self.dists is None:
-            self.dists = dists_sq
+        self._update_obs_sample(x)
+        gram = np.dot(x, x.T)
+        activities_sq = np.einsum('ij,ij->i', x, x)
+        if self.gram is None:
+            self.gram = gram
             self.activities = activities_sq
         else:
-            self.dists += dists_sq
+            self.gram += gram
             self.activities += activities_sq
         self.n_obs += x.shape[1]
 
@@ -131,7 +190,7 @@ class PrunableLayer(object):
         Args:
             params_dict (dict): Dictionary of numpy arrays
         """
-        if self.mask is None:
+        if self.pruned is None:
             self.initialize_mask()
             self.derive_step_size()
         n_to_delete = min(self.count_unpruned_neurons() - self.trg_size,
@@ -141,23 +200,30 @@ class PrunableLayer(object):
             self.reset()
             return
         self.activities /= self.n_obs
-        self.dists /= self.n_obs
+        self.gram /= self.n_obs
         activity_discounts = get_activity_discounts(self)
-        search_mat = np.multiply(self.dists, activity_discounts) + self.mask
-        idxs_flat = np.argsort(search_mat, None)
-        idxs = np.unravel_index(idxs_flat, search_mat.shape)
-        min_score = search_mat[idxs[0][0], idxs[1][0]]
+        # Candidates are all pairs (i,j) with i>j of unpruned neurons
+        rows, cols = np.tril_indices(self.get_size(), -1)
+        valid = np.logical_not(self.pruned[rows] | self.pruned[cols])
+        rows = rows[valid]
+        cols = cols[valid]
+        scores = self.get_distances()[rows, cols]
+        scores *= activity_discounts[rows, cols]
+        order = np.argsort(scores)
+        # Always keep the more active neuron of a pair
+        swap = self.activities[rows] < self.activities[cols]
+        keep = np.where(swap, cols, rows)[order].tolist()
+        remove = np.where(swap, rows, cols)[order].tolist()
+        min_score = scores[order[0]] if len(order) > 0 else INF_DIST
+        max_score = min_score
         to_delete = []
-        for i,j in zip(idxs[0], idxs[1]):
-            if i in self.pruned_neurons or j in self.pruned_neurons:
+        for pos, i, j in zip(xrange(len(keep)), keep, remove):
+            if self.pruned[i] or self.pruned[j]:
                 continue
-            max_score = search_mat[i,j]
-            if self.activities[i] < self.activities[j]:
-                i,j = j,i
+            max_score = scores[order[pos]]
             to_delete.append((i, j))
+            self.pruned[j] = True
             self.pruned_neurons.append(j)
-            self.mask[j,:] = INF_DIST
-            self.mask[:,j] = INF_DIST
             if len(to_delete) >= n_to_delete:
                 break
         compensate_for_pruning(to_delete, self, params_dict)
@@ -178,17 +244,11 @@ class PrunableLayer(object):
         """
         geps = 0.0
         for conn in self.connections:
+            if not self.pruned_neurons:
+                break
             mat = params_dict[conn.mat_name].get_value()
-            mat_idxs = self.pruned_neurons
-            if conn.start_idx > 0.0:
-                offset = int(mat.shape[conn.dim] * conn.start_idx)
-                mat_idxs = [idx+offset for idx in mat_idxs]
-            if len(mat.shape) == 1:
-                eps = np.max(np.absolute(mat[mat_idxs]))
-            elif conn.dim == 0:
-                eps = np.max(np.absolute(mat[mat_idxs,:]))
-            elif conn.dim == 1:
-                eps = np.max(np.absolute(mat[:,mat_idxs]))
+            mat_idxs = get_mat_idxs(self, conn, mat, self.pruned_neurons)
+            eps = np.max(np.absolute(np.take(mat, mat_idxs, axis=conn.dim)))
             geps = max(eps, geps)
         logging.info("Sanity check: max of %d prunned connections: %f" % (
                                                     len(self.pruned_neurons), 
@@ -244,22 +304,15 @@ def _compensate_for_pruning_sum(to_delete, layer, params_dict):
         layer (PrunableLayer): The layer which we are currently pruning
         params_dict (dict): Dictionary of numpy arrays (weight matrices)
     """
-    for i,j in to_delete:
-        # Prune neuron j, add output connections to i
-        for conn in layer.connections:
-            mat = params_dict[conn.mat_name].get_value()
-            mat_i = i
-            mat_j = j
-            if conn.start_idx > 0.0:
-                offset = int(mat.shape[conn.dim] * conn.start_idx)
-                mat_i += offset
-                mat_j += offset
-            if conn.direction == "in" and layer.maxout:
-                mat = set_zero_in_mat(mat, conn.dim, mat_j*2)
-                mat = set_zero_in_mat(mat, conn.dim, mat_j*2+1)
-            else:
-                mat = set_zero_in_mat(mat, conn.dim, mat_j)
-            params_dict[conn.mat_name].set_value(mat)
+    delete_idxs = [j for _,j in to_delete]
+    if not delete_idxs:
+        return
+    for conn in layer.connections:
+        mat = params_dict[conn.mat_name].get_value()
+        mat = set_zero_in_mat(mat, 
+                              conn.dim, 
+                              get_mat_idxs(layer, conn, mat, delete_idxs))
+        params_dict[conn.mat_name].set_value(mat)
 
 
 def _compensate_for_pruning_interpol(to_delete, layer, params_dict):
@@ -273,10 +326,10 @@ def _compensate_for_pruning_interpol(to_delete, layer, params_dict):
         layer (PrunableLayer): The layer which we are currently pruning
         params_dict (dict): Dictionary of numpy arrays (weight matrices)
     """
-    reduced_obs = np.hstack(layer.obs)[:,np.random.randint(
-                                                    layer.n_obs, 
-                                                    size=50000)].transpose()
-    delete_idxs = [j for i,j in to_delete]
+    delete_idxs = np.array([j for _,j in to_delete], dtype=int)
+    if len(delete_idxs) == 0:
+        return
+    reduced_obs = layer.get_obs_sample().transpose()
     survive_mask = np.ones((layer.get_size(),), dtype=bool)
     survive_mask[layer.pruned_neurons] = False
     survive_idxs = np.where(survive_mask)[0]
@@ -296,13 +349,11 @@ def _compensate_for_pruning_interpol(to_delete, layer, params_dict):
             else:
                 work = work[offset:offset+layer.get_size()]
         if conn.direction == "out": 
-            work[survive_idxs,:] += np.dot(weights, work[delete_idxs])
-        for j in delete_idxs:
-            if conn.direction == "in" and layer.maxout:
-                work = set_zero_in_mat(work, 0, j*2)
-                work = set_zero_in_mat(work, 0, j*2+1)
-            else:
-                work = set_zero_in_mat(work, 0, j)
+            work[survive_idxs] += np.dot(weights, work[delete_idxs])
+        if conn.direction == "in" and layer.maxout:
+            work[np.concatenate([delete_idxs*2, delete_idxs*2+1])] = 0.0
+        else:
+            work[delete_idxs] = 0.0
         params_dict[conn.mat_name].set_value(mat)
 
 
@@ -321,14 +372,41 @@ Args:
     params_dict (dict): Dictionary of numpy arrays (weight matrices)
 """
 
+def get_mat_idxs(layer, conn, mat, neurons):
+    """Maps neuron indices in a layer to row or column indices in the
+    weight matrix of a connection. This takes into account the offset
+    given by ``start_idx``, and that each maxout neuron has two inputs.
+    The offset is added after doubling the maxout indices since it
+    refers to positions in the (concatenated) weight matrix. Note that
+    earlier versions doubled the offset for maxout "in" connections,
+    and did not double the maxout indices in the sanity check.
+    
+    Args:
+        layer (PrunableLayer): The layer the neurons belong to
+        conn (Connection): Connection of the layer
+        mat (array): Weight matrix of the connection
+        neurons (list): Neuron indices in ``layer``
+    
+    Returns:
+        array. Indices in dimension ``conn.dim`` of ``mat``
+    """
+    idxs = np.asarray(neurons, dtype=int)
+    if conn.direction == "in" and layer.maxout:
+        idxs = np.concatenate([idxs*2, idxs*2+1])
+    if conn.start_idx > 0.0:
+        idxs = idxs + int(mat.shape[conn.dim] * conn.start_idx)
+    return idxs
+
+
 def add_in_mat(mat, dim, f_idx, t_idx):
     """Helper method to add a row or column to another one in a matrix.
     
     Args:
         mat (array): two dimensional numpy array.
         dim (int): 0 for rows, 1 for columns
-        f_idx (int): Index of the first row or column
-        t_idx (int): Index of the second row or column
+        f_idx (int|array): Index of the first row or column
+        t_idx (int|array): Index of the second row or column. Indices
+                           must be unique if this is an array
     
     Returns:
         array. Matrix in which the first row or column is added to the
@@ -349,7 +427,8 @@ def set_zero_in_mat(mat, dim, idx):
     Args:
         mat (array): two dimensional numpy array.
         dim (int): 0 for rows, 1 for columns
-        idx (int): Index of the row or column
+        idx (int|array): Index of the row or column, or an array
+                         of indices
     
     Returns:
         array. Matrix in which the ``idx``-the row or column is
@@ -387,6 +466,137 @@ class Connection(object):
         self.start_idx = start_idx
 
 
+def load_prune_layout(layout_path):
+    """Loads a network layout file which defines which weight matrices
+    are connected to which prunable layers. See the help text of
+    ``--prune_layout_path`` for the file format.
+    
+    Args:
+        layout_path (string): Path to the network layout file.
+    
+    Returns:
+        dict. Lists of ``Connection`` instances keyed by layer name
+    """
+    conns = {}
+    with open(layout_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            parts = line.strip().split()
+            if not len(parts) in [4, 5]:
+                logging.warn("Syntax error in prune layout file")
+                continue
+            conn = Connection(parts[1], 
+                              parts[2], 
+                              int(parts[3]), 
+                              float(parts[4]) if len(parts) == 5 else 0.0)
+            if parts[0] in conns:
+                conns[parts[0]].append(conn)
+            else:
+                conns[parts[0]] = [conn]
+    return conns
+
+
+def _get_layer_size(layer, param_values):
+    """Infers the size of a layer from the shapes of the connected 
+    weight matrices. At least one connection must cover exactly the
+    neurons in the layer.
+    """
+    sizes = []
+    for conn in layer.connections:
+        dim_size = param_values[conn.mat_name].shape[conn.dim]
+        if conn.direction == "in" and layer.maxout:
+            dim_size //= 2
+        sizes.append(dim_size - int(dim_size * conn.start_idx))
+    return min(sizes)
+
+
+def get_pruned_neurons(layer, param_values):
+    """Get the neurons in a layer whose connections are all zero.
+    
+    Args:
+        layer (PrunableLayer): Layer with connections
+        param_values (dict): Dictionary of numpy arrays
+    
+    Returns:
+        array. Indices of the pruned neurons in ``layer``
+    """
+    size = _get_layer_size(layer, param_values)
+    alive = np.zeros((size,), dtype=bool)
+    for conn in layer.connections:
+        mat = param_values[conn.mat_name]
+        idxs = get_mat_idxs(layer, conn, mat, np.arange(size))
+        weights = np.absolute(np.take(mat, idxs, axis=conn.dim))
+        if len(mat.shape) == 2:
+            weights = weights.sum(axis=1-conn.dim)
+        alive |= (weights.reshape((-1, size)) > 0.0).any(axis=0)
+    return np.where(np.logical_not(alive))[0]
+
+
+def shrink_parameter_values(param_values, layers):
+    """Physically removes pruned neurons from the weight matrices.
+    Neurons are regarded as pruned if all their connections are zero.
+    All rows and columns of pruned neurons are deleted at once for each
+    weight matrix. For layers in ``TIED_LAYERS``, we remove only as 
+    many neurons as possible without violating the constraint that 
+    they must have the same size.
+    
+    Args:
+        param_values (dict): Dictionary of numpy arrays. This is 
+                             updated with the shrunk matrices
+        layers (list): List of ``PrunableLayer`` instances which
+                       have connections
+    
+    Returns:
+        dict. New layer sizes keyed by layer name
+    """
+    pruned = {}
+    sizes = {}
+    for layer in layers:
+        pruned[layer.name] = get_pruned_neurons(layer, param_values)
+        sizes[layer.name] = _get_layer_size(layer, param_values)
+    for tied in TIED_LAYERS:
+        tied = [name for name in tied if name in pruned]
+        if not tied:
+            continue
+        trg_size = max(sizes[name] - len(pruned[name]) for name in tied)
+        for name in tied:
+            pruned[name] = pruned[name][:sizes[name] - trg_size]
+    to_remove = {}
+    for layer in layers:
+        for conn in layer.connections:
+            mat = param_values[conn.mat_name]
+            key = (conn.mat_name, conn.dim)
+            idxs = get_mat_idxs(layer, conn, mat, pruned[layer.name])
+            to_remove[key] = np.union1d(to_remove.get(key, []), idxs)
+    for (mat_name, dim), idxs in to_remove.iteritems():
+        param_values[mat_name] = np.delete(param_values[mat_name], 
+                                           idxs.astype(int), 
+                                           axis=dim)
+    new_sizes = {}
+    for layer in layers:
+        new_sizes[layer.name] = sizes[layer.name] - len(pruned[layer.name])
+        logging.info("Shrink layer %s from %d to %d neurons" % (
+                                                  layer.name,
+                                                  sizes[layer.name],
+                                                  new_sizes[layer.name]))
+    return new_sizes
+
+
+def log_shrunk_config(new_sizes):
+    """Logs the NMT configuration parameters which need to be set to
+    use a shrunk model.
+    
+    Args:
+        new_sizes (dict): Layer sizes as returned by 
+                          ``shrink_parameter_values``
+    """
+    params = sorted(set("%s=%d" % (LAYER_CONFIG_KEYS[name], size)
+                        for name, size in new_sizes.iteritems()))
+    logging.info("Use the following NMT configuration with the shrunk "
+                 "model: %s" % ','.join(params))
+
+
 class PrunableInitializableFeedforwardSequence(FeedforwardSequence, 
                                                Initializable):
     """Version of ``InitializableFeedforwardSequence`` which allows
@@ -527,23 +737,7 @@ class PruningGradientDescent(GradientDescent):
             layer_configs (dict): Layer configurations.
             layout_path (string): Path to the network layout file.
         """
-        conns = {}
-        with open(layout_path) as f:
-            for line in f:
-                if not line.strip():
-                    continue
-                parts = line.strip().split()
-                if not len(parts) in [4, 5]:
-                    logging.warn("Syntax error in prune layout file")
-                    continue
-                conn = Connection(parts[1], 
-                                  parts[2], 
-                                  int(parts[3]), 
-                                  float(parts[4]) if len(parts) == 5 else 0.0)
-                if parts[0] in conns:
-                    conns[parts[0]].append(conn)
-                else:
-                    conns[parts[0]] = [conn]
+        conns = load_prune_layout(layout_path)
         seq_gen = self.nmt_model.decoder.sequence_generator
         self.prunable_layers = []
         for conf in layer_configs:
@@ -611,3 +805,52 @@ class PruningGradientDescent(GradientDescent):
                 self.next_layer_to_reset %= len(self.prunable_layers)
                 self.prunable_layers[self.next_layer_to_reset].reset()
 
+    def get_shrunk_parameter_values(self):
+        """Get the current parameter values with pruned neurons 
+        physically removed from the weight matrices.
+        
+        Returns:
+            dict. Dictionary of numpy arrays with shrunk matrices
+        """
+        param_values = {name: param.get_value() 
+                        for name, param in self.params_dict.iteritems()}
+        new_sizes = shrink_parameter_values(param_values, 
+                                            self.prunable_layers)
+        log_shrunk_config(new_sizes)
+        return param_values
+
+
+def main():
+    """Command line interface for ``shrink_parameter_values``. """
+    parser = argparse.ArgumentParser(
+        description="Removes pruned neurons from the weight matrices of an "
+        "NMT model trained with --prune_every.")
+    parser.add_argument("--params", required=True,
+                        help="Path to the npz file with the pruned model.")
+    parser.add_argument("--layout", default="prune.layout",
+                        help="Network layout file as used for "
+                        "--prune_layout_path in training.")
+    parser.add_argument("--layers", default=','.join(PRUNABLE_LAYERS),
+                        help="Comma separated list of layers to shrink.")
+    parser.add_argument("--output", required=True,
+                        help="Path to the npz file to create.")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=logging.INFO)
+    conns = load_prune_layout(args.layout)
+    layers = []
+    for name in args.layers.split(','):
+        if not name in conns:
+            logging.warn("No connections for layer %s in layout" % name)
+            continue
+        layer = PrunableLayer(name, None, 0, 1, maxout=(name == 'decmaxout'))
+        layer.connections = conns[name]
+        layers.append(layer)
+    save_load = SaveLoadUtils()
+    param_values = save_load.load_parameter_values(args.params)
+    log_shrunk_config(shrink_parameter_values(param_values, layers))
+    save_load.save_parameter_values(param_values, args.output)
+
+
+if __name__ == "__main__":
+    main()
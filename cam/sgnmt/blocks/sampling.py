@@ -1,6 +1,11 @@
 """This module is derived from the ``sampling`` module in the Blocks
 NMT example, but reduced to providing functionality for model selection
 according the BLEU score on the dev set.
+
+Unlike the original implementation, the dev set is decoded in batches
+of sentences with the same length, the BLEU score is computed in-
+process, and validation can run in a background process on a snapshot
+of the parameters so that training continues in the meantime.
 """
 
 from __future__ import print_function
@@ -8,6 +13,7 @@ from __future__ import print_function
 from blocks.extensions import SimpleExtension
 from blocks.search import BeamSearch
 import logging
+import multiprocessing
 import numpy
 import operator
 import os
@@ -17,18 +23,45 @@ from subprocess import Popen, PIPE
 import time
 
 from cam.sgnmt import utils
+from cam.sgnmt.blocks.batch_search import BatchBeamSearch
 from cam.sgnmt.blocks.sparse_search import SparseBeamSearch
+from cam.sgnmt.misc.bleu import IncrementalBleu
 from cam.sgnmt.misc.sparse import FlatSparseFeatMap
 
 
 logger = logging.getLogger(__name__)
 
 
+def _is_stock_multibleu(bleu_script):
+    """Returns true if ``bleu_script`` is the default BLEU command,
+    i.e. ``multi-bleu.perl`` without any options. Only then the
+    in-process BLEU computation is equivalent to the script.
+
+    Args:
+        bleu_script (string): BLEU command as in the NMT configuration
+
+    Returns:
+        bool. True if in-process BLEU can replace ``bleu_script``
+    """
+    cmd = bleu_script.split()
+    return (len(cmd) == 4
+            and cmd[0] == 'perl'
+            and os.path.basename(cmd[1]) == 'multi-bleu.perl'
+            and cmd[2:] == ['%s', '<'])
+
+
 class BleuValidator(SimpleExtension):
     """Implements early stopping based on BLEU score. This class is 
     still very similar to the ``BleuValidator`` in the NMT Blocks
     example.
     
+    If ``val_async`` is set in the configuration, the dev set is 
+    decoded in a forked process with a snapshot of the current 
+    parameters. The result is collected at the next validation or at
+    the end of training, and the checkpoint is created from the
+    snapshot. Note that forking only works reliably with CPU decoding
+    or if Theano has not initialized the GPU in the parent process.
+    
     TODO: Refactor, make this more similar to the rest of SGNMT, use
     vanilla_decoder.py
     """
@@ -75,8 +108,22 @@ class BleuValidator(SimpleExtension):
         self.normalize = normalize
         self.best_models = []
         self.val_bleu_curve = []
-        self.multibleu_cmd = (self.config['bleu_script'] % self.config['val_set_grndtruth']).split()
-        logging.debug("BLEU command: %s" % self.multibleu_cmd)
+        self.val_sources = None
+        self.async_validation = None
+        self.batch_size = max(1, self.config.get('val_batch_size', 1))
+        use_internal = self.config.get('val_bleu_internal', False)
+        if use_internal and not _is_stock_multibleu(self.config['bleu_script']):
+            logging.warn("val_bleu_internal is ignored because bleu_script "
+                         "is not the stock multi-bleu.perl command. Using "
+                         "%s for model selection" % self.config['bleu_script'])
+            use_internal = False
+        if use_internal:
+            self.multibleu_cmd = None
+            with open(self.config['val_set_grndtruth']) as f:
+                self.references = [line.split() for line in f]
+        else:
+            self.multibleu_cmd = (self.config['bleu_script'] % self.config['val_set_grndtruth']).split()
+            logging.debug("BLEU command: %s" % self.multibleu_cmd)
 
         self.src_sparse_feat_map = config['src_sparse_feat_map'] if config['src_sparse_feat_map'] \
                                                                  else FlatSparseFeatMap()
@@ -87,7 +134,10 @@ class BleuValidator(SimpleExtension):
                                  trg_sparse_feat_map=self.trg_sparse_feat_map) 
         else:
             self.trg_sparse_feat_map = FlatSparseFeatMap()
-            self.beam_search = BeamSearch(samples=samples)
+            if self.batch_size > 1:
+                self.beam_search = BatchBeamSearch(samples=samples)
+            else:
+                self.beam_search = BeamSearch(samples=samples)
         
         # Create saving directory if it does not exist
         if not os.path.exists(self.config['saveto']):
@@ -109,78 +159,197 @@ class BleuValidator(SimpleExtension):
 
     def do(self, which_callback, *args):
         """Decodes the dev set and stores checkpoints in case the BLEU
-        score has improved.
+        score has improved. In asynchronous mode, this first collects
+        the result of the previous validation and then starts a new
+        one in the background.
         """
+        if self.async_validation:
+            self._finish_async_validation()
+        if which_callback == 'after_training':
+            return
         if self.main_loop.status['iterations_done'] <= \
                 self.config['val_burn_in']:
             return
-        self._save_model(self._evaluate_model())
+        if self.config.get('val_async', False):
+            self._start_async_validation()
+        else:
+            bleu_score = self._evaluate_model()
+            self.val_bleu_curve.append(bleu_score)
+            self._save_model(bleu_score)
+
+    def _start_async_validation(self):
+        """Takes a snapshot of the current parameters and forks a 
+        process which decodes the dev set with them. The BLEU score is
+        sent back through a pipe.
+        """
+        param_values = self.main_loop.model.get_parameter_values()
+        recv_conn, send_conn = multiprocessing.Pipe(False)
+        process = multiprocessing.Process(
+            target=self._run_async_validation,
+            args=(param_values, send_conn))
+        process.daemon = True
+        process.start()
+        send_conn.close()
+        self.async_validation = (process, recv_conn, param_values)
+        logging.info("Started asynchronous validation in process %d"
+                     % process.pid)
+
+    def _run_async_validation(self, param_values, conn):
+        """Main function of the validation process. """
+        try:
+            self.main_loop.model.set_parameter_values(param_values)
+            conn.send(self._evaluate_model())
+        except Exception as e:
+            logging.error("Asynchronous validation failed: %s" % e)
+            conn.send(None)
+        conn.close()
+
+    def _finish_async_validation(self):
+        """Waits for the running background validation and creates a
+        checkpoint from its parameter snapshot if the BLEU score has 
+        improved.
+        """
+        process, conn, param_values = self.async_validation
+        self.async_validation = None
+        try:
+            bleu_score = conn.recv()
+        except EOFError:
+            bleu_score = None
+        conn.close()
+        process.join()
+        if bleu_score is None:
+            logging.warn("No BLEU score from asynchronous validation")
+            return
+        logging.info("Asynchronous validation BLEU: %f" % bleu_score)
+        self.val_bleu_curve.append(bleu_score)
+        self._save_model(bleu_score, param_values)
+
+    def _get_val_sources(self):
+        """Reads the source sentences of the dev set. """
+        if self.val_sources is None:
+            self.val_sources = [line[0] for line in 
+                                self.data_stream.get_epoch_iterator()]
+            self.data_stream.reset()
+        return self.val_sources
+
+    def _get_batches(self, sources):
+        """Groups the indices of the dev set sentences into batches of
+        at most ``val_batch_size`` sentences with the same length.
+        """
+        batches = []
+        cur_batch = []
+        for idx in sorted(xrange(len(sources)), key=lambda i: len(sources[i])):
+            if cur_batch and (len(cur_batch) >= self.batch_size
+                    or len(sources[cur_batch[0]]) != len(sources[idx])):
+                batches.append(cur_batch)
+                cur_batch = []
+            cur_batch.append(idx)
+        if cur_batch:
+            batches.append(cur_batch)
+        return batches
+
+    def _search_batch(self, seqs):
+        """Runs beam search for a list of source sequences with the
+        same length.
+        
+        Args:
+            seqs (list): Source sentences as dense word representations
+        
+        Returns:
+            list. List of (trans, costs) tuples, one for each sentence
+        """
+        beam_size = self.config['beam_size']
+        if self.src_sparse_feat_map.dim > 1: # sparse src feats
+            input_ = numpy.transpose(
+                         numpy.repeat(numpy.array(seqs), beam_size, axis=0),
+                         (2,0,1))
+        else: # word ids on the source side
+            input_ = numpy.repeat(numpy.array(seqs), beam_size, axis=0)
+        max_length = 3*len(seqs[0])
+        if isinstance(self.beam_search, BatchBeamSearch):
+            return self.beam_search.search(
+                    input_values={self.source_sentence: input_},
+                    n_sentences=len(seqs),
+                    max_length=max_length, eol_symbol=utils.EOS_ID,
+                    ignore_first_eol=True)
+        return [self.beam_search.search(
+                    input_values={self.source_sentence: input_},
+                    max_length=max_length, eol_symbol=utils.EOS_ID,
+                    ignore_first_eol=True)]
 
     def _evaluate_model(self):
-        """Evaluate model and store checkpoints. """
+        """Decodes the dev set and computes the BLEU score. """
         logging.info("Started Validation: ")
         val_start_time = time.time()
-        mb_subprocess = Popen(self.multibleu_cmd, stdin=PIPE, stdout=PIPE)
+        sources = self._get_val_sources()
         total_cost = 0.0
-        ftrans = open(self.config['saveto'] + '/validation_out.txt', 'w')
-        for i, line in enumerate(self.data_stream.get_epoch_iterator()):
-            seq = self.src_sparse_feat_map.words2dense(utils.oov_to_unk(
-                line[0], self.config['src_vocab_size']))
-            if self.src_sparse_feat_map.dim > 1: # sparse src feats
-                input_ = numpy.transpose(
-                             numpy.tile(seq, (self.config['beam_size'], 1, 1)),
-                             (2,0,1))
-            else: # word ids on the source side
-                input_ = numpy.tile(seq, (self.config['beam_size'], 1))
-            # draw sample, checking to ensure we don't get an empty string back
-            trans, costs = \
-                self.beam_search.search(
-                    input_values={self.source_sentence: input_},
-                    max_length=3*len(seq), eol_symbol=utils.EOS_ID,
-                    ignore_first_eol=True)
-            # normalize costs according to the sequence lengths
-            if self.normalize:
-                lengths = numpy.array([len(s) for s in trans])
-                costs = costs / lengths
-
-            nbest_idx = numpy.argsort(costs)[:self.n_best]
-            for j, best in enumerate(nbest_idx):
-                try:
-                    total_cost += costs[best]
-                    trans = trans[best]
-                    if trans and trans[-1] == utils.EOS_ID:
-                        trans = trans[:-1]
-                    trans_out = ' '.join([str(w) for w in trans])
-                except ValueError:
-                    logging.info(
-                        "Can NOT find a translation for line: {}".format(i+1))
-                    trans_out = '<UNK>'
-                if j == 0:
-                    # Write to subprocess and file if it exists
-                    print(trans_out, file=mb_subprocess.stdin)
-                    print(trans_out, file=ftrans)
-            if i != 0 and i % 100 == 0:
-                logging.info(
-                    "Translated {} lines of validation set...".format(i))
-
-            mb_subprocess.stdin.flush()
+        translations = [None] * len(sources)
+        n_translated = 0
+        batches = self._get_batches(sources)
+        if not isinstance(self.beam_search, BatchBeamSearch):
+            batches = [[idx] for batch in batches for idx in batch]
+        for batch in batches:
+            seqs = [self.src_sparse_feat_map.words2dense(utils.oov_to_unk(
+                        sources[idx], self.config['src_vocab_size']))
+                    for idx in batch]
+            for idx, (trans, costs) in zip(batch, self._search_batch(seqs)):
+                # normalize costs according to the sequence lengths
+                if self.normalize:
+                    lengths = numpy.array([len(s) for s in trans])
+                    costs = costs / lengths
+                nbest_idx = numpy.argsort(costs)[:self.n_best]
+                for j, best in enumerate(nbest_idx):
+                    try:
+                        total_cost += costs[best]
+                        best_trans = trans[best]
+                        if best_trans and best_trans[-1] == utils.EOS_ID:
+                            best_trans = best_trans[:-1]
+                        trans_out = ' '.join([str(w) for w in best_trans])
+                    except ValueError:
+                        logging.info("Can NOT find a translation for "
+                                     "line: {}".format(idx+1))
+                        trans_out = '<UNK>'
+                    if j == 0:
+                        translations[idx] = trans_out
+            n_translated += len(batch)
+            if n_translated // 100 != (n_translated - len(batch)) // 100:
+                logging.info("Translated {} lines of validation "
+                             "set...".format(n_translated))
         logging.info("Total cost of the validation: {}".format(total_cost))
-        self.data_stream.reset()
-        ftrans.close()
+        with open(self.config['saveto'] + '/validation_out.txt', 'w') as f:
+            for trans_out in translations:
+                print(trans_out, file=f)
+        if self.multibleu_cmd is None:
+            bleu_score = self._compute_bleu(translations)
+        else:
+            bleu_score = self._compute_bleu_with_script(translations)
+        logging.info("Validation Took: {} minutes".format(
+            float(time.time() - val_start_time) / 60.))
+        logging.info(bleu_score)
+        return bleu_score
+
+    def _compute_bleu(self, translations):
+        """Computes the BLEU score in-process. """
+        bleu = IncrementalBleu()
+        for trans_out, ref in zip(translations, self.references):
+            bleu.add(trans_out.split(), ref)
+        logging.info(str(bleu))
+        return bleu.score()
+
+    def _compute_bleu_with_script(self, translations):
+        """Computes the BLEU score with the external ``bleu_script``. """
+        mb_subprocess = Popen(self.multibleu_cmd, stdin=PIPE, stdout=PIPE)
+        for trans_out in translations:
+            print(trans_out, file=mb_subprocess.stdin)
         # send end of file, read output.
         mb_subprocess.stdin.close()
         stdout = mb_subprocess.stdout.readline()
         logging.info(stdout)
         out_parse = re.match(r'BLEU = [-.0-9]+', stdout)
-        logging.info("Validation Took: {} minutes".format(
-            float(time.time() - val_start_time) / 60.))
         assert out_parse is not None
-        # extract the score
-        bleu_score = float(out_parse.group()[6:])
-        self.val_bleu_curve.append(bleu_score)
-        logging.info(bleu_score)
         mb_subprocess.terminate()
-        return bleu_score
+        # extract the score
+        return float(out_parse.group()[6:])
 
     def _is_valid_to_save(self, bleu_score):
         if not self.best_models or min(self.best_models,
@@ -194,7 +363,11 @@ class BleuValidator(SimpleExtension):
                         for name, param in param_values.items()}
         numpy.savez(path, **param_values)
 
-    def _save_model(self, bleu_score):
+    def _save_model(self, bleu_score, param_values=None):
+        """Creates a checkpoint if ``bleu_score`` is among the n best 
+        scores. If ``param_values`` is given, store these parameters
+        instead of the current parameters of the main loop.
+        """
         if self._is_valid_to_save(bleu_score):
             model = ModelInfo(bleu_score, self.config['saveto'])
             # Manage n-best model list first
@@ -210,7 +383,10 @@ class BleuValidator(SimpleExtension):
             s = signal.signal(signal.SIGINT, signal.SIG_IGN)
             # fs439: introduce store_full_main_loop and 
             # storing best_bleu_params_* files
-            if self.store_full_main_loop:
+            if param_values is not None:
+                logging.info("Saving model parameters {}".format(model.path))
+                self.save_parameter_values(param_values, model.path)
+            elif self.store_full_main_loop:
                 logging.info("Saving full main loop model {}".format(model.path))
                 numpy.savez(model.path, 
                             **self.main_loop.model.get_parameter_dict())
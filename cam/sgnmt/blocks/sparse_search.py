@@ -3,9 +3,10 @@ search with sparse features on the output side. This is significantly
 different from plain word IDs because it requires a cascaded search:
 First, we do beam search to get the n best output vectors. Then, we
 scan the sparse feat map table for the 12 best words given the
-output vectors. In vanilla NMT, the second step is not required because
-the 12 best words directly correspond to the dimensions of the output
-vector.
+output vectors. The second step is done for all vectors in the beam
+with a single batched nearest neighbor query. In vanilla NMT, the
+second step is not required because the 12 best words directly
+correspond to the dimensions of the output vector.
 """
 
 
@@ -63,14 +64,17 @@ class SparseBeamSearch(BeamSearch):
                 break
 
             logprobs = self.compute_logprobs(contexts, states)
-            # Collect n best words
+            # Collect n best words for all active beam entries at once
+            active = [i for i in xrange(len(logprobs)) if all_masks[-1,i]]
+            active_words = self.trg_sparse_feat_map.dense2nwords_batch(
+                                                logprobs[active], beam_size)
             best_words = [] # Format: (beam_idx, word, cost)
-            for i,prob in enumerate(logprobs):
+            for i in xrange(len(logprobs)):
                 base_cost = all_costs[-1,i]
                 if not all_masks[-1,i]: # This one is already finished
                     best_words.append((i, eol_symbol, base_cost))
-                    continue
-                this_words = self.trg_sparse_feat_map.dense2nwords(prob, beam_size)
+            for i,this_words in zip(active, active_words):
+                base_cost = all_costs[-1,i]
                 best_words.extend([(i, w, base_cost + c) for w,c in this_words])
             chosen = sorted(best_words, key=itemgetter(2))[:beam_size]
             indexes = numpy.array([i for (i,w,c) in chosen])
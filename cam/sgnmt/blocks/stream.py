@@ -5,17 +5,21 @@ Blocks code.
 Additionally, this module contains more advanced data sources such as
 ``ParallelTextFile`` for reading a parallel corpus with random access, 
 and the ``ParallelSourceSwitchDataset`` for integrating reinforcement 
-learning methods into the training process.
+learning methods into the training process. ``PrefetchingBatchStream``
+reads memory-mapped corpus stores (see ``cam.sgnmt.misc.corpus``) and
+builds padded mini-batches in a background process.
 """
 
 from __future__ import print_function
 
 from abc import abstractmethod
+import atexit
 from blocks.extensions import SimpleExtension
 import datetime
 from fuel.transformers import Padding
 import logging
 import math
+import multiprocessing
 import numpy
 import os
 import random
@@ -25,10 +29,14 @@ import sys
 import time
 
 from fuel.datasets import Dataset
+from fuel.streams import AbstractDataStream
+from theano import config
 
 from cam.sgnmt import utils
 from cam.sgnmt.blocks.nmt import get_nmt_model_path_params
 from cam.sgnmt.blocks.vanilla_decoder import BlocksNMTVanillaDecoder
+from cam.sgnmt.misc.arraystore import is_array_store
+from cam.sgnmt.misc.corpus import CorpusStore
 from cam.sgnmt.misc.sparse import FlatSparseFeatMap
 
 
@@ -115,10 +123,55 @@ _backtrans_decoder = None
 the main loop iteration state cannot be pickled
 """
 
+
+BACKTRANS_LOG_BUFFER_SIZE = 100
+"""Number of back-translations which are buffered before they are
+written to the log file of ``BacktranslatedParallelSource``.
+"""
+
+
+def _backtranslation_worker(source, task_queue, result_queue, model_version):
+    """Main function of the background processes of
+    ``BacktranslatedParallelSource``. Reads indices of target sentences
+    from ``task_queue`` and writes (index, back-translation) tuples to 
+    ``result_queue``. The back-translation is None if decoding failed.
+    The worker (re)loads its own copy of the NMT model whenever 
+    ``model_version`` changes. A None task stops the worker.
+    
+    Args:
+        source (BacktranslatedParallelSource): The data source
+        task_queue (Queue): Indices of sentences to translate
+        result_queue (Queue): Queue for the back-translations
+        model_version (Value): Shared version of the NMT model
+    """
+    loaded_version = -1
+    while True:
+        idx = task_queue.get()
+        if idx is None:
+            break
+        try:
+            if loaded_version != model_version.value:
+                loaded_version = model_version.value
+                source._load_nmt()
+            src_sen = source.backtranslate(source.trg_sentences[idx])
+        except Exception as e:
+            logging.error("An %s error has occurred while back-translating "
+                          "sentence %d: %s" % (sys.exc_info()[0], idx, e))
+            src_sen = None
+        result_queue.put((idx, src_sen))
+
+
 class BacktranslatedParallelSource(ParallelSource):
     """This data source is based on monolingual target data. The source
     sentences are translated from the target sentence like described by
     Senrich et al., 2015.
+    
+    If ``n_workers`` is positive, back-translation is done ahead of 
+    time by a pool of background processes, each of which holds its
+    own copy of the back-translating NMT model. This keeps the main
+    loop busy with training while the workers decode. Note that the
+    workers are forked, so they should only be used with CPU decoding
+    or if Theano has not initialized the GPU in the parent process.
     """
     
     def __init__(self, 
@@ -127,7 +180,9 @@ class BacktranslatedParallelSource(ParallelSource):
                  store_trans=None, 
                  max_same_word=0.3,
                  reload_frequency=0,
-                 old_backtrans_src=None):
+                 old_backtrans_src=None,
+                 n_workers=0,
+                 queue_size=100):
         """Creates a new back translating data source.
         
         Args:
@@ -155,17 +210,46 @@ class BacktranslatedParallelSource(ParallelSource):
             old_backtrans_src (OldBacktranslatedParallelSource):
                         Instance of ``OldBacktranslatedParallelSource``
                         to send the backtranslated sentences to
+            n_workers (int): Number of background processes for
+                             back-translation. If this is 0, translate
+                             synchronously in ``next``
+            queue_size (int): Maximum number of sentences which are
+                              back-translated ahead of time by the 
+                              background processes
         """
         self.trg_sentences = trg_sentences
         self.nmt_config = nmt_config
         self.seq_len = nmt_config['seq_len']
         self.log_file = store_trans
+        self.log_buffer = []
         self.max_same_word = max_same_word
         self.reload_frequency = reload_frequency
         self.old_backtrans_src = old_backtrans_src
         self.shuffler = Reshuffler(0, len(trg_sentences))
         self.get_count = 0
-        self._load_nmt()
+        self.workers = []
+        if n_workers > 0:
+            self._start_workers(n_workers, max(queue_size, n_workers))
+        else:
+            self._load_nmt()
+        atexit.register(self.close)
+    
+    def _start_workers(self, n_workers, queue_size):
+        """Starts the background processes for back-translation. """
+        self.queue_size = queue_size
+        self.n_pending = 0
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.model_version = multiprocessing.Value('i', 0)
+        for _ in xrange(n_workers):
+            worker = multiprocessing.Process(
+                target=_backtranslation_worker,
+                args=(self, self.task_queue, self.result_queue, 
+                      self.model_version))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        logging.info("Started %d back-translation workers" % n_workers)
     
     def next(self):
         """Emits the target sentences in random order with the
@@ -177,13 +261,19 @@ class BacktranslatedParallelSource(ParallelSource):
         if self.reload_frequency > 0:
             self.get_count += 1
             if self.get_count % self.reload_frequency == 0:
-                self._load_nmt()
-        idx = self.shuffler.next()
-        trg_sen = self.trg_sentences[idx]
-        # TODO: Should be in conf
-        if len(trg_sen) > self.seq_len:
-            return self.next()
-        src_sen = self.backtranslate(trg_sen)
+                self._reload_nmt()
+        if self.workers:
+            idx, src_sen = self._get_async_backtranslation()
+            if src_sen is None:
+                return self.next()
+            trg_sen = self.trg_sentences[idx]
+        else:
+            idx = self.shuffler.next()
+            trg_sen = self.trg_sentences[idx]
+            # TODO: Should be in conf
+            if len(trg_sen) > self.seq_len:
+                return self.next()
+            src_sen = self.backtranslate(trg_sen)
         # Sanity check
         counts = {}
         for w in src_sen:
@@ -196,17 +286,51 @@ class BacktranslatedParallelSource(ParallelSource):
             return self.next() 
         # Write to file
         if self.log_file:
-            with open(self.log_file, "a") as f:
-                f.write("%d ||| %s ||| %s ||| %s\n" % (
+            self.log_buffer.append("%d ||| %s ||| %s ||| %s\n" % (
                                      idx,
                                      datetime.datetime.now(),
                                      ' '.join([str(w) for w in src_sen]),
                                      ' '.join([str(w) for w in trg_sen])))
+            if len(self.log_buffer) >= BACKTRANS_LOG_BUFFER_SIZE:
+                self.flush_log()
         # Send to old backtranslated data source
         if self.old_backtrans_src:
             self.old_backtrans_src.add(idx, src_sen, trg_sen)
         return (src_sen, trg_sen)
     
+    def _get_async_backtranslation(self):
+        """Fills up the task queue of the background processes and 
+        fetches the next back-translation from the result queue.
+        
+        Returns:
+            tuple. (idx, src_sen) tuple with the index of the target
+            sentence and its back-translation (None if failed)
+        """
+        while self.n_pending < self.queue_size:
+            idx = self.shuffler.next()
+            # TODO: Should be in conf
+            if len(self.trg_sentences[idx]) <= self.seq_len:
+                self.task_queue.put(idx)
+                self.n_pending += 1
+        result = self.result_queue.get()
+        self.n_pending -= 1
+        return result
+    
+    def flush_log(self):
+        """Writes buffered back-translations to the log file. """
+        if self.log_buffer:
+            with open(self.log_file, "a") as f:
+                f.write(''.join(self.log_buffer))
+            self.log_buffer = []
+    
+    def close(self):
+        """Flushes the log file and stops the background processes. """
+        self.flush_log()
+        if self.workers:
+            for _ in self.workers:
+                self.task_queue.put(None)
+            self.workers = []
+    
     def backtranslate(self, trg_sentence):
         """Translates a sentence from the target language back into the
         source language.
@@ -228,6 +352,20 @@ class BacktranslatedParallelSource(ParallelSource):
             hypos.sort(key=lambda hypo: hypo.total_score, reverse=True)
         s = hypos[0].trgt_sentence
         return s if s and s[-1] == utils.EOS_ID else (s + [utils.EOS_ID])        
+    
+    def _reload_nmt(self):
+        """Reloads the back-translating NMT model. If background
+        processes are used, they are signalled to reload their models
+        before translating the next sentence. Sentences which are 
+        already in the queue may still be translated with the old
+        model.
+        """
+        self.flush_log()
+        if self.workers:
+            with self.model_version.get_lock():
+                self.model_version.value += 1
+        else:
+            self._load_nmt()
         
     def _load_nmt(self):
         """Loads the back-translating NMT model. """
@@ -591,7 +729,10 @@ class SourceSwitchController(SimpleExtension):
 def load_sentences_from_file(path, vocab_size):
     """Loads sentences from a plain text file. For each sentence we add
     </S> (but not <S>) as expected by the data stream pipeline. Tokens 
-    larger than ``vocab_size`` are replaced by the UNK id.
+    larger than ``vocab_size`` are replaced by the UNK id. If ``path``
+    points to a corpus store created with ``cam.sgnmt.misc.corpus``,
+    return a ``CorpusStore`` which provides the same list interface
+    but keeps the sentences memory-mapped.
      
     Args:
         path(string): Path to the text file
@@ -606,6 +747,8 @@ def load_sentences_from_file(path, vocab_size):
         IOError. If the file could not be read
         ValueError. If the text file contains non-integer tokens
     """
+    if is_array_store(path):
+        return CorpusStore(path, vocab_size)
     sens = []
     with open(path) as f:
         for line in f:
@@ -758,6 +901,241 @@ class ParallelTextFile(Dataset):
                       _current_trg_sparse_feat_map)
              
 
+def _build_batches(src_corpus,
+                   trg_corpus,
+                   seq_len,
+                   batch_size,
+                   sort_k_batches,
+                   shuffle,
+                   seed,
+                   skip,
+                   slots,
+                   free_slots,
+                   ready_batches):
+    """Main function of the batch builder process of 
+    ``PrefetchingBatchStream``. This corresponds to the Fuel pipeline in
+    ``_get_sgnmt_tr_stream`` in ``train``: Sentence pairs longer than
+    ``seq_len`` are removed, ``sort_k_batches`` batches are read ahead
+    and sorted by target length, and then split into batches. Batches
+    are padded with zeros and written into free shared memory slots.
+    Their slot index and sentence lengths are sent through
+    ``ready_batches``. None signals the end of the epoch.
+    
+    Args:
+        src_corpus (CorpusStore): Source sentences
+        trg_corpus (CorpusStore): Target sentences
+        seq_len (int): Maximum sentence length (including </S>)
+        batch_size (int): Number of sentence pairs per batch
+        sort_k_batches (int): Number of batches to sort at once
+        shuffle (bool): Whether to shuffle the corpus
+        seed (int): Random seed for shuffling
+        skip (int): Number of batches to skip at the beginning
+        slots (list): List of (src, trg) tuples of shared arrays
+        free_slots (Queue): Indices of free slots
+        ready_batches (Queue): Slot indices and lengths of batches
+    """
+    src_lengths = src_corpus.lengths + 1
+    trg_lengths = trg_corpus.lengths + 1
+    if shuffle:
+        order = numpy.random.RandomState(seed).permutation(len(trg_corpus))
+    else:
+        order = numpy.arange(len(trg_corpus))
+    order = order[(src_lengths[order] <= seq_len)
+                  & (trg_lengths[order] <= seq_len)]
+    chunk_size = batch_size * sort_k_batches
+    batch_idx = 0
+    for chunk_start in xrange(0, len(order), chunk_size):
+        chunk = order[chunk_start:chunk_start+chunk_size]
+        chunk = chunk[numpy.argsort(trg_lengths[chunk], kind='mergesort')]
+        for batch_start in xrange(0, len(chunk), batch_size):
+            batch_idx += 1
+            if batch_idx <= skip:
+                continue
+            batch = chunk[batch_start:batch_start+batch_size]
+            slot = free_slots.get()
+            lengths = []
+            for corpus, corpus_lengths, buf in [
+                    (src_corpus, src_lengths, slots[slot][0]),
+                    (trg_corpus, trg_lengths, slots[slot][1])]:
+                batch_lengths = corpus_lengths[batch]
+                padded = numpy.frombuffer(buf, dtype=numpy.int32)[
+                    :len(batch)*batch_lengths.max()].reshape(
+                        (len(batch), batch_lengths.max()))
+                padded[:] = 0
+                for i, idx in enumerate(batch):
+                    padded[i, :batch_lengths[i]] = corpus.get_ids(idx)
+                lengths.append(batch_lengths)
+            ready_batches.put((slot, lengths[0], lengths[1]))
+    ready_batches.put(None)
+
+
+class PrefetchingBatchStream(AbstractDataStream):
+    """This data stream replaces the Fuel pipeline in 
+    ``_get_sgnmt_tr_stream`` for corpora in the ``CorpusStore`` format.
+    The sentences are not loaded into memory but stay memory-mapped.
+    Batches are built by a background process which filters, sorts,
+    and pads them ahead of time and writes them into a ring of shared
+    memory slots, so the main loop does not stall on data loading. The
+    stream produces the same sources as ``PaddingWithEOS``. Note that
+    only plain word ids are supported, i.e. no sparse feature maps.
+    
+    When pickled, only the configuration and the position in the 
+    current epoch are stored. The batch builder is restarted after 
+    unpickling and skips the batches which have been consumed already.
+    """
+    
+    def __init__(self,
+                 src_store,
+                 trg_store,
+                 src_vocab_size=30000,
+                 trg_vocab_size=30000,
+                 seq_len=50,
+                 batch_size=80,
+                 sort_k_batches=12,
+                 shuffle=True,
+                 n_slots=20):
+        """Creates a new prefetching stream and starts the batch 
+        builder for the first epoch.
+        
+        Args:
+            src_store (string): Path to the source corpus store
+            trg_store (string): Path to the target corpus store
+            src_vocab_size (int): Size of source vocabulary
+            trg_vocab_size (int): Size of target vocabulary
+            seq_len (int): Sentence pairs longer than this (including
+                           </S>) are discarded
+            batch_size (int): Number of sentence pairs per batch
+            sort_k_batches (int): Number of batches which are read 
+                                  ahead and sorted by length
+            shuffle (bool): Shuffle the corpus in each epoch
+            n_slots (int): Maximum number of batches in shared memory
+        """
+        super(PrefetchingBatchStream, self).__init__()
+        self.sources = ('source', 'source_mask', 'target', 'target_mask')
+        self.src_store = src_store
+        self.trg_store = trg_store
+        self.src_vocab_size = src_vocab_size
+        self.trg_vocab_size = trg_vocab_size
+        self.seq_len = seq_len
+        self.batch_size = batch_size
+        self.sort_k_batches = sort_k_batches
+        self.shuffle = shuffle
+        self.n_slots = max(1, n_slots)
+        self.epoch_started = False
+        self.seed = random.randint(0, 2**31 - 1)
+        self.n_consumed = 0
+        self._start_builder()
+    
+    def _start_builder(self):
+        """Starts the batch builder process for the current epoch. """
+        src_corpus = CorpusStore(self.src_store, self.src_vocab_size)
+        trg_corpus = CorpusStore(self.trg_store, self.trg_vocab_size)
+        if len(src_corpus) != len(trg_corpus):
+            raise ValueError("Corpus stores %s and %s have different sizes"
+                             % (self.src_store, self.trg_store))
+        slot_size = self.batch_size * self.seq_len
+        self.slots = [(multiprocessing.RawArray('i', slot_size),
+                       multiprocessing.RawArray('i', slot_size))
+                      for _ in xrange(self.n_slots)]
+        self.free_slots = multiprocessing.Queue()
+        for slot in xrange(self.n_slots):
+            self.free_slots.put(slot)
+        self.ready_batches = multiprocessing.Queue()
+        self.builder = multiprocessing.Process(
+            target=_build_batches,
+            args=(src_corpus, trg_corpus, self.seq_len, self.batch_size,
+                  self.sort_k_batches, self.shuffle, self.seed, 
+                  self.n_consumed, self.slots, self.free_slots, 
+                  self.ready_batches))
+        self.builder.daemon = True
+        self.builder.start()
+        self.epoch_finished = False
+    
+    def _stop_builder(self):
+        """Terminates the batch builder process. The queues may be left
+        in an inconsistent state, so they are discarded without waiting
+        for pending data to be flushed.
+        """
+        if self.builder is not None:
+            self.builder.terminate()
+            self.builder.join()
+            self.builder = None
+            self.free_slots.cancel_join_thread()
+            self.ready_batches.cancel_join_thread()
+    
+    def get_data(self, request=None):
+        """Get the next batch from the batch builder.
+        
+        Returns:
+            tuple. Padded source, source mask, padded target, and
+            target mask
+        
+        Raises:
+            StopIteration. At the end of the epoch
+        """
+        if request is not None:
+            raise ValueError
+        if self.epoch_finished:
+            raise StopIteration
+        item = self.ready_batches.get()
+        if item is None:
+            self.epoch_finished = True
+            raise StopIteration
+        slot, src_lengths, trg_lengths = item
+        batch = []
+        for buf, lengths in [(self.slots[slot][0], src_lengths),
+                             (self.slots[slot][1], trg_lengths)]:
+            max_len = lengths.max()
+            padded = numpy.frombuffer(buf, dtype=numpy.int32)[
+                :len(lengths)*max_len].reshape((len(lengths), max_len))
+            batch.append(padded.astype(numpy.int64))
+            batch.append((numpy.arange(max_len)[None, :] 
+                          < lengths[:, None]).astype(config.floatX))
+        self.free_slots.put(slot)
+        self.n_consumed += 1
+        return tuple(batch)
+    
+    def get_epoch_iterator(self, **kwargs):
+        """Starts a new epoch if the current one has been used 
+        already.
+        """
+        if self.epoch_started:
+            self.next_epoch()
+        self.epoch_started = True
+        return super(PrefetchingBatchStream, self).get_epoch_iterator(
+                                                                    **kwargs)
+    
+    def next_epoch(self):
+        """Restarts the batch builder with a new random seed. """
+        self._stop_builder()
+        self.seed = random.randint(0, 2**31 - 1)
+        self.n_consumed = 0
+        self._start_builder()
+    
+    def reset(self):
+        """Restarts the current epoch from the beginning. """
+        self._stop_builder()
+        self.n_consumed = 0
+        self._start_builder()
+    
+    def close(self):
+        """Stops the batch builder. """
+        self._stop_builder()
+    
+    def __getstate__(self):
+        """Return state values to be pickled."""
+        d = dict(self.__dict__)
+        for key in ['slots', 'free_slots', 'ready_batches', 'builder',
+                    'epoch_finished']:
+            del d[key]
+        return d
+
+    def __setstate__(self, state):
+        """Restore state and restart the batch builder. """
+        self.__dict__.update(state)
+        self._start_builder()
+
+
 # Beyond this point is code copied from the machine_translation.stream
 # module in blocks-examples.
 
@@ -45,7 +45,8 @@ from fuel.streams import DataStream
 from cam.sgnmt import utils
 from cam.sgnmt.blocks import stream
 from cam.sgnmt.blocks.pruning import PruningGradientDescent
-from cam.sgnmt.blocks.checkpoint import CheckpointNMT, LoadNMT
+from cam.sgnmt.blocks.checkpoint import CheckpointNMT, LoadNMT, \
+                                        SaveLoadUtils
 from cam.sgnmt.blocks.model import NMTModel
 from cam.sgnmt.blocks.nmt import blocks_get_default_nmt_config
 from cam.sgnmt.blocks.sampling import BleuValidator
@@ -55,6 +56,7 @@ from cam.sgnmt.blocks.stream import ParallelSourceSwitchDataset, \
                                     BacktranslatedParallelSource, \
                                     MergedParallelSource, \
                                     OldBacktranslatedParallelSource
+from cam.sgnmt.misc.corpus import get_corpus_store
 from cam.sgnmt.misc.sparse import FileBasedFeatMap
 from cam.sgnmt.blocks.nmt import get_blocks_train_parser
 
@@ -126,6 +128,8 @@ def _get_dataset_with_mono(mono_data_integration='exp3s',
                            min_parallel_data=0.2,
                            backtrans_reload_frequency=0,
                            backtrans_max_same_word=0.3,
+                           backtrans_workers=0,
+                           backtrans_queue_size=100,
                            src_data='',
                            trg_data='',
                            src_mono_data='',
@@ -164,13 +168,18 @@ def _get_dataset_with_mono(mono_data_integration='exp3s',
                                                      backtrans_file,
                                                      backtrans_max_same_word,
                                                      backtrans_reload_frequency,
-                                                     old_backtrans_src)
+                                                     old_backtrans_src,
+                                                     backtrans_workers,
+                                                     backtrans_queue_size)
     else:
         backtrans_src = BacktranslatedParallelSource(trg_mono_sens,
                                                      backtrans_config,
                                                      None,
                                                      backtrans_max_same_word,
-                                                     backtrans_reload_frequency)
+                                                     backtrans_reload_frequency,
+                                                     None,
+                                                     backtrans_workers,
+                                                     backtrans_queue_size)
 
     if min_parallel_data > 0.0:
         if add_mono_dummy_data:
@@ -249,6 +258,34 @@ def _get_text_stream(src_data,
                    ('source', 'target'))
 
 
+def _get_prefetching_stream(src_data,
+                            trg_data,
+                            src_vocab_size=30000,
+                            trg_vocab_size=30000,
+                            seq_len=50,
+                            batch_size=80,
+                            sort_k_batches=12,
+                            shuffle=True,
+                            n_slots=20,
+                            **kwargs):
+    """Creates a ``PrefetchingBatchStream`` for the training data. The
+    text files are converted to memory-mapped corpus stores first if 
+    necessary. The returned stream replaces the output of 
+    ``_get_sgnmt_tr_stream``.
+    
+    The arguments to this method are given by the configuration dict.
+    """
+    return stream.PrefetchingBatchStream(get_corpus_store(src_data),
+                                         get_corpus_store(trg_data),
+                                         src_vocab_size,
+                                         trg_vocab_size,
+                                         seq_len=seq_len,
+                                         batch_size=batch_size,
+                                         sort_k_batches=sort_k_batches,
+                                         shuffle=shuffle,
+                                         n_slots=n_slots)
+
+
 def _get_sgnmt_dev_stream(val_set=None,
                           src_vocab=None,
                           src_vocab_size=30000,
@@ -329,6 +366,9 @@ def main(config,
         Printing(after_batch=True),
         CheckpointNMT(config['saveto'], 
                       slim_iteration_state, 
+                      background=config['checkpoint_background'],
+                      keep_checkpoints=config['keep_checkpoints'],
+                      param_format=config['checkpoint_format'],
                       every_n_batches=config['save_freq'])
     ]
 
@@ -342,7 +382,8 @@ def main(config,
                           model=nmt_model.search_model, data_stream=dev_stream,
                           normalize=config['normalized_bleu'],
                           store_full_main_loop=config['store_full_main_loop'],
-                          every_n_batches=config['bleu_val_freq']))
+                          every_n_batches=config['bleu_val_freq'],
+                          after_training=config['val_async']))
 
     if switch_controller:
         switch_controller.beam_search = BeamSearch(samples=nmt_model.samples)
@@ -427,6 +468,11 @@ def main(config,
 
     # Train!
     main_loop.run()
+    if args.prune_every > 0 and args.prune_shrink_output:
+        logging.info("Storing shrunk model at %s" % args.prune_shrink_output)
+        SaveLoadUtils().save_parameter_values(
+            algorithm.get_shrunk_parameter_values(),
+            args.prune_shrink_output)
 
 
 # MAIN CODE STARTS HERE
@@ -451,15 +497,25 @@ if configuration['trg_sparse_feat_map']:
 
 # Get data streams and start building the blocks main loop
 switch_controller = None
+tr_stream = None
 if args.mono_data_integration != 'none':
     logging.fatal("Could not find policy %s" % args.mono_data_integration)
+elif args.binary_corpus:
+    if (configuration['src_sparse_feat_map'] 
+            or configuration['trg_sparse_feat_map']):
+        logging.fatal("--binary_corpus does not support sparse feature maps")
+    tr_stream = _get_prefetching_stream(shuffle=args.reshuffle,
+                                        n_slots=args.prefetch_batches,
+                                        **configuration)
 elif args.reshuffle:
     configuration['data_stream'] = _get_shuffled_text_stream(**configuration)
 else:
     configuration['data_stream'] = _get_text_stream(**configuration)
+if tr_stream is None:
+    tr_stream = _get_sgnmt_tr_stream(**configuration)
     
 main(configuration,
-     _get_sgnmt_tr_stream(**configuration),
+     tr_stream,
      _get_sgnmt_dev_stream(**configuration),
      args.bokeh,
      args.slim_iteration_state,
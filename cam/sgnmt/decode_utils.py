@@ -10,6 +10,8 @@ to learn how to use this module.
 
 import logging
 import codecs
+import collections
+import itertools
 import sys
 import time
 import traceback
@@ -25,10 +27,12 @@ from cam.sgnmt.predictors.parse import ParsePredictor, TokParsePredictor, \
                                        BpeParsePredictor
 from cam.sgnmt.decoding import combination
 from cam.sgnmt.decoding.astar import AstarDecoder
+from cam.sgnmt.decoding.batchbeam import BatchBeamDecoder
 from cam.sgnmt.decoding.beam import BeamDecoder
 from cam.sgnmt.decoding.bigramgreedy import BigramGreedyDecoder
 from cam.sgnmt.decoding.bow import BOWDecoder
-from cam.sgnmt.decoding.bucket import BucketDecoder
+from cam.sgnmt.decoding.bucket import BucketDecoder, BucketWorker, \
+    ParallelBucketDecoder
 from cam.sgnmt.decoding.core import UnboundedVocabularyPredictor
 from cam.sgnmt.decoding.core import Hypothesis
 from cam.sgnmt.decoding.dfs import DFSDecoder
@@ -73,6 +77,10 @@ from cam.sgnmt.predictors.vocabulary import IdxmapPredictor, \
                                             UnkvocabPredictor, \
                                             SkipvocabPredictor
 from cam.sgnmt.predictors.ngram import SRILMPredictor, KenLMPredictor
+from cam.sgnmt.predictors.synthetic import SyntheticDensePredictor, \
+                                           SyntheticSparsePredictor, \
+                                           SyntheticUnboundedPredictor, \
+                                           SyntheticFstPredictor
 from cam.sgnmt.predictors.tf_t2t import T2TPredictor, FertilityT2TPredictor
 from cam.sgnmt.predictors.tf_nizza import NizzaPredictor, LexNizzaPredictor
 from cam.sgnmt.predictors.tokenization import Word2charPredictor, FSTTokPredictor
@@ -269,7 +277,8 @@ def add_predictors(decoder):
                                  t2t_unk_id=_get_override_args("t2t_unk_id"),
                                  single_cpu_thread=args.single_cpu_thread,
                                  max_terminal_id=args.syntax_max_terminal_id,
-                                 pop_id=args.syntax_pop_id)
+                                 pop_id=args.syntax_pop_id,
+                                 batch_predictions=(args.sentence_batch > 1))
             elif pred == "fertt2t":
                 p = FertilityT2TPredictor(
                                  _get_override_args("pred_src_vocab_size"),
@@ -341,7 +350,8 @@ def add_predictors(decoder):
                                  args.normalize_rtn_weights,
                                  to_log=args.fst_to_log,
                                  minimize_rtns=args.minimize_rtns,
-                                 rmeps=args.remove_epsilon_in_rtns)
+                                 rmeps=args.remove_epsilon_in_rtns,
+                                 cache_size=args.rtn_cache_size)
             elif pred == "srilm":
                 p = SRILMPredictor(args.lm_path, 
                                    _get_override_args("ngramc_order"),
@@ -349,7 +359,10 @@ def add_predictors(decoder):
             elif pred == "kenlm":
                 p = KenLMPredictor(args.lm_path)
             elif pred == "nplm":
-                p = NPLMPredictor(args.nplm_path, args.normalize_nplm_probs)
+                p = NPLMPredictor(args.nplm_path,
+                                  args.normalize_nplm_probs,
+                                  args.nplm_cache_size,
+                                  args.nplm_max_candidates)
             elif pred == "rnnlm":
                 p = tf_get_rnnlm_predictor(_get_override_args("rnnlm_path"),
                                            _get_override_args("rnnlm_config"),
@@ -364,7 +377,8 @@ def add_predictors(decoder):
             elif pred == "ngramc":
                 p = NgramCountPredictor(_get_override_args("ngramc_path"),
                                         _get_override_args("ngramc_order"),
-                                        args.ngramc_discount_factor)
+                                        args.ngramc_discount_factor,
+                                        args.ngramc_cache_size)
             elif pred == "unkc":
                 p = UnkCountPredictor(
                      _get_override_args("pred_src_vocab_size"), 
@@ -378,6 +392,29 @@ def add_predictors(decoder):
                                       args.length_model_offset)
             elif pred == "extlength":
                 p = ExternalLengthPredictor(args.extlength_path)
+            elif pred == "synthdense":
+                p = SyntheticDensePredictor(
+                                _get_override_args("pred_trg_vocab_size"),
+                                args.synthetic_seed + idx,
+                                args.synthetic_latency)
+            elif pred == "synthsparse":
+                p = SyntheticSparsePredictor(
+                                _get_override_args("pred_trg_vocab_size"),
+                                args.synthetic_active_words,
+                                args.synthetic_seed + idx,
+                                args.synthetic_latency)
+            elif pred == "synthunbounded":
+                p = SyntheticUnboundedPredictor(
+                                _get_override_args("pred_trg_vocab_size"),
+                                args.synthetic_seed + idx,
+                                args.synthetic_latency)
+            elif pred == "synthfst":
+                p = SyntheticFstPredictor(
+                                _get_override_args("pred_trg_vocab_size"),
+                                args.synthetic_fst_states,
+                                args.synthetic_active_words,
+                                args.synthetic_seed + idx,
+                                args.synthetic_latency)
             elif pred == "lrhiero":
                 fw = None
                 if args.grammar_feature_weights:
@@ -467,7 +504,8 @@ def add_predictors(decoder):
                     p = SkipvocabPredictor(args.skipvocab_max_id, 
                                            args.skipvocab_stop_size, 
                                            args.beam, 
-                                           p)
+                                           p,
+                                           args.skipvocab_cache_size)
                 elif wrapper == "fsttok":
                     fsttok_path = _get_override_args("fsttok_path")
                     # fsttok always wraps unbounded predictors
@@ -536,7 +574,13 @@ def create_decoder():
         if args.decoder == "greedy":
             decoder = GreedyDecoder(args)
         elif args.decoder == "beam":
-            decoder = BeamDecoder(args)
+            # The MoE network is evaluated once per beam step in the
+            # batch beam decoder, even for a single sentence
+            if (args.sentence_batch > 1 
+                    or "moe" in args.interpolation_strategy):
+                decoder = BatchBeamDecoder(args)
+            else:
+                decoder = BeamDecoder(args)
         elif args.decoder == "multisegbeam":
             decoder = MultisegBeamDecoder(args,
                                           args.hypo_recombination,
@@ -563,7 +607,10 @@ def create_decoder():
                                         args.low_decoder_memory,
                                         args.restarting_node_score,
                                         args.stochastic_decoder,
-                                        args.decode_always_single_step)
+                                        args.decode_always_single_step,
+                                        args.max_node_children,
+                                        args.node_state_interval,
+                                        args.max_open_nodes)
         elif args.decoder == "bow":
             decoder = BOWDecoder(args)
         elif args.decoder == "flip":
@@ -571,18 +618,21 @@ def create_decoder():
         elif args.decoder == "bigramgreedy":
             decoder = BigramGreedyDecoder(args)
         elif args.decoder == "bucket":
-            decoder = BucketDecoder(args,
-                                    args.hypo_recombination,
-                                    args.max_node_expansions,
-                                    args.low_decoder_memory,
-                                    args.beam,
-                                    args.pure_heuristic_scores,
-                                    args.decoder_diversity_factor,
-                                    args.early_stopping,
-                                    args.stochastic_decoder,
-                                    args.bucket_selector,
-                                    args.bucket_score_strategy,
-                                    args.collect_statistics)
+            bucket_decoder_class = BucketDecoder
+            if args.bucket_workers > 1:
+                bucket_decoder_class = ParallelBucketDecoder
+            decoder = bucket_decoder_class(args,
+                                           args.hypo_recombination,
+                                           args.max_node_expansions,
+                                           args.low_decoder_memory,
+                                           args.beam,
+                                           args.pure_heuristic_scores,
+                                           args.decoder_diversity_factor,
+                                           args.early_stopping,
+                                           args.stochastic_decoder,
+                                           args.bucket_selector,
+                                           args.bucket_score_strategy,
+                                           args.collect_statistics)
         elif args.decoder == "astar":
             decoder = AstarDecoder(args)
         elif args.decoder == "vanilla":
@@ -598,10 +648,20 @@ def create_decoder():
                                             traceback.format_exc()))
     if decoder is None:
         sys.exit("Could not initialize decoder.")
+    if args.sentence_batch > 1 and not isinstance(decoder, BatchBeamDecoder):
+        logging.warn("--sentence_batch is only supported by the beam "
+                     "decoder. Decoding sentences one by one.")
     add_predictors(decoder)
     # Add heuristics for search strategies like A*
     if args.heuristics:
         add_heuristics(decoder)
+    if isinstance(decoder, ParallelBucketDecoder):
+        for _ in xrange(args.bucket_workers - 1):
+            worker = BucketWorker(args)
+            add_predictors(worker)
+            if args.heuristics:
+                add_heuristics(worker)
+            decoder.add_worker(worker)
     return decoder
 
 
@@ -823,12 +883,192 @@ def _generate_dummy_hypo(predictors):
     return Hypothesis([utils.UNK_ID], 0.0, [[(0.0, w) for _, w in predictors]]) 
 
 
+def _get_src_sentence(decoder, src_sentences, sen_idx):
+    """Reads the source sentence with index ``sen_idx`` and applies
+    the source word map. If --per_sentence_predictor_weights is set,
+    this also changes the predictor weights of ``decoder``.
+
+    Args:
+        decoder (Decoder):  Current decoder instance
+        src_sentences (list):  Source sentences, see ``do_decode()``
+        sen_idx (int): Sentence index
+
+    Returns:
+        list. Source sentence as list of word IDs
+    """
+    if src_sentences is False:
+        src = "0"
+        logging.info("Next sentence (ID: %d)" % (sen_idx + 1))
+    else:
+        src = src_sentences[sen_idx]
+    if len(src) > 0 and args.per_sentence_predictor_weights:
+        # change predictor weights per-sentence
+        weights = src[-1].split(',')
+        if len(weights) > 1:
+            weights = [float(x) for x in weights]
+            src = src[:-1]
+            logging.info('Changing predictor weights to {}'.format(
+                weights))
+            decoder.change_predictor_weights(weights)
+        else:
+            logging.info(
+                'No weights read in {} - leaving unchanged'.format(
+                    src))
+    logging.info("Next sentence (ID: %d): %s" % (sen_idx + 1, ' '.join(src)))
+    src = [int(x) for x in src]
+    return utils.apply_src_wmap(src)
+
+
+def _process_hypos(decoder, sen_idx, hypos, num_expansions, decoding_time):
+    """Applies --min_score, postprocessing, and character maps to the
+    full hypotheses for a sentence and logs decoding statistics.
+
+    Args:
+        decoder (Decoder):  Current decoder instance
+        sen_idx (int): Sentence index
+        hypos (list): Full hypotheses returned by the decoder
+        num_expansions (int): Number of node expansions
+        decoding_time (float): Time needed to decode the sentence
+
+    Returns:
+        list. Processed hypotheses
+    """
+    hypos = [hypo for hypo in hypos if hypo.total_score > args.min_score]
+    if not hypos:
+        logging.error("No translation found for ID %d!" % (sen_idx+1))
+        logging.info("Stats (ID: %d): score=<not-found> "
+                 "num_expansions=%d "
+                 "time=%.2f" % (sen_idx+1,
+                                num_expansions,
+                                decoding_time))
+        hypos = [_generate_dummy_hypo(decoder.predictors)]
+    hypos = _postprocess_complete_hypos(hypos)
+    if utils.trg_cmap:
+        hypos = [h.convert_to_char_level(utils.trg_cmap) for h in hypos]
+    logging.info("Decoded (ID: %d): %s" % (
+            sen_idx+1,
+            utils.apply_trg_wmap(hypos[0].trgt_sentence, 
+                                 {} if utils.trg_cmap else utils.trg_wmap)))
+    logging.info("Stats (ID: %d): score=%f "
+                 "num_expansions=%d "
+                 "time=%.2f" % (sen_idx+1,
+                                hypos[0].total_score,
+                                num_expansions,
+                                decoding_time))
+    return hypos
+
+
+def _log_decoding_error(sen_idx, e):
+    """Logs an exception which occurred while decoding the sentence
+    with index ``sen_idx``.
+    """
+    if isinstance(e, ValueError):
+        logging.error("Number format error at sentence id %d: %s, "
+                      "Stack trace: %s" % (sen_idx+1, 
+                                           e,
+                                           traceback.format_exc()))
+    elif isinstance(e, AttributeError):
+        logging.fatal("Attribute error at sentence id %d: %s. This often "
+                      "indicates an error in the predictor configuration "
+                      "which could not be detected in initialisation. "
+                      "Stack trace: %s" 
+                      % (sen_idx+1, e, traceback.format_exc()))
+    else:
+        logging.error("An unexpected %s error has occurred at sentence id "
+                      "%d: %s, Stack trace: %s" % (sys.exc_info()[0],
+                                                   sen_idx+1,
+                                                   e,
+                                                   traceback.format_exc()))
+
+
+def _decode_sentence(decoder, sen_idx, src):
+    """Decodes a single source sentence with ``decoder.decode()``.
+
+    Returns:
+        list. Processed full hypotheses, see ``_process_hypos()``
+    """
+    decoder.set_current_sen_id(sen_idx)
+    start_hypo_time = time.time()
+    decoder.apply_predictors_count = 0
+    hypos = decoder.decode(src)
+    return _process_hypos(decoder,
+                          sen_idx,
+                          hypos,
+                          decoder.apply_predictors_count,
+                          time.time() - start_hypo_time)
+
+
+def _decode_sequential(decoder, src_sentences):
+    """Decodes the source sentences one after another. This is a
+    generator of (sen_idx, hypos) tuples.
+    """
+    for sen_idx in get_sentence_indices(args.range, src_sentences):
+        try:
+            src = _get_src_sentence(decoder, src_sentences, sen_idx)
+            hypos = _decode_sentence(decoder, sen_idx, src)
+        except Exception as e:
+            _log_decoding_error(sen_idx, e)
+            continue
+        yield sen_idx, hypos
+
+
+def _decode_batch(decoder, src_sentences):
+    """Decodes the source sentences in lock-step with the
+    ``BatchBeamDecoder``. This is a generator of (sen_idx, hypos)
+    tuples in the original sentence order, i.e. results of sentences
+    which finish early are held back until all previous sentences are
+    done. If batch decoding fails, the remaining sentences are decoded
+    one by one.
+    """
+    def read_src_sentences():
+        for sen_idx in get_sentence_indices(args.range, src_sentences):
+            try:
+                src = _get_src_sentence(decoder, src_sentences, sen_idx)
+            except Exception as e:
+                _log_decoding_error(sen_idx, e)
+                continue
+            yield sen_idx, src
+    src_iter = read_src_sentences()
+    submitted = collections.deque()
+    def submit():
+        for sen_idx, src in src_iter:
+            submitted.append((sen_idx, src))
+            yield sen_idx, src
+    results = {}
+    try:
+        for sen_idx, hypos, num_expansions, decoding_time in \
+                decoder.decode_batch(submit()):
+            results[sen_idx] = _process_hypos(
+                    decoder, sen_idx, hypos, num_expansions, decoding_time)
+            while submitted and submitted[0][0] in results:
+                sen_idx, _ = submitted.popleft()
+                yield sen_idx, results.pop(sen_idx)
+    except Exception as e:
+        logging.error("An unexpected %s error has occurred in lock-step "
+                      "batch decoding: %s. Decoding the remaining sentences "
+                      "one by one. Stack trace: %s" % (sys.exc_info()[0],
+                                                       e,
+                                                       traceback.format_exc()))
+        for sen_idx, src in itertools.chain(list(submitted), src_iter):
+            if sen_idx in results:
+                yield sen_idx, results.pop(sen_idx)
+                continue
+            try:
+                hypos = _decode_sentence(decoder, sen_idx, src)
+            except Exception as e:
+                _log_decoding_error(sen_idx, e)
+                continue
+            yield sen_idx, hypos
+
+
 def do_decode(decoder, 
               output_handlers, 
               src_sentences):
     """This method contains the main decoding loop. It iterates through
-    ``src_sentences`` and applies ``decoder.decode()`` to each of them.
-    At the end, it calls the output handlers to create output files.
+    ``src_sentences`` and applies ``decoder.decode()`` to each of them,
+    or ``decoder.decode_batch()`` to all of them if the decoder is a
+    ``BatchBeamDecoder``. At the end, it calls the output handlers to
+    create output files.
     
     Args:
         decoder (Decoder):  Current decoder instance
@@ -849,81 +1089,26 @@ def do_decode(decoder,
     start_time = time.time()
     logging.info("Start time: %s" % start_time)
     sen_indices = []
-    for sen_idx in get_sentence_indices(args.range, src_sentences):
-        decoder.set_current_sen_id(sen_idx)
+    decoded = None
+    if isinstance(decoder, BatchBeamDecoder):
+        if args.per_sentence_predictor_weights:
+            logging.warn("Per-sentence predictor weights are not supported "
+                         "in lock-step batch decoding. Decoding sentences "
+                         "one by one.")
+        else:
+            decoded = _decode_batch(decoder, src_sentences)
+    if decoded is None:
+        decoded = _decode_sequential(decoder, src_sentences)
+    for sen_idx, hypos in decoded:
+        all_hypos.append(hypos)
+        sen_indices.append(sen_idx)
         try:
-            if src_sentences is False:
-                src = "0"
-                logging.info("Next sentence (ID: %d)" % (sen_idx + 1))
-            else:
-                src = src_sentences[sen_idx]
-            if len(src) > 0 and args.per_sentence_predictor_weights:
-                # change predictor weights per-sentence
-                weights = src[-1].split(',')
-                if len(weights) > 1:
-                    weights = [float(x) for x in weights]
-                    src = src[:-1]
-                    logging.info('Changing predictor weights to {}'.format(
-                        weights))
-                    decoder.change_predictor_weights(weights)
-                else:
-                    logging.info(
-                        'No weights read in {} - leaving unchanged'.format(
-                            src))
-            logging.info("Next sentence (ID: %d): %s" % (sen_idx + 1, ' '.join(src)))
-            src = [int(x) for x in src]
-            start_hypo_time = time.time()
-            decoder.apply_predictors_count = 0
-            hypos = [hypo 
-                     for hypo in decoder.decode(utils.apply_src_wmap(src))
-                        if hypo.total_score > args.min_score]
-            if not hypos:
-                logging.error("No translation found for ID %d!" % (sen_idx+1))
-                logging.info("Stats (ID: %d): score=<not-found> "
-                         "num_expansions=%d "
-                         "time=%.2f" % (sen_idx+1,
-                                        decoder.apply_predictors_count,
-                                        time.time() - start_hypo_time))
-                hypos = [_generate_dummy_hypo(decoder.predictors)]
-            hypos = _postprocess_complete_hypos(hypos)
-            if utils.trg_cmap:
-                hypos = [h.convert_to_char_level(utils.trg_cmap) for h in hypos]
-            logging.info("Decoded (ID: %d): %s" % (
-                    sen_idx+1,
-                    utils.apply_trg_wmap(hypos[0].trgt_sentence, 
-                                         {} if utils.trg_cmap else utils.trg_wmap)))
-            logging.info("Stats (ID: %d): score=%f "
-                         "num_expansions=%d "
-                         "time=%.2f" % (sen_idx+1,
-                                        hypos[0].total_score,
-                                        decoder.apply_predictors_count,
-                                        time.time() - start_hypo_time))
-            all_hypos.append(hypos)
-            sen_indices.append(sen_idx)
-            try:
-                # Write text output as we go
-                if text_output_handler:
-                    text_output_handler.write_hypos([hypos])
-            except IOError as e:
-                logging.error("I/O error %d occurred when creating output files: %s"
-                            % (sys.exc_info()[0], e))
-        except ValueError as e:
-            logging.error("Number format error at sentence id %d: %s, "
-                          "Stack trace: %s" % (sen_idx+1, 
-                                               e,
-                                               traceback.format_exc()))
-        except AttributeError as e:
-            logging.fatal("Attribute error at sentence id %d: %s. This often "
-                          "indicates an error in the predictor configuration "
-                          "which could not be detected in initialisation. "
-                          "Stack trace: %s" 
-                          % (sen_idx+1, e, traceback.format_exc()))
-        except Exception as e:
-            logging.error("An unexpected %s error has occurred at sentence id "
-                          "%d: %s, Stack trace: %s" % (sys.exc_info()[0],
-                                                       sen_idx+1,
-                                                       e,
-                                                       traceback.format_exc()))
+            # Write text output as we go
+            if text_output_handler:
+                text_output_handler.write_hypos([hypos])
+        except IOError as e:
+            logging.error("I/O error %d occurred when creating output files: %s"
+                        % (sys.exc_info()[0], e))
     logging.info("Decoding finished. Time: %.2f" % (time.time() - start_time))
     try:
         for output_handler in output_handlers:
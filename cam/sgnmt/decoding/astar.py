@@ -94,9 +94,6 @@ class AstarDecoder(Decoder):
             for trgt_word in posterior: # Estimate future cost, add to heap
                 next_hypo = hypo.cheap_expand(trgt_word, posterior[trgt_word],
                                                   score_breakdown[trgt_word])
-                combined_score = -self.estimate_future_cost(next_hypo)
-                if not self.pure_heuristic_scores:
-                    combined_score += next_hypo.score
                 heappush(open_set, (-self._get_combined_score(next_hypo),
                                     next_hypo))
             # Limit heap capacity
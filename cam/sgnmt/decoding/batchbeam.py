@@ -0,0 +1,237 @@
+"""Implementation of beam search over several source sentences in
+lock-step.
+"""
+
+import copy
+import logging
+import time
+
+from cam.sgnmt import utils
+from cam.sgnmt.decoding.beam import BeamDecoder
+from cam.sgnmt.predictors.core import UnboundedVocabularyPredictor
+
+
+class SentenceSlot(object):
+    """Search state of a single source sentence in the batch of the
+    ``BatchBeamDecoder``.
+    """
+
+    def __init__(self, sen_id, src_sentence, contexts, max_len, hypos):
+        """Creates a new slot.
+
+        Args:
+            sen_id (int): Sentence id
+            src_sentence (list): Source sentence
+            contexts (list): Sentence contexts of all predictors
+            max_len (int): Maximum hypothesis length
+            hypos (list): Initial beam
+        """
+        self.sen_id = sen_id
+        self.src_sentence = src_sentence
+        self.contexts = contexts
+        self.max_len = max_len
+        self.hypos = hypos
+        self.full_hypos = []
+        self.it = 0
+        self.n_expansions = 0
+        self.start_time = time.time()
+
+
+class BatchBeamDecoder(BeamDecoder):
+    """This beam decoder advances the beams of up to
+    ``sentence_batch`` source sentences in lock-step. In each
+    iteration, the posteriors of the bounded vocabulary predictors for
+    all active hypotheses of all sentences are computed with a single
+    ``predict_next_batch()`` call per predictor. Predictors with
+    batched implementations (e.g. t2t) can thereby make better use of
+    the hardware, while all other predictors fall back to computing
+    posteriors one by one. Likewise, interpolation strategies (e.g.
+    MoE) find the predictor weights for all hypotheses in a single
+    ``find_weights_batch()`` call. When a sentence is finished, its
+    slot is filled with the next source sentence. The search itself is
+    the same as in ``BeamDecoder``, i.e. both decoders produce 
+    identical results.
+    """
+
+    def __init__(self, decoder_args):
+        """Creates a new batch beam decoder instance. In addition to
+        the constructor of ``BeamDecoder``, the following values are
+        fetched from ``decoder_args``:
+
+            sentence_batch (int): Number of sentences to decode in
+                                  lock-step
+
+        Args:
+            decoder_args (object): Decoder configuration passed through
+                                   from the configuration API.
+        """
+        super(BatchBeamDecoder, self).__init__(decoder_args)
+        self.sentence_batch = max(1, decoder_args.sentence_batch)
+
+    def decode_batch(self, src_sentences):
+        """Decodes a sequence of source sentences. This is a generator
+        which yields the results in the order in which the sentences
+        are finished, which is not necessarily the input order.
+
+        Args:
+            src_sentences (iterable): (sen_id, src_sentence) tuples
+
+        Returns:
+            iterator. (sen_id, hypos, num_expansions, time) tuples
+            where ``hypos`` are the full hypotheses sorted by score
+        """
+        if self.heuristics:
+            logging.warn("Lock-step batch decoding does not support "
+                         "heuristics. Decoding sentences one by one.")
+            for sen_id, src_sentence in src_sentences:
+                self.set_current_sen_id(sen_id)
+                self.apply_predictors_count = 0
+                start_time = time.time()
+                hypos = self.decode(src_sentence)
+                yield (sen_id, hypos, self.apply_predictors_count,
+                       time.time() - start_time)
+            return
+        src_sentences = iter(src_sentences)
+        slots = []
+        exhausted = False
+        while True:
+            active_slots = []
+            for slot in slots:
+                if (not self.stop_criterion(slot.hypos)
+                        or slot.it > slot.max_len):
+                    self._activate_slot(slot)
+                    hypos = self._get_final_hypos(slot.hypos,
+                                                  slot.src_sentence)
+                    yield (slot.sen_id, hypos, slot.n_expansions,
+                           time.time() - slot.start_time)
+                else:
+                    active_slots.append(slot)
+            slots = active_slots
+            while not exhausted and len(slots) < self.sentence_batch:
+                try:
+                    sen_id, src_sentence = next(src_sentences)
+                except StopIteration:
+                    exhausted = True
+                    break
+                slots.append(self._create_slot(sen_id, src_sentence))
+            if not slots:
+                break
+            self._expand_slots(slots)
+
+    def _create_slot(self, sen_id, src_sentence):
+        """Initializes the predictors with a new source sentence and
+        stores the resulting sentence contexts in a new slot.
+        """
+        self.set_current_sen_id(sen_id)
+        self.initialize_predictors(src_sentence)
+        contexts = [p.get_sentence_context() for (p, _) in self.predictors]
+        return SentenceSlot(sen_id,
+                            src_sentence,
+                            contexts,
+                            self.max_len,
+                            self._get_initial_hypos())
+
+    def _activate_slot(self, slot):
+        """Loads the sentence contexts and the sentence-level decoder
+        attributes of ``slot``. Predictor states need to be set
+        afterwards.
+        """
+        for (p, _), context in zip(self.predictors, slot.contexts):
+            p.set_sentence_context(context)
+        self.current_sen_id = slot.sen_id
+        self.max_len = slot.max_len
+        self.full_hypos = slot.full_hypos
+
+    def _expand_slots(self, slots):
+        """Runs one beam search iteration on all slots. This follows
+        the main loop in ``BeamDecoder.decode()`` except that all
+        bounded vocabulary posteriors and interpolation weights are 
+        computed in batch before hypotheses are expanded.
+        """
+        # Consume the last words and collect states of all hypotheses
+        all_contexts = []
+        all_states = []
+        slot_items = []
+        for slot in slots:
+            slot.it += 1
+            self._activate_slot(slot)
+            items = []
+            for hypo in slot.hypos:
+                if hypo.get_last_word() == utils.EOS_ID:
+                    items.append(-1)
+                    continue
+                self.set_predictor_states(
+                                    copy.deepcopy(hypo.predictor_states))
+                if not hypo.word_to_consume is None:
+                    self.consume(hypo.word_to_consume)
+                    hypo.word_to_consume = None
+                items.append(len(all_states))
+                all_contexts.append(slot.contexts)
+                all_states.append(self.get_predictor_states())
+            slot_items.append(items)
+        # Batched predictions
+        all_posteriors = []
+        for idx, (p, _) in enumerate(self.predictors):
+            if isinstance(p, UnboundedVocabularyPredictor):
+                continue
+            posteriors, next_states = p.predict_next_batch(
+                                    [contexts[idx] for contexts in all_contexts],
+                                    [states[idx] for states in all_states])
+            all_posteriors.append(posteriors)
+            for states, state in zip(all_states, next_states):
+                states[idx] = state
+        # Add unbounded predictors and find interpolation weights for
+        # all hypotheses at once
+        all_collected = []
+        for slot, items in zip(slots, slot_items):
+            self._activate_slot(slot)
+            for item in items:
+                if item < 0:
+                    continue
+                self.set_predictor_states(all_states[item])
+                all_collected.append(self.collect_posteriors(
+                    [posteriors[item] for posteriors in all_posteriors]))
+                all_states[item] = self.get_predictor_states()
+        if all_collected:
+            all_weights = self.apply_interpolation_strategy_batch(
+                [collected[3] for collected in all_collected],
+                [collected[0] for collected in all_collected],
+                [collected[1] for collected in all_collected],
+                [collected[2] for collected in all_collected])
+        # Combine posteriors and update beams
+        for slot, items in zip(slots, slot_items):
+            self._activate_slot(slot)
+            count = self.apply_predictors_count
+            next_hypos = []
+            next_scores = []
+            self.min_score = utils.NEG_INF
+            self.best_scores = []
+            for hypo, item in zip(slot.hypos, items):
+                if item < 0:
+                    next_hypos.append(hypo)
+                    next_scores.append(self._get_combined_score(hypo))
+                    continue
+                if hypo.score <= self.min_score:
+                    continue
+                non_zero_words, posteriors, unk_probs, _ = all_collected[item]
+                posterior, score_breakdown = \
+                    self.combine_collected_posteriors(non_zero_words,
+                                                      posteriors,
+                                                      unk_probs,
+                                                      all_weights[item],
+                                                      self.sub_beam_size)
+                hypo.predictor_states = all_states[item]
+                for trgt_word in posterior:
+                    next_hypo = hypo.cheap_expand(trgt_word,
+                                                  posterior[trgt_word],
+                                                  score_breakdown[trgt_word])
+                    next_score = self._get_combined_score(next_hypo)
+                    if next_score > self.min_score:
+                        next_hypos.append(next_hypo)
+                        next_scores.append(next_score)
+                        self._register_score(next_score)
+            slot.n_expansions += self.apply_predictors_count - count
+            if self.hypo_recombination:
+                slot.hypos = self._filter_equal_hypos(next_hypos, next_scores)
+            else:
+                slot.hypos = self._get_next_hypos(next_hypos, next_scores)
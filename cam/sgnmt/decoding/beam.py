@@ -193,6 +193,19 @@ class BeamDecoder(Decoder):
                 hypos = self._filter_equal_hypos(next_hypos, next_scores)
             else:
                 hypos = self._get_next_hypos(next_hypos, next_scores)
+        return self._get_final_hypos(hypos, src_sentence)
+
+    def _get_final_hypos(self, hypos, src_sentence):
+        """Adds the hypotheses in the final beam which end with </S> to
+        the full hypotheses, or all of them if none ends with </S>.
+        
+        Args:
+            hypos (list): Final beam
+            src_sentence (list): Source sentence for logging
+        
+        Returns:
+            list. Full hypotheses sorted by score
+        """
         for hypo in hypos:
             if hypo.get_last_word() == utils.EOS_ID:
                 self.add_full_hypo(hypo.generate_full_hypothesis()) 
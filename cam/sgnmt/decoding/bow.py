@@ -1,7 +1,7 @@
 """Implementation of the bow search strategy """
 
 import copy
-from heapq import heappush, heappop, heapify
+from heapq import heappush, heappop, heapify, nsmallest
 import logging
 
 from cam.sgnmt import utils
@@ -11,17 +11,21 @@ import numpy as np
 
 class BOWNode(object):
     """Helper class for ``BOWDecoder``` representing a child
-    object in the search tree. 
+    object in the search tree. Outgoing arcs are stored in arrays
+    which are sorted by score.
     
     Attributes:
         hypo (PartialHypothesis): Hypothesis corresponding to this node
-        posterior (dict): Scores on outgoing arcs
-        score_breakdown (dict): Score breakdowns for outgoing arcs
-        prev_nodes (list): Path from the root to this node
-        active_arcs (dict): Dictionary of unexplored outgoing arcs
+        words (array): Word IDs on outgoing arcs
+        scores (array): Scores on outgoing arcs
+        score_breakdowns (list): Score breakdowns for outgoing arcs
+        prev_node (BOWNode): Parent node, or None for the root
+        active_arcs (dict): Maps words on unexplored outgoing arcs to
+                            their index in ``words``
     """
     
-    def __init__(self, hypo, posterior, score_breakdown, prev_nodes):
+    def __init__(self, hypo, posterior, score_breakdown, prev_node,
+                 max_arcs=0):
         """Creates a new search tree node. All outgoing arcs are set to
         active by default.
         
@@ -29,13 +33,33 @@ class BOWNode(object):
             hypo (PartialHypothesis): Hypothesis corresponding to this node
             posterior (dict): Scores on outgoing arcs
             score_breakdown (dict): Score breakdowns for outgoing arcs
-            prev_nodes (list): Path from the root to this node
+            prev_node (BOWNode): Parent node, or None for the root
+            max_arcs (int): If positive, keep only the ``max_arcs`` 
+                            best outgoing arcs
         """
+        words = sorted(posterior, key=posterior.get, reverse=True)
+        if max_arcs > 0:
+            words = words[:max_arcs]
         self.hypo = hypo
-        self.posterior = posterior
-        self.score_breakdown = score_breakdown
-        self.prev_nodes = prev_nodes
-        self.active_arcs = {k: True for k in self.posterior.iterkeys()}
+        self.words = np.array(words, dtype=np.int64)
+        self.scores = np.array([posterior[w] for w in words])
+        self.score_breakdowns = [score_breakdown[w] for w in words]
+        self.prev_node = prev_node
+        self.active_arcs = {w: idx for idx, w in enumerate(words)}
+
+    def get_score(self, idx):
+        """Returns the score of the arc with index ``idx``. """
+        return float(self.scores[idx])
+
+    def get_path(self):
+        """Returns the list of nodes from the root to this node. """
+        path = []
+        node = self
+        while node is not None:
+            path.append(node)
+            node = node.prev_node
+        path.reverse()
+        return path
 
 
 class BOWDecoder(Decoder):
@@ -79,6 +103,13 @@ class BOWDecoder(Decoder):
                                        false, we perform greedy 
                                        decoding from that node until
                                        we reach a final node
+            max_node_children (int): Maximum number of unexplored arcs
+                                     stored at each node
+            node_state_interval (int): Store predictor states only at
+                                       every n-th tree level and 
+                                       recompute them for other nodes
+            max_open_nodes (int): Maximum size of the heap of open 
+                                  nodes
                                        
         Args:
             decoder_args (object): Decoder configuration passed through
@@ -89,21 +120,36 @@ class BOWDecoder(Decoder):
         self.early_stopping = decoder_args.early_stopping
         self.hypo_recombination = decoder_args.hypo_recombination
         self.always_single_step = decoder_args.decode_always_single_step
+        self.max_children = decoder_args.max_node_children
+        self.state_interval = max(1, decoder_args.node_state_interval)
+        self.max_open_nodes = decoder_args.max_open_nodes
+        if self.hypo_recombination and self.state_interval > 1:
+            logging.warn("Hypothesis recombination needs predictor states "
+                         "at all nodes. Set node state interval to 1.")
+            self.state_interval = 1
         if decoder_args.stochastic_decoder:
             self.select_node = self._select_node_stochastic
         else:
             self.select_node = self._select_node_max
     
-    def greedy_decode(self, node, word, single_step):
+    def greedy_decode(self, node, idx, single_step):
         """Helper function for greedy decoding from a certain point in
-        the search tree."""
+        the search tree.
         
+        Args:
+            node (BOWNode): Node to restart from
+            idx (int): Index of the outgoing arc of ``node`` to follow
+            single_step (bool): Expand only a single node
+        """
+        word = int(node.words[idx])
         prev_hypo = node.hypo.expand(word,
                                      None,
-                                     node.posterior[word],
-                                     node.score_breakdown[word])
-        prev_nodes = node.prev_nodes + [node]
-        
+                                     node.get_score(idx),
+                                     node.score_breakdowns[idx])
+        prev_nodes = node.get_path()
+        max_arcs = self.max_children
+        if max_arcs > 0 and not single_step:
+            max_arcs += 1 # Best word is explored immediately
         best_word = word
         while ((prev_hypo.score > self.best_score or not self.early_stopping)
                and best_word != utils.EOS_ID):
@@ -125,13 +171,16 @@ class BOWDecoder(Decoder):
             node = BOWNode(prev_hypo, 
                            posterior, 
                            score_breakdown, 
-                           list(prev_nodes))
+                           prev_nodes[-1],
+                           max_arcs)
+            store_states = not (len(prev_hypo.trgt_sentence) 
+                                % self.state_interval)
             if not single_step:
                 del node.active_arcs[best_word]
-                if len(node.active_arcs) > 0:
+                if len(node.active_arcs) > 0 and store_states:
                     prev_hypo.predictor_states = copy.deepcopy(
                                                 self.get_predictor_states())
-            else:
+            elif store_states:
                 prev_hypo.predictor_states = self.get_predictor_states()
             prev_nodes.append(node)
             prev_hypo = new_hypo
@@ -144,19 +193,13 @@ class BOWDecoder(Decoder):
         else:
             full_hypo_score = self._estimate_full_hypo_score(prev_hypo)
         # Update the heap
-        sen = prev_hypo.trgt_sentence
-        l = len(sen)
-        for pos in xrange(l):
-            worst_scores = {}
-            for p in xrange(pos, l):
-                worst_scores[sen[p]] = min(worst_scores.get(sen[p], 0.0),
-                                           prev_nodes[p].posterior[sen[p]])
-            node = prev_nodes[pos]
-            for w in node.active_arcs:
+        for node in prev_nodes:
+            for w,idx in node.active_arcs.iteritems():
                 expected_score = self._estimate_full_hypo_score(
-                                node.hypo.cheap_expand(w, 
-                                                       node.posterior[w], 
-                                                       node.score_breakdown[w]))
+                                node.hypo.cheap_expand(
+                                                w, 
+                                                node.get_score(idx), 
+                                                node.score_breakdowns[idx]))
                 self._add_to_heap(node, w, expected_score) 
     
     def _update_best_word_scores(self, posterior):
@@ -202,6 +245,24 @@ class BOWDecoder(Decoder):
         we do not traverse nodes twice.
         """
         heappush(self.open_nodes, (-expected_score, (node, w))) 
+
+    def _set_node_states(self, node):
+        """Sets the predictor states to the states of ``node``. If the
+        states are not stored in the node, they are recomputed from
+        the nearest ancestor with stored states.
+        """
+        checkpoint = node
+        while checkpoint.hypo.predictor_states is None:
+            checkpoint = checkpoint.prev_node
+        if checkpoint is not node:
+            self.replay_predictor_states(
+                checkpoint.hypo.predictor_states,
+                node.hypo.trgt_sentence[len(checkpoint.hypo.trgt_sentence):])
+        elif node.active_arcs or self.state_interval > 1:
+            self.set_predictor_states(copy.deepcopy(
+                                                node.hypo.predictor_states))
+        else: # No need to copy, node is not used anymore
+            self.set_predictor_states(node.hypo.predictor_states)
     
     def _select_node_stochastic(self):
         """Implements stochastic node selection. """
@@ -221,7 +282,11 @@ class BOWDecoder(Decoder):
         posterior,score_breakdown = self.apply_predictors()
         best_word = utils.argmax(posterior)
         init_hypo.predictor_states = self.get_predictor_states()
-        init_node = BOWNode(init_hypo, posterior, score_breakdown, [])
+        init_node = BOWNode(init_hypo, 
+                            posterior, 
+                            score_breakdown, 
+                            None, 
+                            self.max_children)
         self._add_to_heap(init_node, best_word, 0.0) # Expected score irrelevant 
 
     def decode(self, src_sentence):
@@ -244,8 +309,8 @@ class BOWDecoder(Decoder):
             node,word = tmp
             if not word in node.active_arcs: # Already expanded
                 continue
-            del node.active_arcs[word]
-            if node.hypo.score + node.posterior[word] <= self.best_score:
+            idx = node.active_arcs.pop(word)
+            if node.hypo.score + node.get_score(idx) <= self.best_score:
                 continue # Admissible pruning
             logging.debug(
                 "Best: %f Expected: %f Expansions: %d Restart from %s -> %d" % (
@@ -254,13 +319,12 @@ class BOWDecoder(Decoder):
                           self.apply_predictors_count,
                           ' '.join([str(w) for w in node.hypo.trgt_sentence]),
                           word))
-            if node.active_arcs:
-                self.set_predictor_states(copy.deepcopy(
-                                                node.hypo.predictor_states))
-            else:
-                self.set_predictor_states(node.hypo.predictor_states)
-            self.greedy_decode(node, word, single_step)
+            self._set_node_states(node)
+            self.greedy_decode(node, idx, single_step)
             single_step = self.always_single_step
+            if 0 < self.max_open_nodes < len(self.open_nodes):
+                self.open_nodes = nsmallest(self.max_open_nodes, 
+                                            self.open_nodes)
             if self.hypo_recombination:
                 rest = self.max_expansions - self.apply_predictors_count
                 new_open = []
@@ -3,10 +3,12 @@
 import copy
 import logging
 import operator
+import sys
+import threading
 
 from cam.sgnmt import utils
 from cam.sgnmt.decoding.core import Decoder, PartialHypothesis
-from cam.sgnmt.utils import INF, NEG_INF
+from cam.sgnmt.utils import INF, NEG_INF, MESSAGE_TYPE_FULL_HYPO
 import numpy as np
 
 
@@ -283,6 +285,11 @@ class BucketDecoder(Decoder):
         if necessary. After this method, ``apply_predictors`` computes
         the next posterior vector
         """
+        self._update_stats_on_activation(hypo, length, heap_score)
+        self._load_hypo_states(hypo)
+    
+    def _update_stats_on_activation(self, hypo, length, heap_score):
+        """Updates global word scores when ``hypo`` is activated. """
         if (self.collect_stats_from_partial 
                 and hypo.score > self.best_word_scores[length]):
             self.best_word_scores[length] = hypo.score
@@ -295,6 +302,11 @@ class BucketDecoder(Decoder):
                                heap_score,
                                self.apply_predictors_count,
                                ' '.join([str(w) for w in hypo.trgt_sentence])))
+    
+    def _load_hypo_states(self, hypo):
+        """Loads the predictor states of ``hypo`` and consumes its last
+        word if necessary.
+        """
         self.set_predictor_states(copy.deepcopy(hypo.predictor_states))
         if not hypo.word_to_consume is None: # Consume if cheap expand
             self.consume(hypo.word_to_consume)
@@ -500,6 +512,39 @@ class BucketDecoder(Decoder):
                         self.expanded_hypos[length].append(hypo)
         return hypo
 
+    def _expand_hypo(self, hypo, posterior, score_breakdown, 
+                     min_next_bucket_score, hypos_to_add):
+        """Creates the successors of ``hypo`` given the posterior from
+        ``apply_predictors``. Full hypotheses are registered directly,
+        all other successors which survive pruning are appended to 
+        ``hypos_to_add`` as (heap score, hypo) tuples.
+        """
+        if self.diverse_decoding:
+            hypo_array_idx = self._get_next_hypo_array_idx(hypo)
+        for w,score in posterior.iteritems():
+            exp_hypo = hypo.cheap_expand(w, score, score_breakdown[w])
+            exp_hypo.scores = hypo.scores + [hypo.score] 
+            if self.diverse_decoding:
+                exp_hypo.parent_hypo_array_idx = hypo_array_idx
+            combi_score = self._get_combined_score(exp_hypo) 
+            if w == utils.EOS_ID:
+                self._register_full_hypo(exp_hypo)
+            elif (combi_score >= min_next_bucket_score
+                  and (exp_hypo.score > self.best_score 
+                       or not self.early_stopping)):
+                hypos_to_add.append((-combi_score, exp_hypo))
+
+    def _get_decoding_result(self, src_sentence):
+        """Called at the end of ``decode`` to collect the results. """
+        if self.guaranteed_optimality and self.max_expansions <= self.apply_predictors_count:
+            logging.info("Reached max_node_expansions. Optimality not guaranteed for ID %d" %
+                      (self.current_sen_id + 1))
+        if not self.full_hypos: # Add incomplete longest hypos if no complete
+            logging.warn("No complete hypotheses found for %s" % src_sentence)
+            for hypo in self.buckets[self.max_len]:
+                self.add_full_hypo(hypo.generate_full_hypothesis())
+        return self.get_full_hypos_sorted()
+
     def decode(self, src_sentence):
         """Decodes a single source sentence. 
         """
@@ -516,26 +561,223 @@ class BucketDecoder(Decoder):
                     break
                 posterior,score_breakdown = self.apply_predictors()
                 hypo.predictor_states = self.get_predictor_states()
-                if self.diverse_decoding:
-                    hypo_array_idx = self._get_next_hypo_array_idx(hypo)
-                for w,score in posterior.iteritems():
-                    exp_hypo = hypo.cheap_expand(w, score, score_breakdown[w])
-                    exp_hypo.scores = hypo.scores + [hypo.score] 
-                    if self.diverse_decoding:
-                        exp_hypo.parent_hypo_array_idx = hypo_array_idx
-                    combi_score = self._get_combined_score(exp_hypo) 
-                    if w == utils.EOS_ID:
-                        self._register_full_hypo(exp_hypo)
-                    elif (combi_score >= min_next_bucket_score
-                          and (exp_hypo.score > self.best_score 
-                               or not self.early_stopping)):
-                        hypos_to_add.append((-combi_score, exp_hypo))
+                self._expand_hypo(hypo, posterior, score_breakdown,
+                                  min_next_bucket_score, hypos_to_add)
             self._add_new_hypos_to_bucket(length+1, hypos_to_add)
-        if self.guaranteed_optimality and self.max_expansions <= self.apply_predictors_count:
-            logging.info("Reached max_node_expansions. Optimality not guaranteed for ID %d" %
-                      (self.current_sen_id + 1))
-        if not self.full_hypos: # Add incomplete longest hypos if no complete
-            logging.warn("No complete hypotheses found for %s" % src_sentence)
-            for hypo in self.buckets[self.max_len]:
-                self.add_full_hypo(hypo.generate_full_hypothesis())
-        return self.get_full_hypos_sorted()
+        return self._get_decoding_result(src_sentence)
+
+
+class BucketWorker(Decoder):
+    """Helper decoder for the ``ParallelBucketDecoder``. A worker owns
+    a set of predictors and heuristics which is used by exactly one
+    thread. Workers do not implement a search strategy on their own,
+    i.e. ``decode()`` is not supported.
+    """
+
+
+class ParallelBucketDecoder(BucketDecoder):
+    """Speculative multi-threaded variant of the ``BucketDecoder``. 
+    Each thread uses its own ``BucketWorker`` with separate predictor
+    and heuristic instances. The first worker uses the predictors of
+    this decoder, further workers are added with ``add_worker()``.
+    
+    The buckets are shared between all threads and protected by a
+    single lock which is released while the predictors are evaluated.
+    A bucket is assigned to at most one thread at a time, so that
+    concurrent expansions are always in different buckets. Bucket
+    selection, pruning and ``max_node_expansions`` accounting work as
+    in the ``BucketDecoder``. However, as the best score may improve
+    while other expansions are still running, hypotheses may be 
+    expanded which sequential search would have pruned.
+    
+    Predictor states are passed between workers. Therefore, all
+    predictors need to accept states which have been created by
+    another instance with the same configuration.
+    """
+    
+    def __init__(self, decoder_args, *args, **kwargs):
+        """Creates a new parallel bucket decoder. The arguments are
+        the same as for ``BucketDecoder``.
+        """
+        super(ParallelBucketDecoder, self).__init__(decoder_args, 
+                                                    *args, 
+                                                    **kwargs)
+        self.workers = [BucketWorker(decoder_args)]
+        self.local = threading.local()
+        self.lock = threading.Condition()
+    
+    def add_worker(self, worker):
+        """Adds a worker with its own predictors and heuristics. Each
+        worker runs in a separate thread.
+        
+        Args:
+            worker (BucketWorker): Worker with the same predictor
+                                   configuration as this decoder
+        """
+        self.workers.append(worker)
+    
+    def _get_worker(self):
+        """Returns the worker of the current thread. """
+        return getattr(self.local, "worker", self.workers[0])
+    
+    def initialize_predictors(self, src_sentence):
+        """Initializes the predictors of all workers. """
+        super(ParallelBucketDecoder, self).initialize_predictors(
+                                                            src_sentence)
+        main_worker = self.workers[0]
+        main_worker.predictors = self.predictors
+        main_worker.heuristics = self.heuristics
+        main_worker.observers = self.observers
+        for worker in self.workers[1:]:
+            worker.set_current_sen_id(self.current_sen_id)
+            worker.initialize_predictors(src_sentence)
+    
+    def add_full_hypo(self, hypo):
+        """Adds ``hypo`` to ``full_hypos`` and notifies the observers
+        of all workers.
+        """
+        super(ParallelBucketDecoder, self).add_full_hypo(hypo)
+        for worker in self.workers[1:]:
+            worker.notify_observers(hypo, 
+                                    message_type = MESSAGE_TYPE_FULL_HYPO)
+    
+    def apply_predictors(self, top_n=0):
+        """Uses the predictors of the current worker. The expansion is
+        counted in ``decode()``.
+        """
+        return self._get_worker().apply_predictors(top_n)
+    
+    def consume(self, word):
+        """Uses the predictors of the current worker. """
+        self._get_worker().consume(word)
+    
+    def get_predictor_states(self):
+        """Uses the predictors of the current worker. """
+        return self._get_worker().get_predictor_states()
+    
+    def set_predictor_states(self, states):
+        """Uses the predictors of the current worker. """
+        self._get_worker().set_predictor_states(states)
+    
+    def are_equal_predictor_states(self, states1, states2):
+        """Uses the predictors of the current worker. """
+        return self._get_worker().are_equal_predictor_states(states1, 
+                                                             states2)
+    
+    def estimate_future_cost(self, hypo):
+        """Uses the heuristics of the current worker. """
+        return self._get_worker().estimate_future_cost(hypo)
+    
+    def _get_free_bucket(self):
+        """Selects a bucket with the bucket selector, ignoring buckets
+        which are currently assigned to other threads.
+        """
+        if not any(b and not busy for b, busy in zip(self.buckets, 
+                                                       self.busy)):
+            return -1
+        buckets = self.buckets
+        self.buckets = [[] if busy else b 
+                        for b, busy in zip(buckets, self.busy)]
+        try:
+            return self.get_bucket()
+        finally:
+            self.buckets = buckets
+    
+    def _pop_hypo(self, length):
+        """Like ``_get_hypo``, but releases the lock while the 
+        predictor states are loaded. Must be called with the lock.
+        """
+        while self.buckets[length]:
+            s,hypo = self.buckets[length].pop(0)
+            if self.early_stopping and hypo.score <= self.best_score:
+                continue
+            self._update_stats_on_activation(hypo, length, s)
+            self.lock.release()
+            try:
+                self._load_hypo_states(hypo)
+                if self.hypo_recombination:
+                    hypo.predictor_states = self.get_predictor_states()
+            finally:
+                self.lock.acquire()
+            if self.hypo_recombination:
+                recombined = False
+                for other_hypo in self.expanded_hypos[length]:
+                    if other_hypo.score >= hypo.score and self.are_equal_predictor_states(
+                                                hypo.predictor_states,
+                                                other_hypo.predictor_states):
+                        logging.debug("Hypo recombination: %s > %s (activate)"
+                                              % (other_hypo.trgt_sentence,
+                                                 hypo.trgt_sentence))
+                        recombined = True
+                        break
+                if recombined:
+                    continue
+                self.expanded_hypos[length].append(hypo)
+            return hypo
+        return None
+    
+    def _expand_bucket(self, length):
+        """Expands up to ``beam`` hypotheses in the bucket ``length``. 
+        Must be called with the lock.
+        """
+        min_next_bucket_score = self._get_min_bucket_score(length+1)
+        hypos_to_add = []
+        for _ in xrange(self.beam): # Expand beam_size hypos in this bucket
+            hypo = self._pop_hypo(length)
+            if hypo is None:
+                break
+            self.apply_predictors_count += 1
+            self.lock.release()
+            try:
+                posterior,score_breakdown = self.apply_predictors()
+                hypo.predictor_states = self.get_predictor_states()
+            finally:
+                self.lock.acquire()
+            self._expand_hypo(hypo, posterior, score_breakdown,
+                              min_next_bucket_score, hypos_to_add)
+        self._add_new_hypos_to_bucket(length+1, hypos_to_add)
+    
+    def _run_worker(self, worker):
+        """Main loop of a single thread. """
+        self.local.worker = worker
+        with self.lock:
+            try:
+                while (not self.worker_error 
+                       and self.max_expansions > self.apply_predictors_count):
+                    length = self._get_free_bucket()
+                    if length < 0:
+                        if self.n_busy == 0: # No more full buckets
+                            break
+                        self.lock.wait()
+                        continue
+                    self.busy[length] = True
+                    self.n_busy += 1
+                    try:
+                        self._expand_bucket(length)
+                    finally:
+                        self.busy[length] = False
+                        self.n_busy -= 1
+                        self.lock.notify_all()
+            except:
+                if not self.worker_error:
+                    self.worker_error = sys.exc_info()
+                self.lock.notify_all()
+    
+    def decode(self, src_sentence):
+        """Decodes a single source sentence with all workers. 
+        """
+        self._initialize_decoding(src_sentence)
+        self.busy = [False] * (self.max_len+1)
+        self.n_busy = 0
+        self.worker_error = None
+        threads = [threading.Thread(target=self._run_worker, args=(worker,))
+                   for worker in self.workers]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.worker_error:
+            raise self.worker_error[0], self.worker_error[1], \
+                  self.worker_error[2]
+        return self._get_decoding_result(src_sentence)
@@ -526,28 +526,52 @@ class Decoder(Observable):
         Returns:
           A list of predictor weights.
         """
-        if self.interpolation_strategies:
-            predictions = [[] for _ in pred_weights]
-            for strat, pred_indices in self.interpolation_strategies:
-                new_pred_weights = strat.find_weights(
-                        [pred_weights[idx] for idx in pred_indices],
-                        non_zero_words,
-                        [posteriors[idx] for idx in pred_indices],
-                        [unk_probs[idx] for idx in pred_indices])
+        if not self.interpolation_strategies:
+            return pred_weights
+        return self.apply_interpolation_strategy_batch(
+            [pred_weights], [non_zero_words], [posteriors], [unk_probs])[0]
+
+    def apply_interpolation_strategy_batch(
+            self, pred_weights, non_zero_words, posteriors, unk_probs):
+        """Like ``apply_interpolation_strategy`` but for several
+        predictions at once. Each argument is a list with one entry 
+        for each prediction. Interpolation strategies can use this to
+        evaluate their model only once for all hypotheses in a beam.
+
+        Returns:
+          A list of lists of predictor weights.
+        """
+        if not self.interpolation_strategies:
+            return pred_weights
+        n_items = len(pred_weights)
+        predictions = [[[] for _ in weights] for weights in pred_weights]
+        for strat, pred_indices in self.interpolation_strategies:
+            all_new_pred_weights = strat.find_weights_batch(
+                    [[weights[idx] for idx in pred_indices]
+                        for weights in pred_weights],
+                    non_zero_words,
+                    [[posts[idx] for idx in pred_indices]
+                        for posts in posteriors],
+                    [[probs[idx] for idx in pred_indices]
+                        for probs in unk_probs])
+            for item_predictions, new_pred_weights in zip(
+                                    predictions, all_new_pred_weights):
                 for idx, weight in zip(pred_indices, new_pred_weights):
-                    predictions[idx].append(weight)
-            for idx, preds in enumerate(predictions):
+                    item_predictions[idx].append(weight)
+        for item_idx in xrange(n_items):
+            item_weights = pred_weights[item_idx]
+            for idx, preds in enumerate(predictions[item_idx]):
                 if preds:
                     if self.interpolation_mean == 'arith':
-                        pred_weights[idx] = sum(preds) / float(len(preds))
+                        item_weights[idx] = sum(preds) / float(len(preds))
                     else:
-                        pred_weights[idx] = reduce(mul, preds, 1)
+                        item_weights[idx] = reduce(mul, preds, 1)
                     if self.interpolation_mean == 'geo':
-                        pred_weights[idx] = pred_weights[idx]**(1.0/len(preds))
+                        item_weights[idx] = item_weights[idx]**(1.0/len(preds))
             if self.interpolation_mean == 'prob':
-                partition = sum(pred_weights)
-                for idx in xrange(len(pred_weights)):
-                    pred_weights[idx] /= partition
+                partition = sum(item_weights)
+                for idx in xrange(len(item_weights)):
+                    item_weights[idx] /= partition
         return pred_weights
     
     def apply_predictors(self, top_n=0):
@@ -563,11 +587,58 @@ class Decoder(Observable):
             contains the scores for each predictor separately 
             represented as tuples (unweighted_score, predictor_weight)
         """
-        self.apply_predictors_count += 1
-        bounded_predictors = [el for el in self.predictors 
-                        if not isinstance(el[0], UnboundedVocabularyPredictor)]
-        # Get bounded posteriors
-        bounded_posteriors = [p.predict_next() for (p, _) in bounded_predictors]
+        bounded_posteriors = [p.predict_next()
+                              for (p, _) in self.get_bounded_predictors()]
+        return self.apply_predictors_with_posteriors(bounded_posteriors, top_n)
+
+    def get_bounded_predictors(self):
+        """Returns the (predictor, weight) tuples of all predictors
+        which are not ``UnboundedVocabularyPredictor`` instances.
+        """
+        return [el for el in self.predictors
+                    if not isinstance(el[0], UnboundedVocabularyPredictor)]
+
+    def apply_predictors_with_posteriors(self, bounded_posteriors, top_n=0):
+        """Like ``apply_predictors`` but the posteriors of the bounded
+        vocabulary predictors have already been computed, e.g. by
+        ``predict_next_batch``. The predictors need to be in the state
+        after computing ``bounded_posteriors``.
+
+        Args:
+            bounded_posteriors (list): Posteriors of the predictors in
+                                       ``get_bounded_predictors()``
+            top_n (int): If positive, return only the best n words.
+
+        Returns:
+            combined,score_breakdown: See ``apply_predictors``
+        """
+        non_zero_words, posteriors, unk_probs, pred_weights = \
+            self.collect_posteriors(bounded_posteriors)
+        pred_weights = self.apply_interpolation_strategy(
+                pred_weights, non_zero_words, posteriors, unk_probs)
+        return self.combine_collected_posteriors(
+            non_zero_words, posteriors, unk_probs, pred_weights, top_n)
+
+    def collect_posteriors(self, bounded_posteriors):
+        """Completes ``bounded_posteriors`` with the posteriors of the
+        unbounded vocabulary predictors and the UNK probabilities. The
+        predictors need to be in the state after computing 
+        ``bounded_posteriors``. This is the first step of
+        ``apply_predictors_with_posteriors``, followed by 
+        ``apply_interpolation_strategy`` and 
+        ``combine_collected_posteriors``. Decoders can call these
+        steps separately to find the interpolation weights for several
+        hypotheses at once.
+
+        Args:
+            bounded_posteriors (list): Posteriors of the predictors in
+                                       ``get_bounded_predictors()``
+
+        Returns:
+            tuple. non_zero_words, posteriors, unk_probs, and the a 
+            priori predictor weights
+        """
+        bounded_predictors = self.get_bounded_predictors()
         non_zero_words = self._get_non_zero_words(bounded_predictors,
                                                   bounded_posteriors)
         if not non_zero_words: # Special case: no word is possible
@@ -577,17 +648,80 @@ class Decoder(Observable):
         unk_probs = []
         pred_weights = []
         bounded_idx = 0
+        candidates = {}
         for (p, w) in self.predictors:
             if isinstance(p, UnboundedVocabularyPredictor):
-                posterior = p.predict_next(non_zero_words)
+                max_candidates = p.get_max_candidates()
+                if 0 < max_candidates < len(non_zero_words):
+                    if not max_candidates in candidates:
+                        candidates[max_candidates] = self._get_best_words(
+                            bounded_predictors,
+                            bounded_posteriors,
+                            non_zero_words,
+                            max_candidates)
+                    posterior = p.predict_next(candidates[max_candidates])
+                else:
+                    posterior = p.predict_next(non_zero_words)
             else: # Take it from the bounded_* variables
                 posterior = bounded_posteriors[bounded_idx]
                 bounded_idx += 1
             posteriors.append(posterior)
             unk_probs.append(p.get_unk_probability(posterior))
             pred_weights.append(w)
-        pred_weights = self.apply_interpolation_strategy(
-                pred_weights, non_zero_words, posteriors, unk_probs)
+        return non_zero_words, posteriors, unk_probs, pred_weights
+
+    def _get_best_words(self, 
+                        bounded_predictors, 
+                        bounded_posteriors, 
+                        non_zero_words, 
+                        n):
+        """Get the ``n`` best words in ``non_zero_words`` according the
+        weighted sum of the bounded predictor scores. This is used to
+        restrict the words passed to unbounded predictors (see
+        ``UnboundedVocabularyPredictor.get_max_candidates()``).
+
+        Args:
+            bounded_predictors (list): (predictor, weight) tuples of 
+                                       the bounded predictors
+            bounded_posteriors (list): Their posteriors
+            non_zero_words (set): All words with positive probability
+            n (int): Number of words to select
+
+        Returns:
+            set. The ``n`` best words
+        """
+        words = np.fromiter(non_zero_words, 
+                            dtype=np.int64, 
+                            count=len(non_zero_words))
+        scores = np.zeros(len(words))
+        for (p, w), posterior in zip(bounded_predictors, bounded_posteriors):
+            unk_prob = p.get_unk_probability(posterior)
+            if isinstance(posterior, dict):
+                pred_scores = np.array([posterior.get(word, unk_prob)
+                                        for word in words.tolist()])
+            else:
+                posterior = np.asarray(posterior)
+                pred_scores = np.empty(len(words))
+                pred_scores.fill(unk_prob)
+                in_range = words < len(posterior)
+                pred_scores[in_range] = posterior[words[in_range]]
+            scores += w * pred_scores
+        best = np.argpartition(-scores, n - 1)[:n]
+        return set(words[best].tolist())
+
+    def combine_collected_posteriors(self,
+                                     non_zero_words,
+                                     posteriors,
+                                     unk_probs,
+                                     pred_weights,
+                                     top_n=0):
+        """Combines the output of ``collect_posteriors`` with the
+        given predictor weights. See ``collect_posteriors``.
+
+        Returns:
+            combined,score_breakdown: See ``apply_predictors``
+        """
+        self.apply_predictors_count += 1
         ret = self.combine_posteriors(
             non_zero_words, posteriors, unk_probs, pred_weights, top_n)
         if not self.allow_unk_in_output and utils.UNK_ID in ret[0]:
@@ -932,6 +1066,24 @@ class Decoder(Observable):
     def get_predictor_states(self):
         """Calls ``get_state()`` on all predictors. """
         return [p.get_state() for (p, _) in self.predictors]
+
+    def replay_predictor_states(self, states, words):
+        """Restores predictor states which have not been stored. The
+        predictors are set to a copy of ``states`` and then consume 
+        ``words`` one by one. ``states`` must have been fetched after
+        ``apply_predictors``, and ``apply_predictors`` is called again
+        after each consumed word. Therefore, replays count as node
+        expansions.
+        
+        Args:
+            states (list): Predictor states as returned by 
+                           ``get_predictor_states``
+            words (list): Words to consume after restoring ``states``
+        """
+        self.set_predictor_states(copy.deepcopy(states))
+        for word in words:
+            self.consume(word)
+            self.apply_predictors()
     
     def set_predictor_combi_method(self, method):
         """Defines how to accumulate scores over the sequence. Should
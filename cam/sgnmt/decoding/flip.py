@@ -6,6 +6,7 @@ import logging
 
 from cam.sgnmt import utils
 from cam.sgnmt.decoding.core import Decoder, PartialHypothesis
+from cam.sgnmt.misc.cache import LRUCache
 from cam.sgnmt.misc.trie import SimpleTrie
 
 
@@ -48,6 +49,12 @@ class FlipDecoder(Decoder):
     Do not use the bow predictor in combination with this decoder as
     it will hide the EOS scores which are important to estimate bigram
     scores.
+    
+    Predictor states are not stored in the hypotheses. Instead, the
+    decoder keeps the states after each explored prefix in a bounded
+    store which is shared by all candidates. Candidates start from the
+    longest explored prefix and only need to apply the predictors from
+    the changed position onwards.
     """
     
     def __init__(self, decoder_args, always_greedy=False):
@@ -61,6 +68,10 @@ class FlipDecoder(Decoder):
             max_node_expansions (int): Maximum number of node expansions 
                                        for inadmissible pruning.
             early_stopping (boolean): Activates admissible pruning
+            flip_max_states (int): Maximum number of stored predictor
+                                   states for explored prefixes
+            flip_bigram_pruning (boolean): Activates pruning with
+                                           bigram score estimates
 
         Args:
             decoder_args (object): Decoder configuration passed through
@@ -74,6 +85,8 @@ class FlipDecoder(Decoder):
         super(FlipDecoder, self).__init__(decoder_args) 
         self.max_expansions_param = decoder_args.max_node_expansions
         self.early_stopping = decoder_args.early_stopping
+        self.bigram_pruning = decoder_args.flip_bigram_pruning
+        self.states = LRUCache(decoder_args.flip_max_states)
         self.always_greedy = always_greedy
         with open(decoder_args.trg_test) as f:
             self.lines = f.read().splitlines()
@@ -96,7 +109,7 @@ class FlipDecoder(Decoder):
         bag = dict(self.full_bag)
         while bag:
             posterior,score_breakdown = self.apply_predictors()
-            hypo.predictor_states = copy.deepcopy(self.get_predictor_states())
+            self._store_states(hypo.trgt_sentence)
             hypos.append(hypo)
             posteriors.append(posterior)
             score_breakdowns.append(score_breakdown)
@@ -111,7 +124,7 @@ class FlipDecoder(Decoder):
                                score_breakdown[best_word])
             scores.append(posterior[best_word])
         posterior,score_breakdown = self.apply_predictors()
-        hypo.predictor_states = self.get_predictor_states()
+        self._store_states(hypo.trgt_sentence)
         hypos.append(hypo)
         posteriors.append(posterior)
         score_breakdowns.append(score_breakdown)
@@ -144,6 +157,40 @@ class FlipDecoder(Decoder):
             bigram_scores[w] = {w2: 0.0 for w2 in words}
         return bigram_scores
 
+    def _store_states(self, prefix):
+        """Stores a copy of the current predictor states as states
+        for the explored ``prefix``. The states of the empty prefix
+        are additionally kept in ``root_states`` as they must not be
+        evicted from the state store.
+        """
+        states = copy.deepcopy(self.get_predictor_states())
+        self.states.add(tuple(prefix), states)
+        if not prefix:
+            self.root_states = states
+
+    def _restore_states(self, prefix):
+        """Sets the predictor states to the states after consuming
+        ``prefix``. The states of ``prefix`` without the last word
+        are usually in the state store. If they have been removed, we
+        start from the longest prefix with stored states and apply the
+        predictors along the missing positions.
+        
+        Args:
+            prefix (list): Non-empty target prefix
+        """
+        for pos in xrange(len(prefix)-1, -1, -1):
+            states = self.states.get(tuple(prefix[0:pos]))
+            if states is not None:
+                break
+        if states is None:
+            states = self.root_states
+        self.set_predictor_states(copy.deepcopy(states))
+        for pos in xrange(pos, len(prefix)-1):
+            self.consume(prefix[pos])
+            self.apply_predictors()
+            self._store_states(prefix[0:pos+1])
+        self.consume(prefix[-1])
+
     def _is_explored(self, trgt_sentence):
         """Returns true if this target sentence has been explored
         already
@@ -255,18 +302,22 @@ class FlipDecoder(Decoder):
         """
         prefix = self.hypos.get_prefix(candidate.trgt_sentence)
         hypo = self.hypos.get(prefix)
-        self.set_predictor_states(copy.deepcopy(hypo.predictor_states))
         for pos,score in enumerate(hypo.scores): # Update candidate scores
             candidate.scores[pos] = score
-        self.consume(hypo.word_to_consume) 
         hypos = []
         posteriors = []
         score_breakdowns = []
         for pos in xrange(len(prefix), len(candidate.trgt_sentence)):
             if self.early_stopping and hypo.score <= self.best_score:
                 break # admissible pruning
+            if (self.bigram_pruning 
+                    and hypo.score + sum(candidate.scores[pos:]) 
+                                                    <= self.best_score):
+                break # inadmissible pruning with bigram estimates
+            if pos == len(prefix): # Predictor states are set lazily
+                self._restore_states(prefix)
             posterior,score_breakdown = self.apply_predictors()
-            hypo.predictor_states = copy.deepcopy(self.get_predictor_states())
+            self._store_states(hypo.trgt_sentence)
             hypos.append(hypo)
             posteriors.append(posterior)
             score_breakdowns.append(score_breakdown)
@@ -323,6 +374,7 @@ class FlipDecoder(Decoder):
         self.max_expansions = self.get_max_expansions(self.max_expansions_param,
                                                       src_sentence) 
         self._load_bag()
+        self.states.clear()
         self.hypos = SimpleTrie()
         self.explored = SimpleTrie()
         self.open_candidates = []
@@ -9,7 +9,7 @@ import logging
 from cam.sgnmt import utils
 from cam.sgnmt.decoding.core import Heuristic, Decoder
 from cam.sgnmt.decoding.greedy import GreedyDecoder
-from cam.sgnmt.misc.trie import SimpleTrie
+from cam.sgnmt.misc.cache import LRUCache
 from cam.sgnmt.misc.unigram import FileUnigramTable, BestStatsUnigramTable, \
     FullStatsUnigramTable, AllStatsUnigramTable
 from cam.sgnmt.utils import MESSAGE_TYPE_DEFAULT
@@ -104,7 +104,7 @@ class GreedyHeuristic(Heuristic):
         super(GreedyHeuristic, self).__init__()
         self.cache_estimates = cache_estimates
         self.decoder = GreedyDecoder(decoder_args)
-        self.cache = SimpleTrie()
+        self.cache = LRUCache(decoder_args.heuristic_cache_size)
         
     def set_predictors(self, predictors):
         """Override ``Decoder.set_predictors`` to redirect the 
@@ -115,7 +115,12 @@ class GreedyHeuristic(Heuristic):
     
     def initialize(self, src_sentence):
         """Initialize the cache. """
-        self.cache = SimpleTrie()
+        if self.cache.hits or self.cache.misses:
+            logging.debug("Greedy heuristic cache: %d hits, %d misses, "
+                          "%d entries" % (self.cache.hits,
+                                          self.cache.misses,
+                                          len(self.cache)))
+        self.cache.clear()
     
     def estimate_future_cost(self, hypo):
         """Estimate the future cost by full greedy decoding. If
@@ -127,8 +132,13 @@ class GreedyHeuristic(Heuristic):
             return self.estimate_future_cost_without_cache(hypo)
     
     def estimate_future_cost_with_cache(self, hypo):
-        """Enabled cache... """
-        cached_cost = self.cache.get(hypo.trgt_sentence)
+        """Enabled cache. The cache maps translation prefixes to future
+        costs and is bounded by ``--heuristic_cache_size`` with LRU 
+        eviction. The greedy rollout stops as soon as it reaches a
+        prefix in the cache and reuses the cached cost of the suffix.
+        """
+        prefix = tuple(hypo.trgt_sentence)
+        cached_cost = self.cache.get(prefix)
         if not cached_cost is None:
             return cached_cost
         old_states = self.decoder.get_predictor_states()
@@ -137,18 +147,26 @@ class GreedyHeuristic(Heuristic):
         trgt_word = hypo.trgt_sentence[-1]
         scores = []
         words = []
+        suffix_cost = 0.0
         while trgt_word != utils.EOS_ID:
             self.decoder.consume(trgt_word)
             posterior,_ = self.decoder.apply_predictors()
             trgt_word = utils.argmax(posterior)
             scores.append(posterior[trgt_word])
             words.append(trgt_word)
+            if trgt_word != utils.EOS_ID:
+                cached_cost = self.cache.get(prefix + tuple(words))
+                if not cached_cost is None:
+                    suffix_cost = cached_cost
+                    break
         # Update cache using scores and words
-        for i in xrange(1,len(scores)):
-            self.cache.add(hypo.trgt_sentence + words[:i], -sum(scores[i:]))
+        cost = suffix_cost
+        for i in xrange(len(scores)-1, -1, -1):
+            cost -= scores[i]
+            self.cache.add(prefix + tuple(words[:i]), cost)
         # Reset predictor states
         self.decoder.set_predictor_states(old_states)
-        return -sum(scores)
+        return cost
     
     def estimate_future_cost_without_cache(self, hypo):
         """Disabled cache... """
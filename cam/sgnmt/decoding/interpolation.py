@@ -3,7 +3,9 @@ specified via the --interpolation_strategy parameter.
 """
 
 from cam.sgnmt import utils
+from cam.sgnmt.misc.cache import LRUCache
 import numpy as np
+import hashlib
 import logging
 from abc import abstractmethod
 
@@ -19,6 +21,41 @@ except ImportError:
     pass # Deal with it in decode.py
 
 
+MOE_WEIGHTS_CACHE_SIZE = 1000
+"""Maximum number of MoE predictions which are memoised. """
+
+
+def fill_score_matrix(scores, posteriors, unk_probs):
+    """Fills a ``[n_predictors, vocab_size]`` matrix with predictor
+    scores in place. Dict posteriors are scattered into rows which are
+    initialized with the UNK probability of the predictor. Dense 
+    posteriors are written directly into the matrix, clipped at -99.
+
+    Args:
+        scores (array): Matrix of shape [n_predictors, vocab_size]
+        posteriors (list): Predictor posteriors
+        unk_probs (list): UNK probabilities of the predictors
+
+    Returns:
+        array. ``scores``
+    """
+    for row, posterior in enumerate(posteriors):
+        if isinstance(posterior, dict):
+            scores[row].fill(unk_probs[row])
+            n_words = len(posterior)
+            if n_words:
+                idxs = np.fromiter(posterior.iterkeys(),
+                                   dtype=np.int64, count=n_words)
+                scores[row, idxs] = np.fromiter(posterior.itervalues(),
+                                                dtype=scores.dtype,
+                                                count=n_words)
+        else:
+            n_words = len(posterior)
+            np.maximum(posterior, -99, out=scores[row, :n_words])
+            scores[row, n_words:] = unk_probs[row]
+    return scores
+
+
 class InterpolationStrategy(object):
     """Base class for interpolation strategies."""
 
@@ -42,6 +79,20 @@ class InterpolationStrategy(object):
         """
         raise NotImplementedError
 
+    def find_weights_batch(
+            self, pred_weights, non_zero_words, posteriors, unk_probs):
+        """Find interpolation weights for several predictions at once.
+        The arguments are lists with one entry per prediction, each
+        entry is as in ``find_weights()``. The default implementation
+        calls ``find_weights()`` for each prediction.
+
+        Returns:
+            list of lists of floats. The predictor weights for each
+            prediction.
+        """
+        return [self.find_weights(w, n, p, u) for w, n, p, u in zip(
+                    pred_weights, non_zero_words, posteriors, unk_probs)]
+
 
 class FixedInterpolationStrategy(InterpolationStrategy):
     """Null-object (GoF design pattern) implementation."""
@@ -56,6 +107,11 @@ class MoEInterpolationStrategy(InterpolationStrategy):
     model. In this scenario, we have a neural model which predicts 
     predictor weights from the predictor outputs. See the sgnmt_moe 
     project on how to train this gating network with TensorFlow.
+
+    The network is run once for all predictions passed to 
+    ``find_weights_batch()``. Weights are memoised by the digest of the
+    score matrix, i.e. hypotheses with identical predictor outputs 
+    (e.g. equal predictor states) reuse the same weights.
     """
 
     def __init__(self, num_experts, args):
@@ -84,6 +140,7 @@ class MoEInterpolationStrategy(InterpolationStrategy):
         with moe_graph.as_default() as g:
           self.model.initialize()
           self.sess = self._create_session()
+        self._weights_cache = LRUCache(MOE_WEIGHTS_CACHE_SIZE)
 
     def _create_hparams(self, num_experts, config):
         """Creates self.params."""
@@ -136,16 +193,16 @@ class MoEInterpolationStrategy(InterpolationStrategy):
             raise AttributeError("Could not initialize TF session for MoE.")
 
     def _create_score_matrix(self, posteriors, unk_probs):
-        scores = np.transpose(np.tile(np.array(unk_probs, dtype=np.float32),
-                                      (self.params.vocab_size, 1)))
-        # Scores has shape [n_predictors, vocab_size], fill it
-        for row, posterior in enumerate(posteriors):
-            if isinstance(posterior, dict):
-                for  w, s in posterior.iteritems():
-                    scores[row,int(w)] = s
-            else:
-                scores[row,:len(posterior)] = np.maximum(-99, posterior)
-        return np.expand_dims(scores, axis=0)
+        """Creates a [batch_size, n_predictors, vocab_size] matrix
+        for a list of predictions.
+        """
+        scores = np.empty((len(posteriors), 
+                           len(posteriors[0]),
+                           self.params.vocab_size), dtype=np.float32)
+        for item_scores, item_posteriors, item_unk_probs in zip(
+                scores, posteriors, unk_probs):
+            fill_score_matrix(item_scores, item_posteriors, item_unk_probs)
+        return scores
 
     def find_weights(self, pred_weights, non_zero_words, posteriors, unk_probs):
         """Runs the MoE model to find interpolation weights.
@@ -164,10 +221,33 @@ class MoEInterpolationStrategy(InterpolationStrategy):
         Raises:
             ``NotImplementedError``: if the method is not implemented
         """
+        return self.find_weights_batch(
+            [pred_weights], [non_zero_words], [posteriors], [unk_probs])[0]
+
+    def find_weights_batch(
+            self, pred_weights, non_zero_words, posteriors, unk_probs):
+        """Runs the MoE model once for all predictions which are not
+        in the cache yet.
+        """
         scores = self._create_score_matrix(posteriors, unk_probs)
-        weights = self.sess.run(self.model.weights, 
-                                feed_dict={self.model.expert_scores: scores})
-        return weights[0,:]
+        weights = [None] * len(scores)
+        keys = [hashlib.md5(item_scores).digest() for item_scores in scores]
+        missing = {}
+        for idx, key in enumerate(keys):
+            weights[idx] = self._weights_cache.get(key)
+            if weights[idx] is None:
+                missing.setdefault(key, []).append(idx)
+        if missing:
+            missing_keys = missing.keys()
+            missing_scores = scores[[missing[key][0] for key in missing_keys]]
+            missing_weights = self.sess.run(
+                self.model.weights,
+                feed_dict={self.model.expert_scores: missing_scores})
+            for key, key_weights in zip(missing_keys, missing_weights):
+                self._weights_cache.add(key, key_weights)
+                for idx in missing[key]:
+                    weights[idx] = key_weights
+        return weights
 
 
 class EntropyInterpolationStrategy(InterpolationStrategy):
@@ -181,28 +261,22 @@ class EntropyInterpolationStrategy(InterpolationStrategy):
 
     def __init__(self, vocab_size):
         self.vocab_size = vocab_size
+        self._scores = None
 
     def _create_score_matrix(self, posteriors, unk_probs):
-        scores = np.transpose(np.tile(np.array(unk_probs),
-                                      (self.vocab_size, 1)))
-        # Scores has shape [n_predictors, vocab_size], fill it
-        for row, posterior in enumerate(posteriors):
-            if isinstance(posterior, dict):
-                for  w, s in posterior.iteritems():
-                    scores[row,int(w)] = s
-            else:
-                scores[row,:len(posterior)] = np.maximum(-99, posterior)
-        return scores
+        """Fills the [n_predictors, vocab_size] score matrix. The
+        matrix is reused between calls.
+        """
+        if self._scores is None or len(self._scores) != len(posteriors):
+            self._scores = np.empty((len(posteriors), self.vocab_size))
+        return fill_score_matrix(self._scores, posteriors, unk_probs)
 
     def find_weights(self, pred_weights, non_zero_words, posteriors, unk_probs):
         logprobs = self._create_score_matrix(posteriors, unk_probs)
         probs = np.exp(logprobs)
-        n_preds = len(pred_weights)
-        ents = np.zeros((n_preds, n_preds))
-        for p_idx in xrange(n_preds):
-            for q_idx in xrange(n_preds):
-                ents[p_idx,q_idx] = -np.sum(probs[p_idx] * logprobs[q_idx])
-                ents[p_idx,q_idx] *= pred_weights[p_idx]
+        # ents[p,q] is the cross entropy between p and q, weighted by p
+        ents = -np.dot(probs, logprobs.T)
+        ents *= np.asarray(pred_weights, dtype=np.float64)[:, np.newaxis]
         ent_weights = -np.sum(ents, axis=0)
         ent_weights -= np.min(ent_weights)
         ent_weights /= np.sum(ent_weights)
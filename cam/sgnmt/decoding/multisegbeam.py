@@ -10,6 +10,7 @@ import pywrapfst as fst
 
 from cam.sgnmt import utils
 from cam.sgnmt.decoding.core import Decoder, PartialHypothesis
+from cam.sgnmt.misc.vocab import get_vocab_store
 from cam.sgnmt.predictors.automata import EPS_ID
 
 
@@ -57,8 +58,7 @@ class WordMapper(object):
         ``utils.trg_wmap``.
         """
         self.max_word_id = 3
-        self.wmap_len = 0
-        self.key2id = {}
+        self.wmap = None
         self.synchronize()
         self.reserved_keys = {'<unk> ': utils.UNK_ID,
                               '<eps> ': utils.UNK_ID,
@@ -68,18 +68,15 @@ class WordMapper(object):
 
     def synchronize(self):
         """Synchronizes the internal state of this mapper with
-        ``utils.trg_wmap``. This includes updating the reverse lookup
-        table and finding the lowest free word ID which can be assigned
-        to new words. 
+        ``utils.trg_wmap``, i.e. finds the lowest free word ID which
+        can be assigned to new words if the word map has been reloaded.
+        Reverse lookups use the vocabulary store of the word map, so
+        no reverse lookup table is needed.
         """
-        if self.wmap_len == len(utils.trg_wmap):
+        if self.wmap is utils.trg_wmap:
             return
-        self.key2id = {}
-        self.max_word_id = 3
-        for word_id, key in utils.trg_wmap.iteritems():
-            self.max_word_id = max(self.max_word_id, word_id)
-            self.key2id["%s " % key] = word_id
-        self.wmap_len = len(utils.trg_wmap)
+        self.wmap = utils.trg_wmap
+        self.max_word_id = max(3, self.wmap.get_max_id())
 
     def get_word_id(self, key):
         """Finds a word ID for the given key. If no such key is in the
@@ -97,12 +94,11 @@ class WordMapper(object):
         if key in self.reserved_keys:
             return self.reserved_keys[key]
         self.synchronize()
-        if key in self.key2id:
-            return self.key2id[key]
+        word_id = self.wmap.get_id(key[:-1])
+        if word_id is not None:
+            return word_id
         self.max_word_id += 1
-        utils.trg_wmap[self.max_word_id] = key[:-1]
-        self.key2id[key] = self.max_word_id
-        self.wmap_len += 1
+        self.wmap[self.max_word_id] = key[:-1]
         return self.max_word_id
 
 
@@ -146,34 +142,36 @@ class Tokenizer(object):
 
 class WordTokenizer(Tokenizer):
     """This tokenizer implements a purly word-level tokenization.
-    Keys are generated according a standard word map.
+    Keys are generated according a standard word map, which is
+    accessed via its vocabulary store (``misc.vocab``).
     """
     
     def __init__(self, path):
-        self.id2key = {}
-        self.key2id = {}
         try:
             split = path.split(":", 1)
-            max_id = int(split[0])
+            self.max_id = int(split[0])
             path = split[1]
         except:
-            max_id = utils.INF
-        with codecs.open(path, encoding='utf-8') as f:
-            for line in f:
-                entry = line.strip().split()
-                key = entry[0]
-                word_id = int(entry[-1])
-                if word_id < max_id and word_id != utils.UNK_ID:
-                    self.id2key[word_id] = "%s " % key
-                    self.key2id["%s " % key] = word_id
+            self.max_id = utils.INF
+        self.vocab = get_vocab_store(path)
+    
+    def _is_valid_id(self, word_id):
+        return (word_id is not None 
+                and word_id < self.max_id 
+                and word_id != utils.UNK_ID)
     
     def key2tokens(self, key):
-        return [self.key2id.get(key, utils.UNK_ID)]
+        if is_key_complete(key):
+            word_id = self.vocab.get_id(key[:-1])
+            if self._is_valid_id(word_id):
+                return [word_id]
+        return [utils.UNK_ID]
     
     def tokens2key(self, tokens):
-        if len(tokens) != 1:
+        if len(tokens) != 1 or not self._is_valid_id(tokens[0]):
             return ""
-        return self.id2key.get(tokens[0], "")
+        key = self.vocab.get_key(tokens[0])
+        return "" if key is None else "%s " % key
 
     def is_word_begin_token(self, token):
         return True
@@ -181,23 +179,40 @@ class WordTokenizer(Tokenizer):
 
 class EOWTokenizer(Tokenizer):
     """This tokenizer reads word maps with explicit </w> endings. This
-    can be used for subword unit based tokenizers.
+    can be used for subword unit based tokenizers. The word map is
+    accessed via its vocabulary store (``misc.vocab``). Keys in the
+    store are translated on the fly: '</w>' endings, '<s>', and '</s>'
+    correspond to complete keys.
     """
     
     def __init__(self, path):
-        self.id2key = {}
-        self.key2id = {}
-        with codecs.open(path, encoding='utf-8') as f:
-            for line in f:
-                key, word_id = line.strip().split()
-                if word_id == str(utils.UNK_ID):
-                    continue
-                if key[-4:] == "</w>": 
-                    key = "%s " % key[:-4]
-                elif key in ['<s>', '</s>']:
-                    key = "%s " % key
-                self.id2key[int(word_id)] = key
-                self.key2id[key] = int(word_id)
+        self.vocab = get_vocab_store(path)
+    
+    def _get_token(self, key):
+        """Returns the token ID for ``key`` or None. """
+        if is_key_complete(key):
+            word = key[:-1]
+            if not word in ['<s>', '</s>']:
+                word = "%s</w>" % word
+        elif key in ['<s>', '</s>'] or key[-4:] == "</w>":
+            return None
+        else:
+            word = key
+        token = self.vocab.get_id(word)
+        return None if token == utils.UNK_ID else token
+    
+    def _get_key(self, token):
+        """Returns the key for ``token`` or an empty string. """
+        if token == utils.UNK_ID:
+            return ""
+        key = self.vocab.get_key(token)
+        if key is None:
+            return ""
+        if key[-4:] == "</w>":
+            return "%s " % key[:-4]
+        if key in ['<s>', '</s>']:
+            return "%s " % key
+        return key
     
     def key2tokens(self, key):
         tokens = self._key2tokens_recursive(key)
@@ -208,21 +223,23 @@ class EOWTokenizer(Tokenizer):
             return []
         if max_len <= 0:
             return None
-        if key in self.key2id: # Match of the full key
-            return [self.key2id[key]]
+        token = self._get_token(key)
+        if token is not None: # Match of the full key
+            return [token]
         if max_len <= 1:
             return None
         best_tokens = None
         for l in xrange(len(key)-1, 0, -1):
-            if key[:l] in self.key2id:
+            token = self._get_token(key[:l])
+            if token is not None:
                 rest = self._key2tokens_recursive(key[l:], max_len-1)
                 if not rest is None and len(rest) < max_len:
-                    best_tokens = [self.key2id[key[:l]]] + rest
+                    best_tokens = [token] + rest
                     max_len = len(best_tokens) - 1
         return best_tokens
     
     def tokens2key(self, tokens):
-        return ''.join([self.id2key.get(t, "") for t in tokens])
+        return ''.join([self._get_key(t) for t in tokens])
 
     def is_word_begin_token(self, token):
         return token in [utils.GO_ID, utils.EOS_ID]
@@ -421,6 +438,82 @@ class PredictorStub(object):
         return new_stub
 
 
+class PrefixTrieNode(object):
+    """A node in a ``PrefixTrie``. """
+
+    def __init__(self, pred_state, posterior, unk_prob):
+        """Creates a new trie node.
+
+        Args:
+            pred_state (object): Predictor state after consuming the
+                                 token prefix and calling 
+                                 ``predict_next``
+            posterior (dict|array): Posterior after the token prefix
+            unk_prob (float): UNK probability for ``posterior``
+        """
+        self.pred_state = pred_state
+        self.posterior = posterior
+        self.unk_prob = unk_prob
+        self.children = {}
+
+
+class PrefixTrie(object):
+    """A trie over token prefixes of the next word for a single 
+    predictor and a single parent hypothesis. Each node stores the
+    predictor state and posterior after consuming the token prefix.
+    All continuations of the parent hypothesis share this trie, so that
+    each distinct prefix is scored only once with the predictor, 
+    regardless of how many continuations or search steps contain it.
+    Nodes are only created for prefixes which are requested by the 
+    (pruned) search.
+    """
+
+    def __init__(self, predictor, pred_state, posterior):
+        """Creates a new trie with root node for the empty prefix.
+
+        Args:
+            predictor (Predictor): The predictor
+            pred_state (object): Predictor state at the word boundary
+            posterior (dict|array): Predictor posterior for the first
+                                    token of the next word, including
+                                    the UNK score
+        """
+        self.predictor = predictor
+        self.root = PrefixTrieNode(pred_state, 
+                                   posterior, 
+                                   posterior[utils.UNK_ID])
+
+    def get_node(self, tokens):
+        """Get the node for the prefix ``tokens``. Missing nodes on the
+        path are created by consuming the tokens with the predictor.
+
+        Args:
+            tokens (list): Token prefix
+
+        Returns:
+            PrefixTrieNode. The node for ``tokens``
+        """
+        node = self.root
+        for token in tokens:
+            child = node.children.get(token)
+            if child is None:
+                child = self._expand(node, token)
+            node = child
+        return node
+
+    def _expand(self, node, token):
+        """Creates a child node of ``node`` by consuming ``token``. """
+        predictor = self.predictor
+        predictor.set_state(copy.deepcopy(node.pred_state))
+        predictor.consume(token)
+        posterior = predictor.predict_next()
+        child = PrefixTrieNode(predictor.get_state(), 
+                               posterior,
+                               predictor.get_unk_probability(posterior))
+        node.children[token] = child
+        return child
+
+
 class Continuation(object):
     """A continuation is a partial hypothesis plus the next word. A
     continuation can be incomplete if predictors use finer grained
@@ -493,18 +586,21 @@ class Continuation(object):
                                        self.calculate_score(pred_weights),
                                        score_breakdown)
     
-    def expand(self, decoder):
-        for pidx,(p, _) in enumerate(decoder.predictors):
+    def expand(self, tries):
+        """Scores the next token of all incomplete predictor stubs.
+        
+        Args:
+            tries (list): ``PrefixTrie`` instances of the parent hypo,
+                          one for each predictor
+        """
+        for pidx, trie in enumerate(tries):
             stub = self.pred_stubs[pidx]
             if not stub.has_full_score():
-                p.set_state(copy.deepcopy(stub.pred_state))
-                p.consume(stub.tokens[stub.score_pos-1])
-                posterior = p.predict_next()
-                stub.score_next(utils.common_get(
-                                             posterior,
-                                             stub.tokens[stub.score_pos],
-                                             p.get_unk_probability(posterior)))
-                stub.pred_state = p.get_state()
+                node = trie.get_node(stub.tokens[:stub.score_pos])
+                stub.score_next(utils.common_get(node.posterior,
+                                                 stub.tokens[stub.score_pos],
+                                                 node.unk_prob))
+                stub.pred_state = node.pred_state
 
 
 class MultisegBeamDecoder(Decoder):
@@ -649,8 +745,23 @@ class MultisegBeamDecoder(Decoder):
         return all([is_key_complete(tok.tokens2key(s.tokens)) 
                                            for s in stubs[:self.beam_size]])
 
-    def _search_full_words(self, predictor, start_posterior, tok, min_score):
-        stubs = self._get_initial_stubs(predictor, start_posterior, min_score)
+    def _search_full_words(self, trie, tok, min_score):
+        """Full word search with a single predictor. The search 
+        proceeds breadth-first over the token positions and keeps the
+        ``beam_size`` best stubs at each position. Posteriors are 
+        retrieved from the prefix trie of the predictor.
+        
+        Args:
+            trie (PrefixTrie): Prefix trie of the predictor
+            tok (Tokenizer): Tokenizer of the predictor
+            min_score (float): Stubs with lower scores are discarded
+        
+        Returns:
+            list. List of ``PredictorStub`` instances sorted by score
+        """
+        stubs = self._get_initial_stubs(trie.predictor, 
+                                        trie.root.posterior, 
+                                        min_score)
         while not self._best_keys_complete(stubs, tok):
             next_stubs = []
             for stub in stubs[:self.beam_size]:
@@ -660,10 +771,9 @@ class MultisegBeamDecoder(Decoder):
                 if is_key_complete(key):
                     next_stubs.append(stub)
                     continue
-                predictor.set_state(copy.deepcopy(stub.pred_state))
-                predictor.consume(stub.tokens[-1])
-                posterior = predictor.predict_next()
-                pred_state = predictor.get_state()
+                node = trie.get_node(stub.tokens)
+                posterior = node.posterior
+                pred_state = node.pred_state
                 for t, s in utils.common_iterable(posterior):
                     if t != utils.UNK_ID and not tok.is_word_begin_token(t):
                         child_stub = stub.expand(t, s, pred_state)
@@ -685,10 +795,11 @@ class MultisegBeamDecoder(Decoder):
         # Get initial continuations by searching with predictors separately
         start_posteriors = self._get_word_initial_posteriors(hypo)
         pred_states = self.get_predictor_states()
+        tries = [PrefixTrie(p, pred_states[pidx], start_posteriors[pidx])
+                    for pidx, (p, _) in enumerate(self.predictors)]
         keys = {}
         for pidx, (p,w) in enumerate(self.predictors):
-            stubs = self._search_full_words(p,
-                                            start_posteriors[pidx],
+            stubs = self._search_full_words(tries[pidx],
                                             self.toks[pidx],
                                             min_score / w)
             n_added = 0
@@ -708,12 +819,12 @@ class MultisegBeamDecoder(Decoder):
         for cont in keys.itervalues():
             for pidx in xrange(len(self.predictors)):
                 if cont.pred_stubs[pidx] is None:
+                    root = tries[pidx].root
                     stub = PredictorStub(self.toks[pidx].key2tokens(cont.key),
-                                         pred_states[pidx])
-                    stub.score_next(utils.common_get(
-                                         start_posteriors[pidx],
-                                         stub.tokens[0],
-                                         start_posteriors[pidx][utils.UNK_ID]))
+                                         root.pred_state)
+                    stub.score_next(utils.common_get(root.posterior,
+                                                     stub.tokens[0],
+                                                     root.unk_prob))
                     cont.pred_stubs[pidx] = stub
         conts = [(-c.calculate_score(pred_weights), c) for c in keys.itervalues()]
         heapq.heapify(conts)
@@ -723,7 +834,7 @@ class MultisegBeamDecoder(Decoder):
             if cont.is_complete():
                 yield -s,cont
             else: # Need to rescore with sec predictors
-                cont.expand(self)
+                cont.expand(tries)
                 heapq.heappush(conts, (-cont.calculate_score(pred_weights), cont))
     
     def decode(self, src_sentence):
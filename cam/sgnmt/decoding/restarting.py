@@ -1,7 +1,7 @@
 """Implementation of the restarting search strategy """
 
 import copy
-from heapq import heappop, heappush, heapify
+from heapq import heappop, heappush, heapify, nsmallest
 import logging
 
 from cam.sgnmt import utils
@@ -23,12 +23,60 @@ class RestartingChild(object):
 
 class RestartingNode(object):
     """Helper class for ``RestartingDecoder``` representing a node
-    in the search tree. """
+    in the search tree. The unexplored children are stored in arrays
+    which are sorted by score. 
     
-    def __init__(self, hypo, children):
-        """Creates a new node instance """
+    Attributes:
+        hypo (PartialHypothesis): Hypothesis corresponding to this node
+        words (array): Word IDs of the children
+        scores (array): Scores of the children
+        score_breakdowns (list): Score breakdowns of the children
+        next_child (int): Index of the best unexplored child
+        checkpoint (PartialHypothesis): Nearest ancestor hypothesis
+                                        with stored predictor states
+                                        if ``hypo`` does not store them
+    """
+    
+    def __init__(self, hypo, posterior, score_breakdown, words,
+                 checkpoint=None):
+        """Creates a new node instance.
+        
+        Args:
+            hypo (PartialHypothesis): Hypothesis corresponding to this
+                                      node
+            posterior (dict): Scores on outgoing arcs
+            score_breakdown (dict): Score breakdowns for outgoing arcs
+            words (list): Words of the children to keep, sorted by score
+            checkpoint (PartialHypothesis): Hypothesis from which the
+                                            predictor states can be 
+                                            recomputed
+        """
         self.hypo = hypo
-        self.children = children
+        self.words = np.array(words, dtype=np.int64)
+        self.scores = np.array([posterior[w] for w in words])
+        self.score_breakdowns = [score_breakdown[w] for w in words]
+        self.next_child = 0
+        self.checkpoint = checkpoint
+
+    def has_children(self):
+        """Returns true if there are unexplored children. """
+        return self.next_child < len(self.words)
+
+    def get_next_score(self):
+        """Returns the score of the best unexplored child. """
+        return self.scores[self.next_child]
+
+    def pop_child(self):
+        """Removes the best unexplored child and returns it as 
+        ``RestartingChild`` instance.
+        """
+        idx = self.next_child
+        self.next_child += 1
+        child = RestartingChild(int(self.words[idx]),
+                                float(self.scores[idx]),
+                                self.score_breakdowns[idx])
+        self.score_breakdowns[idx] = None
+        return child
     
     
 class RestartingDecoder(Decoder):
@@ -58,7 +106,10 @@ class RestartingDecoder(Decoder):
                  low_memory_mode = True,
                  node_cost_strategy='difference',
                  stochastic=False,
-                 always_single_step=False):
+                 always_single_step=False,
+                 max_children=0,
+                 state_interval=1,
+                 max_open_nodes=0):
         """Creates new Restarting decoder instance.
         
         Args:
@@ -80,12 +131,28 @@ class RestartingDecoder(Decoder):
                                        when restarting. If true, expand
                                        the hypothesis only by a single
                                        token
+            max_children (int): Maximum number of children stored at
+                                each node. Non-positive values mean no
+                                limit
+            state_interval (int): Store predictor states only at every
+                                  n-th tree level and recompute them for
+                                  other nodes
+            max_open_nodes (int): Maximum size of the heap of open 
+                                  nodes. Non-positive values mean no
+                                  limit
         """
         super(RestartingDecoder, self).__init__(decoder_args)
         self.max_expansions_param = max_expansions
         self.always_single_step = always_single_step
         self.low_memory_mode = low_memory_mode
         self.hypo_recombination = hypo_recombination
+        self.max_children = max_children
+        self.state_interval = max(1, state_interval)
+        self.max_open_nodes = max_open_nodes
+        if hypo_recombination and self.state_interval > 1:
+            logging.warn("Hypothesis recombination needs predictor states "
+                         "at all nodes. Set node state interval to 1.")
+            self.state_interval = 1
         if node_cost_strategy == 'difference':
             self.get_node_cost = self._get_node_cost_difference
         elif node_cost_strategy == 'absolute':
@@ -141,13 +208,50 @@ class RestartingDecoder(Decoder):
         """Implements the node scoring function constant. """
         return prev_node_cost + 1.0
     
-    def greedy_decode(self, hypo):
+    def _set_node_states(self, node):
+        """Sets the predictor states to the states of ``node``. If the
+        states are not stored in the node, they are recomputed from
+        the checkpoint of the node.
+        """
+        if node.hypo.predictor_states is None:
+            self.replay_predictor_states(
+                node.checkpoint.predictor_states,
+                node.hypo.trgt_sentence[len(node.checkpoint.trgt_sentence):])
+        elif node.has_children() or self.state_interval > 1:
+            self.set_predictor_states(copy.deepcopy(
+                                                node.hypo.predictor_states))
+        else: # No need to copy, node is not used anymore
+            self.set_predictor_states(node.hypo.predictor_states)
+
+    def _reduce_open_nodes(self, max_size):
+        """Keeps only the ``max_size`` best open nodes and updates
+        ``max_heap_node_cost`` such that worse nodes are not added
+        anymore.
+        """
+        new_open = nsmallest(max_size, self.open_nodes)
+        self.max_heap_node_cost = new_open[-1][0]
+        self.open_nodes = new_open
+        heapify(self.open_nodes)
+
+    def greedy_decode(self, hypo, checkpoint):
         """Helper function for greedy decoding from a certain point in
-        the search tree."""
+        the search tree.
+        
+        Args:
+            hypo (PartialHypothesis): Hypothesis to start from. The 
+                                      predictor states must be set to 
+                                      the states before consuming the
+                                      last word of ``hypo``
+            checkpoint (PartialHypothesis): Nearest ancestor of 
+                                            ``hypo`` with stored 
+                                            predictor states
+        """
         best_word = hypo.trgt_sentence[-1]
         prev_hypo = hypo
         remaining_exps = max(self.max_expansions - self.apply_predictors_count,
                              1)
+        if self.max_children > 0:
+            remaining_exps = min(remaining_exps, self.max_children)
         while (best_word != utils.EOS_ID 
                and len(prev_hypo.trgt_sentence) <= self.max_len):
             self.consume(best_word)
@@ -168,20 +272,27 @@ class RestartingDecoder(Decoder):
             if len(posterior) > 1:
                 if not self.always_single_step:
                     posterior.pop(best_word)
-                children = sorted([RestartingChild(w,
-                                                   posterior[w],
-                                                   score_breakdown[w])
-                    for w in posterior], key=lambda c: c.score, reverse=True)
-                children = children[:remaining_exps]
+                words = sorted(posterior, key=posterior.get, reverse=True)
+                words = words[:remaining_exps]
                 node_cost = self.get_node_cost(0.0, 
                                                best_word_score, 
-                                               children[0].score)
+                                               posterior[words[0]])
                 if node_cost <= self.max_heap_node_cost:
-                    prev_hypo.predictor_states = copy.deepcopy(
+                    if len(prev_hypo.trgt_sentence) % self.state_interval:
+                        node = RestartingNode(prev_hypo, 
+                                              posterior,
+                                              score_breakdown,
+                                              words,
+                                              checkpoint)
+                    else:
+                        prev_hypo.predictor_states = copy.deepcopy(
                                                 self.get_predictor_states())
-                    heappush(self.open_nodes, (node_cost,
-                                               RestartingNode(prev_hypo,
-                                                              children)))
+                        node = RestartingNode(prev_hypo, 
+                                              posterior,
+                                              score_breakdown,
+                                              words)
+                        checkpoint = prev_hypo
+                    heappush(self.open_nodes, (node_cost, node))
             prev_hypo = new_hypo
             if self.always_single_step:
                 break
@@ -199,11 +310,14 @@ class RestartingDecoder(Decoder):
         """Create the root node for the search tree. """
         init_hypo = PartialHypothesis()
         posterior,score_breakdown = self.apply_predictors()
-        children = sorted([RestartingChild(w, posterior[w], score_breakdown[w])
-                            for w in posterior],
-                          key=lambda c: c.score, reverse=True)
+        words = sorted(posterior, key=posterior.get, reverse=True)
+        if self.max_children > 0:
+            words = words[:self.max_children]
         init_hypo.predictor_states = self.get_predictor_states()
-        heappush(self.open_nodes, (0.0, RestartingNode(init_hypo, children)))
+        heappush(self.open_nodes, (0.0, RestartingNode(init_hypo, 
+                                                       posterior,
+                                                       score_breakdown,
+                                                       words)))
 
     def decode(self, src_sentence):
         """Decodes a single source sentence using Restarting search. """
@@ -218,7 +332,7 @@ class RestartingDecoder(Decoder):
         # Then, restart from open nodes until the heap is empty
         while self.open_nodes:
             prev_node_score,node = self.select_node()
-            best_child = node.children.pop(0)
+            best_child = node.pop_child()
             new_hypo = node.hypo.expand(best_child.word,
                                         None,
                                         best_child.score,
@@ -226,16 +340,16 @@ class RestartingDecoder(Decoder):
             if new_hypo.score > self.best_score: # Admissible pruning
                 logging.debug("Restart from %s" % (
                             ' '.join([str(w) for w in new_hypo.trgt_sentence])))
-                if node.children: # Still has children -> back to heap
+                if node.has_children(): # Still has children -> back to heap
                     node_cost = self.get_node_cost(prev_node_score, 
                                                    best_child.score, 
-                                                   node.children[0].score)
+                                                   node.get_next_score())
                     heappush(self.open_nodes, (node_cost, node))
-                    self.set_predictor_states(copy.deepcopy(
-                                                node.hypo.predictor_states))
-                else: # No need to copy, don't put back to heap
-                    self.set_predictor_states(node.hypo.predictor_states)
-                self.greedy_decode(new_hypo)
+                self._set_node_states(node)
+                if node.hypo.predictor_states is None:
+                    self.greedy_decode(new_hypo, node.checkpoint)
+                else:
+                    self.greedy_decode(new_hypo, node.hypo)
             # Reduce heap size (we don't need more nodes than remaining exps
             rest = self.max_expansions - self.apply_predictors_count
             if rest <= 0:
@@ -258,9 +372,8 @@ class RestartingDecoder(Decoder):
                 self.open_nodes = new_open
                 heapify(self.open_nodes) 
             elif self.low_memory_mode and len(self.open_nodes) > rest:
-                new_open = [heappop(self.open_nodes) for _ in xrange(rest+1)]
-                self.max_heap_node_cost = new_open[-1][0]
-                self.open_nodes = new_open
-                heapify(self.open_nodes)
+                self._reduce_open_nodes(rest+1)
+            if 0 < self.max_open_nodes < len(self.open_nodes):
+                self._reduce_open_nodes(self.max_open_nodes)
         return self.get_full_hypos_sorted()
 
@@ -12,8 +12,15 @@ The script supports most of the command-line arguments of
 - heuristics (no heuristic necessary for forced decoding)
 - src_test2 (usr altest predictor wrapper for multiple input
   streams)
-- outputs (only posteriors,json is produced)
+- outputs (only 'json', 'pickle', and 'store' are supported)
 - trg/src_cmap/wmap: Use indexed data only
+
+With the 'store' output format, --trg_test can also be an n-best list in
+Moses format. All references for a source sentence are then scored
+along a shared prefix trie, so that predictor posteriors are computed
+only once for each distinct prefix. Only the statistics selected with
+--forced_stats are kept, and they are appended to a memory-mappable
+``ArrayStore`` (see ``cam.sgnmt.misc.arraystore``) after each sentence.
 """
 
 import logging
@@ -22,12 +29,15 @@ import traceback
 import time
 import numpy as np
 import pickle
+import copy
 
 from cam.sgnmt.decoding import core
 from cam.sgnmt import decode_utils
 from cam.sgnmt import utils
 from cam.sgnmt.ui import get_args
 from cam.sgnmt.predictors.core import UnboundedVocabularyPredictor
+from cam.sgnmt.misc.arraystore import ArrayStoreWriter
+from cam.sgnmt.utils import NEG_INF
 
 # Load configuration from command line arguments or configuration file
 args = get_args()
@@ -81,6 +91,287 @@ class ForcedDecoder(core.Decoder):
         }
         return self.full_hypos
 
+class TrieForcedDecoder(core.Decoder):
+    """Forced decoder which scores all references for a source
+    sentence at once. The references are organized in a prefix trie
+    which is traversed depth-first, so that predictors are called only
+    once for each distinct prefix. Instead of keeping all posteriors,
+    only the statistics in ``stats`` are extracted, and they are 
+    appended to an ``ArrayStoreWriter`` at the end of each sentence.
+    
+    The store contains flat arrays, indexed via offset arrays:
+    
+      - ``sen_ids``, ``sen_refs``: Sentence ids and reference offsets
+      - ``ref_tokens``, ``ref_scores``: Token offsets and combined 
+        score for each reference
+      - ``tokens``, ``token_edges``: Reference tokens (including </S>)
+        and the trie edge which corresponds to each token
+      - ``edge_nodes``: Trie node (i.e. prefix) for each edge
+      - ``target_scores`` (edge x predictor), ``unk_scores`` (node x
+        predictor): Predictor scores of the reference tokens
+      - ``entropy`` (node x predictor): Posterior entropies
+      - ``topk_words``, ``topk_scores`` (node x predictor x k): Best
+        words at each node, padded with -1 and -inf
+      - ``post_offsets``, ``post_words``, ``post_scores``: Full
+        posteriors for each (node, predictor) pair in float16
+    
+    Note that unbounded vocabulary predictors are only asked for the
+    words in the trie, so their entropies, top-k lists, and posteriors
+    are restricted to these words.
+    """
+    
+    def __init__(self, decoder_args, writer):
+        """Initialize the decoder and load target references.
+        
+        Args:
+            decoder_args (object): Decoder configuration passed through
+                                   from the configuration API.
+            writer (ArrayStoreWriter): Store writer for the statistics
+        """
+        super(TrieForcedDecoder, self).__init__(decoder_args)
+        self.writer = writer
+        self.stats = [s.strip() 
+                      for s in decoder_args.forced_stats.split(",") 
+                      if s.strip()]
+        for stat in self.stats:
+            if not stat in ["target", "topk", "entropy", "posteriors"]:
+                logging.fatal("Unknown statistic '%s' in --forced_stats"
+                              % stat)
+        self.topk = decoder_args.forced_topk
+        self.trg_references = load_references(decoder_args.trg_test)
+        self.writer.append("sen_refs", [0], dtype=np.int64)
+        self.writer.append("ref_tokens", [0], dtype=np.int64)
+        if "posteriors" in self.stats:
+            self.writer.append("post_offsets", [0], dtype=np.int64)
+    
+    def decode(self, src_sentence):
+        """Scores all references for ``src_sentence`` and appends the
+        statistics to the store.
+        """
+        self.initialize_predictors(src_sentence)
+        refs = []
+        if self.current_sen_id < len(self.trg_references):
+            refs = [ref + [utils.EOS_ID] 
+                    for ref in self.trg_references[self.current_sen_id]]
+        root = {}
+        for ref in refs:
+            node = root
+            for w in ref[:-1]:
+                node = node.setdefault(w, {})
+            node[utils.EOS_ID] = None
+        self._init_sentence_stats()
+        edges = {}
+        self._score_trie(root, edges)
+        self._add_references(root, refs, edges)
+        self._write_sentence_stats()
+        return self.full_hypos
+    
+    def _score_trie(self, root, edges):
+        """Traverses the prefix trie depth-first and scores all edges.
+        
+        Args:
+            root (dict): Root of the trie. Nodes are dictionaries 
+                         mapping words to child nodes. </S> maps to
+                         None
+            edges (dict): Filled with (node id, word) -> edge index
+        """
+        n_nodes = 0
+        stack = [(root, None, None)]
+        while stack:
+            node, states, word = stack.pop()
+            if states is not None:
+                self.set_predictor_states(states)
+                self.consume(word)
+            node_id = n_nodes
+            n_nodes += 1
+            self.apply_predictors_count += 1
+            words = sorted(node.iterkeys())
+            unk_scores = []
+            target_scores = []
+            for (p, _) in self.predictors:
+                if isinstance(p, UnboundedVocabularyPredictor):
+                    posterior = p.predict_next(words)
+                else: 
+                    posterior = p.predict_next()
+                unk_prob = p.get_unk_probability(posterior)
+                unk_scores.append(unk_prob)
+                target_scores.append([utils.common_get(posterior, w, unk_prob)
+                                      for w in words])
+                self._add_posterior_stats(posterior)
+            self.sen_stats["unk_scores"].append(unk_scores)
+            for idx, w in enumerate(words):
+                edges[(id(node), w)] = len(self.sen_stats["edge_nodes"])
+                self.sen_stats["edge_nodes"].append(node_id)
+                self.sen_stats["target_scores"].append(
+                                        [s[idx] for s in target_scores])
+            children = [(w, node[w]) for w in reversed(words) 
+                        if node[w] is not None]
+            if not children:
+                continue
+            states = self.get_predictor_states()
+            for w, child in children[:-1]:
+                stack.append((child, copy.deepcopy(states), w))
+            w, child = children[-1]
+            stack.append((child, states, w))
+    
+    def _add_posterior_stats(self, posterior):
+        """Extracts entropy, top-k, and the full posterior (depending
+        on ``stats``) for a single predictor posterior.
+        """
+        if isinstance(posterior, dict):
+            words = np.fromiter(posterior.iterkeys(), dtype=np.int32, 
+                                count=len(posterior))
+            scores = np.fromiter(posterior.itervalues(), dtype=np.float64,
+                                 count=len(posterior))
+        else:
+            scores = np.asarray(posterior, dtype=np.float64)
+            words = np.arange(len(scores), dtype=np.int32)
+        if "entropy" in self.stats:
+            finite = scores[scores > NEG_INF]
+            self.sen_stats["entropy"].append(
+                                -np.sum(np.exp(finite) * finite))
+        if "topk" in self.stats:
+            top_words = np.full((self.topk,), -1, dtype=np.int32)
+            top_scores = np.full((self.topk,), NEG_INF, dtype=np.float16)
+            if len(scores) > self.topk:
+                idx = np.argpartition(-scores, self.topk)[:self.topk]
+            else:
+                idx = np.arange(len(scores))
+            idx = idx[np.argsort(-scores[idx], kind="mergesort")]
+            top_words[:len(idx)] = words[idx]
+            top_scores[:len(idx)] = scores[idx]
+            self.sen_stats["topk_words"].append(top_words)
+            self.sen_stats["topk_scores"].append(top_scores)
+        if "posteriors" in self.stats:
+            self.sen_stats["post_words"].append(words)
+            self.sen_stats["post_scores"].append(scores.astype(np.float16))
+    
+    def _add_references(self, root, refs, edges):
+        """Adds full hypotheses for all references and collects the
+        reference level statistics.
+        """
+        target_scores = self.sen_stats["target_scores"]
+        weights = [w for (_, w) in self.predictors]
+        for ref in refs:
+            node = root
+            score = 0.0
+            score_breakdown = []
+            for w in ref:
+                edge = edges[(id(node), w)]
+                breakdown = zip(target_scores[edge], weights)
+                score += sum(s*weight for (s, weight) in breakdown)
+                score_breakdown.append(breakdown)
+                self.sen_stats["token_edges"].append(edge)
+                node = node[w]
+            self.sen_stats["ref_scores"].append(score)
+            self.add_full_hypo(core.Hypothesis(ref, score, score_breakdown))
+
+    def _init_sentence_stats(self):
+        """Resets the statistics buffers for the next sentence. """
+        self.sen_stats = {"unk_scores": [],
+                          "edge_nodes": [],
+                          "target_scores": [],
+                          "token_edges": [],
+                          "ref_scores": [],
+                          "entropy": [],
+                          "topk_words": [],
+                          "topk_scores": [],
+                          "post_words": [],
+                          "post_scores": []}
+    
+    def _write_sentence_stats(self):
+        """Appends the statistics of the current sentence to the
+        store. Node and edge indices are shifted to global indices.
+        """
+        n_preds = len(self.predictors)
+        w = self.writer
+        stats = self.sen_stats
+        node_offset = w.size("unk_scores")
+        edge_offset = w.size("edge_nodes")
+        token_offset = w.size("tokens")
+        w.append("sen_ids", self.current_sen_id, dtype=np.int32)
+        w.append("sen_refs", w.size("ref_scores") + len(self.full_hypos),
+                 dtype=np.int64)
+        tokens = [t for hypo in self.full_hypos for t in hypo.trgt_sentence]
+        w.append("tokens", np.array(tokens, dtype=np.int32))
+        w.append("token_edges", 
+                 edge_offset + np.array(stats["token_edges"], dtype=np.int64))
+        w.append("ref_tokens", token_offset + np.cumsum(
+                    [len(hypo.trgt_sentence) for hypo in self.full_hypos],
+                    dtype=np.int64))
+        w.append("ref_scores", np.array(stats["ref_scores"], 
+                                        dtype=np.float64))
+        w.append("edge_nodes", 
+                 node_offset + np.array(stats["edge_nodes"], dtype=np.int64))
+        w.append("unk_scores", np.array(stats["unk_scores"],
+                                        dtype=np.float32).reshape(-1, n_preds))
+        if "target" in self.stats:
+            w.append("target_scores", 
+                     np.array(stats["target_scores"],
+                              dtype=np.float32).reshape(-1, n_preds))
+        if "entropy" in self.stats:
+            w.append("entropy", np.array(stats["entropy"],
+                                         dtype=np.float32).reshape(-1, n_preds))
+        if "topk" in self.stats:
+            w.append("topk_words", np.array(
+                stats["topk_words"],
+                dtype=np.int32).reshape(-1, n_preds, self.topk))
+            w.append("topk_scores", np.array(
+                stats["topk_scores"],
+                dtype=np.float16).reshape(-1, n_preds, self.topk))
+        if "posteriors" in self.stats:
+            lengths = [len(p) for p in stats["post_words"]]
+            w.append("post_offsets", w.size("post_words") 
+                     + np.cumsum(lengths, dtype=np.int64))
+            if lengths and sum(lengths) > 0:
+                w.append("post_words", np.concatenate(stats["post_words"]))
+                w.append("post_scores", np.concatenate(stats["post_scores"]))
+            else:
+                w.append("post_words", np.zeros((0,), dtype=np.int32))
+                w.append("post_scores", np.zeros((0,), dtype=np.float16))
+        self.last_meta_data = None
+
+
+def load_references(path):
+    """Loads the target references. If the lines in ``path`` contain
+    '|||', the file is read as n-best list in Moses format with 
+    multiple references per sentence. Otherwise, each line contains
+    a single reference.
+    
+    Args:
+        path (string): Path to the text file
+    
+    Returns:
+        list. List of reference lists for each sentence
+    """
+    if not path:
+        logging.fatal("Please specify the path to the target sentences.")
+        return []
+    refs = []
+    try:
+        with open(path) as f:
+            for line in f:
+                if not "|||" in line:
+                    refs.append([map(int, line.strip().split())])
+                    continue
+                parts = line.split("|||")
+                sen_id = int(parts[0].strip())
+                while len(refs) <= sen_id:
+                    refs.append([])
+                sen = map(int, parts[1].strip().split())
+                if sen and sen[0] == utils.GO_ID:
+                    sen = sen[1:]
+                if sen and sen[-1] == utils.EOS_ID:
+                    sen = sen[:-1]
+                refs[sen_id].append(sen)
+    except ValueError:
+        logging.fatal("Non-numeric characters in target sentence file %s"
+                      % path)
+    except IOError:
+        logging.fatal("Could not read target sentence file %s" % path)
+    return refs
+
+
 def load_sentences(path, name="source"):
     """Loads sentences from a plain (indexed) text file.
 
@@ -154,10 +445,9 @@ def to_json(o, level=0):
     return ret
 
 
-decoder = ForcedDecoder(args) 
-decode_utils.add_predictors(decoder)
-
-if "pickle" in args.outputs:
+if "store" in args.outputs:
+    out_format = "store"
+elif "pickle" in args.outputs:
     out_format = "pickle"
     mode = "wb"
 else:
@@ -171,13 +461,22 @@ if '%s' in args.output_path:
 else:
     out_path = args.output_path
 
+if out_format == "store":
+    store_writer = ArrayStoreWriter(out_path, {
+                "format": "forced_scores",
+                "predictors": args.predictors.split(","),
+                "stats": args.forced_stats.split(","),
+                "topk": args.forced_topk})
+    decoder = TrieForcedDecoder(args, store_writer)
+else:
+    decoder = ForcedDecoder(args) 
+decode_utils.add_predictors(decoder)
+
 
-with open(out_path, mode) as writer:
-    if out_format == "json":
-        writer.write("[\n")
-        json_comma = ""
-    else:
-        all_meta_data = []
+def decode_all(write_meta_data):
+    """Decodes all sentences in the range and passes the meta data of
+    each sentence to ``write_meta_data``.
+    """
     src_sentences = load_sentences(args.src_test, "source")
     for sen_idx in decode_utils.get_sentence_indices(args.range, src_sentences):
         decoder.set_current_sen_id(sen_idx)
@@ -188,6 +487,9 @@ with open(out_path, mode) as writer:
             start_hypo_time = time.time()
             decoder.apply_predictors_count = 0
             hypos = [hypo for hypo in decoder.decode(src)]
+            if not hypos:
+                logging.info("No references for sentence ID %d" % (sen_idx+1))
+                continue
             logging.info("Decoded (ID: %d): %s" % (
                     sen_idx+1,
                     " ".join(map(str, hypos[0].trgt_sentence))))
@@ -203,14 +505,24 @@ with open(out_path, mode) as writer:
                                                        sen_idx+1,
                                                        e,
                                                        traceback.format_exc()))
+        write_meta_data(decoder.last_meta_data)
+
+
+if out_format == "store":
+    decode_all(lambda meta_data: None)
+    store_writer.close()
+else:
+    with open(out_path, mode) as writer:
         if out_format == "json":
-            writer.write(json_comma + to_json(
-                    decoder.last_meta_data).replace("inf", "Infinity"))
-            json_comma = ",\n"
+            writer.write("[\n")
+            json_comma = [""]
+            def write_json(meta_data):
+                writer.write(json_comma[0] + to_json(
+                        meta_data).replace("inf", "Infinity"))
+                json_comma[0] = ",\n"
+            decode_all(write_json)
+            writer.write("\n]")
         else:
-            all_meta_data.append(decoder.last_meta_data)
-    if out_format == "json":
-        writer.write("\n]")
-    else:
-        pickle.dump(all_meta_data, writer)
-
+            all_meta_data = []
+            decode_all(all_meta_data.append)
+            pickle.dump(all_meta_data, writer)
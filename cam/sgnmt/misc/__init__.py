@@ -4,5 +4,9 @@ framework (blocks, tensorflow...). For example, this includes rolling
 out sparse features into a dense representation or searching for the 
 best surface form for a given attribute vector. ``trie`` contains a
 generic trie implementation, ``unigram`` can be used for keeping 
-track of unigram statistics during decoding.
+track of unigram statistics during decoding. ``cache`` provides a
+bounded LRU cache, and ``arraystore`` a memory-mappable container for
+numpy arrays which is used e.g. by ``ngramstore``. ``bleu`` computes
+corpus-level BLEU scores in-process. ``corpus`` stores indexed training
+corpora in memory-mappable form, and ``vocab`` word maps.
 """
\ No newline at end of file
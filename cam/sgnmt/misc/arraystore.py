@@ -0,0 +1,216 @@
+"""This module implements a simple binary container for named numpy
+arrays which can be memory-mapped. Large per-corpus data structures
+(e.g. n-gram posteriors for all sentences of a test set) can be
+written into a single ``ArrayStore`` file once and then be accessed
+lazily by many processes, which share the pages via the OS page cache
+instead of parsing text files over and over again.
+
+File layout: An 8 byte magic string, the length of the JSON header as
+little-endian uint64, the JSON header itself, and the raw array data.
+Each array starts at an offset aligned to ``ALIGNMENT`` bytes. The
+header stores dtype, shape, and offset of each array, and an
+arbitrary JSON-serializable ``meta`` dictionary.
+"""
+
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+
+MAGIC = b"SGNMTAS1"
+"""Magic string at the beginning of each array store file. """
+
+
+ALIGNMENT = 64
+"""Arrays in the store are aligned to this number of bytes. """
+
+
+def _align(offset):
+    """Rounds ``offset`` up to the next multiple of ``ALIGNMENT``. """
+    return ((offset + ALIGNMENT - 1) // ALIGNMENT) * ALIGNMENT
+
+
+def is_array_store(path):
+    """Returns true if ``path`` points to an array store file. """
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+class ArrayStoreWriter(object):
+    """Writes an array store incrementally. Arrays are built up by
+    appending chunks along the first axis with ``append()``. Chunks
+    are buffered in temporary files next to the target path, so the
+    memory footprint does not depend on the size of the store. The
+    final file is assembled and atomically moved to ``path`` in
+    ``close()``.
+    """
+
+    def __init__(self, path, meta=None):
+        """Creates a new writer.
+
+        Args:
+            path (string): Path to the store file to create
+            meta (dict): JSON-serializable meta data
+        """
+        self.path = path
+        self.meta = meta if meta is not None else {}
+        self.tmp_dir = tempfile.mkdtemp(
+            prefix=".sgnmt-store.",
+            dir=os.path.dirname(os.path.abspath(path)))
+        self.streams = {}
+        self.names = []
+
+    def append(self, name, arr, dtype=None):
+        """Appends ``arr`` to the array ``name`` along the first axis.
+        The dtype and the trailing dimensions are fixed by the first
+        call for each name.
+
+        Args:
+            name (string): Name of the array
+            arr (array): Array-like chunk to append. Scalars are
+                         appended as single element
+            dtype (type): Numpy dtype. Defaults to the dtype of the
+                          first chunk
+
+        Raises:
+            ValueError if the chunk is incompatible with previous ones
+        """
+        if name in self.streams:
+            stream = self.streams[name]
+            arr = np.asarray(arr, dtype=stream["dtype"])
+            if arr.ndim == 0:
+                arr = arr.reshape((1,))
+            if list(arr.shape[1:]) != stream["inner_shape"]:
+                raise ValueError("Shape mismatch when appending to %s" % name)
+        else:
+            arr = np.asarray(arr, dtype=dtype)
+            if arr.ndim == 0:
+                arr = arr.reshape((1,))
+            stream = {"dtype": arr.dtype,
+                      "inner_shape": list(arr.shape[1:]),
+                      "rows": 0,
+                      "file": open(os.path.join(self.tmp_dir,
+                                                "%d.bin" % len(self.names)),
+                                   "wb")}
+            self.streams[name] = stream
+            self.names.append(name)
+        stream["file"].write(np.ascontiguousarray(arr).tobytes())
+        stream["rows"] += arr.shape[0]
+
+    def size(self, name):
+        """Returns the number of rows written to ``name`` so far. """
+        if name in self.streams:
+            return self.streams[name]["rows"]
+        return 0
+
+    def close(self):
+        """Assembles the store file and removes temporary files. """
+        specs = {}
+        offset = 0
+        for name in self.names:
+            stream = self.streams[name]
+            stream["file"].close()
+            specs[name] = {"dtype": stream["dtype"].str,
+                           "shape": [stream["rows"]] + stream["inner_shape"],
+                           "offset": offset}
+            offset = _align(offset + os.path.getsize(stream["file"].name))
+        header = json.dumps({"meta": self.meta,
+                             "arrays": specs}).encode("utf-8")
+        data_start = _align(len(MAGIC) + 8 + len(header))
+        # Unique temporary file in the target directory such that
+        # concurrent writers of the same store do not interfere, and
+        # os.rename() stays atomic
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=".sgnmt-store.",
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(MAGIC)
+                f.write(struct.pack("<Q", len(header)))
+                f.write(header)
+                for name in self.names:
+                    f.seek(data_start + specs[name]["offset"])
+                    with open(self.streams[name]["file"].name, "rb") as src:
+                        shutil.copyfileobj(src, f)
+                f.truncate(max(f.tell(), data_start))
+            os.chmod(tmp_path, 0o644) # mkstemp creates files with 0600
+            os.rename(tmp_path, self.path)
+        except:
+            os.remove(tmp_path)
+            raise
+        finally:
+            shutil.rmtree(self.tmp_dir)
+        logging.debug("Wrote array store %s with %d arrays"
+                      % (self.path, len(self.names)))
+
+
+def write_array_store(path, arrays, meta=None):
+    """Writes a complete array store at once.
+
+    Args:
+        path (string): Path to the store file to create
+        arrays (dict): Mapping from array names to numpy arrays
+        meta (dict): JSON-serializable meta data
+    """
+    writer = ArrayStoreWriter(path, meta)
+    for name, arr in sorted(arrays.items()):
+        writer.append(name, arr)
+    writer.close()
+
+
+class ArrayStore(object):
+    """Read access to an array store. Arrays are memory-mapped lazily
+    on first access and are read-only.
+    """
+
+    def __init__(self, path):
+        """Reads the header of the store at ``path``.
+
+        Args:
+            path (string): Path to the store file
+
+        Raises:
+            IOError if ``path`` is not a valid array store
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError("%s is not an SGNMT array store" % path)
+            header_len = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_len).decode("utf-8"))
+        self.data_start = _align(len(MAGIC) + 8 + header_len)
+        self.meta = header["meta"]
+        self.specs = header["arrays"]
+        self.arrays = {}
+
+    def keys(self):
+        """Returns the names of all arrays in the store. """
+        return list(self.specs.keys())
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def __getitem__(self, name):
+        """Returns the memory-mapped array ``name``. """
+        arr = self.arrays.get(name)
+        if arr is None:
+            spec = self.specs[name]
+            shape = tuple(spec["shape"])
+            if 0 in shape: # Zero-sized arrays cannot be memory-mapped
+                arr = np.zeros(shape, dtype=spec["dtype"])
+            else:
+                arr = np.memmap(self.path,
+                                dtype=np.dtype(spec["dtype"]),
+                                mode="r",
+                                offset=self.data_start + spec["offset"],
+                                shape=shape)
+            self.arrays[name] = arr
+        return arr
@@ -0,0 +1,118 @@
+"""This module computes corpus-level BLEU scores in-process. The
+implementation follows the conventions of the ``multi-bleu.perl``
+script in Moses (whitespace tokenization, clipped n-gram counts up to
+order 4, brevity penalty with the closest reference length), so scores
+are comparable to the ones reported by the script. The sufficient
+statistics are accumulated sentence by sentence, which makes it
+possible to compute the BLEU score incrementally while translations
+are generated, without writing them to a subprocess.
+"""
+
+from collections import Counter
+import math
+
+
+def _get_ngram_counts(words, max_order):
+    """Counts all n-grams in ``words`` up to ``max_order``.
+
+    Args:
+        words (list): List of tokens
+        max_order (int): Maximum n-gram order
+
+    Returns:
+        list. List of ``Counter`` objects, one for each order
+    """
+    return [Counter(tuple(words[i:i+n]) for i in xrange(len(words)-n+1))
+            for n in xrange(1, max_order+1)]
+
+
+class IncrementalBleu(object):
+    """Collects n-gram statistics for hypothesis-reference pairs and
+    computes the corpus-level BLEU score from them.
+    """
+
+    def __init__(self, max_order=4):
+        """Creates an empty BLEU accumulator.
+
+        Args:
+            max_order (int): Maximum n-gram order
+        """
+        self.max_order = max_order
+        self.reset()
+
+    def reset(self):
+        """Removes all collected statistics. """
+        self.correct = [0] * self.max_order
+        self.total = [0] * self.max_order
+        self.hyp_length = 0
+        self.ref_length = 0
+
+    def add(self, hypothesis, references):
+        """Adds statistics for a single sentence.
+
+        Args:
+            hypothesis (list): Tokens of the hypothesis
+            references (list): Either a list of tokens for a single
+                               reference, or a list of such lists
+                               for multiple references
+        """
+        if references and not isinstance(references[0], list):
+            references = [references]
+        hyp_len = len(hypothesis)
+        self.hyp_length += hyp_len
+        closest_len = None
+        max_ref_counts = [Counter() for _ in xrange(self.max_order)]
+        for ref in references:
+            ref_len = len(ref)
+            if (closest_len is None
+                    or abs(hyp_len - ref_len) < abs(hyp_len - closest_len)
+                    or (abs(hyp_len - ref_len) == abs(hyp_len - closest_len)
+                        and ref_len < closest_len)):
+                closest_len = ref_len
+            for max_counts, counts in zip(max_ref_counts,
+                                          _get_ngram_counts(ref,
+                                                            self.max_order)):
+                for ngram, count in counts.iteritems():
+                    if count > max_counts[ngram]:
+                        max_counts[ngram] = count
+        self.ref_length += closest_len if closest_len is not None else 0
+        for n, counts in enumerate(_get_ngram_counts(hypothesis,
+                                                     self.max_order)):
+            self.total[n] += sum(counts.itervalues())
+            self.correct[n] += sum(min(count, max_ref_counts[n][ngram])
+                                   for ngram, count in counts.iteritems())
+
+    def get_precisions(self):
+        """Returns the n-gram precisions for all orders. """
+        return [float(c) / t if t else 0.0
+                for c, t in zip(self.correct, self.total)]
+
+    def get_brevity_penalty(self):
+        """Returns the brevity penalty. """
+        if self.hyp_length == 0:
+            return 0.0
+        if self.hyp_length < self.ref_length:
+            return math.exp(1.0 - float(self.ref_length) / self.hyp_length)
+        return 1.0
+
+    def score(self):
+        """Returns the BLEU score for the statistics collected so far
+        as percentage (like ``multi-bleu.perl``).
+        """
+        precisions = self.get_precisions()
+        if self.ref_length == 0 or not all(precisions):
+            return 0.0
+        log_prec = sum(math.log(p) for p in precisions) / self.max_order
+        return 100.0 * self.get_brevity_penalty() * math.exp(log_prec)
+
+    def __str__(self):
+        """Summary in the output format of ``multi-bleu.perl``. """
+        return "BLEU = %.2f, %s (BP=%.3f, ratio=%.3f, hyp_len=%d, " \
+               "ref_len=%d)" % (
+                   self.score(),
+                   '/'.join(["%.1f" % (100.0*p)
+                             for p in self.get_precisions()]),
+                   self.get_brevity_penalty(),
+                   float(self.hyp_length) / max(1, self.ref_length),
+                   self.hyp_length,
+                   self.ref_length)
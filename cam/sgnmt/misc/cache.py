@@ -0,0 +1,77 @@
+"""This module contains ``LRUCache``, a simple bounded key-value cache
+with least-recently-used eviction. Predictors and heuristics can use it
+to share expensive results (e.g. posteriors for a given context)
+between hypotheses without letting memory grow without bound.
+"""
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Bounded mapping which evicts the least recently used entry when
+    the capacity is exceeded. Both ``get`` and ``add`` mark the key as
+    recently used. Keys have to be hashable.
+    """
+
+    def __init__(self, capacity):
+        """Creates an empty cache.
+
+        Args:
+            capacity (int): Maximum number of entries. If this is not
+                            positive, the cache is unbounded.
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Retrieve the element stored under ``key``.
+
+        Args:
+            key (object): Hashable query key
+            default (object): Return value if ``key`` is not cached
+
+        Returns:
+            object. The cached element or ``default``
+        """
+        try:
+            element = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = element
+        self.hits += 1
+        return element
+
+    def add(self, key, element):
+        """Add an element to the cache. If the cache is full, the least
+        recently used entry is removed.
+
+        Args:
+            key (object): Hashable key
+            element (object): The object to store for ``key``
+        """
+        if key in self.entries:
+            del self.entries[key]
+        elif self.capacity > 0 and len(self.entries) >= self.capacity:
+            self.entries.popitem(last=False)
+        self.entries[key] = element
+
+    def pop(self, key, default=None):
+        """Removes ``key`` from the cache and returns its element, or
+        ``default`` if ``key`` is not cached.
+        """
+        return self.entries.pop(key, default)
+
+    def clear(self):
+        """Removes all entries and resets the hit statistics. """
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,163 @@
+"""This module converts indexed plain text corpora (one sentence of
+word ids per line) into a memory-mappable ``ArrayStore``. Training
+data pipelines usually keep all sentences as Python lists in memory,
+which needs a lot of resident memory for corpora with millions of
+sentences. A corpus store contains two flat arrays:
+
+  - ``tokens``: The word ids of all sentences as int32, concatenated
+  - ``offsets``: Start position of each sentence in ``tokens`` (+1
+    entry), i.e. sentence ``i`` is ``tokens[offsets[i]:offsets[i+1]]``
+
+Word ids are stored as they are in the text file. The vocabulary
+size is applied when sentences are read from the store, so that the
+same store can be used with different vocabulary sizes.
+
+The module can be used as script::
+
+  python -m cam.sgnmt.misc.corpus --input train.ids.en \\
+                                  --output train.ids.en.store
+"""
+
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from cam.sgnmt import utils
+from cam.sgnmt.misc.arraystore import ArrayStore, ArrayStoreWriter, \
+                                      is_array_store
+
+
+CORPUS_STORE_CHUNK_SIZE = 100000
+"""Number of sentences which are converted at once. """
+
+
+def build_corpus_store(text_path, store_path):
+    """Converts an indexed plain text file to a corpus store.
+
+    Args:
+        text_path (string): Path to the text file with word ids
+        store_path (string): Path to the store file to create
+
+    Raises:
+        IOError. If the text file could not be read
+        ValueError. If the text file contains non-integer tokens
+    """
+    writer = ArrayStoreWriter(store_path, {"format": "corpus"})
+    writer.append("offsets", [0], dtype=np.int64)
+    writer.append("tokens", np.zeros((0,), dtype=np.int32))
+    n_tokens = 0
+    n_sentences = 0
+    tokens = []
+    offsets = []
+    with open(text_path) as f:
+        for line in f:
+            tokens.extend(int(w) for w in line.split())
+            offsets.append(n_tokens + len(tokens))
+            if len(offsets) >= CORPUS_STORE_CHUNK_SIZE:
+                writer.append("tokens", tokens, dtype=np.int32)
+                writer.append("offsets", offsets, dtype=np.int64)
+                n_tokens += len(tokens)
+                n_sentences += len(offsets)
+                tokens = []
+                offsets = []
+    writer.append("tokens", np.asarray(tokens, dtype=np.int32))
+    writer.append("offsets", np.asarray(offsets, dtype=np.int64))
+    n_sentences += len(offsets)
+    writer.close()
+    logging.info("Stored %d sentences from %s in %s"
+                 % (n_sentences, text_path, store_path))
+
+
+def get_corpus_store(text_path):
+    """Returns the path to the corpus store for ``text_path``. If
+    ``text_path`` is a corpus store itself, return it directly.
+    Otherwise, the store is ``text_path`` plus the suffix '.store'. It
+    is created if it does not exist or is older than the text file.
+
+    Args:
+        text_path (string): Path to a text file or a corpus store
+
+    Returns:
+        string. Path to the corpus store
+    """
+    if is_array_store(text_path):
+        return text_path
+    store_path = "%s.store" % text_path
+    if (not os.path.isfile(store_path)
+            or os.path.getmtime(store_path) < os.path.getmtime(text_path)):
+        build_corpus_store(text_path, store_path)
+    return store_path
+
+
+class CorpusStore(object):
+    """Read access to a corpus store. Sentences can be accessed like in
+    a list of sentences loaded with ``load_sentences_from_file`` in
+    ``cam.sgnmt.blocks.stream``: Indexing returns a list of word ids
+    with </S> at the end in which tokens which are not in the
+    vocabulary are replaced with UNK. Only the sentences which are
+    accessed are paged in.
+    """
+
+    def __init__(self, path, vocab_size):
+        """Opens the corpus store at ``path``.
+
+        Args:
+            path (string): Path to the store
+            vocab_size (int): Vocabulary size. Larger word ids are
+                              replaced with ``utils.UNK_ID``
+        """
+        self.path = path
+        self.vocab_size = vocab_size
+        store = ArrayStore(path)
+        self.tokens = store["tokens"]
+        self.offsets = store["offsets"]
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_ids(self, idx):
+        """Returns the word ids of sentence ``idx`` as numpy array with
+        UNK replacement and </S> at the end.
+        """
+        ids = np.empty(self.lengths[idx] + 1, dtype=np.int32)
+        ids[:-1] = self.tokens[self.offsets[idx]:self.offsets[idx+1]]
+        ids[ids >= self.vocab_size] = utils.UNK_ID
+        ids[-1] = utils.EOS_ID
+        return ids
+
+    def __getitem__(self, idx):
+        """Returns sentence ``idx`` as list of integers. """
+        return self.get_ids(idx).tolist()
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+    def __getstate__(self):
+        """Only the path and vocabulary size are pickled. """
+        return self.path, self.vocab_size
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+def main():
+    """Command line interface for ``build_corpus_store``. """
+    parser = argparse.ArgumentParser(
+        description="Converts an indexed text file into a memory-mappable "
+        "corpus store.")
+    parser.add_argument("--input", required=True,
+                        help="Path to the indexed text file.")
+    parser.add_argument("--output", required=True,
+                        help="Path to the store file to create.")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=logging.INFO)
+    build_corpus_store(args.input, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""This module converts MBR-style n-gram posteriors as used by the
+``ngramc`` predictor into a single memory-mappable ``ArrayStore``.
+The text format has one file per sentence with lines of the form
+'<ngram> : <score>'. Parsing these files for every sentence is often
+slower than decoding itself, so this module builds a reversed trie
+over n-gram histories for each sentence and stores all tries in flat
+arrays:
+
+  - ``sen_nodes``: Node offsets for each sentence (+1 entry). The first
+    node of each sentence is the root (empty history)
+  - ``sen_max_hist``: Maximum history length for each sentence
+  - ``child_offsets``, ``child_words``, ``child_nodes``: Outgoing edges
+    of each node, sorted by word. Edges are labelled with history words
+    in reverse order, i.e. the most recent word comes first
+  - ``post_offsets``, ``post_words``, ``post_scores``: n-gram
+    posteriors for the history at each node, sorted by word
+
+The module can be used as script::
+
+  python -m cam.sgnmt.misc.ngramstore --input ngramc/%d.txt \\
+                                      --output ngramc.store
+"""
+
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from cam.sgnmt.misc.arraystore import ArrayStore, ArrayStoreWriter
+
+
+def read_ngram_posteriors(path):
+    """Parses a single n-gram posterior file.
+
+    Args:
+        path (string): Path to the text file (format: <ngram> : <score>)
+
+    Returns:
+        list. List of (words, score) tuples
+    """
+    ngrams = []
+    with open(path) as f:
+        for line in f:
+            ngram, score = line.split(':')
+            ngrams.append(([int(w) for w in ngram.strip().split()],
+                           float(score.strip())))
+    return ngrams
+
+
+def _build_reversed_trie(ngrams):
+    """Builds a reversed history trie from a list of (words, score)
+    tuples. Nodes are dictionaries with the keys 'children' and
+    'posterior'. Returns the root node and the maximum history length.
+    """
+    root = {'children': {}, 'posterior': {}}
+    max_hist = 0
+    for words, score in ngrams:
+        hist = words[:-1]
+        max_hist = max(max_hist, len(hist))
+        node = root
+        for w in reversed(hist):
+            children = node['children']
+            if not w in children:
+                children[w] = {'children': {}, 'posterior': {}}
+            node = children[w]
+        node['posterior'][words[-1]] = score
+    return root, max_hist
+
+
+def build_ngram_store(path_template, store_path, n_sentences=0):
+    """Converts per-sentence n-gram posterior files to a single array
+    store.
+
+    Args:
+        path_template (string): Path to the text files. The placeholder
+                                %d is replaced with the sentence id
+                                (starting at 1)
+        store_path (string): Path to the store file to create
+        n_sentences (int): Number of sentences. If not positive, read
+                           files until the first one is missing
+    """
+    writer = ArrayStoreWriter(store_path, {"format": "ngramc"})
+    writer.append("sen_nodes", [0], dtype=np.int64)
+    writer.append("child_offsets", [0], dtype=np.int64)
+    writer.append("post_offsets", [0], dtype=np.int64)
+    if n_sentences <= 0 and not "%d" in path_template:
+        n_sentences = 1
+    n_nodes = 0
+    n_edges = 0
+    n_posts = 0
+    sen_id = 1
+    while n_sentences <= 0 or sen_id <= n_sentences:
+        try:
+            path = path_template % sen_id
+        except TypeError:
+            path = path_template
+        if n_sentences <= 0 and not os.path.isfile(path):
+            break
+        root, max_hist = _build_reversed_trie(read_ngram_posteriors(path))
+        # Assign node ids in breadth-first order
+        nodes = [root]
+        idx = 0
+        while idx < len(nodes):
+            node = nodes[idx]
+            node['id'] = n_nodes + idx
+            for w in sorted(node['children']):
+                nodes.append(node['children'][w])
+            idx += 1
+        child_offsets = []
+        child_words = []
+        child_nodes = []
+        post_offsets = []
+        post_words = []
+        post_scores = []
+        for node in nodes:
+            for w in sorted(node['children']):
+                child_words.append(w)
+                child_nodes.append(node['children'][w]['id'])
+            n_edges += len(node['children'])
+            child_offsets.append(n_edges)
+            for w in sorted(node['posterior']):
+                post_words.append(w)
+                post_scores.append(node['posterior'][w])
+            n_posts += len(node['posterior'])
+            post_offsets.append(n_posts)
+        n_nodes += len(nodes)
+        writer.append("sen_nodes", [n_nodes], dtype=np.int64)
+        writer.append("sen_max_hist", [max_hist], dtype=np.int32)
+        writer.append("child_offsets", child_offsets, dtype=np.int64)
+        writer.append("child_words", child_words, dtype=np.int32)
+        writer.append("child_nodes", child_nodes, dtype=np.int64)
+        writer.append("post_offsets", post_offsets, dtype=np.int64)
+        writer.append("post_words", post_words, dtype=np.int32)
+        writer.append("post_scores", post_scores, dtype=np.float64)
+        logging.debug("Converted n-gram posteriors in %s (%d nodes)"
+                      % (path, len(nodes)))
+        sen_id += 1
+    writer.close()
+    logging.info("Stored n-gram posteriors for %d sentences in %s"
+                 % (sen_id - 1, store_path))
+
+
+class NgramPosteriorStore(object):
+    """Read access to n-gram posteriors created with
+    ``build_ngram_store``. Only the slices for the nodes which are
+    actually visited are paged in.
+    """
+
+    def __init__(self, path):
+        """Opens the store at ``path``. """
+        store = ArrayStore(path)
+        self.sen_nodes = store["sen_nodes"]
+        self.sen_max_hist = store["sen_max_hist"]
+        self.child_offsets = store["child_offsets"]
+        self.child_words = store["child_words"]
+        self.child_nodes = store["child_nodes"]
+        self.post_offsets = store["post_offsets"]
+        self.post_words = store["post_words"]
+        self.post_scores = store["post_scores"]
+
+    def get_root(self, sen_idx):
+        """Returns the root node and maximum history length for the
+        sentence with index ``sen_idx`` (starting at 0).
+        """
+        return int(self.sen_nodes[sen_idx]), int(self.sen_max_hist[sen_idx])
+
+    def get_child(self, node, word):
+        """Follows the edge labelled with ``word`` from ``node``.
+
+        Returns:
+            int. The child node or -1 if there is no such edge
+        """
+        lo = self.child_offsets[node]
+        hi = self.child_offsets[node+1]
+        if lo == hi:
+            return -1
+        words = self.child_words[lo:hi]
+        pos = words.searchsorted(word)
+        if pos < hi - lo and words[pos] == word:
+            return int(self.child_nodes[lo+pos])
+        return -1
+
+    def match_history(self, root, history):
+        """Returns the nodes for all suffixes of ``history`` which are
+        in the trie, ordered by increasing suffix length.
+
+        Args:
+            root (int): Root node of the current sentence
+            history (list): Word history
+
+        Returns:
+            list. List of (suffix_length, node) tuples
+        """
+        matches = [(0, root)]
+        node = root
+        for depth, w in enumerate(reversed(history)):
+            node = self.get_child(node, w)
+            if node < 0:
+                break
+            matches.append((depth+1, node))
+        return matches
+
+    def get_posterior(self, node):
+        """Returns the words and scores stored at ``node`` as arrays. """
+        lo = self.post_offsets[node]
+        hi = self.post_offsets[node+1]
+        return self.post_words[lo:hi], self.post_scores[lo:hi]
+
+
+def main():
+    """Command line interface for ``build_ngram_store``. """
+    parser = argparse.ArgumentParser(
+        description="Converts n-gram posterior files for the ngramc "
+        "predictor into a single memory-mappable store.")
+    parser.add_argument("--input", required=True,
+                        help="Path to the n-gram posterior files. Use the "
+                        "placeholder %%d for the sentence id.")
+    parser.add_argument("--output", required=True,
+                        help="Path to the store file to create.")
+    parser.add_argument("--n_sentences", default=0, type=int,
+                        help="Number of sentences. If not positive, read "
+                        "files until the first missing one.")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=logging.INFO)
+    build_ngram_store(args.input, args.output, args.n_sentences)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,12 +7,24 @@ be activated at a time.
 """
 
 from abc import abstractmethod
-from cam.sgnmt.misc.trie import SimpleTrie
 import copy
 import logging
 import numpy as np
 import operator
 
+try:
+    # Requires scikit-learn
+    from sklearn.neighbors import BallTree
+except ImportError:
+    pass # Fall back to brute force search in DenseNearestNeighbors
+
+
+KNN_BRUTE_FORCE_MAX_WORDS = 100000
+"""The 'auto' index of ``DenseNearestNeighbors`` uses brute force 
+search for tables with up to this number of words, and a ball tree 
+for larger tables.
+"""
+
 
 def sparse_euclidean2(v1, v2):
     """Calculates the squared Euclidean distance between two sparse 
@@ -75,6 +87,77 @@ def dense_euclidean(v1, v2):
     return np.sqrt(dense_euclidean2(v1, v2))
 
 
+class DenseNearestNeighbors(object):
+    """Nearest neighbor search over a table of word feature vectors.
+    The table is stored as dense matrix. Queries are processed in
+    batches, i.e. the n nearest words for all vectors in a beam can be
+    retrieved with a single call. The default brute force search 
+    computes all squared Euclidean distances with one matrix product.
+    For large vocabularies, a ball tree index (requires scikit-learn)
+    can be used instead.
+    """
+    
+    def __init__(self, words, vectors, index='auto', leaf_size=40):
+        """Creates the search index.
+        
+        Args:
+            words (list): Word IDs corresponding to the rows in 
+                          ``vectors``
+            vectors (array): Feature table (one row for each word)
+            index (string): 'brute' for exact brute force search,
+                            'balltree' for a ball tree index, 'auto'
+                            to select according the table size
+            leaf_size (int): Leaf size of the ball tree
+        """
+        self.words = np.asarray(words, dtype=np.int64)
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.sq_norms = np.sum(self.vectors**2, axis=1)
+        self.tree = None
+        if index == 'auto':
+            index = 'brute' if len(self.words) <= KNN_BRUTE_FORCE_MAX_WORDS \
+                            else 'balltree'
+        if index == 'balltree':
+            try:
+                self.tree = BallTree(self.vectors, leaf_size=leaf_size)
+            except NameError:
+                logging.warn("Could not import scikit-learn. Use brute force "
+                             "nearest neighbor search instead of ball tree")
+        elif index != 'brute':
+            logging.fatal("Unknown nearest neighbor index %s" % index)
+    
+    def query(self, queries, n=1):
+        """Finds the n nearest words for each query vector.
+        
+        Args:
+            queries (array): Query matrix with one dense vector in 
+                             each row, or a single vector
+            n (int): Number of words to retrieve for each query
+        
+        Returns:
+            Tuple of two arrays. Word IDs and squared Euclidean 
+            distances, both of shape (#queries, n) and sorted by 
+            distance
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n = min(n, len(self.words))
+        if self.tree is not None:
+            dists, idx = self.tree.query(queries, k=n)
+            return self.words[idx], dists**2
+        dists = np.dot(queries, self.vectors.T)
+        dists *= -2.0
+        dists += self.sq_norms[None, :]
+        dists += np.sum(queries**2, axis=1)[:, None]
+        np.maximum(dists, 0.0, out=dists)
+        if n < len(self.words):
+            idx = np.argpartition(dists, n-1, axis=1)[:, :n]
+        else:
+            idx = np.tile(np.arange(len(self.words)), (len(queries), 1))
+        rows = np.arange(len(queries))[:, None]
+        order = np.argsort(dists[rows, idx], axis=1, kind='mergesort')
+        idx = idx[rows, order]
+        return self.words[idx], dists[rows, idx]
+
+
 class SparseFeatMap(object):
     """This is the super class for mapping strategies between sparse
     feature representations and symbolic word indices. The translation
@@ -214,6 +297,19 @@ class SparseFeatMap(object):
         """
         return self.sparse2nwords(self.dense2sparse(feat), n)
     
+    def dense2nwords_batch(self, feats, n=1):
+        """Applies ``dense2nwords`` to each row in ``feats``. 
+        Subclasses can override this method with a batched search.
+        
+        Args:
+            feats (list): List of dense feature vectors
+            n (int): Number of words to retrieve for each vector
+        
+        Returns:
+            list. List of ``dense2nwords`` results for each vector
+        """
+        return [self.dense2nwords(feat, n) for feat in feats]
+    
     def dense2words(self, seq):
         """Applies ``dense2word`` to a sequence. """
         return [self.dense2word(w) for w in seq]
@@ -302,24 +398,29 @@ class FileBasedFeatMap(SparseFeatMap):
     a file (see ``--src_sparse_feat_map`` and ``--trg_sparse_feat_map``)
     The mapping from word to feature is a simple dictionary lookup.
     
-    The mapping from feature to word is implemented with a Trie based
-    nearest neighbor implementation and does not require an exact
-    match. However, in case of an exact match, is runs linearly in the
-    number of non-zero entries in the vector.
+    The mapping from feature to word first tries an exact match via
+    dictionary lookup. Otherwise, it falls back to nearest neighbor
+    search with ``DenseNearestNeighbors``, which also supports batched
+    queries with ``dense2nwords_batch``.
     """
     
-    def __init__(self, dim, path):
+    def __init__(self, dim, path, knn_index='auto'):
         """Loads the feature map from the file system.
         
         Args:
             dim (int). Dimensionality of the feature space
             path (string). Path to the mapping file
+            knn_index (string). Nearest neighbor index ('auto', 
+                                'brute', or 'balltree'). See
+                                ``DenseNearestNeighbors``
         
         Raises:
             IOError. If the file could not be loaded
         """
         super(FileBasedFeatMap, self).__init__(dim)
         self.f2w = None
+        self.knn = None
+        self.knn_index = knn_index
         self.w2f = {}
         logging.info("Loading sparse feat map from %s" % path)
         with open(path) as f:
@@ -334,27 +435,60 @@ class FileBasedFeatMap(SparseFeatMap):
         logging.info("Loaded %d entries from %s" % (len(self.w2f), path))
 
     def _load_f2w(self):
-        logging.info("Building Trie with %d elements for sparse vector lookup"
-                     % len(self.w2f))
-        self.f2w = SimpleTrie()
+        """Builds the dictionary for exact matches and the nearest
+        neighbor index.
+        """
+        logging.info("Building nearest neighbor index with %d elements for "
+                     "sparse vector lookup" % len(self.w2f))
+        self.f2w = {}
         for w,f in sorted(self.w2f.items(), 
                           key=operator.itemgetter(0), 
                           reverse=True):
             # We iterate through the file in reversed ordered such that if 
             # vector representations clash we keep the first one
             # in f2w
-            self.f2w.add_sparse(f, w)
+            self.f2w[tuple(f)] = w
+        words = sorted(self.w2f)
+        self.knn = DenseNearestNeighbors(
+            words,
+            [self.sparse2dense(self.w2f[w]) for w in words],
+            self.knn_index)
+    
+    def _dense_threshold(self, dense, eps = 0.5):
+        """Sets all values smaller or equal ``eps`` to zero. This is 
+        the dense equivalent to ``dense2sparse``.
+        """
+        dense = np.asarray(dense, dtype=np.float32)
+        return np.where(dense > eps, dense, 0.0)
     
     def sparse2word(self, feat):
         if not self.f2w:
             self._load_f2w()
-        w,_ = self.f2w.nearest_sparse(feat)
+        w = self.f2w.get(tuple(feat))
+        if w is None:
+            words,_ = self.knn.query(self.sparse2dense(feat), 1)
+            w = int(words[0, 0])
         return w
     
     def sparse2nwords(self, feat, n=1):
         if not self.f2w:
             self._load_f2w()
-        return self.f2w.n_nearest_sparse(feat, n)
+        words, dists = self.knn.query(self.sparse2dense(feat), n)
+        return zip(words[0].tolist(), dists[0].tolist())
+    
+    def dense2nwords(self, feat, n=1):
+        return self.dense2nwords_batch([feat], n)[0]
+    
+    def dense2nwords_batch(self, feats, n=1):
+        """Retrieves the n nearest words for all vectors in ``feats``
+        with a single query to the nearest neighbor index.
+        """
+        if not self.f2w:
+            self._load_f2w()
+        if len(feats) == 0:
+            return []
+        words, dists = self.knn.query(self._dense_threshold(feats), n)
+        return [zip(w, d) for w, d in zip(words.tolist(), dists.tolist())]
     
     def word2sparse(self, word):
         return self.w2f.get(word, None)
@@ -2,7 +2,7 @@
 implementation based on strings of integers.
 """
 
-from operator import itemgetter
+import bisect
 
 class SimpleNode:
     """Helper class representing a node in a ``SimpleTrie`` """
@@ -160,6 +160,7 @@ class SimpleTrie:
             return [self.nearest_sparse(query)]
         self.best_dist = float("inf")
         self.best_elements = [(None, self.best_dist)] # guardian element
+        self.best_dists = [self.best_dist]
         self.n = n
         self._register_best_element = self._register_best_element_multi
         self._nearest_sparse_recursive(self._sparse2seq(query), self.root, 0.0)
@@ -170,9 +171,16 @@ class SimpleTrie:
         self.best_element = el
         
     def _register_best_element_multi(self, dist, el):
-        self.best_elements = self.best_elements[:self.n-1] + [(el, dist)]
-        self.best_elements.sort(key=itemgetter(1))
-        self.best_dist = self.best_elements[-1][1] 
+        """Inserts ``el`` into the sorted n-best list. ``best_dists`` 
+        holds the distances in ``best_elements`` for binary search.
+        """
+        pos = bisect.bisect_right(self.best_dists, dist)
+        self.best_dists.insert(pos, dist)
+        self.best_elements.insert(pos, (el, dist))
+        if len(self.best_elements) > self.n:
+            self.best_dists.pop()
+            self.best_elements.pop()
+        self.best_dist = self.best_dists[-1]
             
     def _nearest_sparse_recursive(self, seq, root, dist):
         if dist > self.best_dist:
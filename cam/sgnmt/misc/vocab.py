@@ -0,0 +1,456 @@
+"""This module implements a compact, memory-mapped vocabulary store for
+word maps and similar plain text mappings. Loading a word map with
+100k entries into Python dictionaries needs tens of megabytes per map
+and process, and several maps are often loaded by different modules
+(``utils.load_src_wmap``, tokenizers, idxmap wrappers...). Instead,
+each text file is converted once into an ``ArrayStore`` next to it,
+which is memory-mapped lazily so that all processes share its pages.
+A vocabulary store contains the following arrays:
+
+  - ``data``: UTF-8 encoded keys as uint8, sorted and concatenated
+  - ``offsets``: Start position of each key in ``data`` (+1 entry)
+  - ``ids``: The id of each key
+  - ``id2idx``: Position of the key for each id, or -1
+  - ``table``: Open addressing hash table (CRC32, linear probing)
+    with key positions, or -1 for empty slots
+  - ``int_map`` (optional): Dense mapping from integer keys to ids if
+    all keys are non-negative integers. Missing keys are mapped to 0
+  - ``symbols`` (optional): Sorted token ids which occur in keys of
+    files in word2char format
+
+Both directions are resolved without Python dictionaries: id->key
+lookups use ``id2idx`` in O(1), key->id lookups hash the key. Only
+recent lookups are cached in small dictionaries (``VOCAB_CACHE_SIZE``)
+since single lookups are slower than in Python dictionaries. Two
+text formats are supported. The 'wmap' format is the standard SGNMT
+word map format (first token: key, last token: id). The 'word2char'
+format is used by the word2char predictor (first token: id, remaining
+tokens: key).
+
+``KeyToIdMap`` and ``IdToKeyMap`` provide dictionary-like views on a
+store, e.g. for ``utils.src_wmap`` and ``utils.trg_wmap``.
+"""
+
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+from cam.sgnmt.misc.arraystore import ArrayStore, write_array_store, \
+                                      is_array_store
+
+
+VOCAB_STORE_SUFFIXES = {"wmap": "vocab.store",
+                        "word2char": "word2char.store"}
+"""Suffix of the store files for each text format. """
+
+
+_stores = {}
+"""Vocabulary stores which are opened in this process. """
+
+
+VOCAB_CACHE_SIZE = 10000
+"""Maximum number of recent lookups which are cached in each direction.
+The caches are cleared when they are full.
+"""
+
+
+_INT32 = struct.Struct("<i")
+_INT32_PAIR = struct.Struct("<ii")
+
+
+def _hash_key(key):
+    """Hash function for keys in the store (CRC32 of the bytes). """
+    return zlib.crc32(key) & 0xffffffff
+
+
+def _read_entries(text_path, key_format):
+    """Reads (key, id) pairs from a text file. Keys are bytes.
+
+    Args:
+        text_path (string): Path to the text file
+        key_format (string): 'wmap' or 'word2char'
+
+    Returns:
+        list. List of (key, id) tuples in file order
+    """
+    entries = []
+    with open(text_path, "rb") as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if key_format == "word2char":
+                entries.append((b" ".join([str(int(t)).encode("ascii")
+                                           for t in parts[1:]]),
+                                int(parts[0])))
+            else:
+                entries.append((parts[0], int(parts[-1])))
+    return entries
+
+
+def build_vocab_store(text_path, store_path, key_format="wmap"):
+    """Converts a text mapping into a vocabulary store. If keys or ids
+    occur multiple times, the last entry wins as when the file is
+    loaded into a dictionary.
+
+    Args:
+        text_path (string): Path to the text file
+        store_path (string): Path to the store file to create
+        key_format (string): 'wmap' or 'word2char'
+
+    Raises:
+        IOError. If the text file could not be read
+        ValueError. If ids are not non-negative integers
+    """
+    key2id = {}
+    id2key = {}
+    for key, word_id in _read_entries(text_path, key_format):
+        if word_id < 0:
+            raise ValueError("Negative id %d in %s" % (word_id, text_path))
+        key2id[key] = word_id
+        id2key[word_id] = key
+    keys = sorted(key2id)
+    key_idx = {key: idx for idx, key in enumerate(keys)}
+    offsets = np.zeros(len(keys) + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum([len(key) for key in keys])
+    id2idx = np.full(max(id2key) + 1 if id2key else 0, -1, dtype=np.int32)
+    for word_id, key in id2key.items():
+        id2idx[word_id] = key_idx[key]
+    table_size = 2
+    while table_size < 2 * len(keys):
+        table_size *= 2
+    mask = table_size - 1
+    table = np.full(table_size, -1, dtype=np.int32)
+    for idx, key in enumerate(keys):
+        pos = _hash_key(key) & mask
+        while table[pos] >= 0:
+            pos = (pos + 1) & mask
+        table[pos] = idx
+    arrays = {"data": np.frombuffer(b"".join(keys), dtype=np.uint8),
+              "offsets": offsets,
+              "ids": np.array([key2id[key] for key in keys], dtype=np.int32),
+              "id2idx": id2idx,
+              "table": table}
+    if key_format == "word2char":
+        arrays["symbols"] = np.unique(np.array(
+            [int(t) for key in keys for t in key.split()], dtype=np.int32))
+    elif keys and all(key.isdigit() for key in keys):
+        int_map = np.zeros(max(int(key) for key in keys) + 1, dtype=np.int32)
+        int_map[[int(key) for key in keys]] = arrays["ids"]
+        arrays["int_map"] = int_map
+    write_array_store(store_path, arrays, {"format": "vocab",
+                                           "key_format": key_format,
+                                           "source": text_path})
+    logging.info("Stored %d entries from %s in %s"
+                 % (len(keys), text_path, store_path))
+
+
+def _is_up_to_date(store_path, text_path):
+    """Returns true if ``store_path`` exists and is newer than the
+    text file.
+    """
+    return (os.path.isfile(store_path)
+            and os.path.getmtime(store_path) >= os.path.getmtime(text_path))
+
+
+def _get_store_path(text_path, key_format):
+    """Returns the path to the up-to-date store for ``text_path``. The
+    store is created next to the text file, or in the temporary
+    directory if this is not possible (e.g. read-only model
+    directories).
+    """
+    suffix = VOCAB_STORE_SUFFIXES[key_format]
+    store_path = "%s.%s" % (text_path, suffix)
+    if _is_up_to_date(store_path, text_path):
+        return store_path
+    try:
+        logging.info("Creating vocabulary store %s for %s"
+                     % (store_path, text_path))
+        build_vocab_store(text_path, store_path, key_format)
+        return store_path
+    except (IOError, OSError) as e:
+        store_path = os.path.join(
+            tempfile.gettempdir(),
+            "sgnmt.%s.%s" % (hashlib.md5(os.path.abspath(text_path).encode(
+                                                "utf-8")).hexdigest(),
+                             suffix))
+        logging.warn("Could not create vocabulary store next to %s (%s). "
+                     "Using %s" % (text_path, e, store_path))
+    if not _is_up_to_date(store_path, text_path):
+        build_vocab_store(text_path, store_path, key_format)
+    return store_path
+
+
+def get_vocab_store(path, key_format="wmap"):
+    """Returns the vocabulary store for a text file. If ``path`` is a
+    vocabulary store itself, it is opened directly. Otherwise, the
+    store is created if it does not exist or is older than the text
+    file. Stores are opened only once per process.
+
+    Args:
+        path (string): Path to a text file or a vocabulary store
+        key_format (string): 'wmap' or 'word2char'
+
+    Returns:
+        VocabStore. The store for ``path``
+    """
+    cache_key = (os.path.realpath(path), key_format)
+    store = _stores.get(cache_key)
+    if store is None:
+        store_path = path if is_array_store(path) \
+                          else _get_store_path(path, key_format)
+        store = VocabStore(store_path)
+        _stores[cache_key] = store
+    return store
+
+
+class VocabStore(object):
+    """Read access to a vocabulary store. Keys are returned as unicode
+    strings. Query keys can be unicode or UTF-8 encoded byte strings.
+    """
+
+    def __init__(self, path, cache_size=VOCAB_CACHE_SIZE):
+        """Opens the vocabulary store at ``path``.
+
+        Args:
+            path (string): Path to the store
+            cache_size (int): Maximum number of cached lookups in each
+                              direction
+
+        Raises:
+            IOError if ``path`` is not a vocabulary store
+        """
+        self.path = path
+        self.store = ArrayStore(path)
+        if self.store.meta.get("format") != "vocab":
+            raise IOError("%s is not a vocabulary store" % path)
+        self.id2idx = np.asarray(self.store["id2idx"])
+        self.n_keys = len(self.store["ids"])
+        self.mask = len(self.store["table"]) - 1
+        self.n_ids = None
+        # Single lookups read the raw buffers directly since indexing
+        # numpy arrays with scalars is slow
+        self.data = self.store["data"].data
+        self.offsets_buf = self.store["offsets"].data
+        self.ids_buf = self.store["ids"].data
+        self.id2idx_buf = self.store["id2idx"].data
+        self.table_buf = self.store["table"].data
+        self.cache_size = cache_size
+        self.id_cache = {}
+        self.key_cache = {}
+
+    def __len__(self):
+        """Returns the number of keys in the store. """
+        return self.n_keys
+
+    def _get_key(self, idx):
+        """Returns the key at position ``idx`` as bytes. """
+        start, end = _INT32_PAIR.unpack_from(self.offsets_buf, 4*idx)
+        return bytes(self.data[start:end])
+
+    def _get_id(self, idx):
+        """Returns the id of the key at position ``idx``. """
+        return _INT32.unpack_from(self.ids_buf, 4*idx)[0]
+
+    def get_id(self, key, default=None):
+        """Looks up the id of ``key``.
+
+        Args:
+            key (string): Key to look up
+            default (object): Returned if ``key`` is not in the store
+
+        Returns:
+            int. The id of ``key``, or ``default``
+        """
+        try:
+            word_id = self.id_cache[key]
+        except KeyError:
+            word_id = self._lookup_id(key)
+            if len(self.id_cache) >= self.cache_size:
+                self.id_cache.clear()
+            self.id_cache[key] = word_id
+        return default if word_id is None else word_id
+
+    def _lookup_id(self, key):
+        """Hash table lookup of ``key``. Returns None if not found. """
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+        pos = _hash_key(key) & self.mask
+        while True:
+            idx = _INT32.unpack_from(self.table_buf, 4*pos)[0]
+            if idx < 0:
+                return None
+            if self._get_key(idx) == key:
+                return self._get_id(idx)
+            pos = (pos + 1) & self.mask
+
+    def get_key(self, word_id, default=None):
+        """Looks up the key for ``word_id``.
+
+        Args:
+            word_id (int): Id to look up
+            default (object): Returned if ``word_id`` is not mapped
+
+        Returns:
+            unicode. The key for ``word_id``, or ``default``
+        """
+        try:
+            key = self.key_cache[word_id]
+        except KeyError:
+            key = None
+            if 0 <= word_id < len(self.id2idx):
+                idx = _INT32.unpack_from(self.id2idx_buf, 4*word_id)[0]
+                if idx >= 0:
+                    key = self._get_key(idx).decode("utf-8")
+            if len(self.key_cache) >= self.cache_size:
+                self.key_cache.clear()
+            self.key_cache[word_id] = key
+        return default if key is None else key
+
+    def get_max_id(self):
+        """Returns the largest id in the store, or -1 if empty. """
+        return len(self.id2idx) - 1
+
+    def count_ids(self):
+        """Returns the number of distinct ids in the store. """
+        if self.n_ids is None:
+            self.n_ids = int(np.count_nonzero(self.id2idx >= 0))
+        return self.n_ids
+
+    def iterkeys(self):
+        """Iterates over (key, id) pairs in key order. """
+        for idx in xrange(self.n_keys):
+            yield self._get_key(idx).decode("utf-8"), self._get_id(idx)
+
+    def iterids(self):
+        """Iterates over (id, key) pairs in id order. """
+        for word_id in np.flatnonzero(self.id2idx >= 0):
+            yield int(word_id), self._get_key(
+                                    int(self.id2idx[word_id])).decode("utf-8")
+
+    def get_int_map(self):
+        """Returns the dense mapping from integer keys to ids, or None
+        if the keys are not all integers.
+        """
+        if "int_map" in self.store:
+            return np.asarray(self.store["int_map"])
+        return None
+
+    def get_symbols(self):
+        """Returns the sorted token ids in keys (word2char format). """
+        return np.asarray(self.store["symbols"])
+
+
+class KeyToIdMap(object):
+    """Read-only dictionary view on a vocabulary store which maps keys
+    to ids, e.g. the source word map or the target character map. An
+    empty map is created if ``store`` is None.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store) if self.store is not None else 0
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    __bool__ = __nonzero__
+
+    def get(self, key, default=None):
+        if self.store is None:
+            return default
+        return self.store.get_id(key, default)
+
+    def __getitem__(self, key):
+        word_id = self.get(key)
+        if word_id is None:
+            raise KeyError(key)
+        return word_id
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def iteritems(self):
+        return self.store.iterkeys() if self.store is not None else iter([])
+
+    def keys(self):
+        return [key for key, _ in self.iteritems()]
+
+
+class IdToKeyMap(object):
+    """Dictionary view on a vocabulary store which maps ids to keys,
+    e.g. the target word map. Entries can be added at runtime (see
+    ``WordMapper`` in ``decoding.multisegbeam``). They are stored in
+    an overlay dictionary, the store itself is never modified. An
+    empty map is created if ``store`` is None.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self.added = {}
+        self.added_keys = {}
+        self.n_store_ids = store.count_ids() if store is not None else 0
+        self.n_new = 0
+
+    def __len__(self):
+        return self.n_store_ids + self.n_new
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    __bool__ = __nonzero__
+
+    def _get_store_key(self, word_id):
+        if self.store is None:
+            return None
+        return self.store.get_key(word_id)
+
+    def get(self, word_id, default=None):
+        key = self.added.get(word_id)
+        if key is None:
+            key = self._get_store_key(word_id)
+        return default if key is None else key
+
+    def __getitem__(self, word_id):
+        key = self.get(word_id)
+        if key is None:
+            raise KeyError(word_id)
+        return key
+
+    def __contains__(self, word_id):
+        return self.get(word_id) is not None
+
+    def __setitem__(self, word_id, key):
+        if not word_id in self:
+            self.n_new += 1
+        self.added[word_id] = key
+        self.added_keys[key] = word_id
+
+    def iteritems(self):
+        if self.store is not None:
+            for word_id, key in self.store.iterids():
+                if not word_id in self.added:
+                    yield word_id, key
+        for word_id, key in self.added.iteritems():
+            yield word_id, key
+
+    def get_id(self, key, default=None):
+        """Reverse lookup of the id for ``key``. """
+        word_id = self.added_keys.get(key)
+        if word_id is None and self.store is not None:
+            word_id = self.store.get_id(key)
+        return default if word_id is None else word_id
+
+    def get_max_id(self):
+        """Returns the largest id in the map, or -1 if empty. """
+        max_id = self.store.get_max_id() if self.store is not None else -1
+        if self.added:
+            max_id = max(max_id, max(self.added))
+        return max_id
@@ -22,6 +22,7 @@ import os
 import sys
 
 from cam.sgnmt import utils
+from cam.sgnmt.misc.cache import LRUCache
 from cam.sgnmt.predictors.core import Predictor
 from cam.sgnmt.utils import w2f, load_fst
 import pywrapfst as fst
@@ -180,6 +181,14 @@ class NondeterministicFstPredictor(Predictor):
     lattices. In contrast to the fst predictor for deterministic
     lattices, we store a set of nodes which are all reachable from
     the start node through the current history.
+    
+    The set of nodes (the frontier) is stored as tuple of (weight, 
+    node) pairs sorted by node. Frontiers are interned, i.e. equal 
+    frontiers are represented by the same object, and immutable, so 
+    they can be shared between hypotheses and used as dictionary keys.
+    We memoize the epsilon closure of each node, the posterior of each
+    frontier, and the transitions from each frontier for each word.
+    All these tables are reset when a new lattice is loaded.
     """
     
     def __init__(self, 
@@ -212,7 +221,16 @@ class NondeterministicFstPredictor(Predictor):
         self.skip_bos_weight = skip_bos_weight
         self.normalize_scores = normalize_scores
         self.cur_fst = None
-        self.cur_nodes = []
+        self.cur_nodes = ()
+        self._reset_tables()
+
+    def _reset_tables(self):
+        """Clears all memoization tables. """
+        self.node_arcs = {}
+        self.eps_closures = {}
+        self.frontiers = {}
+        self.transitions = {}
+        self.posteriors = {}
         
     def get_unk_probability(self, posterior):
         """Always returns negative infinity: Words outside the 
@@ -237,18 +255,22 @@ class NondeterministicFstPredictor(Predictor):
             together with their scores, or an empty set if we currently
             have no active nodes or fst.
         """
-        scores = {}
-        for weight,node in self.cur_nodes:
-            for arc in self.cur_fst.arcs(node): 
-                if arc.olabel != EPS_ID:
-                    score = weight + self.weight_factor*w2f(arc.weight) 
-                    if arc.olabel in scores:
-                        scores[arc.olabel] = self.score_max_func(
-                                        scores[arc.olabel], score)
-                    else:
-                        scores[arc.olabel] = score 
-        return self.finalize_posterior(scores,
-                self.use_weights, self.normalize_scores)
+        posterior = self.posteriors.get(self.cur_nodes)
+        if posterior is None:
+            scores = {}
+            for weight,node in self.cur_nodes:
+                for label, arcs in self._get_arcs(node).iteritems():
+                    for _, arc_weight in arcs:
+                        score = weight + arc_weight
+                        if label in scores:
+                            scores[label] = self.score_max_func(
+                                            scores[label], score)
+                        else:
+                            scores[label] = score 
+            posterior = self.finalize_posterior(scores,
+                    self.use_weights, self.normalize_scores)
+            self.posteriors[self.cur_nodes] = posterior
+        return dict(posterior)
     
     def initialize(self, src_sentence):
         """Loads the FST from the file system and consumes the start
@@ -259,7 +281,8 @@ class NondeterministicFstPredictor(Predictor):
         """
         self.cur_fst = load_fst(utils.get_path(self.fst_path,
                                                self.current_sen_id+1))
-        self.cur_nodes = []
+        self._reset_tables()
+        self.cur_nodes = ()
         if self.cur_fst:
             self.cur_nodes = self._follow_eps({self.cur_fst.start(): 0.0})
         self.consume(utils.GO_ID)
@@ -280,34 +303,70 @@ class NondeterministicFstPredictor(Predictor):
         Args:
             word (int): Word on an outgoing arc from the current node
         """
+        key = (self.cur_nodes, word)
+        next_nodes = self.transitions.get(key)
+        if next_nodes is None:
+            next_nodes = self._compute_transition(word)
+            self.transitions[key] = next_nodes
+        self.cur_nodes = next_nodes
+
+    def _compute_transition(self, word):
+        """Computes the frontier after consuming ``word``. See 
+        ``consume``. 
+        """
         d_unconsumed = {}
         # Collect distances to nodes reachable by word
         for weight,node in self.cur_nodes:
-            for arc in self.cur_fst.arcs(node):
-                if arc.olabel == word:
-                    next_node = arc.nextstate
-                    next_score = weight + self.weight_factor*w2f(arc.weight)
-                    if d_unconsumed.get(next_node, utils.NEG_INF) < next_score:
-                        d_unconsumed[next_node] = next_score
+            for next_node, arc_weight in self._get_arcs(node).get(word, []):
+                next_score = weight + arc_weight
+                if d_unconsumed.get(next_node, utils.NEG_INF) < next_score:
+                    d_unconsumed[next_node] = next_score
+        if not d_unconsumed:
+            return ()
         # Subtract the word score from the last predict_next 
         consumed_score = self.score_max_func(d_unconsumed.itervalues()) \
              if (word != utils.GO_ID or self.skip_bos_weight) else 0.0
         # Add epsilon reachable states
-        self.cur_nodes = self._follow_eps({node: score - consumed_score
+        return self._follow_eps({node: score - consumed_score
                     for node,score in d_unconsumed.iteritems()})
-    
-    def _follow_eps(self, roots):
-        """BFS to find nodes reachable from root through eps arcs. This
-        traversal strategy is efficient if the triangle inquality holds 
-        for weights in the graphs, i.e. for all vertices v1,v2,v3: 
-        (v1,v2),(v2,v3),(v1,v3) in E => d(v1,v2)+d(v2,v3) >= d(v1,v3).
-        The method still returns the correct results if the triangle
-        inequality does not hold, but edges may be traversed multiple
-        times which makes it more inefficient.
+
+    def _get_arcs(self, node):
+        """Get the non-epsilon arcs leaving ``node``.
+        
+        Returns:
+            dict. Maps labels to lists of (nextstate, weight) tuples
         """
-        open_nodes = dict(roots)
+        arcs = self.node_arcs.get(node)
+        if arcs is None:
+            arcs = {}
+            for arc in self.cur_fst.arcs(node):
+                if arc.olabel != EPS_ID:
+                    arcs.setdefault(arc.olabel, []).append((
+                                    arc.nextstate,
+                                    self.weight_factor*w2f(arc.weight)))
+            self.node_arcs[node] = arcs
+        return arcs
+
+    def _get_eps_closure(self, root):
+        """BFS to find nodes reachable from ``root`` through eps arcs. 
+        This traversal strategy is efficient if the triangle inquality
+        holds for weights in the graphs, i.e. for all vertices 
+        v1,v2,v3: (v1,v2),(v2,v3),(v1,v3) in E => 
+        d(v1,v2)+d(v2,v3) >= d(v1,v3). The method still returns the 
+        correct results if the triangle inequality does not hold, but 
+        edges may be traversed multiple times which makes it more 
+        inefficient. The result is memoized for each node.
+        
+        Returns:
+            list. List of (distance, node) tuples for all nodes with
+            non-epsilon arcs reachable from ``root``
+        """
+        closure = self.eps_closures.get(root)
+        if closure is not None:
+            return closure
+        open_nodes = {root: 0.0}
         d = {}
-        visited = dict(roots)
+        visited = {root: 0.0}
         while open_nodes:
             next_open = {}
             for node,score in open_nodes.iteritems():
@@ -322,9 +381,41 @@ class NondeterministicFstPredictor(Predictor):
                     else:
                         has_noneps = True
                 if has_noneps:
-                    d[node] = score
+                    d[node] = True
             open_nodes = next_open
-        return [(weight, node) for node, weight in d.iteritems()]
+        closure = [(visited[node], node) for node in d]
+        self.eps_closures[root] = closure
+        return closure
+    
+    def _follow_eps(self, roots):
+        """Find nodes reachable from ``roots`` through eps arcs using
+        the memoized epsilon closures of the root nodes.
+        
+        Args:
+            roots (dict): Accumulated weights of the root nodes
+        
+        Returns:
+            tuple. Interned frontier
+        """
+        d = {}
+        for root, score in roots.iteritems():
+            for dist, node in self._get_eps_closure(root):
+                if d.get(node, utils.NEG_INF) < score + dist:
+                    d[node] = score + dist
+        return self._intern(d)
+
+    def _intern(self, nodes):
+        """Converts a dictionary from nodes to weights to a frontier.
+        Equal frontiers are represented by the same object.
+        
+        Args:
+            nodes (dict): Weights of the nodes in the frontier
+        
+        Returns:
+            tuple. Tuple of (weight, node) pairs sorted by node
+        """
+        frontier = tuple((nodes[node], node) for node in sorted(nodes))
+        return self.frontiers.setdefault(frontier, frontier)
         
     def get_state(self):
         """Returns the set of current nodes """
@@ -343,8 +434,8 @@ class NondeterministicFstPredictor(Predictor):
         use the shortest path in the fst as future cost estimator. """
         last_word = hypo.trgt_sentence[-1]
         dists = []
-        for n in self.cur_nodes:
-            for arc in self.cur_fst[n].arcs:
+        for _,n in self.cur_nodes:
+            for arc in self.cur_fst.arcs(n):
                 if arc.olabel == last_word:
                     dists.append(w2f(self.distances[arc.nextstate]))
                     break
@@ -352,7 +443,67 @@ class NondeterministicFstPredictor(Predictor):
     
     def is_equal(self, state1, state2):
         """Returns true if the current nodes are the same """
-        return sorted([n for _,n in state1]) == sorted([n for _,n in state2])
+        return [n for _,n in state1] == [n for _,n in state2]
+
+
+class RtnSubFst(object):
+    """Wrapper around a sub FST of an RTN which is used by the
+    ``RtnPredictor``. Outgoing arcs are partitioned into epsilon arcs,
+    non-terminal arcs, and terminal arcs when a state is visited for
+    the first time, so that subsequent visits (for example by other
+    hypotheses or later sentences which share this sub FST) do not need
+    to iterate over the arcs again.
+    """
+
+    def __init__(self, sub_fst, weight_factor, is_nt_label):
+        """Creates a wrapper for ``sub_fst``.
+
+        Args:
+            sub_fst (Fst): OpenFST object
+            weight_factor (float): Factor for arc weights (see 
+                                   ``to_log`` in ``RtnPredictor``)
+            is_nt_label (function): Returns true for NT labels
+        """
+        self.fst = sub_fst
+        self.start = sub_fst.start()
+        self.weight_factor = weight_factor
+        self.is_nt_label = is_nt_label
+        self.states = {}
+
+    def get_arcs(self, node):
+        """Get the outgoing arcs of ``node``.
+
+        Args:
+            node (int): State ID in the sub FST
+
+        Returns:
+            tuple. (eps, nts, terminals, final_weight) where ``eps`` is
+            a list of (nextstate, weight) tuples for epsilon arcs, 
+            ``nts`` a list of (label, nextstate, weight) tuples for NT
+            arcs, ``terminals`` maps terminal labels to lists of
+            (nextstate, weight) tuples, and ``final_weight`` is the 
+            final weight of ``node`` or None if it is not final.
+        """
+        arcs = self.states.get(node)
+        if arcs is None:
+            eps = []
+            nts = []
+            terminals = {}
+            for arc in self.fst.arcs(node):
+                weight = self.weight_factor*w2f(arc.weight)
+                if arc.olabel == EPS_ID:
+                    eps.append((arc.nextstate, weight))
+                elif self.is_nt_label(arc.olabel):
+                    nts.append((arc.olabel, arc.nextstate, weight))
+                else:
+                    terminals.setdefault(arc.olabel, []).append(
+                                                    (arc.nextstate, weight))
+            final_weight = w2f(self.fst.final(node))
+            final_weight = None if final_weight == float("inf") \
+                                else self.weight_factor*final_weight
+            arcs = (eps, nts, terminals, final_weight)
+            self.states[node] = arcs
+        return arcs
 
 
 class RtnPredictor(Predictor):
@@ -362,14 +513,18 @@ class RtnPredictor(Predictor):
     implementation supports late expansion: RTNs are only expanded as
     far as necessary to retrieve all currently reachable states.
     
-    ``cur_nodes`` contains the accumulated weights from the last 
-    consumed word (if ambiguous, the largest)
-    
-    This implementation does not maintain a list of active nodes like 
-    the other automata predictors. Instead, we store the current 
-    history and search for the active nodes at each expansion. This is
-    more expensive, but fstreplace might change state IDs so a list of
-    active nodes might get corrupted.
+    Instead of replacing NT arcs in the root FST with ``fst.replace``,
+    we traverse the RTN like a pushdown automaton. A position in the 
+    RTN is a stack of (NT label, state) tuples. The top of the stack is
+    the current state in the current sub FST, the entries below are the
+    states to return to when a final state of the sub FST is reached. 
+    The root FST has the label None. Like ``cur_nodes`` in the nfst
+    predictor, the predictor state is the list of positions which are
+    reachable through the current history, together with the 
+    accumulated weights (if ambiguous, the largest). Only positions 
+    with outgoing terminal arcs are stored. Sub FSTs are loaded when an
+    NT arc is reached for the first time, and kept in a cache which is
+    shared across sentences.
     
     Note that this predictor does not support FSTs in gzip format.
     """
@@ -380,7 +535,8 @@ class RtnPredictor(Predictor):
                  normalize_scores,
                  to_log = True,
                  minimize_rtns = False,
-                 rmeps = True):
+                 rmeps = True,
+                 cache_size = 1000):
         """Creates a new RTN predictor.
         
         Args:
@@ -394,10 +550,13 @@ class RtnPredictor(Predictor):
                            arc weights in FSTs normally have cost (i.e.
                            neg. log values) semantics. Therefore, if
                            true, we multiply arc weights by -1.
-            minimize_rtns (bool): Minimize the FST after each replace
-                                  operation
-            rmeps (bool): Remove epsilons in the FST after each replace
-                          operation 
+            minimize_rtns (bool): Not used since the RTN is never 
+                                  expanded explicitly. Kept for
+                                  compatibility
+            rmeps (bool): Not used since the RTN is never expanded
+                          explicitly. Kept for compatibility
+            cache_size (int): Maximum number of sub FSTs which are kept
+                              in memory across sentences
         """
         super(RtnPredictor, self).__init__()
         self.root_path = rtn_path
@@ -406,7 +565,9 @@ class RtnPredictor(Predictor):
         self.use_weights = use_weights
         self.normalize_scores = normalize_scores
         self.weight_factor = -1.0 if to_log else 1.0
-        self.cur_fst = None # current root fst
+        self.fst_cache = LRUCache(cache_size)
+        self.sub_fsts = {}
+        self.cur_nodes = []
         start_id = '1'
         try:
             with open("%s/ntmap" % self.root_path) as f:
@@ -432,118 +593,57 @@ class RtnPredictor(Predictor):
         Args:
             src_sentence (list):  Not used
         """
+        self.sub_fsts = {}
+        self.cur_nodes = []
+        file_name = "%s/%d.fst" % (self.root_path, self.current_sen_id+1)
+        if not os.access(file_name, os.R_OK): # Find root FST
+            search_pattern = '%s/%d/%s*.fst' % (self.root_path,
+                                                self.current_sen_id+1,
+                                                self.root_fst_prefix)
+            candidates = glob.glob(search_pattern)
+            if not candidates:
+                logging.error("Could not find root fst in %s" % 
+                                search_pattern)
+                return
+            if len(candidates) > 1:
+                logging.warn("Ambiguous root fst for %s. Take the one "
+                             "with largest span." % search_pattern)
+                candidates = sorted(candidates)
+            file_name = candidates[-1]
+        root_fst = self._load_fst(file_name)
+        if root_fst is None:
+            return
+        self.sub_fsts[None] = root_fst
+        self.cur_nodes = self._follow_eps({((None, root_fst.start),): 0.0})
+        self.consume(utils.GO_ID)
+
+    def _load_fst(self, path):
+        """Loads an FST from the file system or the cache. The cache is
+        keyed by inode and modification time, so that sub FSTs are 
+        shared between sentences if their files are links to the same
+        file.
+        
+        Args:
+            path (string): Path to the FST file
+        
+        Returns:
+            RtnSubFst. The wrapped FST, or None if it could not be read
+        """
         try:
-            file_name = "%s/%d.fst" % (self.root_path, self.current_sen_id+1)
-            if not os.access(file_name, os.R_OK): # Find root FST
-                search_pattern = '%s/%d/%s*.fst' % (self.root_path,
-                                                    self.current_sen_id+1,
-                                                    self.root_fst_prefix)
-                candidates = glob.glob(search_pattern)
-                if not candidates:
-                    logging.error("Could not find root fst in %s" % 
-                                    search_pattern)
-                    self.cur_fst = None
-                    return
-                if len(candidates) > 1:
-                    logging.warn("Ambiguous root fst for %s. Take the one "
-                                 "with largest span." % search_pattern)
-                    candidates = sorted(candidates)
-                file_name = candidates[-1]
-            self.cur_fst = fst.Fst.read(file_name) 
-            logging.debug("Read (root)fst from %s" % file_name)
+            stat = os.stat(path)
+            key = (stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size)
+            sub_fst = self.fst_cache.get(key)
+            if sub_fst is None:
+                sub_fst = RtnSubFst(fst.Fst.read(path), 
+                                    self.weight_factor, 
+                                    self.is_nt_label)
+                self.fst_cache.add(key, sub_fst)
+                logging.debug("Read fst from %s" % path)
+            return sub_fst
         except Exception as e:
             logging.error("%s error reading fst from %s: %s" %
-                (sys.exc_info()[1], file_name, e))
-            self.cur_fst = None
-        finally:
-            self.cur_history = []
-            self.sub_fsts = {}
-        self.consume(utils.GO_ID)
-    
-    def expand_rtn(self, func):
-        """This method expands the RTN as far as necessary. This means
-        that the RTN is expanded s.t. we can build the posterior for 
-        ``cur_history``. In practice, this means that we follow all 
-        epsilon edges and replaces all NT edges until all paths with 
-        the prefix ``cur_history`` in the RTN have at least one more 
-        terminal token. Then, we apply ``func`` to all reachable nodes.
-        """
-        updated = True
-        while updated:
-            updated = False
-            label_fst_map = {}
-            self.visited_nodes = {}
-            self.cur_fst.arcsort(sort_type="olabel")
-            self.add_to_label_fst_map_recursive(label_fst_map,
-                                                {},
-                                                self.cur_fst.start(), 
-                                                0.0,
-                                                self.cur_history, func)
-            if label_fst_map:
-                logging.debug("Replace %d NT arcs for history %s" % (
-                                                            len(label_fst_map),
-                                                            self.cur_history))
-                # First in the list is the root FST and label
-                replaced_fst = fst.replace(
-                        [(len(label_fst_map) + 2000000000, self.cur_fst)] 
-                        + [(nt_label, f) 
-                            for (nt_label, f) in label_fst_map.iteritems()],
-                        epsilon_on_replace=True)
-                self.cur_fst = replaced_fst
-                updated = True
-        if self.rmeps or self.minimize_rtns:
-            self.cur_fst.rmepsilon()
-        if self.minimize_rtns:
-            tmp = fst.determinize(self.cur_fst.determinize)
-            self.cur_fst = tmp
-            self.cur_fst.minimize()
-    
-    def add_to_label_fst_map_recursive(self, 
-                                       label_fst_map, 
-                                       visited_nodes, 
-                                       root_node, 
-                                       acc_weight, 
-                                       history, 
-                                       func):
-        """Adds arcs to ``label_fst_map`` if they are labeled with an
-        NT symbol and reachable from ``root_node`` via ``history``.
-          
-        Note: visited_nodes is maintained for each history separately
-        """
-        if root_node in visited_nodes:
-            # This introduces some error as we take the score of the first best
-            # path with a certain history, not the globally best path. For now,
-            # this error should not be significant
-            return
-        visited_nodes[root_node] = True
-        for arc in self.cur_fst.arcs(root_node):
-            arc_acc_weight = acc_weight + self.weight_factor*w2f(arc.weight)
-            if arc.olabel == EPS_ID: # Follow epsilon edges
-                self.add_to_label_fst_map_recursive(label_fst_map,
-                                                    visited_nodes,
-                                                    arc.nextstate,
-                                                    arc_acc_weight, 
-                                                    history,
-                                                    func)
-            elif not history:
-                if self.is_nt_label(arc.olabel): # Add to label_fst_map
-                    replace_label = len(label_fst_map) + 2000000000
-                    label_fst_map[replace_label] = self.get_sub_fst(
-                                                                    arc.olabel)
-                    arc.ilabel = replace_label
-                    arc.olabel = replace_label
-                else: # This is a regular arc and we have no history left
-                    func(arc.nextstate, arc.olabel, arc_acc_weight) # apply func
-            elif arc.olabel == history[0]: # history is not empty
-                self.add_to_label_fst_map_recursive(label_fst_map,
-                                                    {},
-                                                    arc.nextstate,
-                                                    arc_acc_weight,
-                                                    history[1:],
-                                                    func)
-            elif arc.olabel > history[0]: # FST is arc sorted, we can stop here
-                break
-        
+                (sys.exc_info()[1], path, e))
+        return None
     
     def is_nt_label(self, label):
         """Returns true if ``label`` is a non-terminal. """
@@ -551,51 +651,114 @@ class RtnPredictor(Predictor):
         return len(s) == 10 and s[0] == '1'
 
     def get_sub_fst(self, fst_id):
-        """ Load sub fst from the file system or the cache """
+        """Load sub fst from the file system or the cache.
+        
+        Args:
+            fst_id (int): NT label of the sub FST
+        
+        Returns:
+            RtnSubFst. The wrapped sub FST or None if it could not be
+            loaded.
+        """
         if fst_id in self.sub_fsts:
             return self.sub_fsts[fst_id]
-        sub_fst_path = "%s/%d/%d.fst" %  (self.root_path,
-                                          self.current_sen_id+1,
-                                          fst_id)
-        try:
-            sub_fst = fst.Fst.read(sub_fst_path)
-            logging.debug("Read sub fst from %s" % sub_fst_path)
-            self.sub_fsts[fst_id] = sub_fst
-            return sub_fst
-        except Exception as e:
-            logging.error("%s error reading sub fst from %s: %s" %
-                (sys.exc_info()[1], sub_fst_path, e))
+        sub_fst = self._load_fst("%s/%d/%d.fst" %  (self.root_path,
+                                                    self.current_sen_id+1,
+                                                    fst_id))
+        self.sub_fsts[fst_id] = sub_fst
+        return sub_fst
+
+    def _follow_eps(self, roots):
+        """Finds all RTN positions which are reachable from ``roots``
+        without consuming a terminal, i.e. via epsilon arcs, by 
+        entering sub FSTs on NT arcs, or by returning from final states
+        of sub FSTs. Like ``NondeterministicFstPredictor._follow_eps``,
+        positions are revisited if a better score is found.
+        
+        Args:
+            roots (dict): Accumulated weights keyed by RTN positions
         
-    def _add_to_cur_posterior(self, node, label, weight):
-        """Can be used as ``func`` argument in ``expand_rtn`` to build
-        up the posterior for the next target token  in ``predict_next``
+        Returns:
+            list. List of (weight, position) tuples for all reachable
+            positions with outgoing terminal arcs
         """
-        self.cur_posterior[label] = max(self.cur_posterior.get(label, utils.NEG_INF),
-                                        weight)
+        open_nodes = dict(roots)
+        visited = dict(roots)
+        frontier = set()
+        while open_nodes:
+            next_open = {}
+            for stack, score in open_nodes.iteritems():
+                label, node = stack[-1]
+                eps, nts, terminals, final_weight = \
+                        self.sub_fsts[label].get_arcs(node)
+                successors = [(stack[:-1] + ((label, next_node),),
+                               score + weight) 
+                              for next_node, weight in eps]
+                for nt_label, next_node, weight in nts:
+                    if any(l == nt_label for l,_ in stack):
+                        logging.warn("Recursive NT %d in RTN" % nt_label)
+                        continue
+                    sub_fst = self.get_sub_fst(nt_label)
+                    if sub_fst is not None:
+                        successors.append((stack[:-1] 
+                                           + ((label, next_node),
+                                              (nt_label, sub_fst.start)),
+                                           score + weight))
+                if final_weight is not None and len(stack) > 1:
+                    successors.append((stack[:-1], score + final_weight))
+                for next_stack, next_score in successors:
+                    if visited.get(next_stack, utils.NEG_INF) < next_score:
+                        visited[next_stack] = next_score
+                        next_open[next_stack] = next_score
+                if terminals:
+                    frontier.add(stack)
+            open_nodes = next_open
+        return [(visited[stack], stack) for stack in frontier]
     
     def predict_next(self):
-        """Expands RTN as far as possible and uses the outgoing edges 
-        from nodes reachable by the current history to build up
-        the posterior for the next word. If there are no such nodes
-        or arcs, or no root FST is loaded, return the empty set.
+        """Uses the outgoing terminal arcs from all current positions
+        to build up the posterior for the next word. If there are no
+        such positions or arcs, or no root FST is loaded, return the 
+        empty set. The score of a word is the best accumulated weight
+        of a path with the current history and the word.
         """
-        if not self.cur_fst:
+        if not self.cur_nodes:
             return {}
-        self.cur_posterior = {}
-        self.expand_rtn(self._add_to_cur_posterior)
-        return self.finalize_posterior(self.cur_posterior,
+        scores = {}
+        for weight, stack in self.cur_nodes:
+            label, node = stack[-1]
+            terminals = self.sub_fsts[label].get_arcs(node)[2]
+            for word, arcs in terminals.iteritems():
+                score = weight + max(w for _,w in arcs)
+                if scores.get(word, utils.NEG_INF) < score:
+                    scores[word] = score
+        return self.finalize_posterior(scores,
                                        self.use_weights,
                                        self.normalize_scores)
     
     def consume(self, word):
-        """Adds ``word`` to the current history. """
-        self.cur_history.append(word)
+        """Updates the current positions by following all terminal arcs
+        with ``word`` and expanding the reachable positions with
+        ``_follow_eps``.
+        
+        Args:
+            word (int): Word on an outgoing arc from a current position
+        """
+        next_nodes = {}
+        for weight, stack in self.cur_nodes:
+            label, node = stack[-1]
+            for next_node, arc_weight in \
+                    self.sub_fsts[label].get_arcs(node)[2].get(word, []):
+                next_stack = stack[:-1] + ((label, next_node),)
+                next_score = weight + arc_weight
+                if next_nodes.get(next_stack, utils.NEG_INF) < next_score:
+                    next_nodes[next_stack] = next_score
+        self.cur_nodes = self._follow_eps(next_nodes)
     
     def get_state(self):
-        """Returns the current history. """
-        return self.cur_history
+        """Returns the current RTN positions. """
+        return self.cur_nodes
     
     def set_state(self, state):
-        """Sets the current history. """
-        self.cur_history = state
-
+        """Sets the current RTN positions. """
+        self.cur_nodes = state
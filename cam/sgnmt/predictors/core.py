@@ -184,7 +184,71 @@ class Predictor(Observer):
             bool. True if both states are equal, false if not
         """
         return False
-    
+
+    def get_sentence_context(self):
+        """Get everything which has been set up by ``initialize()`` for
+        the current source sentence. Together with ``get_state()``,
+        this makes it possible to switch between hypotheses of
+        different source sentences without calling ``initialize()``
+        again (see ``BatchBeamDecoder``). The default implementation
+        returns a shallow copy of the instance attributes and the
+        contexts of wrapped predictors. Therefore, ``initialize()``
+        must not reset sentence-level attributes (e.g. caches) in
+        place, but should replace them with new objects. Otherwise,
+        the reset would also affect sentences which have been
+        initialized before. Predictors which cannot follow this rule
+        need to override this method.
+
+        Returns:
+            object. Sentence context
+        """
+        slave_contexts = {name: p.get_sentence_context()
+                          for name, p in self.__dict__.iteritems()
+                              if isinstance(p, Predictor)}
+        return dict(self.__dict__), slave_contexts
+
+    def set_sentence_context(self, context):
+        """Restores a sentence context which has been created with
+        ``get_sentence_context()``. The predictor state needs to be
+        set with ``set_state()`` afterwards.
+
+        Args:
+            context (object): Sentence context as returned by
+                              ``get_sentence_context()``
+        """
+        attributes, slave_contexts = context
+        self.__dict__.update(attributes)
+        for name, slave_context in slave_contexts.iteritems():
+            getattr(self, name).set_sentence_context(slave_context)
+
+    def predict_next_batch(self, contexts, states):
+        """Computes the posteriors for several hypotheses at once,
+        possibly from different source sentences. Predictors which can
+        process batches more efficiently than one by one (e.g. neural
+        models) should override this method. The default
+        implementation calls ``predict_next()`` for each hypothesis.
+        After this call, the sentence context and the state of the
+        predictor are undefined.
+
+        Args:
+            contexts (list): Sentence contexts as returned by
+                             ``get_sentence_context()``
+            states (list): Predictor states as returned by
+                           ``get_state()``. They may be modified
+
+        Returns:
+            tuple. Two lists: The posteriors, and the predictor states
+            after ``predict_next()`` for each hypothesis
+        """
+        posteriors = []
+        next_states = []
+        for context, state in zip(contexts, states):
+            self.set_sentence_context(context)
+            self.set_state(state)
+            posteriors.append(self.predict_next())
+            next_states.append(self.get_state())
+        return posteriors, next_states
+
     def notify(self, message, message_type = MESSAGE_TYPE_DEFAULT):
         """We implement the ``notify`` method from the ``Observer``
         super class with an empty method here s.t. predictors do not
@@ -233,3 +297,15 @@ class UnboundedVocabularyPredictor(Predictor):
             does not have to score all of them
         """
         raise NotImplementedError
+
+    def get_max_candidates(self):
+        """Unbounded vocabulary predictors can limit the number of
+        words passed to ``predict_next()``. If this returns a positive
+        number n, the decoder passes only the n best words according
+        the bounded vocabulary predictors. Words which are not passed
+        are scored with ``get_unk_probability()``.
+
+        Returns:
+            int. Maximum number of words to score, or 0 for no limit
+        """
+        return 0
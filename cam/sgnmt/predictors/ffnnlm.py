@@ -6,8 +6,10 @@ http://nlg.isi.edu/software/nplm/
 """
 
 from cam.sgnmt.predictors.core import UnboundedVocabularyPredictor
+from cam.sgnmt.misc.cache import LRUCache
 from cam.sgnmt import utils
 import logging
+import numpy as np
 
 try:
     import nplm
@@ -23,9 +25,14 @@ class NPLMPredictor(UnboundedVocabularyPredictor):
     from
      
     http://nlg.isi.edu/software/nplm/
+
+    The forward pass through the network is carried out once for each
+    n-gram history, and the resulting output distribution is shared
+    between all hypotheses (and sentences) with the same history.
     """
     
-    def __init__(self, path, normalize_scores):
+    def __init__(self, path, normalize_scores, cache_size=0,
+                 max_candidates=0):
         """Creates a new NPLM predictor instance.
         
         Args:
@@ -33,6 +40,12 @@ class NPLMPredictor(UnboundedVocabularyPredictor):
             normalize_scores (bool): Whether to renormalize scores s.t.
                                      scores returned by ``predict_next``
                                      sum up to 1
+            cache_size (int): Maximum number of n-gram histories for
+                              which the output distribution is cached.
+                              If not positive, the cache is unbounded
+            max_candidates (int): If positive, score only this many 
+                                  words which are best according the
+                                  other predictors
         
         Raises:
             NameError. If NPLM is not installed
@@ -40,6 +53,8 @@ class NPLMPredictor(UnboundedVocabularyPredictor):
         super(NPLMPredictor, self).__init__()
         self.model = nplm.NeuralLM.from_file(path)
         self.normalize_scores = normalize_scores
+        self.max_candidates = max_candidates
+        self.cache = LRUCache(cache_size)
         ngram_order = self.model.ngram_size
         self.history_len = ngram_order-1
         self.unk_id = self.model.word_to_index['<unk>']
@@ -49,6 +64,24 @@ class NPLMPredictor(UnboundedVocabularyPredictor):
                 or self.bos_id != utils.GO_ID 
                 or self.eos_id != utils.EOS_ID):
             logging.error("NPLM reserved word IDs inconsistent with SGNMT")
+        self._create_word_idxs()
+
+    def _create_word_idxs(self):
+        """Creates ``word_idxs`` which maps SGNMT word IDs to NPLM word
+        indices. The last entry is used for all IDs which are out of
+        range and points to the NPLM UNK index.
+        """
+        max_id = utils.EOS_ID
+        for w in self.model.word_to_index:
+            if w.isdigit():
+                max_id = max(max_id, int(w))
+        self.word_idxs = np.empty(max_id + 2, dtype=np.int64)
+        self.word_idxs.fill(self.unk_id)
+        for w, idx in self.model.word_to_index.iteritems():
+            if w.isdigit() and str(int(w)) == w:
+                self.word_idxs[int(w)] = idx
+        for w in [utils.UNK_ID, utils.GO_ID, utils.EOS_ID]:
+            self.word_idxs[w] = w
     
     def initialize(self, src_sentence):
         """Set the n-gram history to initial value.
@@ -60,22 +93,34 @@ class NPLMPredictor(UnboundedVocabularyPredictor):
 
     def _get_nplm_idx(self, w):
         """Get word index for internal NPLM word map """
-        if w == utils.UNK_ID or w == utils.GO_ID or w == utils.EOS_ID:
-            return w
-        return self.model.word_to_index.get(str(w), self.unk_id)   
+        return int(self.word_idxs[min(w, len(self.word_idxs) - 1)])
+
+    def _get_log_probs(self):
+        """Get the NPLM output distribution over the full NPLM 
+        vocabulary for the current history from the cache, or run the
+        network if the history is not cached yet.
+        """
+        context = tuple(self.history)
+        log_probs = self.cache.get(context)
+        if log_probs is None:
+            ngrams = self.model.make_data([self.history + [self.unk_id]])
+            log_probs = np.asarray(
+                self.model.forward_prop(ngrams[:-1])).ravel()
+            self.cache.add(context, log_probs)
+        return log_probs
     
     def predict_next(self, words):
         """Scores the words in ``words`` using NPLM. """
-        ngram_words = []
-        ngrams = []
-        for w in words:
-            ngram_words.append(w) # cannot use words directly because its a set
-            ngrams.append(self.history + [self._get_nplm_idx(w)])
-        ngrams = self.model.make_data(ngrams)
-        posteriors = self.model.forward_prop(ngrams[:-1],
-                                             output=ngrams[-1])[:,0]
-        scores = {w: posteriors[idx] for idx,w in enumerate(ngram_words)}
+        word_ids = np.fromiter(words, dtype=np.int64, count=len(words))
+        nplm_idxs = self.word_idxs[np.minimum(word_ids, 
+                                              len(self.word_idxs) - 1)]
+        posteriors = self._get_log_probs()[nplm_idxs]
+        scores = dict(zip(word_ids.tolist(), posteriors.tolist()))
         return self.finalize_posterior(scores, True, self.normalize_scores)
+
+    def get_max_candidates(self):
+        """Returns ``max_candidates`` """
+        return self.max_candidates
         
     def get_unk_probability(self, posterior):
         """Use NPLM UNK score if exists """
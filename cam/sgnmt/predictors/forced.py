@@ -94,6 +94,41 @@ class ForcedPredictor(Predictor):
         return n1 == n2 and s1 == s2
 
 
+class NbestTrieNode(object):
+    """Node in the prefix trie over the n-best list entries of a single
+    sentence, used by ``ForcedLstPredictor``. Nodes are immutable once
+    the trie is built. They are used directly as predictor states, so
+    copying returns the node itself: hypotheses with the same prefix
+    share the same node.
+    """
+
+    __slots__ = ['children', 'score', 'posterior']
+
+    def __init__(self):
+        """Creates a node without children which does not end an
+        n-best list entry.
+        """
+        self.children = {}
+        self.score = NEG_INF
+        self.posterior = None
+
+    def get_posterior(self):
+        """Returns the allowed continuations at this node, i.e. 0.0 for
+        all children and the n-best score for </S>. The dictionary is
+        built on first access and shared afterwards.
+        """
+        if self.posterior is None:
+            self.posterior = dict.fromkeys(self.children, 0.0)
+            self.posterior[utils.EOS_ID] = self.score
+        return self.posterior
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
 class ForcedLstPredictor(Predictor):
     """This predictor can be used for direct n-best list rescoring. In
     contrast to the ``ForcedPredictor``, it reads an n-best list in 
@@ -105,11 +140,15 @@ class ForcedLstPredictor(Predictor):
     Second column: Hypothesis in integer format
     Last column: score
     
+    The constructor only indexes the byte ranges of the entries for 
+    each sentence. The entries of a sentence are parsed when the 
+    sentence is first used and compiled into a prefix trie of 
+    ``NbestTrieNode`` instances. The predictor state is the tuple of
+    trie nodes consistent with the current history (a single node 
+    unless ``match_unk`` is set).
+    
     Note: Behavior is undefined if you have duplicates in the n-best
     list
-    
-    TODO: Would be much more efficient to use Tries for 
-    cur_trgt_sentences instead of a flat list.
     """
     
     def __init__(self, 
@@ -134,28 +173,85 @@ class ForcedLstPredictor(Predictor):
                                 if you wish to do that.
         """
         super(ForcedLstPredictor, self).__init__()
-        self.trg_sentences = []
+        self.trg_test_file = trg_test_file
+        self.use_scores = use_scores
         self.match_unk = match_unk
-        score = 0.0
-        with open(trg_test_file) as f:
-            for line in f:
-                parts = line.split("|||")
-                if len(parts) < 2:
+        self.feat_name = feat_name
+        self.trie_sen_id = None
+        self.sen_ranges = self._index_nbest_file(trg_test_file)
+
+    def _index_nbest_file(self, path):
+        """Scans the n-best list once and records the byte ranges of
+        the entries for each sentence id without parsing them.
+        
+        Args:
+            path (string): Path to the n-best list
+        
+        Returns:
+            dict. Maps sentence ids to lists of [start, end) byte 
+            ranges in the n-best file
+        """
+        sen_ranges = {}
+        offset = 0
+        with open(path, "rb") as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                start = offset
+                offset += len(line)
+                if not "|||" in line:
                     logging.warn("Malformed line %s in n-best list %s" % (
                                         line.strip(),
-                                        trg_test_file))
+                                        path))
+                    continue
+                sen_id = int(line[:line.index("|||")].strip())
+                ranges = sen_ranges.setdefault(sen_id, [])
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1][1] = offset
                 else:
-                    if use_scores:
-                        score = self._get_score(parts, feat_name)
-                    sen_id = int(parts[0].strip())
-                    while len(self.trg_sentences) <= sen_id:
-                        self.trg_sentences.append([])
+                    ranges.append([start, offset])
+        return sen_ranges
+
+    def _build_trie(self, sen_id):
+        """Parses the n-best entries for ``sen_id`` and compiles them 
+        into a prefix trie.
+        
+        Args:
+            sen_id (int): Sentence id as used in the n-best list
+        
+        Returns:
+            NbestTrieNode. Root node of the trie
+        """
+        root = NbestTrieNode()
+        score = 0.0
+        n_entries = 0
+        with open(self.trg_test_file, "rb") as f:
+            for start, end in self.sen_ranges.get(sen_id, []):
+                f.seek(start)
+                for line in f.read(end - start).splitlines():
+                    parts = line.split("|||")
+                    if len(parts) < 2:
+                        continue
+                    if self.use_scores:
+                        score = self._get_score(parts, self.feat_name)
                     sen = [int(w) for w in parts[1].strip().split()]
                     if sen and sen[0] == utils.GO_ID:
                         sen  = sen[1:]
                     if sen and sen[-1] == utils.EOS_ID:
                         sen = sen[:-1]
-                    self.trg_sentences[sen_id].append((score, sen))
+                    node = root
+                    for w in sen:
+                        child = node.children.get(w)
+                        if child is None:
+                            child = NbestTrieNode()
+                            node.children[w] = child
+                        node = child
+                    node.score = score
+                    n_entries += 1
+        logging.debug("Compiled %d n-best entries for sentence %d into a "
+                      "prefix trie" % (n_entries, sen_id))
+        return root
         
     def _get_score(self, parts, feat_name):
         """Get the score for a hypothesis.
@@ -186,59 +282,56 @@ class ForcedLstPredictor(Predictor):
     
     def predict_next(self):
         """Outputs 0.0 (i.e. prob=1) for all words for which there is 
-        an entry ``in cur_trg_sentences``, and the score in 
-        ``cur_trg_sentences`` if the current history is by itself equal
-        to an entry in ``cur_trg_sentences``.
-        
-        TODO: The implementation here is fairly inefficient as it scans 
-        through all target sentences linearly. Would be better to 
-        organize the target sentences in a Trie
+        an n-best entry consistent with the current history, and the
+        n-best score for </S> if the current history is by itself equal
+        to an n-best entry. This is a lookup in the current trie node.
         """
+        if len(self.nodes) == 1:
+            return self.nodes[0].get_posterior()
         scores = {}
-        hist_len = len(self.history)
-        for sen_score,trg_sentence in self.cur_trg_sentences:
-            sen_len = len(trg_sentence)
-            if sen_len < hist_len:
-                continue
-            if self.match_unk:
-                hist = [self.history[i] 
-                      if trg_sentence[i] != utils.UNK_ID else utils.UNK_ID
-                      for i in xrange(hist_len)]
-            else:
-                hist = self.history 
-            if trg_sentence[:hist_len] == hist:
-                if sen_len == hist_len:
-                    scores[utils.EOS_ID] = sen_score
-                else:
-                    scores[trg_sentence[hist_len]] = 0.0
-        if not utils.EOS_ID in scores:
-            scores[utils.EOS_ID] = NEG_INF
+        eos_score = NEG_INF
+        for node in self.nodes:
+            posterior = node.get_posterior()
+            scores.update(posterior)
+            eos_score = max(eos_score, posterior[utils.EOS_ID])
+        scores[utils.EOS_ID] = eos_score
         return scores
     
     def initialize(self, src_sentence):
-        """Resets the history and loads the n-best list entries for the
-        next source sentence
+        """Resets the history and compiles the n-best list entries for
+        the next source sentence into a trie if necessary.
         
         Args:
             src_sentence (list): Not used
         """
-        self.cur_trg_sentences = self.trg_sentences[self.current_sen_id] 
-        self.history = []
+        if self.trie_sen_id != self.current_sen_id:
+            self.trie_root = self._build_trie(self.current_sen_id)
+            self.trie_sen_id = self.current_sen_id
+        self.nodes = (self.trie_root,)
     
     def consume(self, word):
-        """Extends the current history by ``word``. """
-        self.history.append(word)
+        """Follows the edge for ``word`` in the trie. If ``match_unk``
+        is set, UNK edges match any word.
+        """
+        next_nodes = []
+        for node in self.nodes:
+            child = node.children.get(word)
+            if child is not None:
+                next_nodes.append(child)
+            if self.match_unk and word != utils.UNK_ID:
+                child = node.children.get(utils.UNK_ID)
+                if child is not None:
+                    next_nodes.append(child)
+        self.nodes = tuple(next_nodes)
     
     def get_state(self):
-        """Returns the current history. """
-        return self.history
+        """Returns the trie nodes consistent with the history. """
+        return self.nodes
     
     def set_state(self, state):
-        """Sets the current history. """
-        self.history = state
+        """Sets the trie nodes consistent with the history. """
+        self.nodes = state
 
     def is_equal(self, state1, state2):
-        """Returns true if the history is the same """
+        """Returns true if the trie nodes are the same """
         return state1 == state2
-
-
@@ -13,6 +13,9 @@ from scipy.misc import logsumexp
 from scipy.special import gammaln
 
 from cam.sgnmt import utils
+from cam.sgnmt.misc.arraystore import is_array_store
+from cam.sgnmt.misc.cache import LRUCache
+from cam.sgnmt.misc.ngramstore import NgramPosteriorStore
 from cam.sgnmt.misc.trie import SimpleTrie
 from cam.sgnmt.predictors.core import Predictor, UnboundedVocabularyPredictor
 import numpy as np
@@ -20,6 +23,7 @@ import numpy as np
 
 NUM_FEATURES = 5
 EPS_R = 0.1;
+MIN_LENGTH_TABLE_SIZE = 64
 
 
 
@@ -138,7 +142,7 @@ class NBLengthPredictor(Predictor):
         
     def get_unk_probability(self, posterior):
         """If we use point estimates, return 0 (=1). Otherwise, return
-        the 1-p(EOS), with p(EOS) fetched from ``posterior``
+        the 1-p(EOS), with p(EOS) fetched from the precomputed table
         """
         if self.use_point_probs:
             if self.n_consumed == 0:
@@ -146,29 +150,50 @@ class NBLengthPredictor(Predictor):
             return 0.0
         if self.n_consumed == 0:
             return 0.0
-        return np.log(1.0 - np.exp(posterior[utils.EOS_ID]))
+        return self._get_table_entry('unk_probs', self.n_consumed)
     
     def predict_next(self):
         """Returns a dictionary with single entry for EOS. """
         if self.n_consumed == 0:
             return {utils.EOS_ID : utils.NEG_INF}
-        return {utils.EOS_ID : self._get_eos_prob()}
+        return {utils.EOS_ID : self._get_table_entry('eos_probs', 
+                                                     self.n_consumed)}
     
-    def _get_eos_prob(self):
-        """Get loglikelihood according cur_p, cur_r, and n_consumed """
-        eos_point_prob = self._get_eos_point_prob(max(
-                                              1, 
-                                              self.n_consumed - self.offset))
+    def _get_table_entry(self, table_name, n):
+        """Look up ``n`` in the table ``eos_probs`` or ``unk_probs``.
+        Tables are extended if ``n`` exceeds the current table size.
+        """
+        if n >= len(self.eos_probs):
+            self._compute_tables(2*n)
+        return float(getattr(self, table_name)[n])
+    
+    def _compute_tables(self, max_len):
+        """Precomputes EOS and UNK scores for all hypothesis lengths up
+        to ``max_len`` (exclusive). Without point estimates, the EOS 
+        score for length n is the probability of the target length
+        being n given that it is at least n, i.e. the NB point 
+        probability normalized by one minus the CDF at n-1.
+        
+        Args:
+            max_len (int): Size of the tables
+        """
+        n = np.maximum(1, np.arange(max_len) - self.offset)
+        point_probs = self._get_eos_point_prob(n)
         if self.use_point_probs:
-            return eos_point_prob - self.max_eos_prob
-        if not self.prev_eos_probs:
-            self.prev_eos_probs.append(eos_point_prob)
-            return eos_point_prob
-        # bypass utils.log_sum because we always want to use logsumexp here 
-        prev_sum = logsumexp(np.asarray([p for p in self.prev_eos_probs])) 
-        self.prev_eos_probs.append(eos_point_prob)
-        # Desired prob is eos_point_prob / (1-last_eos_probs_sum)
-        return eos_point_prob - np.log(1.0-np.exp(prev_sum))
+            self.eos_probs = point_probs - self.max_eos_prob
+            self.unk_probs = np.zeros(max_len)
+            return
+        # log_cdf[i] is the log of the accumulated point probabilities
+        # for the lengths 1 to i
+        log_cdf = np.logaddexp.accumulate(point_probs[1:])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.eos_probs = np.empty(max_len)
+            self.eos_probs[0] = utils.NEG_INF
+            self.eos_probs[1] = point_probs[1]
+            self.eos_probs[2:] = point_probs[2:] \
+                                 - np.log1p(-np.exp(log_cdf[:-1]))
+            self.unk_probs = np.log1p(-np.exp(self.eos_probs))
+        self.unk_probs[0] = 0.0
     
     def _get_eos_point_prob(self, n):
         return gammaln(n + self.cur_r) \
@@ -178,22 +203,23 @@ class NBLengthPredictor(Predictor):
                 + self.cur_r * np.log(1.0-self.cur_p)
     
     def _get_max_eos_prob(self):
-        """Get the maximum loglikelihood according cur_p, cur_r 
-        TODO: replace this brute force impl. with something smarter
+        """Get the maximum loglikelihood according cur_p, cur_r for
+        lengths greater than zero. The mode of the negative binomial
+        distribution is floor((r-1)p/(1-p)) for r>1 and 0 otherwise.
         """
-        max_prob = utils.NEG_INF
-        n_prob = max_prob
-        n = 0
-        while n_prob == max_prob:
-            n += 1
-            n_prob = self._get_eos_point_prob(n)
-            max_prob = max(max_prob, n_prob)
-        return max_prob
+        mode = 0
+        if self.cur_r > 1.0:
+            mode = int(math.floor((self.cur_r - 1.0) * self.cur_p 
+                                  / (1.0 - self.cur_p)))
+        mode = max(1, mode)
+        return float(np.max(self._get_eos_point_prob(
+                                            np.array([mode, mode+1]))))
     
     def initialize(self, src_sentence):
-        """Extract features for the source sentence. Note that this
-        method does not use ``src_sentence`` as we need the string
-        representation of the source sentence to extract features.
+        """Extract features for the source sentence and precompute the
+        EOS scores for this sentence. Note that this method does not 
+        use ``src_sentence`` as we need the string representation of
+        the source sentence to extract features.
         
         Args:
             src_sentence (list): Not used
@@ -204,9 +230,11 @@ class NBLengthPredictor(Predictor):
         p = 1.0 / (1.0 + math.exp(-p))
         self.cur_p = max(utils.EPS_P, min(1.0 - utils.EPS_P, p))
         self.n_consumed = 0
-        self.prev_eos_probs = []
         if self.use_point_probs:
             self.max_eos_prob = self._get_max_eos_prob()
+        mean = self.cur_p * self.cur_r / (1.0 - self.cur_p)
+        self._compute_tables(max(MIN_LENGTH_TABLE_SIZE, 
+                                 int(2.0*mean) + self.offset + 1))
     
     def consume(self, word):
         """Increases the current history length
@@ -217,21 +245,16 @@ class NBLengthPredictor(Predictor):
         self.n_consumed = self.n_consumed + 1
     
     def get_state(self):
-        """State consists of the number of consumed words, and the
-        accumulator for previous EOS probability estimates if we 
-        don't use point estimates.
-        """
-        return self.n_consumed,self.prev_eos_probs
+        """State is the number of consumed words. """
+        return self.n_consumed
     
     def set_state(self, state):
         """Set the predictor state """
-        self.n_consumed,self.prev_eos_probs = state
+        self.n_consumed = state
 
     def is_equal(self, state1, state2):
         """Returns true if the number of consumed words is the same """
-        n1,_ = state1
-        n2,_ = state2
-        return n1 == n2
+        return state1 == state2
 
 
 class WordCountPredictor(Predictor):
@@ -401,23 +424,29 @@ class ExternalLengthPredictor(Predictor):
         return utils.NEG_INF
     
     def predict_next(self):
-        """Returns a dictionary with one entry and value 0 (=log 1). The
-        key is either the next word in the target sentence or (if the
-        target sentence has no more words) the end-of-sentence symbol.
+        """Returns a dictionary with one entry for the end-of-sentence
+        symbol, with the score of the current length in the length
+        distribution, or -inf if the length is not in the 
+        distribution.
         """
-        if self.n_consumed in self.cur_scores: 
-            return {utils.EOS_ID : self.cur_scores[self.n_consumed]}
+        if self.n_consumed <= self.max_length: 
+            return {utils.EOS_ID : float(self.cur_scores[self.n_consumed])}
         return {utils.EOS_ID : utils.NEG_INF} 
     
     def initialize(self, src_sentence):
         """Fetches the corresponding target sentence length 
-        distribution and resets the word counter.
+        distribution, stores it as table indexed by length, and resets
+        the word counter.
         
         Args:
             src_sentence (list):  Not used
         """
-        self.cur_scores = self.trg_lengths[self.current_sen_id]
-        self.max_length = max(self.cur_scores)
+        scores = self.trg_lengths[self.current_sen_id]
+        self.max_length = max(scores)
+        self.cur_scores = np.full((self.max_length + 1,), utils.NEG_INF)
+        for length, score in scores.iteritems():
+            if length >= 0:
+                self.cur_scores[length] = score
         self.n_consumed = 0
 
     def consume(self, word):
@@ -444,34 +473,52 @@ class ExternalLengthPredictor(Predictor):
 class NgramCountPredictor(Predictor):
     """This predictor counts the number of n-grams in hypotheses. n-gram
     posteriors are loaded from a file. The predictor score is the sum of
-    all n-gram posteriors in a hypothesis. """
-    
-    def __init__(self, path, order=0, discount_factor=-1.0):
+    all n-gram posteriors in a hypothesis.
+
+    If ``path`` points to a store created with
+    ``cam.sgnmt.misc.ngramstore``, the posteriors of all sentences are
+    memory-mapped from a single file instead of being parsed for each
+    sentence. In this mode, merged posteriors are cached for each
+    n-gram context and shared between hypotheses.
+    """
+
+    def __init__(self, path, order=0, discount_factor=-1.0, cache_size=0):
         """Creates a new ngram count predictor instance.
-        
+
         Args:
             path (string): Path to the n-gram posteriors. File format:
                            <ngram> : <score> (one ngram per line). Use
-                           placeholder %d for sentence id.
+                           placeholder %d for sentence id. Alternatively,
+                           path to an n-gram posterior store
             order (int): If positive, count n-grams of the specified
                          order. Otherwise, count all n-grams
             discount_factor (float): If non-negative, discount n-gram
-                                     posteriors by this factor each time 
-                                     they are consumed 
+                                     posteriors by this factor each time
+                                     they are consumed
+            cache_size (int): Maximum number of cached posteriors if
+                              ``path`` is a store. Unbounded if not
+                              positive
         """
         super(NgramCountPredictor, self).__init__()
-        self.path = path 
+        self.path = path
         self.order = order
         self.discount_factor = discount_factor
-        
+        self.store = None
+        if is_array_store(path):
+            logging.info("Memory-mapping n-gram posteriors from %s" % path)
+            self.store = NgramPosteriorStore(path)
+            self.posterior_cache = LRUCache(cache_size)
+
     def get_unk_probability(self, posterior):
         """Always return 0.0 """
         return 0.0
-    
+
     def predict_next(self):
         """Composes the posterior vector by collecting all ngrams which
         are consistent with the current history.
         """
+        if self.store is not None:
+            return self._predict_next_store()
         posterior = {}
         for i in reversed(range(len(self.cur_history)+1)):
             scores = self.ngrams.get(self.cur_history[i:])
@@ -487,7 +534,55 @@ class NgramCountPredictor(Predictor):
                         posterior[w] = posterior.get(w, 0.0) +  \
                                        factors.get(w, 1.0) * score
         return posterior
-    
+
+    def _get_store_matches(self, history):
+        """Returns (suffix_length, node) tuples for all suffixes of
+        ``history`` which are n-gram contexts in the store.
+        """
+        matches = self.store.match_history(self.store_root, history)
+        if self.order > 0:
+            return [(n, node) for n, node in matches if n == self.order-1]
+        return matches
+
+    def _predict_next_store(self):
+        """Implementation of ``predict_next`` for memory-mapped n-gram
+        posteriors. Without discounting, the posterior only depends on
+        the deepest matching trie node, which is used as cache key.
+        """
+        matches = self._get_store_matches(self.cur_history)
+        if not matches:
+            return {}
+        use_discounts = self.discount_factor >= 0.0
+        if not use_discounts:
+            posterior = self.posterior_cache.get(matches[-1][1])
+            if posterior is not None:
+                return posterior
+        all_words = []
+        all_scores = []
+        for n, node in matches:
+            words, scores = self.store.get_posterior(node)
+            if len(words) == 0:
+                continue
+            if use_discounts:
+                factors = self.discounts.get(
+                    self.cur_history[len(self.cur_history)-n:])
+                if factors:
+                    scores = np.array(scores, dtype=np.float64)
+                    for w, factor in factors.iteritems():
+                        scores[words == w] *= factor
+            all_words.append(words)
+            all_scores.append(scores)
+        posterior = {}
+        if all_words:
+            words, inv = np.unique(np.concatenate(all_words),
+                                   return_inverse=True)
+            scores = np.bincount(inv, weights=np.concatenate(all_scores))
+            posterior = dict(zip(words.tolist(), scores.tolist()))
+            posterior.pop(utils.GO_ID, None)
+        if not use_discounts:
+            self.posterior_cache.add(matches[-1][1], posterior)
+        return posterior
+
     def _load_posteriors(self, path):
         """Sets up self.max_history_len and self.ngrams """
         self.max_history_len = 0
@@ -516,7 +611,15 @@ class NgramCountPredictor(Predictor):
         Args:
             src_sentence (list): not used
         """
-        self._load_posteriors(utils.get_path(self.path, self.current_sen_id+1))
+        if self.store is not None:
+            self.store_root, self.max_history_len = self.store.get_root(
+                self.current_sen_id)
+            if self.order > 0:
+                self.max_history_len = self.order - 1
+            self.posterior_cache = LRUCache(self.posterior_cache.capacity)
+        else:
+            self._load_posteriors(utils.get_path(self.path,
+                                                 self.current_sen_id+1))
         self.cur_history = [utils.GO_ID]
         self.discounts = SimpleTrie()
     
@@ -558,6 +661,9 @@ class NgramCountPredictor(Predictor):
         hist2 = state2[0]
         if hist1 == hist2: # Return true if histories match
             return True
+        if self.store is not None:
+            return (self._get_store_matches(hist1)[-1:]
+                    == self._get_store_matches(hist2)[-1:])
         if len(hist1) > len(hist2):
             hist_long = hist1
             hist_short = hist2
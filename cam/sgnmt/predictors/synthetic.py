@@ -0,0 +1,270 @@
+"""This module contains synthetic predictors which produce random but
+deterministic scores without loading any model. They can be used to
+measure the throughput of search strategies independently of real
+models (see ``cam.sgnmt.benchmark``). The scores only depend on the
+seed, the source sentence, and the target prefix, i.e. restoring a
+predictor state reproduces the same posterior as with real models.
+The end-of-sentence symbol is very unlikely until the target prefix is
+as long as the source sentence, and very likely afterwards. Therefore,
+the length of the source sentence controls the length of hypotheses.
+
+Four predictors simulate the different types of posteriors in SGNMT:
+
+  - ``SyntheticDensePredictor``: Dense numpy arrays over the full
+    vocabulary, e.g. like NMT
+  - ``SyntheticSparsePredictor``: Dictionaries with a small number of
+    active words, e.g. like forced decoding or bag-of-words
+  - ``SyntheticUnboundedPredictor``: Scores only for the requested
+    words, e.g. like n-gram language models
+  - ``SyntheticFstPredictor``: Random deterministic automaton with a
+    fixed number of states, e.g. like translation lattices
+"""
+
+import math
+import time
+
+import numpy as np
+
+from cam.sgnmt import utils
+from cam.sgnmt.predictors.core import Predictor, UnboundedVocabularyPredictor
+
+
+EOS_SCORE_OFFSET = 10.0
+"""Added to the EOS score if the target prefix is at least as long as
+the source sentence, and subtracted otherwise.
+"""
+
+
+class SyntheticPredictor(Predictor):
+    """Base class for synthetic predictors. The predictor state is a
+    tuple of the target prefix length and a hash value of the target
+    prefix, so that states are immutable and cheap to copy.
+    """
+
+    def __init__(self, vocab_size, seed=0, latency=0.0):
+        """Creates a new synthetic predictor.
+
+        Args:
+            vocab_size (int): Target vocabulary size
+            seed (int): Random seed. Predictors with the same seed
+                        produce the same scores
+            latency (float): Time in seconds to sleep in each call of
+                             ``predict_next`` to simulate expensive
+                             predictors
+        """
+        super(SyntheticPredictor, self).__init__()
+        self.vocab_size = vocab_size
+        self.seed = seed
+        self.latency = latency
+        self.n_calls = 0
+        self.src_length = 0
+        self.src_hash = 0
+        self.length = 0
+        self.prefix_hash = 0
+
+    def initialize(self, src_sentence):
+        """Resets the target prefix and stores the length and a hash
+        value of the source sentence.
+        """
+        self.src_length = len(src_sentence)
+        self.src_hash = hash((self.seed, tuple(src_sentence)))
+        self.length = 0
+        self.prefix_hash = self.src_hash
+
+    def _get_random_state(self):
+        """Returns a ``RandomState`` which is seeded with the current
+        history.
+        """
+        return np.random.RandomState(self.prefix_hash & 0x7fffffff)
+
+    def _get_eos_score(self):
+        """Returns the score offset for EOS given the prefix length. """
+        if self.length >= self.src_length:
+            return EOS_SCORE_OFFSET
+        return -EOS_SCORE_OFFSET
+
+    def _simulate_latency(self):
+        """Counts the call and sleeps for ``latency`` seconds. """
+        self.n_calls += 1
+        if self.latency > 0.0:
+            time.sleep(self.latency)
+
+    def get_unk_probability(self, posterior):
+        """Returns the score of UNK in ``posterior`` if available,
+        otherwise ``NEG_INF``.
+        """
+        return utils.common_get(posterior, utils.UNK_ID, utils.NEG_INF)
+
+    def consume(self, word):
+        """Updates the length and the hash value of the prefix. """
+        self.length += 1
+        self.prefix_hash = hash((self.prefix_hash, word))
+
+    def get_state(self):
+        """Returns the length and the hash value of the prefix. """
+        return self.length, self.prefix_hash
+
+    def set_state(self, state):
+        """Sets the length and the hash value of the prefix. """
+        self.length, self.prefix_hash = state
+
+    def reset(self):
+        """Empty method. """
+        pass
+
+    def is_equal(self, state1, state2):
+        """Returns true if the prefix hashes are equal. """
+        return state1 == state2
+
+
+class SyntheticDensePredictor(SyntheticPredictor):
+    """Synthetic predictor which returns normalized scores over the
+    full vocabulary as numpy array.
+    """
+
+    def predict_next(self):
+        """Returns a random log-softmax distribution over the
+        vocabulary.
+        """
+        self._simulate_latency()
+        logits = self._get_random_state().randn(self.vocab_size) * 2.0
+        logits[utils.EOS_ID] += self._get_eos_score()
+        logits[utils.UNK_ID] = utils.NEG_INF
+        max_logit = np.max(logits)
+        return logits - max_logit - np.log(np.sum(np.exp(logits - max_logit)))
+
+
+class SyntheticSparsePredictor(SyntheticPredictor):
+    """Synthetic predictor which returns normalized scores for a small
+    number of randomly selected words as dictionary.
+    """
+
+    def __init__(self, vocab_size, n_active=10, seed=0, latency=0.0):
+        """Creates a new sparse synthetic predictor.
+
+        Args:
+            vocab_size (int): Target vocabulary size
+            n_active (int): Maximum number of words with scores in
+                            each posterior (plus EOS)
+            seed (int): Random seed
+            latency (float): Time in seconds to sleep in each call of
+                             ``predict_next``
+        """
+        super(SyntheticSparsePredictor, self).__init__(vocab_size,
+                                                       seed,
+                                                       latency)
+        self.n_active = min(n_active, vocab_size - 3)
+
+    def predict_next(self):
+        """Returns a random distribution over ``n_active`` words and
+        EOS.
+        """
+        self._simulate_latency()
+        rs = self._get_random_state()
+        words = np.unique(rs.randint(3, self.vocab_size, self.n_active))
+        logits = rs.randn(len(words) + 1) * 2.0
+        logits[-1] += self._get_eos_score()
+        max_logit = np.max(logits)
+        logits -= max_logit + np.log(np.sum(np.exp(logits - max_logit)))
+        posterior = {int(w): float(s) for w, s in zip(words, logits[:-1])}
+        posterior[utils.EOS_ID] = float(logits[-1])
+        return posterior
+
+
+class SyntheticUnboundedPredictor(SyntheticPredictor,
+                                  UnboundedVocabularyPredictor):
+    """Synthetic predictor with unbounded vocabulary. Each word is
+    scored independently, so the scores are not normalized.
+    """
+
+    def predict_next(self, trgt_words):
+        """Returns random scores for the words in ``trgt_words``. """
+        self._simulate_latency()
+        eos_score = self._get_eos_score()
+        posterior = {}
+        for w in trgt_words:
+            r = (hash((self.prefix_hash, w)) & 0xffffff) / float(0x1000000)
+            posterior[w] = math.log(0.001 + 0.099 * r)
+        if utils.EOS_ID in posterior:
+            posterior[utils.EOS_ID] += eos_score
+        return posterior
+
+
+class SyntheticFstPredictor(SyntheticPredictor):
+    """Synthetic predictor which simulates a deterministic weighted
+    automaton. The automaton has a fixed number of states with
+    ``n_arcs`` random outgoing arcs each. All states are final once
+    the target prefix is as long as the source sentence. The state of
+    this predictor consists of the prefix length and the automaton
+    state.
+    """
+
+    def __init__(self, vocab_size, n_states=100, n_arcs=10, seed=0,
+                 latency=0.0):
+        """Creates a new synthetic automaton predictor.
+
+        Args:
+            vocab_size (int): Target vocabulary size
+            n_states (int): Number of automaton states
+            n_arcs (int): Maximum number of outgoing arcs of each
+                          state
+            seed (int): Random seed
+            latency (float): Time in seconds to sleep in each call of
+                             ``predict_next``
+        """
+        super(SyntheticFstPredictor, self).__init__(vocab_size, seed, latency)
+        self.n_states = n_states
+        self.n_arcs = min(n_arcs, vocab_size - 3)
+        self.arcs = {}
+        self.fst_state = 0
+
+    def initialize(self, src_sentence):
+        """Resets the automaton to the start state. Arcs depend on the
+        source sentence, i.e. each sentence has its own automaton.
+        """
+        super(SyntheticFstPredictor, self).initialize(src_sentence)
+        self.arcs = {}
+        self.fst_state = 0
+
+    def _get_arcs(self, fst_state):
+        """Returns the outgoing arcs of ``fst_state`` as dictionary
+        which maps words to tuples (score, next state).
+        """
+        arcs = self.arcs.get(fst_state)
+        if arcs is None:
+            rs = np.random.RandomState(
+                        hash((self.src_hash, fst_state)) & 0x7fffffff)
+            words = np.unique(rs.randint(3, self.vocab_size, self.n_arcs))
+            scores = np.log(rs.uniform(0.01, 1.0, len(words)))
+            next_states = rs.randint(0, self.n_states, len(words))
+            arcs = {int(w): (float(s), int(n))
+                    for w, s, n in zip(words, scores, next_states)}
+            self.arcs[fst_state] = arcs
+        return arcs
+
+    def predict_next(self):
+        """Returns the arc weights of the current automaton state. EOS
+        is only allowed if the prefix is long enough.
+        """
+        self._simulate_latency()
+        posterior = {w: s for w, (s, _) in
+                        self._get_arcs(self.fst_state).iteritems()}
+        if self.length >= self.src_length:
+            posterior[utils.EOS_ID] = 0.0
+        return posterior
+
+    def consume(self, word):
+        """Follows the arc labeled with ``word``. Words which are not
+        accepted lead back to the start state.
+        """
+        self.length += 1
+        arc = self._get_arcs(self.fst_state).get(word)
+        self.fst_state = arc[1] if arc else 0
+
+    def get_state(self):
+        """Returns the prefix length and the automaton state. """
+        return self.length, self.fst_state
+
+    def set_state(self, state):
+        """Sets the prefix length and the automaton state. """
+        self.length, self.fst_state = state
@@ -84,7 +84,7 @@ def _initialize_t2t(t2t_usr_dir):
 
 def log_prob_from_logits(logits):
     """Softmax function."""
-    return logits - tf.reduce_logsumexp(logits, keepdims=True)
+    return logits - tf.reduce_logsumexp(logits, axis=-1, keepdims=True)
 
 
 class _BaseTensor2TensorPredictor(Predictor):
@@ -173,6 +173,21 @@ def expand_input_dims_for_t2t(t):
     return t
 
 
+def expand_batch_input_dims_for_t2t(t):
+    """Like ``expand_input_dims_for_t2t`` but for tensors which
+    already have a batch dimension.
+
+    Args:
+        t: Tensor of shape [batch_size, length]
+
+    Returns:
+      Tensor `t` expanded by two dimensions on the right.
+    """
+    t = tf.expand_dims(t, -1) # Because of modality
+    t = tf.expand_dims(t, -1) # Because of random reason X
+    return t
+
+
 class T2TPredictor(_BaseTensor2TensorPredictor):
     """This predictor implements scoring with Tensor2Tensor models. We
     follow the decoder implementation in T2T and do not reuse network
@@ -192,7 +207,8 @@ class T2TPredictor(_BaseTensor2TensorPredictor):
                  t2t_unk_id=None,
                  single_cpu_thread=False,
                  max_terminal_id=-1,
-                 pop_id=-1):
+                 pop_id=-1,
+                 batch_predictions=False):
         """Creates a new T2T predictor. The constructor prepares the
         TensorFlow session for predict_next() calls. This includes:
         - Load hyper parameters from the given set (hparams)
@@ -221,6 +237,9 @@ class T2TPredictor(_BaseTensor2TensorPredictor):
                 be set for syntax-based T2T models.
             pop_id (int): If positive, ID of the POP or closing bracket symbol.
                 Needs to be set for syntax-based T2T models.
+            batch_predictions (bool): If true, also create a graph which
+                computes log probs for several source sentences and
+                target prefixes at once (see ``predict_next_batch``).
         """
         super(T2TPredictor, self).__init__(t2t_usr_dir, 
                                            checkpoint_dir, 
@@ -266,6 +285,24 @@ class T2TPredictor(_BaseTensor2TensorPredictor):
             logits, _ = translate_model(features)
             logits = tf.squeeze(logits, [0, 1, 2, 3])
             self._log_probs = log_prob_from_logits(logits)
+            self._batch_log_probs = None
+            if batch_predictions:
+                self._batch_inputs_var = tf.placeholder(
+                    dtype=tf.int32, shape=[None, None],
+                    name="sgnmt_batch_inputs")
+                self._batch_targets_var = tf.placeholder(
+                    dtype=tf.int32, shape=[None, None],
+                    name="sgnmt_batch_targets")
+                features = {
+                    "inputs": expand_batch_input_dims_for_t2t(
+                        self._batch_inputs_var),
+                    "targets": expand_batch_input_dims_for_t2t(
+                        self._batch_targets_var)}
+                translate_model.prepare_features_for_infer(features)
+                translate_model._fill_problem_hparams_features(features)
+                logits, _ = translate_model(features)
+                logits = tf.squeeze(logits, [1, 2, 3])
+                self._batch_log_probs = log_prob_from_logits(logits)
             self.mon_sess = self.create_session()
 
     def _add_problem_hparams(
@@ -321,6 +358,45 @@ class T2TPredictor(_BaseTensor2TensorPredictor):
                  self._t2t_unk_id)})
         log_probs[text_encoder.PAD_ID] = utils.NEG_INF
         return log_probs
+
+    def predict_next_batch(self, contexts, states):
+        """Computes the posteriors for several hypotheses with the 
+        batched graph. The T2T model only returns the logits for the
+        last target position, so we group the hypotheses by history
+        length and run the session once for each group. Source 
+        sentences are padded with ``PAD_ID``.
+        """
+        if self._batch_log_probs is None:
+            return super(T2TPredictor, self).predict_next_batch(contexts,
+                                                                states)
+        posteriors = [None] * len(states)
+        groups = {}
+        for idx, consumed in enumerate(states):
+            groups.setdefault(len(consumed), []).append(idx)
+        for indices in groups.itervalues():
+            max_src_len = max([len(contexts[idx]) for idx in indices])
+            inputs = [contexts[idx] + [text_encoder.PAD_ID] * (
+                                            max_src_len - len(contexts[idx]))
+                      for idx in indices]
+            targets = [utils.oov_to_unk(states[idx] + [text_encoder.PAD_ID],
+                                        self.trg_vocab_size,
+                                        self._t2t_unk_id)
+                       for idx in indices]
+            log_probs = self.mon_sess.run(self._batch_log_probs,
+                {self._batch_inputs_var: inputs,
+                 self._batch_targets_var: targets})
+            log_probs[:, text_encoder.PAD_ID] = utils.NEG_INF
+            for row, idx in enumerate(indices):
+                posteriors[idx] = log_probs[row]
+        return posteriors, states
+
+    def get_sentence_context(self):
+        """The sentence context is the source sentence. """
+        return self.src_sentence
+
+    def set_sentence_context(self, context):
+        """The sentence context is the source sentence. """
+        self.src_sentence = context
     
     def initialize(self, src_sentence):
         """Set src_sentence, reset consumed."""
@@ -16,7 +16,7 @@ import copy
 import logging
 
 from cam.sgnmt import utils
-from cam.sgnmt.misc.trie import SimpleTrie
+from cam.sgnmt.misc.vocab import get_vocab_store
 from cam.sgnmt.predictors.core import UnboundedVocabularyPredictor, Predictor
 from cam.sgnmt.utils import NEG_INF, common_get
 
@@ -312,7 +312,8 @@ class Word2charPredictor(UnboundedVocabularyPredictor):
         """Creates a new word2char wrapper predictor. The map_path 
         file has to be plain text files, each line containing the 
         mapping from a word index to the character index sequence
-        (format: word char1 char2... charn).
+        (format: word char1 char2... charn). The mapping is accessed
+        via a memory-mapped vocabulary store (``misc.vocab``).
         
         Args:
             map_path (string): Path to the mapping file
@@ -321,16 +322,8 @@ class Word2charPredictor(UnboundedVocabularyPredictor):
         """
         super(Word2charPredictor, self).__init__()
         self.slave_predictor = slave_predictor
-        self.words = SimpleTrie()
-        self.word_chars = {}
-        with open(map_path) as f:
-            for line in f:
-                l = [int(x) for x in line.strip().split()]
-                word = l[0]
-                chars = l[1:]
-                self.words.add(chars, word)
-                for c in chars:
-                    self.word_chars[c] = True   
+        self.words = get_vocab_store(map_path, "word2char")
+        self.word_chars = set(self.words.get_symbols().tolist())
         if isinstance(slave_predictor, UnboundedVocabularyPredictor): 
             self._get_stub_prob = self._get_stub_prob_unbounded
             self._start_new_word = self._start_new_word_unbounded
@@ -375,11 +368,15 @@ class Word2charPredictor(UnboundedVocabularyPredictor):
         self.slave_posterior = self.slave_predictor.predict_next()
         self._update_slave_vars(self.slave_posterior)
     
+    def _get_word(self):
+        """Get the word ID of ``word_stub`` or None. """
+        return self.words.get_id(' '.join([str(c) for c in self.word_stub]))
+    
     def _get_stub_prob_unbounded(self):
         """get_stub_prob implementation for unbounded vocabulary slave
         predictors.
         """
-        word = self.words.get(self.word_stub)
+        word = self._get_word()
         if word:
             posterior = self.slave_predictor.predict_next([word])
             return common_get(posterior, word, self.slave_unk)
@@ -389,7 +386,7 @@ class Word2charPredictor(UnboundedVocabularyPredictor):
         """get_stub_prob implementation for bounded vocabulary slave
         predictors.
         """
-        word = self.words.get(self.word_stub)
+        word = self._get_word()
         return common_get(self.slave_posterior,
                           word if word else utils.UNK_ID,
                           self.slave_unk)
@@ -425,7 +422,7 @@ class Word2charPredictor(UnboundedVocabularyPredictor):
         if word in self.word_chars:
             self.word_stub.append(word)
         elif self.word_stub:
-            word = self.words.get(self.word_stub)
+            word = self._get_word()
             self.slave_predictor.consume(word if word else utils.UNK_ID)
             self._start_new_word()
     
@@ -3,10 +3,16 @@ wrapped predictor. An example is the idxmap wrapper which makes it
 possible to use an alternative word map.
 """
 
-import logging
 import copy
+import heapq
+import logging
+from operator import itemgetter
+
+import numpy as np
 
 from cam.sgnmt import utils
+from cam.sgnmt.misc.cache import LRUCache
+from cam.sgnmt.misc.vocab import get_vocab_store
 from cam.sgnmt.predictors.core import Predictor, UnboundedVocabularyPredictor
 
 
@@ -16,6 +22,11 @@ class IdxmapPredictor(Predictor):
     indices and predictors indices each time the predictor is called.
     This mapping is transparent to both the decoder and the wrapped
     slave predictor.
+    
+    Array posteriors of the slave predictor are translated with a 
+    single gather operation if the target map covers a contiguous 
+    range of SGNMT indices, so that they stay numpy arrays. Index maps
+    are memory-mapped from vocabulary stores (``misc.vocab``).
     """
     
     def __init__(self,
@@ -42,49 +53,115 @@ class IdxmapPredictor(Predictor):
         # trgt map_inverse goes from slave index -> sgnmt index for the target 
         self.src_map = self.load_map(src_idxmap_path, "source")
         self.trgt_map = self.load_map(trgt_idxmap_path, "target")
-        self.trgt_map_inverse = {slave_idx: gnmt_idx 
-                        for gnmt_idx, slave_idx in enumerate(self.trgt_map)}
+        self.trgt_map_inverse_arr = self._build_inverse_array(self.trgt_map)
+        self.index_translations = {}
+    
+    def _build_inverse_array(self, trgt_map):
+        """Creates the inverse of ``trgt_map`` as array, i.e. a 
+        mapping from slave index to SGNMT index. Slave indices which
+        are not in the map are mapped to UNK. The largest SGNMT index
+        wins if the map is not injective.
+        """
+        if trgt_map is None:
+            return None
+        trgt_map = np.asarray(trgt_map, dtype=np.int64)
+        inverse = np.full(np.max(trgt_map) + 1, utils.UNK_ID, dtype=np.int64)
+        slave_ids, rev_pos = np.unique(trgt_map[::-1], return_index=True)
+        inverse[slave_ids] = len(trgt_map) - 1 - rev_pos
+        return inverse
+    
+    def _get_index_translation(self, n_slave):
+        """Get the index arrays which translate a slave posterior array
+        of length ``n_slave`` to SGNMT indices. Translations are 
+        computed once for each posterior length.
+        
+        Args:
+            n_slave (int): Length of the slave posterior
+        
+        Returns:
+            tuple. (dst, src, dense) tuple. ``dst`` contains the sorted
+            SGNMT indices, ``src`` the slave indices they are taken
+            from. ``dense`` is true if ``dst`` is a contiguous range
+            starting at 0.
+        """
+        translation = self.index_translations.get(n_slave)
+        if translation is None:
+            inverse = self.trgt_map_inverse_arr[:n_slave]
+            if n_slave > len(inverse):
+                inverse = np.concatenate([
+                    inverse,
+                    np.full(n_slave - len(inverse), utils.UNK_ID, 
+                            dtype=np.int64)])
+            # If several slave indices map to the same SGNMT index (e.g.
+            # UNK), the last one wins like in a dict comprehension
+            dst, rev_pos = np.unique(inverse[::-1], return_index=True)
+            src = n_slave - 1 - rev_pos
+            dense = len(dst) == 0 or dst[-1] == len(dst) - 1
+            translation = (dst, src, dense)
+            self.index_translations[n_slave] = translation
+        return translation
+    
+    def _translate_posterior(self, posterior):
+        """Translates a slave posterior to SGNMT indices and applies
+        the slave weight. Arrays are translated with index arrays and 
+        are only converted to dictionaries if the translated indices
+        have gaps.
+        """
+        if isinstance(posterior, dict):
+            inverse = self.trgt_map_inverse_arr
+            n_inverse = len(inverse)
+            return {int(inverse[idx]) if idx < n_inverse else utils.UNK_ID:
+                                                    self.slave_weight * prob 
+                    for idx, prob in posterior.iteritems()}
+        posterior = np.asarray(posterior)
+        dst, src, dense = self._get_index_translation(len(posterior))
+        scores = self.slave_weight * posterior[src]
+        if dense:
+            return scores
+        return dict(zip(dst.tolist(), scores.tolist()))
     
     def load_map(self, path, name):
         """Load a index map file. Mappings should be bijections, but
-        there is no sanity check in place to verify this.
+        there is no sanity check in place to verify this. The map is
+        memory-mapped from the vocabulary store of ``path``.
         
         Args:
             path (string): Path to the mapping file
             name (string): 'source' or 'target' for error messages
         
         Returns:
-            dict. Mapping from SGNMT index to slave predictor index
+            array. Mapping from SGNMT index to slave predictor index,
+            or None for the identity mapping
         """
         if not path:
             logging.info("%s-side identity mapping (no idxmap specified)" % name)
-            return {}
-        with open(path) as f:
-            d = dict(map(int, line.strip().split(None, 1)) for line in f)
-            if (d[utils.UNK_ID] != utils.UNK_ID
-                    or d[utils.EOS_ID] != utils.EOS_ID
-                    or d[utils.GO_ID] != utils.GO_ID):
-                logging.fatal(
+            return None
+        idx_map = get_vocab_store(path).get_int_map()
+        if idx_map is None:
+            logging.fatal("idxmap %s contains non-integer indices" % path)
+            return None
+        reserved = [utils.UNK_ID, utils.EOS_ID, utils.GO_ID]
+        if any(idx >= len(idx_map) or idx_map[idx] != idx
+               for idx in reserved):
+            logging.fatal(
                    "idxmap %s contains non-identical maps for reserved indices"
                         % path)
-            logging.debug("Loaded wmap from %s" % path)
-            return [d[idx] if idx in d else 0 for idx in range(max(d)+1)]
+        logging.debug("Loaded wmap from %s" % path)
+        return idx_map
     
     def initialize(self, src_sentence):
         """Pass through to slave predictor """
-        if not self.src_map:
+        if self.src_map is None:
             self.slave_predictor.initialize(src_sentence)
         else:
-            self.slave_predictor.initialize([self.src_map[idx]
+            self.slave_predictor.initialize([int(self.src_map[idx])
                                             for idx in src_sentence])
     
     def predict_next(self):
         """Pass through to slave predictor """
-        if not self.trgt_map:
+        if self.trgt_map is None:
             return self.slave_predictor.predict_next()
-        posterior = self.slave_predictor.predict_next()
-        return {self.trgt_map_inverse.get(idx, utils.UNK_ID): self.slave_weight * prob 
-            for idx, prob in utils.common_iterable(posterior)}
+        return self._translate_posterior(self.slave_predictor.predict_next())
         
     def get_unk_probability(self, posterior):
         """ATTENTION: We should translate the posterior array 
@@ -98,11 +175,11 @@ class IdxmapPredictor(Predictor):
     
     def consume(self, word):
         """Pass through to slave predictor """
-        if not self.trgt_map:
+        if self.trgt_map is None:
             self.slave_predictor.consume(word)
         else:
-            self.slave_predictor.consume(utils.common_get(
-                self.trgt_map, word, utils.UNK_ID))
+            self.slave_predictor.consume(int(utils.common_get(
+                self.trgt_map, word, utils.UNK_ID)))
     
     def get_state(self):
         """Pass through to slave predictor """
@@ -114,18 +191,18 @@ class IdxmapPredictor(Predictor):
 
     def estimate_future_cost(self, hypo):
         """Pass through to slave predictor """
-        if not self.trgt_map:
+        if self.trgt_map is None:
             return self.slave_predictor.estimate_future_cost(hypo)
         old_sen = hypo.trgt_sentence
-        hypo.trgt_sentence = [self.trgt_map[idx] for idx in old_sen]
+        hypo.trgt_sentence = [int(self.trgt_map[idx]) for idx in old_sen]
         ret = self.slave_predictor.estimate_future_cost(hypo)
         hypo.trgt_sentence = old_sen
         return ret
 
     def initialize_heuristic(self, src_sentence):
         """Pass through to slave predictor """
-        if self.src_map:
-            self.slave_predictor.initialize_heuristic([self.src_map[idx] 
+        if self.src_map is not None:
+            self.slave_predictor.initialize_heuristic([int(self.src_map[idx])
                                                     for idx in src_sentence])
 
     def set_current_sen_id(self, cur_sen_id):
@@ -159,20 +236,19 @@ class UnboundedIdxmapPredictor(IdxmapPredictor, UnboundedVocabularyPredictor):
 
     def predict_next(self, trgt_words):
         """Pass through to slave predictor """
-        if not self.trgt_map:
+        if self.trgt_map is None:
             return self.slave_predictor.predict_next(trgt_words)
-        posterior = self.slave_predictor.predict_next([self.trgt_map[w] 
+        posterior = self.slave_predictor.predict_next([int(self.trgt_map[w])
                                                        for w in trgt_words])
-        return {self.trgt_map_inverse.get(idx,
-                                          utils.UNK_ID): self.slave_weight*prob 
-                            for idx, prob in utils.common_iterable(posterior)}
+        return self._translate_posterior(posterior)
 
 
 class MaskvocabPredictor(Predictor):
     """This wrapper predictor hides certain words in the SGNMT 
     vocabulary from the predictor. Those words are scored by the
     masked predictor with zero. The wrapper passes through consume()
-    only for other words.
+    only for other words. Array posteriors are masked with a 
+    precomputed boolean mask.
     """
     
     def __init__(self, words, slave_predictor):
@@ -188,6 +264,26 @@ class MaskvocabPredictor(Predictor):
         super(MaskvocabPredictor, self).__init__()
         self.words = set(words)
         self.slave_predictor = slave_predictor
+        self.masks = {}
+    
+    def _get_mask(self, size):
+        """Get the boolean mask of the masked words for posterior 
+        arrays of length ``size``. Masks are created once for each
+        length.
+        """
+        mask = self.masks.get(size)
+        if mask is None:
+            mask = np.zeros(size, dtype=bool)
+            mask[[w for w in self.words if 0 <= w < size]] = True
+            out_of_range = sorted(w for w in self.words
+                                  if not 0 <= w < size)
+            if out_of_range:
+                logging.warn("Cannot mask word IDs %s in posteriors of "
+                             "size %d (out of range)" % (
+                                ','.join([str(w) for w in out_of_range]),
+                                size))
+            self.masks[size] = mask
+        return mask
 
     def initialize(self, src_sentence):
         """Pass through to slave predictor """
@@ -196,8 +292,12 @@ class MaskvocabPredictor(Predictor):
     def predict_next(self):
         """Pass through to slave predictor, set masked to 0.0 """
         posterior = self.slave_predictor.predict_next()
-        for w in self.words:
-            posterior[w] = 0.0
+        if isinstance(posterior, dict):
+            for w in self.words:
+                posterior[w] = 0.0
+        else:
+            posterior = np.asarray(posterior)
+            posterior[self._get_mask(len(posterior))] = 0.0
         return posterior
         
     def get_unk_probability(self, posterior):
@@ -325,10 +425,11 @@ class UnkvocabPredictor(Predictor):
 class SkipvocabInternalHypothesis(object):
     """Helper class for internal beam search in skipvocab."""
 
-    def __init__(self, score, predictor_state, word_to_consume):
+    def __init__(self, score, predictor_state, word_to_consume, history):
         self.score = score
         self.predictor_state = predictor_state
         self.word_to_consume = word_to_consume
+        self.history = history
 
     
 class SkipvocabPredictor(Predictor):
@@ -338,9 +439,16 @@ class SkipvocabPredictor(Predictor):
     this wrapper. Therefore, this wrapper does not produce any word
     from the larger vocabulary, but searches internally until enough
     in-vocabulary word scores are collected from the wrapped predictor.
+    
+    The wrapper keeps track of the full slave history (including
+    skipped words) and caches the slave posteriors and states for
+    each history in an LRU cache. Outer hypotheses which share a
+    prefix therefore share the internal search results, and the slave
+    predictor is only called for new histories.
     """
     
-    def __init__(self, max_id, stop_size, beam, slave_predictor):
+    def __init__(self, max_id, stop_size, beam, slave_predictor,
+                 cache_size=10000):
         """Creates a new skipvocab wrapper predictor.
         
         Args:
@@ -349,15 +457,29 @@ class SkipvocabPredictor(Predictor):
                              stop_size words are in-vocabulary
             beam (int): Beam size of internal beam search
             slave_predictor (Predictor): Wrapped predictor.
+            cache_size (int): Maximum number of cached slave
+                              posteriors. Non-positive values disable
+                              the bound
         """
         super(SkipvocabPredictor, self).__init__()
         self.slave_predictor = slave_predictor
         self.max_id = max_id
         self.stop_size = stop_size
         self.beam = beam
+        self.cache = LRUCache(cache_size)
+        self.history = ()
     
     def initialize(self, src_sentence):
-        """Pass through to slave predictor """
+        """Pass through to slave predictor and reset the cache """
+        if self.cache.hits or self.cache.misses:
+            logging.debug("Skipvocab cache: %d hits, %d misses, "
+                          "%d entries" % (self.cache.hits,
+                                          self.cache.misses,
+                                          len(self.cache)))
+        # Do not clear in place: the old cache may still be referenced
+        # by the sentence context of another sentence (BatchBeamDecoder)
+        self.cache = LRUCache(self.cache.capacity)
+        self.history = ()
         self.slave_predictor.initialize(src_sentence)
     
     def initialize_heuristic(self, src_sentence):
@@ -369,11 +491,64 @@ class SkipvocabPredictor(Predictor):
         return self.slave_predictor.get_unk_probability(posterior)
 
     def _is_stopping_posterior(self, posterior):
-        for word, _ in sorted(utils.common_iterable(posterior),
-                              key=lambda h: -h[1])[:self.stop_size]:
-            if word > self.max_id:
-                return False
-        return True
+        """Returns true if the best ``stop_size`` entries in 
+        ``posterior`` are in-vocabulary. Ties are resolved in favor of
+        in-vocabulary words. For array posteriors, this only needs a
+        partial sort of the in-vocabulary scores.
+        """
+        if isinstance(posterior, dict):
+            oov_scores = [s for w, s in posterior.iteritems()
+                          if w > self.max_id]
+            if not oov_scores:
+                return True
+            iv_scores = heapq.nlargest(self.stop_size,
+                                       [s for w, s in posterior.iteritems()
+                                        if w <= self.max_id])
+            return (len(iv_scores) >= self.stop_size 
+                    and iv_scores[-1] >= max(oov_scores))
+        posterior = np.asarray(posterior)
+        if len(posterior) <= self.max_id + 1:
+            return True
+        n_iv = self.max_id + 1
+        if n_iv < self.stop_size:
+            return False
+        kth_best = np.partition(posterior[:n_iv], n_iv - self.stop_size)
+        return kth_best[n_iv - self.stop_size] >= np.max(posterior[n_iv:])
+
+    def _get_best_oov_words(self, posterior):
+        """Returns the ``beam`` best OOV words in ``posterior`` as list
+        of (word, score) tuples. Since the internal beam is pruned to
+        ``beam`` hypotheses anyway, no other expansions can survive.
+        """
+        if isinstance(posterior, dict):
+            return heapq.nlargest(self.beam,
+                                  [(w, s) for w, s in posterior.iteritems()
+                                   if w > self.max_id],
+                                  key=itemgetter(1))
+        oov_scores = np.asarray(posterior)[self.max_id+1:]
+        if len(oov_scores) > self.beam:
+            best = np.argpartition(-oov_scores, self.beam - 1)[:self.beam]
+        else:
+            best = np.arange(len(oov_scores))
+        return [(int(idx) + self.max_id + 1, oov_scores[idx]) for idx in best]
+
+    def _expand_internal_hypo(self, hypo):
+        """Returns the slave posterior and the slave state after
+        consuming the word of ``hypo``. Results are looked up in the
+        cache first.
+        """
+        entry = self.cache.get(hypo.history)
+        if entry is None:
+            if hypo.word_to_consume is not None:
+                self.slave_predictor.set_state(copy.deepcopy(
+                    hypo.predictor_state))
+                self.slave_predictor.consume(hypo.word_to_consume)
+            posterior = self.slave_predictor.predict_next()
+            entry = (posterior,
+                     copy.deepcopy(self.slave_predictor.get_state()),
+                     self._is_stopping_posterior(posterior))
+            self.cache.add(hypo.history, entry)
+        return entry
  
     def predict_next(self):
         """This method first performs beam search internally to update
@@ -381,50 +556,57 @@ class SkipvocabPredictor(Predictor):
         entries in the predict_next() return value are in-vocabulary
         (bounded by max_id). Then, it returns the slave posterior in 
         that state.
+        
+        All expansions of an internal hypothesis share its slave
+        state, which is only set once per hypothesis. Only the best
+        ``beam`` OOV expansions of each hypothesis are generated.
         """
         hypos = [SkipvocabInternalHypothesis(0.0, 
                                              self.slave_predictor.get_state(),
-                                             None)]
+                                             None,
+                                             self.history)]
         best_score = utils.NEG_INF
-        best_predictor_state = None
-        best_posterior = None
+        best_hypo = None
+        best_entry = None
         while hypos and hypos[0].score > best_score:
             next_hypos = []
             for hypo in hypos:
-                self.slave_predictor.set_state(copy.deepcopy(
-                    hypo.predictor_state))
-                if hypo.word_to_consume is not None:
-                    self.slave_predictor.consume(hypo.word_to_consume)
-                posterior = self.slave_predictor.predict_next()
-                pred_state = copy.deepcopy(self.slave_predictor.get_state())
-                if (self._is_stopping_posterior(posterior) 
-                        and hypo.score > best_score):
+                entry = self._expand_internal_hypo(hypo)
+                posterior, pred_state, is_stopping = entry
+                if is_stopping and hypo.score > best_score:
                     # This is the new best result of the internal beam search
                     best_score = hypo.score
-                    best_predictor_state = pred_state
-                    best_posterior = posterior
-                else:
+                    best_hypo = hypo
+                    best_entry = entry
+                elif not is_stopping:
                     # Look for ways to expand this hypo with OOV words.
-                    for word, score in utils.common_iterable(posterior):
-                        if word > self.max_id:
-                            next_hypos.append(SkipvocabInternalHypothesis(
-                                hypo.score + score, pred_state, word))
+                    for word, score in self._get_best_oov_words(posterior):
+                        next_hypos.append(SkipvocabInternalHypothesis(
+                            hypo.score + score, 
+                            pred_state, 
+                            word,
+                            hypo.history + (word,)))
             next_hypos.sort(key=lambda h: -h.score)
             hypos = next_hypos[:self.beam]
-        self.slave_predictor.set_state(copy.deepcopy(best_predictor_state))
-        return best_posterior
+        posterior, pred_state, _ = best_entry
+        self.slave_predictor.set_state(copy.deepcopy(pred_state))
+        self.history = best_hypo.history
+        # The cached posterior must not be modified by other wrappers
+        return copy.copy(posterior)
         
     def consume(self, word):
         """Pass through to slave predictor """
+        self.history = self.history + (word,)
         self.slave_predictor.consume(word)
     
     def get_state(self):
-        """Pass through to slave predictor """
-        return self.slave_predictor.get_state()
+        """Returns the slave state and the slave history """
+        return self.slave_predictor.get_state(), self.history
     
     def set_state(self, state):
         """Pass through to slave predictor """
-        self.slave_predictor.set_state(state)
+        slave_state, self.history = state
+        self.slave_predictor.set_state(slave_state)
 
     def estimate_future_cost(self, hypo):
         """Pass through to slave predictor """
@@ -439,5 +621,5 @@ class SkipvocabPredictor(Predictor):
     
     def is_equal(self, state1, state2):
         """Pass through to slave predictor """
-        return self.slave_predictor.is_equal(state1, state2)
+        return self.slave_predictor.is_equal(state1[0], state2[0])
 
@@ -224,6 +224,14 @@ def get_parser():
                         "a partial hypothesis in beam-like decoders. If zero, "
                         "this is set to --beam to reproduce standard beam "
                         "search.")
+    group.add_argument("--sentence_batch", default=1, type=int,
+                        help="Number of source sentences which are decoded "
+                        "in lock-step by the beam decoder. Predictors are "
+                        "then queried for the hypotheses of all sentences "
+                        "at once, which speeds up predictors with batched "
+                        "implementations (e.g. t2t). Sentences are still "
+                        "written to the output in the original order. Only "
+                        "supported by the beam decoder.")
     group.add_argument("--hypo_recombination", default=False, type='bool',
                         help="Activates hypothesis recombination. Has to be "
                         "supported by the decoder. Applicable to beam, "
@@ -304,6 +312,11 @@ def get_parser():
                         help="Whether to cache heuristic future cost "
                         "estimates. This is especially useful with the greedy "
                         "heuristic.")
+    group.add_argument("--heuristic_cache_size", default=100000, type=int,
+                        help="Maximum number of cached future cost estimates "
+                        "of the greedy heuristic. If the cache is full, the "
+                        "least recently used estimates are removed. Set to a "
+                        "non-positive value for an unbounded cache.")
     group.add_argument("--pure_heuristic_scores", default=False, type='bool',
                         help="If this is set to false, heuristic decoders as "
                         "A* score hypotheses with the sum of the partial hypo "
@@ -342,11 +355,46 @@ def get_parser():
                         "search decoders like restarting or bow always perform "
                         "a single decoding step instead of greedy decoding. "
                         "Handle with care...")
+    group.add_argument("--max_node_children", default=0, type=int,
+                        help="Maximum number of unexplored outgoing arcs "
+                        "which are kept for each node in the search tree of "
+                        "the restarting and bow decoders. Only the best arcs "
+                        "are stored. Set to a non-positive value to keep all "
+                        "arcs.")
+    group.add_argument("--node_state_interval", default=1, type=int,
+                        help="The restarting and bow decoders store a copy of "
+                        "all predictor states at each node in the search "
+                        "tree. If this is greater than 1, states are only "
+                        "stored at every n-th tree level. States of other "
+                        "nodes are recomputed from the nearest ancestor with "
+                        "stored states when the decoder restarts from them. "
+                        "This reduces memory consumption, but recomputations "
+                        "count as node expansions. Cannot be combined with "
+                        "hypo_recombination.")
+    group.add_argument("--max_open_nodes", default=0, type=int,
+                        help="Maximum number of open nodes in the heap of the "
+                        "restarting and bow decoders. If the heap grows "
+                        "larger, the nodes with the worst scores are removed. "
+                        "Set to a non-positive value for an unbounded heap.")
     group.add_argument("--flip_strategy", default="move",
                         choices=['move', 'flip'],
                         help="Defines the hypothesis transition in the flip "
                         "decoder. 'flip' flips two words, 'move' moves a word "
                         "to a different position")
+    group.add_argument("--flip_max_states", default=10000, type=int,
+                        help="Maximum number of predictor states for explored "
+                        "prefixes which are kept by the flip decoder. If the "
+                        "store is full, the least recently used states are "
+                        "removed and rebuilt from shorter prefixes if "
+                        "needed. Set to a non-positive value to keep all "
+                        "states.")
+    group.add_argument("--flip_bigram_pruning", default=False, type='bool',
+                        help="If this is set to true, the flip decoder stops "
+                        "exploring a candidate as soon as the score of the "
+                        "explored prefix plus the bigram score estimates for "
+                        "the remaining words drops below the best score. "
+                        "This is checked before the predictors are applied, "
+                        "but is not admissible.")
     group.add_argument("--bucket_selector", default="maxscore",
                         help="Defines the bucket selection strategy for the "
                         "bucket decoder.\n\n"
@@ -370,6 +418,13 @@ def get_parser():
                         "* 'heap': Use best score on bucket heap directly\n"
                         "* 'absolute': Use best hypo score in bucket directly\n"
                         "* 'constant': Uniform bucket scores.")
+    group.add_argument("--bucket_workers", default=1, type=int,
+                        help="Number of threads used by the bucket decoder. "
+                        "If this is greater than 1, each thread loads its own "
+                        "predictors and expands hypotheses from a different "
+                        "bucket at the same time. Note that this search is "
+                        "speculative: hypotheses may be expanded which the "
+                        "single-threaded decoder would have pruned.")
     group.add_argument("--collect_statistics", default="best",
                        choices=['best', 'full', 'all'],
                         help="Determines over which hypotheses statistics are "
@@ -470,8 +525,26 @@ def get_parser():
                         "one of the following output formats:\n"
                         "* 'json': Dump data in pretty JSON format.\n"
                         "* 'pickle': Dump data as binary pickle.\n"
+                        "* 'store': Score all references for a source "
+                        "sentence along a shared prefix trie and write the "
+                        "statistics selected with --forced_stats to a "
+                        "memory-mappable array store.\n"
                         "The path to the output files can be specified with "
                         "--output_path")
+    group.add_argument("--forced_stats", default="target",
+                        help="Comma separated list of statistics written by "
+                        "extract_scores_along_reference.py with the 'store' "
+                        "output format:\n\n"
+                        "* 'target': Predictor scores of the reference "
+                        "tokens.\n"
+                        "* 'topk': The --forced_topk best words and their "
+                        "scores at each position.\n"
+                        "* 'entropy': Entropy of each predictor posterior.\n"
+                        "* 'posteriors': Full predictor posteriors in "
+                        "float16.")
+    group.add_argument("--forced_topk", default=10, type=int,
+                        help="Number of words stored for each position if "
+                        "--forced_stats contains 'topk'.")
     group.add_argument("--remove_eos", default=True, type='bool',
                         help="Whether to remove </S> symbol on output.")
     group.add_argument("--src_wmap", default="",
@@ -540,7 +613,8 @@ def get_parser():
                         "* 'srilm': n-gram language model (SRILM).\n"
                         "          Options: lm_path, ngramc_order\n"
                         "* 'nplm': neural n-gram language model (NPLM).\n"
-                        "          Options: nplm_path, normalize_nplm_probs\n"
+                        "          Options: nplm_path, normalize_nplm_probs, "
+                        "nplm_cache_size, nplm_max_candidates\n"
                         "* 'rnnlm': RNN language model based on TensorFlow.\n"
                         "          Options: rnnlm_config, rnnlm_path\n"
                         "* 'forced': Forced decoding with one reference\n"
@@ -569,8 +643,7 @@ def get_parser():
                         "* 'rtn': Recurrent transition networks as created by "
                         "HiFST with late expansion.\n"
                         "         Options: rtn_path, use_rtn_weights, "
-                        "minimize_rtns, remove_epsilon_in_rtns, "
-                        "normalize_rtn_weights\n"
+                        "rtn_cache_size, normalize_rtn_weights\n"
                         "* 'lrhiero': Direct Hiero (left-to-right Hiero). This "
                         "is an EXPERIMENTAL implementation of LRHiero.\n"
                         "             Options: rules_path, "
@@ -581,12 +654,19 @@ def get_parser():
                         "          Options: unk_count_lambdas, "
                         "pred_src_vocab_size.\n"
                         "* 'ngramc': Number of ngram feature.\n"
-                        "            Options: ngramc_path, ngramc_order.\n"
+                        "            Options: ngramc_path, ngramc_order, "
+                        "ngramc_discount_factor, ngramc_cache_size.\n"
                         "* 'length': Target sentence length model\n"
                         "            Options: src_test_raw, "
                         "length_model_weights, use_length_point_probs\n"
                         "* 'extlength': External target sentence lengths\n"
                         "               Options: extlength_path\n"
+                        "* 'synthdense', 'synthsparse', 'synthunbounded', "
+                        "'synthfst': Synthetic predictors with random but "
+                        "deterministic scores for benchmarking.\n"
+                        "               Options: pred_trg_vocab_size, "
+                        "synthetic_seed, synthetic_latency, "
+                        "synthetic_active_words, synthetic_fst_states\n"
                         "All predictors can be combined with one or more "
                         "wrapper predictors by adding the wrapper name "
                         "separated by a _ symbol. Following wrappers are "
@@ -940,7 +1020,9 @@ def get_parser():
                         "them with the factors defined in the files. The "
                         "format is one ngram per line '<ngram> : <score>'. "
                         "You can use the placeholder %%d for the sentence "
-                        "index.")
+                        "index. Alternatively, this can point to a single "
+                        "memory-mapped store for all sentences created with "
+                        "'python -m cam.sgnmt.misc.ngramstore'.")
     group.add_argument("--ngramc_order", default=0, type=int,
                        help="If positive, count only ngrams of the specified "
                        "Order. Otherwise, count all ngrams")
@@ -953,6 +1035,11 @@ def get_parser():
     group.add_argument("--ngramc_discount_factor", default=-1.0, type=float,
                        help="If this is non-negative, discount ngram counts "
                        "by this factor each time the ngram is consumed")
+    group.add_argument("--ngramc_cache_size", default=100000, type=int,
+                       help="Maximum number of n-gram contexts for which the "
+                       "ngramc predictor caches posteriors if --ngramc_path "
+                       "points to an n-gram posterior store. Set to 0 for an "
+                       "unbounded cache.")
     group.add_argument("--skipvocab_max_id", default=30003, type=int,
                         help="All tokens above this threshold are skipped "
                         "by the skipvocab predictor wrapper.")
@@ -961,6 +1048,12 @@ def get_parser():
                         "predictor wrapper stops if the best stop_size "
                          "scores are for in-vocabulary words (ie. with index "
                          "lower or equal skipvocab_max_id")
+    group.add_argument("--skipvocab_cache_size", default=10000, type=int,
+                        help="Maximum number of slave predictor posteriors "
+                        "cached by the skipvocab predictor wrapper. The cache "
+                        "is shared between hypotheses and reset for each "
+                        "sentence. Set to a non-positive value for an "
+                        "unbounded cache.")
 
     # Forced predictors
     group = parser.add_argument_group('Forced decoding predictor options')
@@ -1082,6 +1175,22 @@ def get_parser():
     group.add_argument("--normalize_nplm_probs", default=False, type='bool',
                         help="Whether to normalize nplm probabilities over "
                         "the current unbounded predictor vocabulary.")
+    group.add_argument("--nplm_cache_size", default=100, type=int,
+                        help="Maximum number of n-gram histories for which "
+                        "the nplm predictor caches the output distribution. "
+                        "The cache is shared between hypotheses and "
+                        "sentences. Each entry stores one 64-bit float for "
+                        "each word in the NPLM vocabulary, i.e. 8 bytes "
+                        "times the vocabulary size (400KB for 50k words, "
+                        "40MB for the default of 100 entries). Set to a "
+                        "non-positive value for an unbounded cache.")
+    group.add_argument("--nplm_max_candidates", default=0, type=int,
+                        help="If positive, the nplm predictor scores only "
+                        "this many words, namely the best ones according "
+                        "the weighted scores of the bounded vocabulary "
+                        "predictors. All other words get the nplm UNK score "
+                        "(or -inf if UNK is not among the candidates). This "
+                        "speeds up decoding but may lead to search errors.")
     
     # FSM predictors
     group = parser.add_argument_group('FST and RTN predictor options')
@@ -1145,10 +1254,16 @@ def get_parser():
     group.add_argument("--use_rtn_weights", default=False, type='bool',
                         help="Whether to use weights in RTNs.")
     group.add_argument("--minimize_rtns", default=True, type='bool',
-                        help="Whether to do determinization, epsilon removal, "
-                        "and minimization after each RTN expansion.")
+                        help="DEPRECATED. Has no effect since the rtn "
+                        "predictor does not expand RTNs explicitly anymore.")
     group.add_argument("--remove_epsilon_in_rtns", default=True, type='bool',
-                        help="Whether to remove epsilons after RTN expansion.")
+                        help="DEPRECATED. Has no effect since the rtn "
+                        "predictor does not expand RTNs explicitly anymore.")
+    group.add_argument("--rtn_cache_size", default=1000, type=int,
+                        help="Maximum number of sub FSTs the rtn predictor "
+                        "keeps in memory. Sub FSTs are shared across "
+                        "sentences if their files are links to the same "
+                        "file. Set to 0 for an unbounded cache.")
     group.add_argument("--normalize_fst_weights", default=False, type='bool',
                         help="Whether to normalize weights in FSTs. This "
                         "forces the weights on outgoing edges to sum up to 1. "
@@ -1158,6 +1273,22 @@ def get_parser():
                         "forces the weights on outgoing edges to sum up to 1. "
                         "Applicable to rtn predictor.")
 
+    group = parser.add_argument_group('Synthetic predictor options')
+    group.add_argument("--synthetic_seed", default=0, type=int,
+                        help="Random seed for synthetic predictors. The n-th "
+                        "predictor in --predictors uses this seed plus n.")
+    group.add_argument("--synthetic_latency", default=0.0, type=float,
+                        help="Time in seconds synthetic predictors sleep in "
+                        "each predict_next call to simulate expensive "
+                        "predictors.")
+    group.add_argument("--synthetic_active_words", default=10, type=int,
+                        help="Number of words with scores in the posteriors "
+                        "of the synthsparse predictor, and number of "
+                        "outgoing arcs per state of the synthfst predictor.")
+    group.add_argument("--synthetic_fst_states", default=100, type=int,
+                        help="Number of states in the automata of the "
+                        "synthfst predictor.")
+
     # Adding arguments for overriding when using same predictor multiple times
     group = parser.add_argument_group('Override options')
     for n,w in [('2', 'second'), ('3', 'third'), ('4', '4-th'), ('5', '5-th'), 
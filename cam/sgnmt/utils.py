@@ -8,7 +8,6 @@ from abc import abstractmethod
 import numpy
 import operator
 from scipy.misc import logsumexp
-import codecs
 from subprocess import call
 from shutil import copyfile
 import logging
@@ -16,6 +15,8 @@ import os
 import pywrapfst as fst
 import sys
 
+from cam.sgnmt.misc.vocab import get_vocab_store, KeyToIdMap, IdToKeyMap
+
 # Reserved IDs
 GO_ID = 1
 """Reserved word ID for the start-of-sentence symbol. """
@@ -217,11 +218,11 @@ def common_contains(obj, key):
 # Word maps
 
 
-src_wmap = {}
+src_wmap = KeyToIdMap()
 """Source language word map (word -> id)"""
 
 
-trg_wmap = {}
+trg_wmap = IdToKeyMap()
 """Target language word map (id -> word)"""
 
 
@@ -230,40 +231,34 @@ trg_cmap = None
 
 
 def load_src_wmap(path):
-    """Loads a source side word map from the file system.
+    """Loads a source side word map from the file system. The map is
+    backed by a memory-mapped vocabulary store (see
+    ``cam.sgnmt.misc.vocab``) which is shared between processes.
     
     Args:
         path (string): Path to the word map (Format: word id)
     
     Returns:
-        dict. Source word map (key: word, value: id)
+        KeyToIdMap. Source word map (key: word, value: id)
     """
     global src_wmap
-    if not path:
-        src_wmap = {}
-        return src_wmap
-    with codecs.open(path, encoding='utf-8') as f:
-        src_wmap = dict(map(lambda e: (e[0], int(e[-1])),
-                        [line.strip().split() for line in f]))
+    src_wmap = KeyToIdMap(get_vocab_store(path) if path else None)
     return src_wmap
 
 
 def load_trg_wmap(path):
-    """Loads a target side word map from the file system.
+    """Loads a target side word map from the file system. The map is
+    backed by a memory-mapped vocabulary store (see
+    ``cam.sgnmt.misc.vocab``) which is shared between processes.
     
     Args:
         path (string): Path to the word map (Format: word id)
     
     Returns:
-        dict. Source word map (key: id, value: word)
+        IdToKeyMap. Target word map (key: id, value: word)
     """
     global trg_wmap
-    if not path:
-        trg_wmap = {}
-        return trg_wmap
-    with codecs.open(path, encoding='utf-8') as f:
-        trg_wmap = dict(map(lambda e: (int(e[-1]), e[0]),
-                        [line.strip().split() for line in f]))
+    trg_wmap = IdToKeyMap(get_vocab_store(path) if path else None)
     return trg_wmap
 
 
@@ -276,18 +271,14 @@ def load_trg_cmap(path):
         path (string): Path to the character map
  
     Returns:
-        dict. Map char -> id or None if character level output is not
-        activated.
+        KeyToIdMap. Map char -> id or None if character level output
+        is not activated.
     """
     global trg_cmap
     if not path:
         trg_cmap = None
         return None
-    trg_cmap = {}
-    with codecs.open(path, encoding='utf-8') as f:
-        for line in f:
-            c,i = line.strip().split()
-            trg_cmap[c] = int(i)
+    trg_cmap = KeyToIdMap(get_vocab_store(path))
     if not "</w>" in trg_cmap:
         logging.warn("Could not find </w> in char map.")
     return trg_cmap
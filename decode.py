@@ -1,2 +1,7 @@
-"""Redirect to ``cam.sgnmt.decode`` """
-import cam.sgnmt.decode
+"""Redirect to ``cam.sgnmt.decode``. The module is run with ``runpy``
+instead of being imported, so that decoding does not hold the import
+lock which would block decoder threads (see --bucket_workers).
+"""
+import runpy
+
+runpy.run_module("cam.sgnmt.decode", run_name="__main__")